@@ -9,8 +9,22 @@ from pycryptopp.publickey import rsa
 
 import allmydata
 from allmydata.storage.server import StorageServer
+from allmydata.storage.fdcache import DEFAULT_MAX_OPEN_FILES
+from allmydata.storage.mutablecache import DEFAULT_MAX_CACHED_SHARES
+from allmydata.storage.diskio import DEFAULT_DISK_IO_THREADS
+from allmydata.storage.space import DEFAULT_SPACE_REFRESH_INTERVAL
+from allmydata.storage.blockcache import DEFAULT_BLOCK_CACHE_SIZE
+from allmydata.storage.expirer import parse_whatif_policies
+from allmydata.storage.crawler import DEFAULT_CRAWLER_THREADS, \
+     DEFAULT_CRAWLER_CPU_BUDGET
+from allmydata.storage.scheduler import DEFAULT_CLIENT_REQUEST_RATE, \
+     DEFAULT_CLIENT_REQUEST_BURST, DEFAULT_MAX_OUTSTANDING_REQUESTS
+from allmydata.storage.pacing import DEFAULT_MAX_CLIENT_LATENCY, \
+     DEFAULT_MAX_REACTOR_DELAY
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
+from allmydata.immutable.workers import DEFAULT_PIPELINE_MAX_MEMORY
+from allmydata.immutable.convergence_cache import ConvergenceCache
 from allmydata.immutable.offloaded import Helper
 from allmydata.control import ControlServer
 from allmydata.introducer.client import IntroducerClient
@@ -205,7 +219,11 @@ class Client(node.Node, pollmixin.PollMixin):
         self.stats_provider.register_producer(self)
 
     def get_stats(self):
-        return { 'node.uptime': time.time() - self.started_timestamp }
+        stats = { 'node.uptime': time.time() - self.started_timestamp }
+        if self.convergence_cache:
+            for (name, value) in self.convergence_cache.get_stats().items():
+                stats['convergence_cache.%s' % name] = value
+        return stats
 
     def init_secrets(self):
         lease_s = self.get_or_create_private_config("secret", _make_secret)
@@ -296,6 +314,63 @@ class Client(node.Node, pollmixin.PollMixin):
         if self.get_config("storage", "expire.mutable", True, boolean=True):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
+        whatif_policies = parse_whatif_policies(
+            self.get_config("storage", "expire.whatif", ""))
+
+        share_index = self.get_config("storage", "share_index.enabled", False,
+                                      boolean=True)
+        lease_db = self.get_config("storage", "lease_db.enabled", False,
+                                   boolean=True)
+        change_journal = self.get_config("storage", "change_journal.enabled",
+                                         False, boolean=True)
+        crawler_threads = int(self.get_config("storage", "crawler.threads",
+                                              DEFAULT_CRAWLER_THREADS))
+        crawler_cpu_budget = float(self.get_config("storage",
+                                                   "crawler.cpu_budget",
+                                                   DEFAULT_CRAWLER_CPU_BUDGET))
+        crawler_pacing = self.get_config("storage", "crawler.adaptive_pacing",
+                                         False, boolean=True)
+        crawler_max_client_latency = float(self.get_config("storage",
+                                                "crawler.max_client_latency",
+                                                DEFAULT_MAX_CLIENT_LATENCY))
+        crawler_max_reactor_delay = float(self.get_config("storage",
+                                                "crawler.max_reactor_delay",
+                                                DEFAULT_MAX_REACTOR_DELAY))
+        share_scrubber = self.get_config("storage", "scrubber.enabled",
+                                         False, boolean=True)
+        fd_cache_size = int(self.get_config("storage", "share_fd_cache_size",
+                                            DEFAULT_MAX_OPEN_FILES))
+        mutable_cache_size = int(self.get_config("storage",
+                                                 "mutable_metadata_cache_size",
+                                                 DEFAULT_MAX_CACHED_SHARES))
+        block_cache_size = parse_abbreviated_size(
+            self.get_config("storage", "block_cache_size",
+                            str(DEFAULT_BLOCK_CACHE_SIZE))) or 0
+        disk_io_threads = int(self.get_config("storage", "disk_io_threads",
+                                              DEFAULT_DISK_IO_THREADS))
+        space_refresh_interval = int(self.get_config("storage",
+                                                     "space_refresh_interval",
+                                                     DEFAULT_SPACE_REFRESH_INTERVAL))
+        packed_share_max_size = int(self.get_config("storage",
+                                                    "packed_share_max_size",
+                                                    0))
+        io_scheduler = self.get_config("storage", "io_scheduler.enabled", False,
+                                       boolean=True)
+        client_request_rate = float(self.get_config("storage",
+                                                    "io_scheduler.client_request_rate",
+                                                    DEFAULT_CLIENT_REQUEST_RATE))
+        client_request_burst = int(self.get_config("storage",
+                                                   "io_scheduler.client_request_burst",
+                                                   DEFAULT_CLIENT_REQUEST_BURST))
+        max_outstanding = int(self.get_config("storage",
+                                              "io_scheduler.max_outstanding_requests",
+                                              DEFAULT_MAX_OUTSTANDING_REQUESTS))
+        sharedirs = None
+        share_dirs_s = self.get_config("storage", "share_dirs", None)
+        if share_dirs_s:
+            # relative names are relative to the node's base directory
+            sharedirs = [os.path.join(self.basedir, d.strip())
+                         for d in share_dirs_s.split(",") if d.strip()]
 
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
@@ -306,7 +381,28 @@ class Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           expiration_whatif_policies=whatif_policies,
+                           share_index_enabled=share_index,
+                           share_fd_cache_size=fd_cache_size,
+                           mutable_metadata_cache_size=mutable_cache_size,
+                           disk_io_threads=disk_io_threads,
+                           sharedirs=sharedirs,
+                           space_refresh_interval=space_refresh_interval,
+                           packed_share_max_size=packed_share_max_size,
+                           lease_db_enabled=lease_db,
+                           io_scheduler_enabled=io_scheduler,
+                           client_request_rate=client_request_rate,
+                           client_request_burst=client_request_burst,
+                           max_outstanding_requests=max_outstanding,
+                           block_cache_size=block_cache_size,
+                           change_journal_enabled=change_journal,
+                           crawler_threads=crawler_threads,
+                           crawler_cpu_budget=crawler_cpu_budget,
+                           crawler_pacing_enabled=crawler_pacing,
+                           crawler_max_client_latency=crawler_max_client_latency,
+                           crawler_max_reactor_delay=crawler_max_reactor_delay,
+                           share_scrubber_enabled=share_scrubber)
         self.add_service(ss)
 
         d = self.when_tub_ready()
@@ -331,15 +427,32 @@ class Client(node.Node, pollmixin.PollMixin):
         DEP["k"] = int(self.get_config("client", "shares.needed", DEP["k"]))
         DEP["n"] = int(self.get_config("client", "shares.total", DEP["n"]))
         DEP["happy"] = int(self.get_config("client", "shares.happy", DEP["happy"]))
+        adaptive_max_segsize = parse_abbreviated_size(
+            self.get_config("client", "upload.max_segment_size", None))
+        if adaptive_max_segsize:
+            DEP["adaptive_max_segment_size"] = adaptive_max_segsize
+        encoding_threads = int(self.get_config("client",
+                                               "upload.encoding_threads", 0))
+        pipeline_depth = int(self.get_config("client", "upload.pipeline_depth",
+                                             0))
+        pipeline_max_memory = parse_abbreviated_size(
+            self.get_config("client", "upload.pipeline_max_memory",
+                            str(DEFAULT_PIPELINE_MAX_MEMORY))) or 0
+        placement_overask = float(self.get_config("client",
+                                                  "upload.placement_overask",
+                                                  0))
 
         self.init_client_storage_broker()
         self.history = History(self.stats_provider)
         self.terminator = Terminator()
         self.terminator.setServiceParent(self)
         self.add_service(Uploader(helper_furl, self.stats_provider,
-                                  self.history))
+                                  self.history, encoding_threads,
+                                  pipeline_depth, pipeline_max_memory,
+                                  placement_overask))
         self.init_blacklist()
         self.init_nodemaker()
+        self.init_convergence_cache()
 
     def init_client_storage_broker(self):
         # create a StorageFarmBroker object, for use by Uploader/Downloader
@@ -383,6 +496,14 @@ class Client(node.Node, pollmixin.PollMixin):
         fn = os.path.join(self.basedir, "access.blacklist")
         self.blacklist = Blacklist(fn)
 
+    def init_convergence_cache(self):
+        self.convergence_cache = None
+        if self.get_config("client", "convergence_cache.enabled", False,
+                           boolean=True):
+            fn = os.path.join(self.basedir, "private",
+                              "convergence_cache.sqlite")
+            self.convergence_cache = ConvergenceCache(fn)
+
     def init_nodemaker(self):
         default = self.get_config("client", "mutable.format", default="SDMF")
         if default.upper() == "MDMF":
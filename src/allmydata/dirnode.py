@@ -11,7 +11,8 @@ from allmydata.unknown import UnknownNode, strip_prefix_for_ro
 from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
      IImmutableFileNode, IMutableFileNode, \
      ExistingChildError, NoSuchChildError, ICheckable, IDeepCheckable, \
-     MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError
+     MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError, \
+     MAX_GET_BUCKETS_MANY
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
 from allmydata.monitor import Monitor
@@ -926,6 +927,12 @@ class ManifestWalker(DeepStats):
 
 
 class DeepChecker:
+    # A plain check only asks each server which shares it has, so we keep
+    # several in flight at once: their queries are then sent to each server
+    # together, in get_buckets_many() messages. Verifying or repairing a file
+    # means downloading it, so those are still done one at a time.
+    MAX_CONCURRENT_CHECKS = MAX_GET_BUCKETS_MANY
+
     def __init__(self, root, verify, repair, add_lease):
         root_si = root.get_storage_index()
         if root_si:
@@ -943,12 +950,19 @@ class DeepChecker:
         else:
             self._results = DeepCheckResults(root_si)
         self._stats = DeepStats(root)
+        self._concurrent = not (verify or repair)
+        self._outstanding = 0
+        self._failure = None
+        self._room = None # fires when another check may be started
+        self._all_done = None # fires when the last check has finished
 
     def set_monitor(self, monitor):
         self.monitor = monitor
         monitor.set_status(self._results)
 
     def add_node(self, node, childpath):
+        if self._failure:
+            return defer.fail(self._failure)
         if self._repair:
             d = node.check_and_repair(self.monitor, self._verify, self._add_lease)
             d.addCallback(self._results.add_check_and_repair, childpath)
@@ -956,12 +970,48 @@ class DeepChecker:
             d = node.check(self.monitor, self._verify, self._add_lease)
             d.addCallback(self._results.add_check, childpath)
         d.addCallback(lambda ignored: self._stats.add_node(node, childpath))
-        return d
+        if not self._concurrent:
+            return d
+        # let the traversal carry on while this check runs, unless there
+        # are already too many in flight
+        self._outstanding += 1
+        d.addCallbacks(self._check_done, self._check_failed)
+        if self._outstanding < self.MAX_CONCURRENT_CHECKS:
+            return None
+        self._room = defer.Deferred()
+        return self._room
+
+    def _check_failed(self, f):
+        if not self._failure:
+            self._failure = f
+        self._check_done(None)
+
+    def _check_done(self, ignored):
+        self._outstanding -= 1
+        if self._room and (self._failure or
+                           self._outstanding < self.MAX_CONCURRENT_CHECKS):
+            room, self._room = self._room, None
+            if self._failure:
+                room.errback(self._failure)
+            else:
+                room.callback(None)
+        if self._all_done and not self._outstanding:
+            all_done, self._all_done = self._all_done, None
+            all_done.callback(None)
 
     def enter_directory(self, parent, children):
         return self._stats.enter_directory(parent, children)
 
     def finish(self):
+        d = defer.succeed(None)
+        if self._outstanding:
+            d = self._all_done = defer.Deferred()
+        d.addCallback(lambda ignored: self._finish())
+        return d
+
+    def _finish(self):
+        if self._failure:
+            return self._failure
         log.msg("deep-check done", parent=self._lp)
         self._results.update_stats(self._stats.get_results())
         return self._results
@@ -85,7 +85,8 @@ class DropUploader(service.MultiService):
             if not isinstance(name, unicode):
                 name = name.decode(get_filesystem_encoding())
 
-            u = FileName(path.path, self._convergence)
+            u = FileName(path.path, self._convergence,
+                         self._client.convergence_cache)
             return self._parent.add_file(name, u)
         d.addCallback(_add_file)
 
@@ -1,8 +1,9 @@
 from zope.interface import implements
 from twisted.internet import defer
 from foolscap.api import DeadReferenceError, RemoteException
-from allmydata import hashtree, codec, uri
-from allmydata.interfaces import IValidatedThingProxy, IVerifierURI
+from allmydata import hashtree, codec, uri, storage_client
+from allmydata.interfaces import IValidatedThingProxy, IVerifierURI, \
+     AddLeaseError
 from allmydata.hashtree import IncompleteHashTree
 from allmydata.check_results import CheckResults
 from allmydata.uri import CHKFileVerifierURI
@@ -496,16 +497,15 @@ class Checker(log.PrefixingLogMixin):
         that we want to track and report whether or not each server
         responded.)"""
 
-        rref = s.get_rref()
         lease_seed = s.get_lease_seed()
         if self._add_lease:
             renew_secret = self._get_renewal_secret(lease_seed)
             cancel_secret = self._get_cancel_secret(lease_seed)
-            d2 = rref.callRemote("add_lease", storageindex,
-                                 renew_secret, cancel_secret)
+            d2 = storage_client.add_lease(s, storageindex,
+                                          renew_secret, cancel_secret)
             d2.addErrback(self._add_lease_failed, s.get_name(), storageindex)
 
-        d = rref.callRemote("get_buckets", storageindex)
+        d = storage_client.get_buckets(s, storageindex)
         def _wrap_results(res):
             return (res, True)
 
@@ -536,6 +536,13 @@ class Checker(log.PrefixingLogMixin):
 
         if f.check(DeadReferenceError):
             return
+        if f.check(AddLeaseError):
+            # the server could not add this lease, and told us why
+            self.log(format="error in add_lease from [%(name)s]: %(f_value)s",
+                     name=server_name,
+                     f_value=str(f.value),
+                     level=log.WEIRD, umid="65ukZz")
+            return
         if f.check(RemoteException):
             if f.value.failure.check(KeyError, IndexError, NameError):
                 # this may ignore a bit too much, but that only hurts us
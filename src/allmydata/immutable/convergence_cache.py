@@ -0,0 +1,114 @@
+import os, time
+
+from allmydata.util import base32
+from allmydata.util.dbutil import get_db
+from allmydata.util.hashutil import convergence_cache_secret_hash
+
+# A convergent upload must read and hash the whole file to derive its
+# encryption key (and therefore its storage index) before the upload can
+# start, and then the encoder reads the whole file again. For a large file
+# which is uploaded again and again without changing (by a drop-upload
+# directory, say), the first pass doubles the disk I/O of every upload. The
+# ConvergenceCache remembers the key that was derived for each local file,
+# along with the file's size, mtime, ctime and inode number and the
+# encoding parameters, so a FileName upload of a file that has not changed
+# since can skip the first pass.
+#
+# The cache holds encryption keys, which are as sensitive as the files they
+# were derived from, so it lives in the node's private/ directory. It does
+# not record the convergence secret itself, just a hash of it. An entry is
+# only used when every one of the file's attributes still matches: a file
+# that is rewritten in place without changing them (which would take some
+# effort) gets the key of its old contents. Such an upload is still
+# correct, since the key is part of the resulting filecap, but it will not
+# converge with other uploads of the new contents.
+
+CONVERGENCE_CACHE_SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE keys
+(
+ path VARCHAR(1024) NOT NULL, -- absolute UTF-8-encoded local filename
+ params VARCHAR(64) NOT NULL, -- "k,n,segsize"
+ secret VARCHAR(52) NOT NULL, -- base32(hash of the convergence secret)
+ size INTEGER NOT NULL,       -- os.stat(fn)[stat.ST_SIZE]
+ mtime NUMBER NOT NULL,       -- os.stat(fn).st_mtime
+ ctime NUMBER NOT NULL,       -- os.stat(fn).st_ctime
+ inode INTEGER NOT NULL,      -- os.stat(fn).st_ino
+ key VARCHAR(26) NOT NULL,    -- base32(encryption key)
+ PRIMARY KEY (path, params, secret)
+);
+"""
+
+# a file modified this recently might be modified again within the
+# resolution of its timestamps, so it is not cached
+MIN_FILE_AGE = 2 # seconds
+
+class ConvergenceCache:
+    """I remember the convergent encryption keys of local files, in an
+    on-disk database. My methods must only be called from the reactor
+    thread."""
+
+    def __init__(self, dbfile, clock=time.time):
+        self.dbfile = dbfile
+        self.clock = clock
+        (self._sqlite, self._db) = get_db(dbfile,
+                                          create_version=(CONVERGENCE_CACHE_SCHEMA_v1, 1),
+                                          dbname="convergence cache")
+        self._cursor = self._db.cursor()
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        if self._db is None:
+            return
+        self._db.close()
+        self._db = None
+
+    def _get_row_key(self, path, params, convergence):
+        path = os.path.abspath(path)
+        if isinstance(path, str):
+            path = path.decode("utf-8", "replace")
+        params = "%d,%d,%d" % params
+        secret = base32.b2a(convergence_cache_secret_hash(convergence))
+        return (path, params, secret)
+
+    def get_key(self, path, s, params, convergence):
+        """Return the encryption key that was recorded for the file at
+        'path', if it was recorded with the same encoding parameters
+        (k,n,segsize) and convergence secret, and 's' (the os.stat() of the
+        file) shows that the file has not changed since. Otherwise return
+        None."""
+        row_key = self._get_row_key(path, params, convergence)
+        self._cursor.execute("SELECT size, mtime, ctime, inode, key"
+                             " FROM keys"
+                             " WHERE path=? AND params=? AND secret=?",
+                             row_key)
+        row = self._cursor.fetchone()
+        if row is None or tuple(row[:4]) != (s.st_size, s.st_mtime,
+                                             s.st_ctime, s.st_ino):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return base32.a2b(str(row[4]))
+
+    def set_key(self, path, s, params, convergence, key):
+        """Record the encryption key that was derived from the file at
+        'path', which 's' (the os.stat() of the file, taken before it was
+        read) describes."""
+        if self.clock() - max(s.st_mtime, s.st_ctime) < MIN_FILE_AGE:
+            return
+        row_key = self._get_row_key(path, params, convergence)
+        self._cursor.execute("INSERT OR REPLACE INTO keys"
+                             " VALUES (?,?,?,?,?,?,?,?)",
+                             row_key + (s.st_size, s.st_mtime, s.st_ctime,
+                                        s.st_ino, base32.b2a(key)))
+        self._db.commit()
+
+    def get_stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                }
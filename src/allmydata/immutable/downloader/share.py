@@ -7,7 +7,7 @@ from twisted.python.failure import Failure
 from foolscap.api import eventually
 from allmydata.util import base32, log, hashutil, mathutil
 from allmydata.util.spans import Spans, DataSpans
-from allmydata.interfaces import HASH_SIZE
+from allmydata.interfaces import HASH_SIZE, MAX_READV_SPANS
 from allmydata.hashtree import IncompleteHashTree, BadHashError, \
      NotEnoughHashesError
 
@@ -84,6 +84,9 @@ class Share:
         v = server.get_version()
         ver = v["http://allmydata.org/tahoe/protocols/storage/v1"]
         self._overrun_ok = ver["tolerates-immutable-read-overrun"]
+        # servers which offer readv() let us send all the spans we want in
+        # a single message, instead of one message per span
+        self._readv_ok = ver.get("supports-immutable-readv", False)
         # If _overrun_ok and we guess the offsets correctly, we can get
         # everything in one RTT. If _overrun_ok and we guess wrong, we might
         # need two RTT (but we could get lucky and do it in one). If overrun
@@ -731,6 +734,7 @@ class Share:
         # Reconsider the removal: maybe bring it back.
         ds = self._download_status
 
+        requests = []
         for (start, length) in ask:
             # TODO: quantize to reasonably-large blocks
             self._pending.add(start, length)
@@ -741,18 +745,50 @@ class Share:
                          level=log.NOISY, parent=self._lp, umid="sgVAyA")
             block_ev = ds.add_block_request(self._server, self._shnum,
                                             start, length, now())
+            requests.append( (start, length, block_ev, lp) )
+
+        if self._readv_ok:
+            for i in range(0, len(requests), MAX_READV_SPANS):
+                d = self._send_readv_request(requests[i:i+MAX_READV_SPANS])
+                self._finish_request(d)
+            return
+        for (start, length, block_ev, lp) in requests:
             d = self._send_request(start, length)
             d.addCallback(self._got_data, start, length, block_ev, lp)
             d.addErrback(self._got_error, start, length, block_ev, lp)
-            d.addCallback(self._trigger_loop)
-            d.addErrback(lambda f:
-                         log.err(format="unhandled error during send_request",
-                                 failure=f, parent=self._lp,
-                                 level=log.WEIRD, umid="qZu0wg"))
+            self._finish_request(d)
+
+    def _finish_request(self, d):
+        d.addCallback(self._trigger_loop)
+        d.addErrback(lambda f:
+                     log.err(format="unhandled error during send_request",
+                             failure=f, parent=self._lp,
+                             level=log.WEIRD, umid="qZu0wg"))
 
     def _send_request(self, start, length):
         return self._rref.callRemote("read", start, length)
 
+    def _send_readv_request(self, requests):
+        readv = [(start, length) for (start, length, block_ev, lp) in requests]
+        d = self._rref.callRemote("readv", readv)
+        # the spans that have not been handed to _got_data() yet. If it
+        # fails partway through, only these (including the one that failed)
+        # are reported to _got_error().
+        undelivered = list(requests)
+        def _got_datav(datav):
+            if len(datav) != len(requests):
+                raise LayoutInvalid("readv returned %d spans, not %d"
+                                    % (len(datav), len(requests)))
+            for ((start, length, block_ev, lp), data) in zip(requests, datav):
+                self._got_data(data, start, length, block_ev, lp)
+                undelivered.pop(0)
+        def _got_readv_error(f):
+            for (start, length, block_ev, lp) in undelivered:
+                self._got_error(f, start, length, block_ev, lp)
+        d.addCallback(_got_datav)
+        d.addErrback(_got_readv_error)
+        return d
+
     def _got_data(self, data, start, length, block_ev, lp):
         block_ev.finished(len(data), now())
         if not self._alive:
@@ -9,7 +9,10 @@ from allmydata.storage.server import si_b2a
 from allmydata.hashtree import HashTree
 from allmydata.util import mathutil, hashutil, base32, log, happinessutil
 from allmydata.util.assertutil import _assert, precondition
+from allmydata.util.deferredutil import result_of_fired
 from allmydata.codec import CRSEncoder
+from allmydata.immutable.workers import SYNCHRONOUS, \
+     DEFAULT_PIPELINE_MAX_MEMORY
 from allmydata.interfaces import IEncoder, IStorageBucketWriter, \
      IEncryptedUploadable, IUploadStatus, UploadUnhappinessError
 
@@ -35,9 +38,14 @@ log(number of segments)).
 Each segment (A,B,C) is read into memory, encrypted, and encoded into
 blocks. The 'share' (say, share #1) that makes it out to a host is a
 collection of these blocks (block A1, B1, C1), plus some hash-tree
-information necessary to validate the data upon retrieval. Only one segment
-is handled at a time: all blocks for segment A are delivered before any
-work is begun on segment B.
+information necessary to validate the data upon retrieval. Segments are
+read and encoded one at a time, in order, and their blocks are delivered
+one segment at a time, in order. By default, all blocks for segment A are
+delivered before any work is begun on segment B. With a pipeline depth
+greater than zero, segment B (and later segments, up to that depth and a
+limit on the memory that their blocks take up) is read and encoded while
+the blocks of segment A are being delivered, and the encoding itself
+(hashing and erasure coding) may be done by worker threads.
 
 As blocks are created, we retain the hash of each one. The list of block hashes
 for a single share (say, hash(A1), hash(B1), hash(C1)) is used to form the base
@@ -74,7 +82,9 @@ PiB=1024*TiB
 class Encoder(object):
     implements(IEncoder)
 
-    def __init__(self, log_parent=None, upload_status=None):
+    def __init__(self, log_parent=None, upload_status=None,
+                 workers=SYNCHRONOUS, pipeline_depth=0,
+                 pipeline_max_memory=DEFAULT_PIPELINE_MAX_MEMORY):
         object.__init__(self)
         self.uri_extension_data = {}
         self._codec = None
@@ -86,6 +96,9 @@ class Encoder(object):
         self._log_number = log.msg("creating Encoder %s" % self,
                                    facility="tahoe.encoder", parent=log_parent)
         self._aborted = False
+        self._workers = workers
+        self._pipeline_depth = pipeline_depth
+        self._pipeline_max_memory = pipeline_max_memory
 
     def __repr__(self):
         if hasattr(self, "_storage_index"):
@@ -228,20 +241,7 @@ class Encoder(object):
         d = fireEventually()
 
         d.addCallback(lambda res: self.start_all_shareholders())
-
-        for i in range(self.num_segments-1):
-            # note to self: this form doesn't work, because lambda only
-            # captures the slot, not the value
-            #d.addCallback(lambda res: self.do_segment(i))
-            # use this form instead:
-            d.addCallback(lambda res, i=i: self._encode_segment(i))
-            d.addCallback(self._send_segment, i)
-            d.addCallback(self._turn_barrier)
-        last_segnum = self.num_segments - 1
-        d.addCallback(lambda res: self._encode_tail_segment(last_segnum))
-        d.addCallback(self._send_segment, last_segnum)
-        d.addCallback(self._turn_barrier)
-
+        d.addCallback(lambda res: self._encode_and_send_segments())
         d.addCallback(lambda res: self.finish_hashing())
 
         d.addCallback(lambda res:
@@ -270,9 +270,9 @@ class Encoder(object):
         self.log("aborting upload", level=log.UNUSUAL)
         assert self._codec, "don't call abort before start"
         self._aborted = True
-        # the next segment read (in _gather_data inside _encode_segment) will
-        # raise UploadAborted(), which will bypass the rest of the upload
-        # chain. If we've sent the final segment's shares, it's too late to
+        # the next segment sent (or read, in _gather_data inside
+        # _encode_segment) will raise UploadAborted(), which will bypass the
+        # rest of the upload chain. If we've sent the final segment's shares, it's too late to
         # abort. TODO: allow abort any time up to close_all_shareholders.
 
     def _turn_barrier(self, res):
@@ -296,8 +296,89 @@ class Encoder(object):
             dl.append(d)
         return self._gather_responses(dl)
 
+    def _encode_and_send_segments(self):
+        # the segments which have been started (read and encoded, or queued
+        # to be) but not yet sent, in order, as (segnum, size, Deferred)
+        self._pipeline = []
+        self._pipeline_memory = 0
+        self._pipeline_stopped = False
+        self._next_segnum = 0
+        # segments are read and encoded strictly one at a time, in order
+        self._encoding_lock = defer.DeferredLock()
+
+        d = defer.succeed(None)
+        for i in range(self.num_segments):
+            # note to self: this form doesn't work, because lambda only
+            # captures the slot, not the value
+            #d.addCallback(lambda res: self._get_encoded_segment(i))
+            # use this form instead:
+            d.addCallback(lambda res, i=i: self._get_encoded_segment(i))
+            d.addCallback(self._send_segment, i)
+            d.addCallback(self._segment_sent, i)
+            d.addCallback(self._turn_barrier)
+        d.addErrback(self._stop_pipeline)
+        return d
+
+    def _get_encoded_segment(self, segnum):
+        if self._aborted:
+            raise UploadAborted()
+        self._fill_pipeline()
+        (first_segnum, size, d) = self._pipeline[0]
+        assert first_segnum == segnum, (first_segnum, segnum)
+        return d
+
+    def _segment_sent(self, res, segnum):
+        (first_segnum, size, d) = self._pipeline.pop(0)
+        assert first_segnum == segnum, (first_segnum, segnum)
+        self._pipeline_memory -= size
+        self._fill_pipeline()
+        return res
+
+    def _fill_pipeline(self):
+        # Start encoding more segments, while the number of segments that
+        # are held in memory (including the one being sent) is within the
+        # pipeline depth, and their blocks fit in the memory limit. The
+        # next segment is always started if nothing else is in memory, so
+        # a depth of zero (or a tiny limit) encodes and sends one segment at
+        # a time.
+        while (not self._pipeline_stopped
+               and self._next_segnum < self.num_segments
+               and len(self._pipeline) <= self._pipeline_depth):
+            segnum = self._next_segnum
+            size = self._get_encoded_segment_size(segnum)
+            if (self._pipeline
+                and (self._pipeline_memory + size
+                     > self._pipeline_max_memory)):
+                break
+            d = self._encoding_lock.run(self._encode_segment, segnum)
+            self._pipeline.append((segnum, size, d))
+            self._pipeline_memory += size
+            self._next_segnum += 1
+
+    def _stop_pipeline(self, f):
+        # the segments that were read ahead will never be sent: make sure
+        # nothing more is started, and that their errors are not reported
+        # as unhandled
+        self._pipeline_stopped = True
+        for (segnum, size, d) in self._pipeline:
+            d.addErrback(lambda ignored: None)
+        self._pipeline = []
+        return f
+
+    def _get_encoded_segment_size(self, segnum):
+        codec = self._codec
+        if segnum == self.num_segments - 1:
+            codec = self._tail_codec
+        return codec.get_block_size() * self.num_shares
+
     def _encode_segment(self, segnum):
         codec = self._codec
+        allow_short = False
+        if segnum == self.num_segments - 1:
+            # the "tail" segment may be short: it is padded, and encoded
+            # with the tail codec
+            codec = self._tail_codec
+            allow_short = True
         start = time.time()
 
         # the ICodecEncoder API wants to receive a total of self.segment_size
@@ -319,62 +400,32 @@ class Encoder(object):
         # we read data from the source one segment at a time, and then chop
         # it into 'input_piece_size' pieces before handing it to the codec
 
-        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
-
         # memory footprint: we only hold a tiny piece of the plaintext at any
         # given time. We build up a segment's worth of cryptttext, then hand
         # it to the encoder. Assuming 3-of-10 encoding (3.3x expansion) and
         # 1MiB max_segment_size, we get a peak memory footprint of 4.3*1MiB =
         # 4.3MiB. Lowering max_segment_size to, say, 100KiB would drop the
-        # footprint to 430KiB at the expense of more hash-tree overhead.
-
-        d = self._gather_data(self.required_shares, input_piece_size,
-                              crypttext_segment_hasher)
-        def _done_gathering(chunks):
-            for c in chunks:
-                assert len(c) == input_piece_size
-            self._crypttext_hashes.append(crypttext_segment_hasher.digest())
-            # during this call, we hit 5*segsize memory
-            return codec.encode(chunks)
-        d.addCallback(_done_gathering)
-        def _done(res):
-            elapsed = time.time() - start
-            self._times["cumulative_encoding"] += elapsed
-            return res
-        d.addCallback(_done)
-        return d
-
-    def _encode_tail_segment(self, segnum):
-
-        start = time.time()
-        codec = self._tail_codec
-        input_piece_size = codec.get_block_size()
-
-        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
-
-        d = self._gather_data(self.required_shares, input_piece_size,
-                              crypttext_segment_hasher, allow_short=True)
-        def _done_gathering(chunks):
-            for c in chunks:
-                # a short trailing chunk will have been padded by
-                # _gather_data
-                assert len(c) == input_piece_size
-            self._crypttext_hashes.append(crypttext_segment_hasher.digest())
-            return codec.encode(chunks)
-        d.addCallback(_done_gathering)
-        def _done(res):
+        # footprint to 430KiB at the expense of more hash-tree overhead. Each
+        # segment that the pipeline reads ahead adds its blocks (3.3*1MiB)
+        # to that.
+
+        d = self._gather_data(self.required_shares, input_piece_size)
+        d.addCallback(lambda data:
+                      self._workers.run(self._hash_and_encode, codec, data,
+                                        input_piece_size, allow_short))
+        def _done((crypttext_segment_hash, shares, shareids, block_hashes)):
+            self._crypttext_hashes.append(crypttext_segment_hash)
             elapsed = time.time() - start
             self._times["cumulative_encoding"] += elapsed
-            return res
+            return (shares, shareids, block_hashes)
         d.addCallback(_done)
         return d
 
-    def _gather_data(self, num_chunks, input_chunk_size,
-                     crypttext_segment_hasher,
-                     allow_short=False):
+    def _gather_data(self, num_chunks, input_chunk_size):
         """Return a Deferred that will fire when the required number of
-        chunks have been read (and hashed and encrypted). The Deferred fires
-        with a list of chunks, each of size input_chunk_size."""
+        chunks have been read (and encrypted). The Deferred fires with a
+        list of strings, which hold at most num_chunks*input_chunk_size
+        bytes between them."""
 
         # I originally built this to allow read_encrypted() to behave badly:
         # to let it return more or less data than you asked for. It would
@@ -393,31 +444,48 @@ class Encoder(object):
         # EOF.
         #  -warner
 
-        if self._aborted:
+        if self._aborted or self._pipeline_stopped:
             raise UploadAborted()
 
         read_size = num_chunks * input_chunk_size
         d = self._uploadable.read_encrypted(read_size, hash_only=False)
         def _got(data):
             assert isinstance(data, (list,tuple))
-            if self._aborted:
+            if self._aborted or self._pipeline_stopped:
                 raise UploadAborted()
-            data = "".join(data)
-            precondition(len(data) <= read_size, len(data), read_size)
-            if not allow_short:
-                precondition(len(data) == read_size, len(data), read_size)
-            crypttext_segment_hasher.update(data)
-            self._crypttext_hasher.update(data)
-            if allow_short and len(data) < read_size:
-                # padding
-                data += "\x00" * (read_size - len(data))
-            encrypted_pieces = [data[i:i+input_chunk_size]
-                                for i in range(0, len(data), input_chunk_size)]
-            return encrypted_pieces
+            return data
         d.addCallback(_got)
         return d
 
-    def _send_segment(self, (shares, shareids), segnum):
+    def _hash_and_encode(self, codec, data, input_chunk_size, allow_short):
+        # This may run in a worker thread, so it must not touch the reactor,
+        # the shareholders, or our status. Segments are encoded one at a
+        # time, in order, so the whole-file crypttext hasher sees them in
+        # the right order. Returns (crypttext segment hash, shares, shareids,
+        # block hashes).
+        read_size = self.required_shares * input_chunk_size
+        data = "".join(data)
+        precondition(len(data) <= read_size, len(data), read_size)
+        if not allow_short:
+            precondition(len(data) == read_size, len(data), read_size)
+        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
+        crypttext_segment_hasher.update(data)
+        self._crypttext_hasher.update(data)
+        if allow_short and len(data) < read_size:
+            # padding
+            data += "\x00" * (read_size - len(data))
+        chunks = [data[i:i+input_chunk_size]
+                  for i in range(0, len(data), input_chunk_size)]
+        del data
+        for c in chunks:
+            assert len(c) == input_chunk_size
+        # during this call, we hit 5*segsize memory
+        (shares, shareids) = result_of_fired(codec.encode(chunks))
+        block_hashes = [hashutil.block_hash(block) for block in shares]
+        return (crypttext_segment_hasher.digest(), shares, shareids,
+                block_hashes)
+
+    def _send_segment(self, (shares, shareids, block_hashes), segnum):
         # To generate the URI, we must generate the roothash, so we must
         # generate all shares, even if we aren't actually giving them to
         # anybody. This means that the set of shares we create will be equal
@@ -436,7 +504,7 @@ class Encoder(object):
             shareid = shareids[i]
             d = self.send_block(shareid, segnum, block, lognum)
             dl.append(d)
-            block_hash = hashutil.block_hash(block)
+            block_hash = block_hashes[i]
             #from allmydata.util import base32
             #log.msg("creating block (shareid=%d, blocknum=%d) "
             #        "len=%d %r .. %r: %s" %
@@ -326,6 +326,10 @@ class ReadBucketProxy:
         # storage server be >= v1.3.0.
         # d.addCallback(self._fetch_sharehashtree_and_ueb)
         # d.addCallback(self._parse_sharehashtree_and_ueb)
+        # Servers that offer readv() are new enough, and let us fetch both
+        # in the same round trip.
+        if self._server_supports_readv():
+            d.addCallback(self._prefetch_sharehashtree_and_ueb)
         def _fail_waiters(f):
             self._ready.fire(f)
         def _notify_waiters(result):
@@ -370,6 +374,45 @@ class ReadBucketProxy:
             self._offsets[field] = offset
         return self._offsets
 
+    def _server_supports_readv(self):
+        if self._server is None:
+            return False
+        v = self._server.get_version()
+        if not v:
+            return False
+        ver = v.get("http://allmydata.org/tahoe/protocols/storage/v1", {})
+        return ver.get("supports-immutable-readv", False)
+
+    def _prefetch_sharehashtree_and_ueb(self, offsets):
+        sharehashtree_size = offsets['uri_extension'] - offsets['share_hashes']
+        if (sharehashtree_size < 0 or sharehashtree_size >= 2**31
+            or sharehashtree_size % (2+HASH_SIZE) != 0):
+            # leave it to the old way to complain about this
+            return offsets
+        d = self._rref.callRemote("readv",
+                                  [(offsets['share_hashes'], sharehashtree_size),
+                                   (offsets['uri_extension'],
+                                    self._fieldsize+self.MAX_UEB_SIZE)])
+        def _got_datav(datav):
+            (sharehashdata, uebdata) = datav
+            # anything that doesn't look right is fetched again (and
+            # rejected) by _get_share_hashes_the_old_way and
+            # _get_uri_extension_the_old_way
+            if len(sharehashdata) == sharehashtree_size:
+                self._share_hashes = []
+                for i in range(0, sharehashtree_size, 2+HASH_SIZE):
+                    hashnum = struct.unpack(">H", sharehashdata[i:i+2])[0]
+                    hashvalue = sharehashdata[i+2:i+2+HASH_SIZE]
+                    self._share_hashes.append( (hashnum, hashvalue) )
+            if len(uebdata) >= self._fieldsize:
+                length = struct.unpack(self._fieldstruct,
+                                       uebdata[:self._fieldsize])[0]
+                if len(uebdata) >= self._fieldsize+length:
+                    self._ueb_data = uebdata[self._fieldsize:self._fieldsize+length]
+            return offsets
+        d.addCallback(_got_datav)
+        return d
+
     def _fetch_sharehashtree_and_ueb(self, offsets):
         sharehashtree_size = offsets['uri_extension'] - offsets['share_hashes']
         return self._read(offsets['share_hashes'],
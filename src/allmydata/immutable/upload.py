@@ -1,7 +1,7 @@
-import os, time, weakref, itertools
+import os, time, math, weakref, itertools
 from zope.interface import implements
 from twisted.python import failure
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.application import service
 from foolscap.api import Referenceable, Copyable, RemoteCopy, fireEventually
 
@@ -12,6 +12,8 @@ from allmydata.util.hashutil import file_renewal_secret_hash, \
 from allmydata import hashtree, uri
 from allmydata.storage.server import si_b2a
 from allmydata.immutable import encode
+from allmydata.immutable.workers import SYNCHRONOUS, EncodingWorkers, \
+     in_encoding_thread, DEFAULT_PIPELINE_MAX_MEMORY
 from allmydata.util import base32, dictutil, idlib, log, mathutil
 from allmydata.util.happinessutil import servers_of_happiness, \
                                          shares_by_server, merge_servers, \
@@ -201,10 +203,28 @@ class ServerTracker:
 def str_shareloc(shnum, bucketwriter):
     return "%s: %s" % (shnum, bucketwriter.get_servername(),)
 
+# The first pass of server selection asks each server in turn to hold one
+# share, and waits for its answer before asking the next one, so placing N
+# shares takes at least N round trips, and a slow server holds up the whole
+# upload. If the selector is given an over-ask factor, it asks the first-pass
+# servers in parallel instead: one server for each homeless share, plus that
+# factor's worth of spares which are asked for the same shares (in case the
+# first server is full, broken or slow). Servers answer in any order; each
+# share is placed with the first server that accepts it, and as soon as every
+# share has a home and the servers-of-happiness test passes, selection is
+# done, without waiting for the rest. Buckets that spares (or late servers)
+# allocate beyond that are aborted. Shares that nobody in the batch accepted
+# go to another batch of first-pass servers, and then to the second pass,
+# which is still sequential.
+
 class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
-    def __init__(self, upload_id, logparent=None, upload_status=None):
+    def __init__(self, upload_id, logparent=None, upload_status=None,
+                 overask=0):
         self.upload_id = upload_id
+        # if set, first-pass servers are asked in parallel, with this many
+        # queries for each homeless share (at least one)
+        self.overask = overask
         self.query_count, self.good_query_count, self.bad_query_count = 0,0,0
         # Servers that are working normally, but full.
         self.full_count = 0
@@ -454,7 +474,9 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                     self.log(servmsg, level=log.INFREQUENT)
                     return self._failed("%s (%s)" % (failmsg, self._get_progress_message()))
 
-        if self.first_pass_trackers:
+        if self.first_pass_trackers and self.overask:
+            return self._query_in_parallel()
+        elif self.first_pass_trackers:
             tracker = self.first_pass_trackers.pop(0)
             # TODO: don't pre-convert all serverids to ServerTrackers
             assert isinstance(tracker, ServerTracker)
@@ -604,6 +626,124 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         return self._loop()
 
 
+    def _query_in_parallel(self):
+        shares = sorted(self.homeless_shares)
+        num_queries = max(len(shares),
+                          int(math.ceil(len(shares) * self.overask)))
+        num_queries = min(num_queries, len(self.first_pass_trackers))
+        asked = set(shares[:num_queries])
+        self.homeless_shares -= asked
+        self.log("asking %d servers in parallel for %d shares"
+                 % (num_queries, len(asked)), level=log.NOISY)
+        if self._status:
+            self._status.set_status("Contacting %d Servers (first query),"
+                                    " %d shares left.."
+                                    % (num_queries, len(self.homeless_shares)))
+        batch = {"outstanding": num_queries,
+                 "pending": dict([(shnum, 0) for shnum in asked]),
+                 "done": defer.Deferred(),
+                 }
+        for i in range(num_queries):
+            tracker = self.first_pass_trackers.pop(0)
+            assert isinstance(tracker, ServerTracker)
+            shnum = shares[i % len(shares)]
+            batch["pending"][shnum] += 1
+            self.query_count += 1
+            self.num_servers_contacted += 1
+            d = tracker.query(set([shnum]))
+            d.addBoth(self._got_parallel_response, tracker, shnum, batch)
+            d.addErrback(self._parallel_error, batch)
+        d = batch["done"]
+        d.addCallback(lambda ign: self._loop())
+        return d
+
+    def _is_placed(self, shnum):
+        if shnum in self.preexisting_shares:
+            return True
+        for tracker in self.use_trackers:
+            if shnum in tracker.buckets:
+                return True
+        return False
+
+    def _got_parallel_response(self, res, tracker, shnum, batch):
+        if batch["done"].called:
+            # selection has moved on without this server: it was slower than
+            # the ones we kept, so give back whatever it allocated
+            if not isinstance(res, failure.Failure):
+                self.log("late response to allocate_buckets() from server %s,"
+                         " aborting its buckets" % (tracker.get_name(),),
+                         level=log.NOISY)
+                tracker.abort()
+            return
+        batch["outstanding"] -= 1
+        batch["pending"][shnum] -= 1
+
+        if isinstance(res, failure.Failure):
+            self.log("%s got error during server selection: %s" % (tracker, res),
+                    level=log.UNUSUAL)
+            self.error_count += 1
+            self.bad_query_count += 1
+            self.last_failure_msg = ("last failure (from %s) was: %s"
+                                     % (tracker, res))
+        else:
+            (alreadygot, allocated) = res
+            self.log("response to allocate_buckets() from server %s: alreadygot=%s, allocated=%s"
+                    % (tracker.get_name(),
+                       tuple(sorted(alreadygot)), tuple(sorted(allocated))),
+                    level=log.NOISY)
+            progress = False
+            if allocated:
+                if self._is_placed(shnum):
+                    # a faster server took this share already
+                    tracker.abort_some_buckets(allocated)
+                else:
+                    self.use_trackers.add(tracker)
+                    self.serverids_with_shares.add(tracker.get_serverid())
+                    progress = True
+            for s in alreadygot:
+                self.preexisting_shares.setdefault(s, set()).add(tracker.get_serverid())
+                self.serverids_with_shares.add(tracker.get_serverid())
+                if s in self.homeless_shares:
+                    self.homeless_shares.remove(s)
+                    progress = True
+                elif s == shnum:
+                    progress = True
+
+            if progress:
+                self.good_query_count += 1
+            else:
+                self.bad_query_count += 1
+                self.full_count += 1
+
+            if shnum in alreadygot or shnum in allocated:
+                # they accepted what we asked for, so they might accept more
+                self.second_pass_trackers.append(tracker)
+
+        if not batch["pending"][shnum] and not self._is_placed(shnum):
+            # every server we asked for this share turned it down
+            self.homeless_shares.add(shnum)
+
+        if not batch["outstanding"] or self._batch_is_happy(batch):
+            batch["done"].callback(None)
+
+    def _parallel_error(self, f, batch):
+        # a bug in _got_parallel_response: don't leave the upload hanging
+        if batch["done"].called:
+            log.err(f, "error in parallel server selection",
+                    facility="tahoe.immutable.upload", umid="oV7bSg")
+        else:
+            batch["done"].errback(f)
+
+    def _batch_is_happy(self, batch):
+        if self.homeless_shares:
+            return False
+        for shnum in batch["pending"]:
+            if not self._is_placed(shnum):
+                return False
+        merged = merge_servers(self.preexisting_shares, self.use_trackers)
+        return servers_of_happiness(merged) >= self.servers_of_happiness
+
+
     def _failed(self, msg):
         """
         I am called when server selection fails. I first abort all of the
@@ -619,11 +759,12 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
 class EncryptAnUploadable:
     """This is a wrapper that takes an IUploadable and provides
-    IEncryptedUploadable."""
+    IEncryptedUploadable. If I am given EncodingWorkers, the plaintext is
+    hashed and encrypted in their threads."""
     implements(IEncryptedUploadable)
     CHUNKSIZE = 50*1024
 
-    def __init__(self, original, log_parent=None):
+    def __init__(self, original, log_parent=None, workers=SYNCHRONOUS):
         precondition(original.default_params_set,
                      "set_default_encoding_parameters not called on %r before wrapping with EncryptAnUploadable" % (original,))
         self.original = IUploadable(original)
@@ -636,6 +777,7 @@ class EncryptAnUploadable:
         self._file_size = None
         self._ciphertext_bytes_read = 0
         self._status = None
+        self._workers = workers
 
     def set_upload_status(self, upload_status):
         self._status = IUploadStatus(upload_status)
@@ -646,6 +788,9 @@ class EncryptAnUploadable:
             kwargs["facility"] = "upload.encryption"
         if "parent" not in kwargs:
             kwargs["parent"] = self._log_number
+        if in_encoding_thread():
+            reactor.callFromThread(log.msg, *args, **kwargs)
+            return None
         return log.msg(*args, **kwargs)
 
     def get_size(self):
@@ -770,10 +915,16 @@ class EncryptAnUploadable:
         # tick. Once you accept a Deferred from IUploadable.read(), you must
         # be prepared to have it fire immediately too.
         d.addCallback(fireEventually)
-        def _good(plaintext):
-            # and encrypt it..
-            # o/' over the fields we go, hashing all the way, sHA! sHA! sHA! o/'
-            ct = self._hash_and_encrypt_plaintext(plaintext, hash_only)
+        # and encrypt it..
+        # o/' over the fields we go, hashing all the way, sHA! sHA! sHA! o/'
+        d.addCallback(lambda plaintext:
+                      self._workers.run(self._hash_and_encrypt_plaintext,
+                                        plaintext, hash_only))
+        def _good((ct, bytes_processed)):
+            self._ciphertext_bytes_read += bytes_processed
+            if self._status:
+                progress = float(self._ciphertext_bytes_read) / self._file_size
+                self._status.set_progress(1, progress)
             ciphertext.extend(ct)
             self._read_encrypted(remaining, ciphertext, hash_only,
                                  fire_when_done)
@@ -784,6 +935,8 @@ class EncryptAnUploadable:
         return None
 
     def _hash_and_encrypt_plaintext(self, data, hash_only):
+        # this may run in an EncodingWorkers thread. Returns (list of
+        # ciphertext chunks, number of plaintext bytes processed).
         assert isinstance(data, (tuple, list)), type(data)
         data = list(data)
         cryptdata = []
@@ -809,11 +962,7 @@ class EncryptAnUploadable:
                 cryptdata.append(ciphertext)
             del ciphertext
             del chunk
-        self._ciphertext_bytes_read += bytes_processed
-        if self._status:
-            progress = float(self._ciphertext_bytes_read) / self._file_size
-            self._status.set_progress(1, progress)
-        return cryptdata
+        return (cryptdata, bytes_processed)
 
 
     def get_plaintext_hashtree_leaves(self, first, last, num_segments):
@@ -893,11 +1042,23 @@ class UploadStatus:
 
 class CHKUploader:
     server_selector_class = Tahoe2ServerSelector
-
-    def __init__(self, storage_broker, secret_holder):
+    # subclasses which do not call __init__ (like the Helper's) encode
+    # in the reactor thread, one segment at a time
+    _workers = SYNCHRONOUS
+    _pipeline_depth = 0
+    _pipeline_max_memory = DEFAULT_PIPELINE_MAX_MEMORY
+    _overask = 0
+
+    def __init__(self, storage_broker, secret_holder, workers=SYNCHRONOUS,
+                 pipeline_depth=0,
+                 pipeline_max_memory=DEFAULT_PIPELINE_MAX_MEMORY, overask=0):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        self._workers = workers
+        self._pipeline_depth = pipeline_depth
+        self._pipeline_max_memory = pipeline_max_memory
+        self._overask = overask
         self._log_number = self.log("CHKUploader starting", parent=None)
         self._encoder = None
         self._storage_index = None
@@ -948,7 +1109,10 @@ class CHKUploader:
 
         started = time.time()
         self._encoder = e = encode.Encoder(self._log_number,
-                                           self._upload_status)
+                                           self._upload_status,
+                                           self._workers,
+                                           self._pipeline_depth,
+                                           self._pipeline_max_memory)
         d = e.set_encrypted_uploadable(eu)
         d.addCallback(self.locate_all_shareholders, started)
         d.addCallback(self.set_shareholders, e)
@@ -967,7 +1131,8 @@ class CHKUploader:
         self.log("using storage index %s" % upload_id)
         server_selector = self.server_selector_class(upload_id,
                                                      self._log_number,
-                                                     self._upload_status)
+                                                     self._upload_status,
+                                                     self._overask)
 
         share_size = encoder.get_param("share_size")
         block_size = encoder.get_param("block_size")
@@ -1339,9 +1504,32 @@ class AssistedUploader:
     def get_upload_status(self):
         return self._upload_status
 
+# With an adaptive segment size, files that would have more than this many
+# segments of the normal size get larger segments instead. Each segment costs
+# a round trip to every server (and a leaf in every block hash tree), so a
+# multi-GB file cut into 128KiB segments spends most of its upload time
+# waiting for acknowledgements.
+ADAPTIVE_SEGMENTS = 256
+
+def choose_segment_size(file_size, max_segsize, adaptive_max_segsize=None):
+    """Return the segment size to use for a file of 'file_size' bytes. This
+    is 'max_segsize', unless 'adaptive_max_segsize' is larger: then a file
+    which would have more than ADAPTIVE_SEGMENTS segments gets the smallest
+    power-of-two multiple of 'max_segsize' that cuts it into no more than
+    that many, up to 'adaptive_max_segsize'. The result depends only on
+    these arguments, so uploads of the same file with the same settings
+    still converge."""
+    segsize = max_segsize
+    while (adaptive_max_segsize and segsize < adaptive_max_segsize
+           and mathutil.div_ceil(file_size, segsize) > ADAPTIVE_SEGMENTS):
+        segsize = min(segsize * 2, adaptive_max_segsize)
+    return segsize
+
 class BaseUploadable:
     # this is overridden by max_segment_size
     default_max_segment_size = DEFAULT_MAX_SEGMENT_SIZE
+    # and this enables larger segments for large files
+    default_adaptive_max_segment_size = None
     default_params_set = False
 
     max_segment_size = None
@@ -1368,6 +1556,9 @@ class BaseUploadable:
             self.default_encoding_param_n = default_params["n"]
         if "max_segment_size" in default_params:
             self.default_max_segment_size = default_params["max_segment_size"]
+        if "adaptive_max_segment_size" in default_params:
+            self.default_adaptive_max_segment_size = \
+                default_params["adaptive_max_segment_size"]
         self.default_params_set = True
 
     def get_all_encoding_parameters(self):
@@ -1376,14 +1567,19 @@ class BaseUploadable:
             return defer.succeed(self._all_encoding_parameters)
 
         max_segsize = self.max_segment_size or self.default_max_segment_size
+        adaptive_max_segsize = None
+        if not self.max_segment_size:
+            adaptive_max_segsize = self.default_adaptive_max_segment_size
         k = self.encoding_param_k or self.default_encoding_param_k
         happy = self.encoding_param_happy or self.default_encoding_param_happy
         n = self.encoding_param_n or self.default_encoding_param_n
 
         d = self.get_size()
         def _got_size(file_size):
+            segsize = choose_segment_size(file_size, max_segsize,
+                                          adaptive_max_segsize)
             # for small files, shrink the segment size to avoid wasting space
-            segsize = min(max_segsize, file_size)
+            segsize = min(segsize, file_size)
             # this must be a multiple of 'required_shares'==k
             segsize = mathutil.next_multiple(segsize, k)
             encoding_parameters = (k, happy, n, segsize)
@@ -1471,15 +1667,47 @@ class FileHandle(BaseUploadable):
         pass
 
 class FileName(FileHandle):
-    def __init__(self, filename, convergence):
+    def __init__(self, filename, convergence, convergence_cache=None):
         """
         Upload the data from the filename.  If convergence is None then a
         random encryption key will be used, else the plaintext will be hashed,
         then the hash will be hashed together with the string in the
-        "convergence" argument to form the encryption key.
+        "convergence" argument to form the encryption key. If a
+        ConvergenceCache is given, and it knows the key of this file as it
+        is now, the plaintext is not hashed.
         """
         assert convergence is None or isinstance(convergence, str), (convergence, type(convergence))
         FileHandle.__init__(self, open(filename, "rb"), convergence=convergence)
+        self._filename = filename
+        self._convergence_cache = convergence_cache
+
+    def _get_encryption_key_convergent(self):
+        if self._key is not None or self._convergence_cache is None:
+            return FileHandle._get_encryption_key_convergent(self)
+        cache = self._convergence_cache
+        # stat the file before we read it, so that changes made while we
+        # read it will cause a miss next time
+        s = os.fstat(self._filehandle.fileno())
+        d = self.get_all_encoding_parameters()
+        def _got(params):
+            k, happy, n, segsize = params
+            key = cache.get_key(self._filename, s, (k, n, segsize),
+                                self.convergence)
+            if key is not None:
+                self._key = key
+                if self._status:
+                    self._status.set_progress(0, 1.0)
+                return key
+            d2 = FileHandle._get_encryption_key_convergent(self)
+            def _hashed(key):
+                cache.set_key(self._filename, s, (k, n, segsize),
+                              self.convergence, key)
+                return key
+            d2.addCallback(_hashed)
+            return d2
+        d.addCallback(_got)
+        return d
+
     def close(self):
         FileHandle.close(self)
         self._filehandle.close()
@@ -1503,7 +1731,10 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
     name = "uploader"
     URI_LIT_SIZE_THRESHOLD = 55
 
-    def __init__(self, helper_furl=None, stats_provider=None, history=None):
+    def __init__(self, helper_furl=None, stats_provider=None, history=None,
+                 encoding_threads=0, pipeline_depth=0,
+                 pipeline_max_memory=DEFAULT_PIPELINE_MAX_MEMORY,
+                 placement_overask=0):
         self._helper_furl = helper_furl
         self.stats_provider = stats_provider
         self._history = history
@@ -1511,6 +1742,13 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         log.PrefixingLogMixin.__init__(self, facility="tahoe.immutable.upload")
         service.MultiService.__init__(self)
+        self._pipeline_depth = pipeline_depth
+        self._pipeline_max_memory = pipeline_max_memory
+        self._placement_overask = placement_overask
+        self._workers = SYNCHRONOUS
+        if encoding_threads:
+            self._workers = EncodingWorkers(encoding_threads)
+            self._workers.setServiceParent(self)
 
     def startService(self):
         service.MultiService.startService(self)
@@ -1565,7 +1803,8 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 uploader = LiteralUploader()
                 return uploader.start(uploadable)
             else:
-                eu = EncryptAnUploadable(uploadable, self._parentmsgid)
+                eu = EncryptAnUploadable(uploadable, self._parentmsgid,
+                                         self._workers)
                 d2 = defer.succeed(None)
                 storage_broker = self.parent.get_storage_broker()
                 if self._helper:
@@ -1575,7 +1814,11 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder)
+                    uploader = CHKUploader(storage_broker, secret_holder,
+                                           self._workers,
+                                           self._pipeline_depth,
+                                           self._pipeline_max_memory,
+                                           self._placement_overask)
                     d2.addCallback(lambda x: uploader.start(eu))
 
                 self._all_uploads[uploader] = None
@@ -0,0 +1,88 @@
+import threading
+
+from twisted.application import service
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+
+# An upload used to encrypt, hash and erasure-code every segment in the
+# reactor thread, so while a segment was being encoded nothing else could
+# happen: not even sending the blocks of the previous segment to the
+# storage servers. The EncodingWorkers run that CPU-bound work in a thread
+# pool instead. AES-CTR and the hashers are sequential, so each upload still
+# produces its segments one at a time, in order; but the Encoder can now
+# encode the next segment while the current one is being sent, and several
+# uploads can encode at the same time (the hash functions, and zfec, do not
+# hold the GIL while they work on large strings).
+#
+# Code which runs in a worker thread must not touch the reactor, foolscap,
+# or the upload status: it is given the data it needs, and returns its
+# results to the reactor thread.
+
+DEFAULT_PIPELINE_MAX_MEMORY = 16*1024*1024 # bytes of encoded segments
+
+_thread_state = threading.local()
+
+def in_encoding_thread():
+    """Return True if the caller is running in an EncodingWorkers thread,
+    where it must not touch the reactor or foolscap."""
+    return getattr(_thread_state, "in_encoding", False)
+
+def _run_in_encoding_thread(f, *args, **kwargs):
+    _thread_state.in_encoding = True # our pool threads do nothing else
+    return f(*args, **kwargs)
+
+class SynchronousWorkers:
+    """I run encoding work immediately, in the reactor thread. I am used
+    when no encoding threads are configured, and by objects that were
+    created without EncodingWorkers (as the unit tests do)."""
+
+    def run(self, f, *args, **kwargs):
+        return defer.maybeDeferred(f, *args, **kwargs)
+
+SYNCHRONOUS = SynchronousWorkers()
+
+
+class EncodingWorkers(service.Service):
+    """I run CPU-bound upload work (encryption, hashing and erasure coding)
+    in a pool of at most 'max_threads' threads.
+
+    My methods must only be called from the reactor thread.
+    """
+    name = "encoding-workers"
+
+    def __init__(self, max_threads):
+        assert max_threads > 0, max_threads
+        self.max_threads = max_threads
+        self._pool = threadpool.ThreadPool(0, max_threads,
+                                           "tahoe-upload-encoding")
+        self._running = 0
+        self._jobs_run = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        self._pool.start()
+
+    def stopService(self):
+        # this waits for the jobs which are already in a thread
+        self._pool.stop()
+        return service.Service.stopService(self)
+
+    def run(self, f, *args, **kwargs):
+        """Run f(*args, **kwargs) in a thread. Returns a Deferred that fires
+        (in the reactor thread) with its result."""
+        self._running += 1
+        d = threads.deferToThreadPool(reactor, self._pool,
+                                      _run_in_encoding_thread,
+                                      f, *args, **kwargs)
+        def _done(res):
+            self._running -= 1
+            self._jobs_run += 1
+            return res
+        d.addBoth(_done)
+        return d
+
+    def get_stats(self):
+        return {"threads": self.max_threads,
+                "running": self._running,
+                "jobs_run": self._jobs_run,
+                }
@@ -18,6 +18,9 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_GET_BUCKETS_MANY = 100 # storage indexes per get_buckets_many() call
+MAX_ADD_LEASES_MANY = 100 # storage indexes per add_leases_many() call
+MAX_ADD_LEASE_ERROR_LENGTH = 1000 # of an error in add_leases_many() results
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -50,10 +53,22 @@ class RIBucketWriter(RemoteInterface):
         return None
 
 
+MAX_READV_SPANS = 30 # the ListOf default, which slot_readv has always used
+ReadVector = ListOf(TupleOf(Offset, ReadSize), maxLength=MAX_READV_SPANS)
+ReadData = ListOf(ShareData, maxLength=MAX_READV_SPANS)
+# returns data[offset:offset+length] for each element of TestVector
+
 class RIBucketReader(RemoteInterface):
     def read(offset=Offset, length=ReadSize):
         return ShareData
 
+    def readv(readv=ReadVector):
+        """Read several spans of share data in a single round trip. I return
+        a list with one string for each (offset, length) tuple, with the
+        same truncation rules as read(). Servers which implement this set
+        'supports-immutable-readv' in their version dictionary."""
+        return ReadData
+
     def advise_corrupt_share(reason=str):
         """Clients who discover hash failures in shares that they have
         downloaded from me will use this method to inform me about the
@@ -79,9 +94,6 @@ TestAndWriteVectorsForShares = DictOf(int,
                                               DataVector,
                                               ChoiceOf(None, Offset), # new_length
                                               ))
-ReadVector = ListOf(TupleOf(Offset, ReadSize))
-ReadData = ListOf(ShareData)
-# returns data[offset:offset+length] for each element of TestVector
 
 
 class RIStorageServer(RemoteInterface):
@@ -132,6 +144,24 @@ class RIStorageServer(RemoteInterface):
         """
         return Any() # returns None now, but future versions might change
 
+    def add_leases_many(leases=ListOf(TupleOf(StorageIndex,
+                                              LeaseRenewSecret,
+                                              LeaseCancelSecret),
+                                      maxLength=MAX_ADD_LEASES_MANY)):
+        """Like add_lease(), but for several storage indexes at once. Each
+        entry of 'leases' is a (storage_index, renew_secret, cancel_secret)
+        tuple. I return a dictionary that maps each storage index to the
+        number of shares on which a lease was added or renewed (0 if I hold
+        no shares for it). If the lease could not be added because of an
+        error, the storage index maps to a string which describes the error
+        instead. Servers which implement this set 'maximum-add-leases-many'
+        in their version dictionary to the largest number of leases they
+        will accept in one call."""
+        return DictOf(StorageIndex,
+                      ChoiceOf(int,
+                               StringConstraint(MAX_ADD_LEASE_ERROR_LENGTH)),
+                      maxKeys=MAX_ADD_LEASES_MANY)
+
     def renew_lease(storage_index=StorageIndex, renew_secret=LeaseRenewSecret):
         """
         Renew the lease on a given bucket, resetting the timer to 31 days.
@@ -149,6 +179,18 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_buckets_many(storage_indexes=ListOf(StorageIndex,
+                                                maxLength=MAX_GET_BUCKETS_MANY)):
+        """Like get_buckets(), but for several storage indexes at once. I
+        return a dictionary that maps storage index to the get_buckets()
+        result for that storage index. Storage indexes for which I hold no
+        shares are omitted. Servers which implement this set
+        'maximum-get-buckets-many' in their version dictionary to the
+        largest number of storage indexes they will accept in one call."""
+        return DictOf(StorageIndex,
+                      DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS),
+                      maxKeys=MAX_GET_BUCKETS_MANY)
+
 
 
     def slot_readv(storage_index=StorageIndex,
@@ -1125,6 +1167,10 @@ class NoServersError(Exception):
     """Upload wasn't given any servers to work with, usually indicating a
     network or Introducer problem."""
 
+class AddLeaseError(Exception):
+    """A storage server reported, in its reply to add_leases_many(), that it
+    was unable to add a lease to the shares of one storage index."""
+
 class ExistingChildError(Exception):
     """A directory node was asked to add or replace a child that already
     exists, and overwrite= was set to False."""
@@ -1829,8 +1875,10 @@ class IUploadable(Interface):
 
     def set_default_encoding_parameters(params):
         """Set the default encoding parameters, which must be a dict mapping
-        strings to ints. The meaningful keys are 'k', 'happy', 'n', and
-        'max_segment_size'. These might have an influence on the final
+        strings to ints. The meaningful keys are 'k', 'happy', 'n',
+        'max_segment_size', and 'adaptive_max_segment_size' (which lets
+        large files use segments larger than 'max_segment_size', up to this
+        size). These might have an influence on the final
         encoding parameters returned by get_all_encoding_parameters(), if the
         Uploadable doesn't have more specific preferences.
 
@@ -6,10 +6,11 @@ from twisted.internet import defer
 from twisted.python import failure
 from foolscap.api import DeadReferenceError, RemoteException, eventually, \
                          fireEventually
+from allmydata import storage_client
 from allmydata.util import base32, hashutil, log, deferredutil
 from allmydata.util.dictutil import DictOfSets
 from allmydata.storage.server import si_b2a
-from allmydata.interfaces import IServermapUpdaterStatus
+from allmydata.interfaces import IServermapUpdaterStatus, AddLeaseError
 from pycryptopp.publickey import rsa
 
 from allmydata.mutable.common import MODE_CHECK, MODE_ANYTHING, MODE_WRITE, \
@@ -595,14 +596,16 @@ class ServermapUpdater:
         ss = server.get_rref()
         if self._add_lease:
             # send an add-lease message in parallel. The results are handled
-            # separately. This is sent before the slot_readv() so that we can
-            # be sure the add_lease is retired by the time slot_readv comes
-            # back (this relies upon our knowledge that the server code for
-            # add_lease is synchronous).
+            # separately. A deep-check adds leases to many files at once, so
+            # the request is batched with the others made to this server in
+            # the same reactor turn, and sent at the end of the turn, after
+            # the slot_readv(). The server may process it before or after
+            # any of our later queries to the same slot, so nothing here
+            # depends on when the lease is added.
             renew_secret = self._node.get_renewal_secret(server)
             cancel_secret = self._node.get_cancel_secret(server)
-            d2 = ss.callRemote("add_lease", storage_index,
-                               renew_secret, cancel_secret)
+            d2 = storage_client.add_lease(server, storage_index,
+                                          renew_secret, cancel_secret)
             # we ignore success
             d2.addErrback(self._add_lease_failed, server, storage_index)
         d = ss.callRemote("slot_readv", storage_index, shnums, readv)
@@ -952,6 +955,13 @@ class ServermapUpdater:
 
         if f.check(DeadReferenceError):
             return
+        if f.check(AddLeaseError):
+            # the server could not add this lease, and told us why
+            self.log(format="error in add_lease from [%(name)s]: %(f_value)s",
+                     name=server.get_name(),
+                     f_value=str(f.value),
+                     level=log.WEIRD, umid="IMGou0")
+            return
         if f.check(RemoteException):
             if f.value.failure.check(KeyError, IndexError, NameError):
                 # this may ignore a bit too much, but that only hurts us
@@ -2,7 +2,9 @@
 import os
 import pickle
 import pprint
+import re
 import time
+import simplejson
 from collections import deque
 
 from twisted.internet import reactor
@@ -11,7 +13,7 @@ from twisted.application.internet import TimerService
 from zope.interface import implements
 from foolscap.api import eventually, DeadReferenceError, Referenceable, Tub
 
-from allmydata.util import log, fileutil
+from allmydata.util import log, fileutil, histogram
 from allmydata.util.encodingutil import quote_local_unicode_path
 from allmydata.interfaces import RIStatsProvider, RIStatsGatherer, IStatsProducer
 
@@ -250,6 +252,8 @@ class PickleStatsGatherer(StdOutStatsGatherer):
         self.verbose = verbose
         StatsGatherer.__init__(self, basedir)
         self.picklefile = os.path.join(basedir, "stats.pickle")
+        # the storage latencies of the whole grid, from get_merged_latencies()
+        self.latenciesfile = os.path.join(basedir, "latencies.json")
 
         if os.path.exists(self.picklefile):
             f = open(self.picklefile, 'rb')
@@ -271,14 +275,42 @@ class PickleStatsGatherer(StdOutStatsGatherer):
         s['stats'] = stats
         self.dump_pickle()
 
+    LATENCY_BUCKET_RE = re.compile(r'^storage_server\.latencies\.([^.]+)\.buckets\.')
+
+    def get_merged_latencies(self):
+        """Merge the recent storage server latency histograms reported by
+        every node, and return a dict like StorageServer.get_latencies()
+        that describes the whole grid."""
+        merged = {}
+        for s in self.gathered_stats.values():
+            stats = s['stats'].get('stats', {})
+            categories = set()
+            for key in stats:
+                mo = self.LATENCY_BUCKET_RE.search(key)
+                if mo:
+                    categories.add(mo.group(1))
+            for category in categories:
+                prefix = 'storage_server.latencies.%s.' % category
+                h = histogram.from_stats(stats, prefix)
+                merged.setdefault(category, histogram.LatencyHistogram()).merge(h)
+        return dict([(category, merged_h.get_summary())
+                     for category, merged_h in merged.items()])
+
     def dump_pickle(self):
-        tmp = "%s.tmp" % (self.picklefile,)
+        self._replace_file(self.picklefile,
+                           pickle.dumps(self.gathered_stats))
+        self._replace_file(self.latenciesfile,
+                           simplejson.dumps(self.get_merged_latencies(),
+                                            indent=1, sort_keys=True) + "\n")
+
+    def _replace_file(self, filename, data):
+        tmp = "%s.tmp" % (filename,)
         f = open(tmp, 'wb')
-        pickle.dump(self.gathered_stats, f)
+        f.write(data)
         f.close()
-        if os.path.exists(self.picklefile):
-            os.unlink(self.picklefile)
-        os.rename(tmp, self.picklefile)
+        if os.path.exists(filename):
+            os.unlink(filename)
+        os.rename(tmp, filename)
 
 class StatsGathererService(service.MultiService):
     furl_file = "stats_gatherer.furl"
@@ -0,0 +1,93 @@
+import threading
+from collections import OrderedDict
+
+# A popular immutable file (a shared directory tree, or a software release)
+# is downloaded by many clients, and every download asks each server for
+# the same blocks and hash-tree nodes of its shares. Each of those
+# BucketReader reads used to go to the disk. The BlockCache keeps the data
+# returned by recent reads in memory, up to a fixed number of bytes, and
+# serves later reads of exactly the same range of the same share from
+# there. Immutable shares never change once they are complete, so entries
+# only have to be dropped when a share is deleted.
+
+DEFAULT_BLOCK_CACHE_SIZE = 0 # bytes
+
+class BlockCache:
+    """I remember the data of recent reads from immutable shares, keyed by
+    (storage index, share number, offset, length), and forget the least
+    recently used ones when they take up more than 'max_bytes'. Reads that
+    are larger than a quarter of my budget are not cached, so that a single
+    large read cannot push out everything else. I am used from the disk I/O
+    threads, so every method takes my lock."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict() # (si, shnum, offset, length) -> data
+        self._shares = {} # (si, shnum) -> set of keys in _entries
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, storage_index, shnum, offset, length):
+        """Return the data that an earlier read of this range returned, or
+        None if it is not cached."""
+        key = (storage_index, shnum, offset, length)
+        self._lock.acquire()
+        try:
+            data = self._entries.pop(key, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries[key] = data
+            self.hits += 1
+            return data
+        finally:
+            self._lock.release()
+
+    def put(self, storage_index, shnum, offset, length, data):
+        if len(data) > self.max_bytes // 4:
+            return
+        key = (storage_index, shnum, offset, length)
+        self._lock.acquire()
+        try:
+            self._remove(key)
+            self._entries[key] = data
+            self._shares.setdefault(key[:2], set()).add(key)
+            self.bytes += len(data)
+            while self.bytes > self.max_bytes:
+                oldest = iter(self._entries).next()
+                self._remove(oldest)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def _remove(self, key):
+        data = self._entries.pop(key, None)
+        if data is None:
+            return
+        self.bytes -= len(data)
+        keys = self._shares[key[:2]]
+        keys.discard(key)
+        if not keys:
+            del self._shares[key[:2]]
+
+    def invalidate_share(self, storage_index, shnum):
+        """Forget everything that was read from a share, because it has
+        been deleted."""
+        self._lock.acquire()
+        try:
+            for key in list(self._shares.get((storage_index, shnum), [])):
+                self._remove(key)
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                }
@@ -0,0 +1,137 @@
+import os, copy
+import cPickle as pickle
+from allmydata.util import fileutil, base32
+
+# A crawler saves its state every time it yields, which on a large server
+# means after every prefix or two (of 1024 per cycle), and used to do so by
+# pickling the whole state into a new file. The state of
+# some crawlers grows during a cycle -- the lease checker keeps histograms,
+# space-recovered counters, and a list of corrupt shares for the cycle so
+# far -- so every checkpoint cost more than the last, although a prefix
+# only changes a few of those values. A CheckpointLog writes the whole state
+# only now and then (a "snapshot", in the old statefile format), and in
+# between appends just the values that changed since the last checkpoint
+# to a log next to it. Loading the state replays the log over the snapshot.
+# Once the log has grown larger than the snapshot, the next checkpoint
+# writes a new snapshot and starts a new, empty log.
+#
+# The state is a dict, and nested dicts are compared key by key, so a
+# change is recorded as the path of keys to a value that was set or
+# deleted. Every other value (lists included) is recorded whole when it
+# changes. The snapshot is followed by a random generation, which the log
+# starts with: a log that does not belong to the snapshot (because we
+# crashed in the middle of writing a new snapshot, or the statefile was
+# removed) is ignored. A log entry that was cut short by a crash is ignored
+# too, as are the entries after it.
+
+MIN_COMPACTION_SIZE = 64*1024 # bytes
+
+def _diff(old, new, path, changes):
+    # record in 'changes' how to turn 'old' into 'new', and make 'old' a
+    # copy of 'new'
+    for key, value in new.iteritems():
+        if key in old:
+            oldvalue = old[key]
+            if isinstance(value, dict) and isinstance(oldvalue, dict):
+                _diff(oldvalue, value, path + (key,), changes)
+                continue
+            if oldvalue == value and type(oldvalue) is type(value):
+                continue
+        changes.append(("set", path + (key,), value))
+        old[key] = copy.deepcopy(value)
+    for key in old.keys():
+        if key not in new:
+            changes.append(("del", path + (key,)))
+            del old[key]
+
+def _apply(state, change):
+    path = change[1]
+    d = state
+    for key in path[:-1]:
+        d = d[key]
+    if change[0] == "set":
+        d[path[-1]] = change[2]
+    else:
+        del d[path[-1]]
+
+class CheckpointLog:
+    """I save a crawler's state dict, as a snapshot in 'statefile' and a log
+    of the changes made since then in 'statefile.log'. Anything that can be
+    pickled may be stored in the state, but I only see changes when save()
+    is called, so values must not be shared with other objects that will
+    change them later."""
+
+    def __init__(self, statefile, min_compaction_size=MIN_COMPACTION_SIZE):
+        self.statefile = statefile
+        self.logfile = statefile + ".log"
+        self.min_compaction_size = min_compaction_size
+        # a copy of the state as of the last checkpoint, or None if the
+        # next one must be a snapshot
+        self._saved = None
+        self._snapshot_size = 0
+        self._log_size = 0
+        self.snapshots_written = 0
+        self.entries_written = 0
+
+    def load(self):
+        """Return the saved state, or None if nothing has been saved. Raises
+        an exception if the snapshot cannot be read."""
+        self._saved = None
+        if not os.path.exists(self.statefile):
+            return None
+        f = open(self.statefile, "rb")
+        try:
+            state = pickle.load(f)
+            try:
+                generation = pickle.load(f)
+            except EOFError:
+                # written before there was a log
+                generation = None
+        finally:
+            f.close()
+        if generation is not None and os.path.exists(self.logfile):
+            f = open(self.logfile, "rb")
+            try:
+                self._replay(f, generation, state)
+            finally:
+                f.close()
+        return state
+
+    def _replay(self, f, generation, state):
+        try:
+            if pickle.load(f) != generation:
+                return
+            while True:
+                for change in pickle.load(f):
+                    _apply(state, change)
+        except Exception:
+            # EOFError at the end of the log, or anything else when the
+            # last entry was cut short
+            pass
+
+    def save(self, state):
+        if (self._saved is None
+            or self._log_size > max(self.min_compaction_size,
+                                    self._snapshot_size)):
+            self._write_snapshot(state)
+            return
+        changes = []
+        _diff(self._saved, state, (), changes)
+        if not changes:
+            return
+        entry = pickle.dumps(changes, pickle.HIGHEST_PROTOCOL)
+        fileutil.write(self.logfile, entry, mode="ab")
+        self._log_size += len(entry)
+        self.entries_written += 1
+
+    def _write_snapshot(self, state):
+        generation = base32.b2a(os.urandom(10))
+        data = pickle.dumps(state) + pickle.dumps(generation)
+        fileutil.write_atomically(self.statefile, data)
+        # until this is in place, the old log is ignored because its
+        # generation does not match
+        fileutil.write_atomically(self.logfile, pickle.dumps(generation))
+        self._saved = copy.deepcopy(state)
+        self._snapshot_size = len(data)
+        self._log_size = 0
+        self.snapshots_written += 1
@@ -1,14 +1,102 @@
 
 import os, time, struct
-import cPickle as pickle
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, threads
 from twisted.application import service
+from twisted.python import threadpool
 from allmydata.storage.common import si_b2a
-from allmydata.util import fileutil
+from allmydata.storage.diskio import _run_in_disk_io_thread
+from allmydata.storage.checkpoint import CheckpointLog
+from allmydata.util import log
+
+DEFAULT_CRAWLER_THREADS = 0
+DEFAULT_CRAWLER_CPU_BUDGET = 0.5 # seconds of work per second
 
 class TimeSliceExceeded(Exception):
     pass
 
+def _timed(f, *args, **kwargs):
+    start = time.time()
+    res = _run_in_disk_io_thread(f, *args, **kwargs)
+    return (res, time.time() - start)
+
+class CrawlerWorkers(service.Service):
+    """I run the work of a StorageServer's crawlers in a pool of up to
+    'max_threads' threads, so that they can examine several prefixes (and
+    use several disks and CPU cores) at once. I also share out a budget of
+    'cpu_budget' seconds of work, summed over all threads and all crawlers,
+    per second of wall-clock time: the time a job takes includes the time
+    it spends waiting for the disk, so this limits both CPU and disk use.
+    After a burst of work, get_delay() tells the crawlers how long to sleep
+    to get back within the budget.
+
+    My methods must only be called from the reactor thread.
+    """
+    name = "crawler-workers"
+
+    def __init__(self, max_threads, cpu_budget=DEFAULT_CRAWLER_CPU_BUDGET):
+        assert max_threads > 0, max_threads
+        assert cpu_budget > 0, cpu_budget
+        self.max_threads = max_threads
+        self.cpu_budget = float(cpu_budget)
+        self._pool = threadpool.ThreadPool(0, max_threads,
+                                           "tahoe-storage-crawler")
+        # seconds of work that may still be done now. Work is charged once
+        # it has been done, so this can go negative.
+        self._balance = 0.0
+        self._last = time.time()
+        self.busy_time = 0.0
+        self.jobs = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        self._pool.start()
+
+    def stopService(self):
+        # this waits for the jobs which are already in a thread
+        self._pool.stop()
+        return service.Service.stopService(self)
+
+    def run(self, f, *args, **kwargs):
+        """Run f(*args, **kwargs) in a thread, and charge the time that it
+        takes to the budget. Returns a Deferred that fires with its result."""
+        d = threads.deferToThreadPool(reactor, self._pool,
+                                      _timed, f, *args, **kwargs)
+        def _done((res, elapsed)):
+            self.spent(elapsed)
+            return res
+        d.addCallback(_done)
+        return d
+
+    def _refill(self):
+        now = time.time()
+        if now > self._last:
+            # let at most one second's worth accumulate while idle
+            self._balance = min(self.cpu_budget,
+                                self._balance
+                                + (now - self._last) * self.cpu_budget)
+        self._last = now
+
+    def spent(self, seconds):
+        self._refill()
+        self._balance -= seconds
+        self.busy_time += seconds
+        self.jobs += 1
+
+    def get_delay(self):
+        """Return the number of seconds to wait before more work can be
+        done."""
+        self._refill()
+        if self._balance >= 0:
+            return 0.0
+        return -self._balance / self.cpu_budget
+
+    def get_stats(self):
+        return {"threads": self.max_threads,
+                "jobs": self.jobs,
+                "busy_time": self.busy_time,
+                "delay": self.get_delay(),
+                }
+
 class ShareCrawler(service.MultiService):
     """A ShareCrawler subclass is attached to a StorageServer, and
     periodically walks all of its shares, processing each one in some
@@ -57,6 +145,40 @@ class ShareCrawler(service.MultiService):
 
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
+
+    If the server has several share directories, each prefix is crawled in
+    all of them at once: the buckets are merged into a single sorted list,
+    and process_bucket() is given the prefixdir in which each bucket was
+    found. If the server keeps small shares in pack files, buckets that
+    only have packed shares are included too, although their bucket
+    directory does not exist: process_bucket() must tolerate that, and can
+    use self.pack_store to find their shares.
+
+    If the server keeps a change journal, a subclass which sets uses_journal
+    can keep its results up to date between cycles instead of waiting for
+    the next one: process_journal_entries() is given the new entries at the
+    start of every timeslice, and every 'journal_interval' seconds between
+    cycles. Full cycles are then only needed to correct any drift, so they
+    are at least 'journal_minimum_cycle_time' apart instead.
+
+    If the server has CrawlerWorkers, a subclass which sets
+    examine_in_threads has several prefixes examined at once, in worker
+    threads: examine_prefix() is called in a thread (by default it calls
+    process_bucket() for each bucket), and its result is given to
+    process_prefix_result() in the reactor thread, one prefix at a time and
+    in order. Neither process_prefixdir() nor cpu_slice are used then, and
+    the pace is set by the workers' budget (which is shared by all crawlers)
+    instead of allowed_cpu_percentage. The code run in threads must not
+    touch self.state, the reactor, or foolscap (use self.server.log() to
+    log), and must only use objects that are safe to call from several
+    threads at once. The statefile records the last prefix for which
+    process_prefix_result() has returned, so prefixes which were being
+    examined when the node stopped are examined again.
+
+    If the server has a CrawlerPacer, allowed_cpu_percentage (or the
+    workers' budget) is multiplied by the pacer's current factor, so that
+    the crawler slows down while clients are waiting for the server, and
+    speeds up while it is idle.
     """
 
     slow_start = 300 # don't start crawling for 5 minutes after startup
@@ -64,6 +186,10 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    uses_journal = False
+    journal_interval = 60 # look for new journal entries this often
+    journal_minimum_cycle_time = 7*24*60*60
+    examine_in_threads = False
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
@@ -71,19 +197,49 @@ class ShareCrawler(service.MultiService):
             self.allowed_cpu_percentage = allowed_cpu_percentage
         self.server = server
         self.sharedir = server.sharedir
+        self.sharedirs = server.sharedirs
+        self.pack_store = getattr(server, "pack_store", None)
         self.statefile = statefile
+        self.checkpoint = CheckpointLog(statefile)
         self.prefixes = [si_b2a(struct.pack(">H", i << (16-10)))[:2]
                          for i in range(2**10)]
         self.prefixes.sort()
         self.timer = None
-        self.bucket_cache = (None, [])
+        # (prefix index, sorted bucket names, {bucket: prefixdir} for buckets
+        # that are not in the first share directory)
+        self.bucket_cache = (None, [], {})
         self.current_sleep_time = None
         self.next_wake_time = None
         self.last_prefix_finished_time = None
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
+        self.journal = None
+        if self.uses_journal:
+            self.journal = getattr(server, "change_journal", None)
+        self.workers = None
+        if self.examine_in_threads:
+            self.workers = getattr(server, "crawler_workers", None)
+        self._examining = None # the batch of prefixes in the workers
+        self.pacer = getattr(server, "crawler_pacer", None)
         self.load_state()
+        if self.journal is not None:
+            self._start_reading_journal()
+
+    def _start_reading_journal(self):
+        position = self.state["journal-position"]
+        if not self.journal.is_valid_position(position):
+            if self.state["current-cycle"] is None:
+                # we have missed some changes, and only a full cycle can
+                # tell us where we stand
+                position = None
+            else:
+                # the prefixes that this cycle has already finished may
+                # have missed some changes, but the rest will be correct
+                position = self.journal.get_position()
+            self.state["journal-position"] = position
+        self.journal.add_reader(self.statefile,
+                                position or self.journal.get_position())
 
     def minus_or_none(self, a, b):
         if a is None:
@@ -128,7 +284,11 @@ class ShareCrawler(service.MultiService):
         if self.state["current-cycle"] is None:
             d["cycle-in-progress"] = False
             d["next-crawl-time"] = self.next_wake_time
-            d["remaining-wait-time"] = self.minus_or_none(self.next_wake_time,
+            if self.journal is not None and self.next_wake_time is not None:
+                # we wake up more often than that to read the journal
+                d["next-crawl-time"] = max(self.next_wake_time,
+                                           self._next_cycle_time())
+            d["remaining-wait-time"] = self.minus_or_none(d["next-crawl-time"],
                                                           time.time())
         else:
             d["cycle-in-progress"] = True
@@ -190,11 +350,19 @@ class ShareCrawler(service.MultiService):
         #  ["last-complete-bucket"]: str, base32 storage index bucket name
         #                            of the last bucket to be processed, or
         #                            None if we are sleeping between cycles
+        #  ["last-cycle-finished-time"]: int, seconds-since-epoch of when the
+        #                                last cycle was finished, or None
+        #  ["journal-position"]: the position in the change journal up to
+        #                        which entries have been processed, or None
+        #                        if we are not reading the journal
+        #
+        # The state is saved by a CheckpointLog, which only writes what has
+        # changed since the last time.
         try:
-            f = open(self.statefile, "rb")
-            state = pickle.load(f)
-            f.close()
+            state = self.checkpoint.load()
         except Exception:
+            state = None
+        if state is None:
             state = {"version": 1,
                      "last-cycle-finished": None,
                      "current-cycle": None,
@@ -202,6 +370,8 @@ class ShareCrawler(service.MultiService):
                      "last-complete-bucket": None,
                      }
         state.setdefault("current-cycle-start-time", time.time()) # approximate
+        state.setdefault("last-cycle-finished-time", None)
+        state.setdefault("journal-position", None)
         self.state = state
         lcp = state["last-complete-prefix"]
         if lcp == None:
@@ -229,11 +399,7 @@ class ShareCrawler(service.MultiService):
         else:
             last_complete_prefix = self.prefixes[lcpi]
         self.state["last-complete-prefix"] = last_complete_prefix
-        tmpfile = self.statefile + ".tmp"
-        f = open(tmpfile, "wb")
-        pickle.dump(self.state, f)
-        f.close()
-        fileutil.move_into_place(tmpfile, self.statefile)
+        self.checkpoint.save(self.state)
 
     def startService(self):
         # arrange things to look like we were just sleeping, so
@@ -248,6 +414,9 @@ class ShareCrawler(service.MultiService):
         if self.timer:
             self.timer.cancel()
             self.timer = None
+        # the results of any prefixes that are being examined in threads
+        # will be ignored
+        self._examining = None
         self.save_state()
         return service.MultiService.stopService(self)
 
@@ -257,6 +426,22 @@ class ShareCrawler(service.MultiService):
         self.sleeping_between_cycles = False
         self.current_sleep_time = None
         self.next_wake_time = None
+        if self.journal is not None:
+            self.read_journal()
+            if (self.state["current-cycle"] is None
+                and start_slice < self._next_cycle_time()):
+                # between cycles, we only keep up with the journal
+                self.save_state()
+                if not self.running:
+                    return
+                now = time.time()
+                sleep_time = min(self.journal_interval,
+                                 self._next_cycle_time() - now)
+                self._sleep(now, max(0.0, sleep_time), True)
+                return
+        if self.workers is not None:
+            self._examine_next_prefixes()
+            return
         try:
             self.start_current_prefix(start_slice)
             finished_cycle = True
@@ -272,7 +457,8 @@ class ShareCrawler(service.MultiService):
         # this_slice/(this_slice+sleep_time) = percentage
         # this_slice/percentage = this_slice+sleep_time
         # sleep_time = (this_slice/percentage) - this_slice
-        sleep_time = (this_slice / self.allowed_cpu_percentage) - this_slice
+        percentage = min(1.0, self.allowed_cpu_percentage * self._get_pace())
+        sleep_time = (this_slice / percentage) - this_slice
         # if the math gets weird, or a timequake happens, don't sleep
         # forever. Note that this means that, while a cycle is running, we
         # will process at least one bucket every 5 minutes, no matter how
@@ -281,17 +467,111 @@ class ShareCrawler(service.MultiService):
         if finished_cycle:
             # how long should we sleep between cycles? Don't run faster than
             # allowed_cpu_percentage says, but also run faster than
-            # minimum_cycle_time
-            self.sleeping_between_cycles = True
-            sleep_time = max(sleep_time, self.minimum_cycle_time)
-        else:
-            self.sleeping_between_cycles = False
+            # minimum_cycle_time. With a journal, we wake up sooner to read
+            # it.
+            sleep_time = self._between_cycles_sleep_time(sleep_time)
+        self._sleep(now, sleep_time, finished_cycle)
+
+    def _get_pace(self):
+        if self.pacer is None:
+            return 1.0
+        return self.pacer.get_factor()
+
+    def _between_cycles_sleep_time(self, sleep_time):
+        if self.journal is not None:
+            return max(sleep_time, self.journal_interval)
+        return max(sleep_time, self.minimum_cycle_time)
+
+    def _sleep(self, now, sleep_time, between_cycles):
+        self.sleeping_between_cycles = between_cycles
         self.current_sleep_time = sleep_time # for status page
         self.next_wake_time = now + sleep_time
         self.yielding(sleep_time)
         self.timer = reactor.callLater(sleep_time, self.start_slice)
 
-    def start_current_prefix(self, start_slice):
+    def _next_cycle_time(self):
+        # only used when we read the journal
+        finished = self.state["last-cycle-finished-time"]
+        if finished is None or self.state["journal-position"] is None:
+            return 0
+        return finished + self.journal_minimum_cycle_time
+
+    def read_journal(self):
+        """Give every journal entry written since the last call to
+        process_journal_entries()."""
+        position = self.state["journal-position"]
+        if position is None:
+            # we are waiting for a full cycle
+            return
+        while True:
+            entries, position = self.journal.read(position)
+            if not entries:
+                break
+            self.process_journal_entries(self.state["current-cycle"], entries)
+        self.state["journal-position"] = position
+        self.journal.release(self.statefile, position)
+
+    def _examine_next_prefixes(self):
+        # hand the next few prefixes to the worker threads
+        self._start_cycle()
+        cycle = self.state["current-cycle"]
+        first = self.last_complete_prefix_index + 1
+        indexes = range(first, min(first + self.workers.max_threads,
+                                   len(self.prefixes)))
+        dl = [self.workers.run(self._examine_prefix, cycle, i)
+              for i in indexes]
+        d = defer.DeferredList(dl, fireOnOneErrback=True, consumeErrors=True)
+        self._examining = d
+        d.addCallback(self._examined_prefixes, d, cycle, indexes)
+        def _failed(f):
+            if self._examining is d:
+                self._examining = None
+            if f.check(defer.FirstError):
+                f = f.value.subFailure
+            # like an exception in start_current_prefix(), this stops the
+            # crawler until the node is restarted
+            log.err(f, "crawler failed to examine a prefix",
+                    facility="tahoe.storage", level=log.WEIRD, umid="Ux3bHw")
+        d.addErrback(_failed)
+
+    def _examine_prefix(self, cycle, i):
+        # this runs in a worker thread
+        prefix = self.prefixes[i]
+        buckets, elsewhere = self._list_buckets(prefix)
+        return self.examine_prefix(cycle, prefix,
+                                   os.path.join(self.sharedir, prefix),
+                                   buckets, elsewhere)
+
+    def _examined_prefixes(self, results, d, cycle, indexes):
+        if self._examining is not d:
+            # stopService() has saved our state without these prefixes, so
+            # they will be examined again
+            return
+        self._examining = None
+        now = time.time()
+        if self.last_prefix_finished_time is not None and indexes:
+            elapsed = now - self.last_prefix_finished_time
+            self.last_prefix_elapsed_time = elapsed / len(indexes)
+        self.last_prefix_finished_time = now
+        for (i, (success, result)) in zip(indexes, results):
+            prefix = self.prefixes[i]
+            self.process_prefix_result(cycle, prefix, result)
+            self.last_complete_prefix_index = i
+            self.finished_prefix(cycle, prefix)
+        finished_cycle = (self.last_complete_prefix_index
+                          == len(self.prefixes) - 1)
+        if finished_cycle:
+            self._finish_cycle(cycle)
+        self.save_state()
+        if not self.running:
+            # finished_cycle() may have used disownServiceParent()
+            return
+        sleep_time = self.workers.get_delay() / self._get_pace()
+        if finished_cycle:
+            sleep_time = self._between_cycles_sleep_time(sleep_time)
+        self._sleep(time.time(), sleep_time, finished_cycle)
+
+    def _start_cycle(self):
         state = self.state
         if state["current-cycle"] is None:
             self.last_cycle_started_time = time.time()
@@ -300,7 +580,15 @@ class ShareCrawler(service.MultiService):
                 state["current-cycle"] = 0
             else:
                 state["current-cycle"] = state["last-cycle-finished"] + 1
+            if self.journal is not None and state["journal-position"] is None:
+                # changes made from now on in the prefixes that this cycle
+                # has already finished must be applied
+                state["journal-position"] = self.journal.get_position()
             self.started_cycle(state["current-cycle"])
+
+    def start_current_prefix(self, start_slice):
+        self._start_cycle()
+        state = self.state
         cycle = state["current-cycle"]
 
         for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
@@ -310,12 +598,8 @@ class ShareCrawler(service.MultiService):
             if i == self.bucket_cache[0]:
                 buckets = self.bucket_cache[1]
             else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
-                self.bucket_cache = (i, buckets)
+                buckets, elsewhere = self._list_buckets(prefix)
+                self.bucket_cache = (i, buckets, elsewhere)
             self.process_prefixdir(cycle, prefix, prefixdir,
                                    buckets, start_slice)
             self.last_complete_prefix_index = i
@@ -331,6 +615,10 @@ class ShareCrawler(service.MultiService):
                 raise TimeSliceExceeded()
 
         # yay! we finished the whole cycle
+        self._finish_cycle(cycle)
+
+    def _finish_cycle(self, cycle):
+        state = self.state
         self.last_complete_prefix_index = -1
         self.last_prefix_finished_time = None # don't include the sleep
         now = time.time()
@@ -338,13 +626,44 @@ class ShareCrawler(service.MultiService):
             self.last_cycle_elapsed_time = now - self.last_cycle_started_time
         state["last-complete-bucket"] = None
         state["last-cycle-finished"] = cycle
+        state["last-cycle-finished-time"] = now
         state["current-cycle"] = None
         self.finished_cycle(cycle)
         self.save_state()
 
+    def _list_buckets(self, prefix):
+        buckets = set()
+        elsewhere = {}
+        for sharedir in self.sharedirs:
+            prefixdir = os.path.join(sharedir, prefix)
+            try:
+                names = os.listdir(prefixdir)
+            except EnvironmentError:
+                names = []
+            for name in names:
+                if name not in buckets:
+                    buckets.add(name)
+                    if sharedir != self.sharedir:
+                        elsewhere[name] = prefixdir
+        if self.pack_store is not None:
+            # buckets whose shares are all packed have no directory: they
+            # are reported in the first share directory's prefixdir
+            buckets.update(self.pack_store.get_storage_indexes_with_prefix(prefix))
+        buckets = list(buckets)
+        buckets.sort()
+        return buckets, elsewhere
+
+    def get_prefixdir(self, prefixdir, bucket):
+        """Return the prefix directory which holds 'bucket', one of the
+        buckets in the current prefix. 'prefixdir' is the prefix directory
+        in the first share directory, as given to process_prefixdir()."""
+        return self.bucket_cache[2].get(bucket, prefixdir)
+
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         """This gets a list of bucket names (i.e. storage index strings,
-        base32-encoded) in sorted order.
+        base32-encoded) in sorted order. If the server has several share
+        directories, 'prefixdir' is the one in the first of them: use
+        get_prefixdir() to find the directory that holds each bucket.
 
         You can override this if your crawler doesn't care about the actual
         shares, for example a crawler which merely keeps track of how many
@@ -357,7 +676,8 @@ class ShareCrawler(service.MultiService):
         for bucket in buckets:
             if bucket <= self.state["last-complete-bucket"]:
                 continue
-            self.process_bucket(cycle, prefix, prefixdir, bucket)
+            self.process_bucket(cycle, prefix,
+                                self.get_prefixdir(prefixdir, bucket), bucket)
             self.state["last-complete-bucket"] = bucket
             if time.time() >= start_slice + self.cpu_slice:
                 raise TimeSliceExceeded()
@@ -423,6 +743,46 @@ class ShareCrawler(service.MultiService):
         """
         pass
 
+    def examine_prefix(self, cycle, prefix, prefixdir, buckets, elsewhere):
+        """Examine the sorted list of 'buckets' in a prefix, in a worker
+        thread (this is only used if examine_in_threads is set, see above).
+        'elsewhere' maps the buckets which are not in 'prefixdir' (the
+        prefix directory in the first share directory) to the prefix
+        directory that holds them. My return value is given to
+        process_prefix_result().
+
+        By default I call process_bucket() for each bucket, which must then
+        be safe to run in a thread.
+        """
+        for bucket in buckets:
+            self.process_bucket(cycle, prefix, elsewhere.get(bucket, prefixdir),
+                                bucket)
+
+    def process_prefix_result(self, cycle, prefix, result):
+        """Apply the result of examine_prefix() for a prefix, in the reactor
+        thread. This is called for each prefix in turn, just before
+        finished_prefix().
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        pass
+
+    def process_journal_entries(self, cycle, entries):
+        """Apply some entries from the server's change journal. 'cycle' is
+        the current cycle, or None if we are sleeping between cycles. Each
+        entry is a tuple of (time, event, storage_index_b32, shnum, size,
+        bucket_delta), as described in allmydata.storage.journal . The
+        buckets in prefixes after the last complete prefix of the current
+        cycle will be seen by process_bucket() later, so changes to them
+        should usually only be applied to the results of earlier cycles.
+
+        This is only called if uses_journal is set. Entries can be given
+        more than once if the node is interrupted by SIGKILL.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        pass
+
     def yielding(self, sleep_time):
         """The crawler is about to sleep for 'sleep_time' seconds. This
         method is mostly for the convenience of unit tests.
@@ -444,6 +804,8 @@ class BucketCountingCrawler(ShareCrawler):
     """
 
     minimum_cycle_time = 60*60 # we don't need this more than once an hour
+    uses_journal = True
+    examine_in_threads = True
 
     def __init__(self, server, statefile, num_sample_prefixes=1):
         ShareCrawler.__init__(self, server, statefile)
@@ -470,6 +832,13 @@ class BucketCountingCrawler(ShareCrawler):
         if prefix in self.prefixes[:self.num_sample_prefixes]:
             self.state["storage-index-samples"][prefix] = (cycle, buckets)
 
+    def examine_prefix(self, cycle, prefix, prefixdir, buckets, elsewhere):
+        # listing the prefix is all the work there is
+        return buckets
+
+    def process_prefix_result(self, cycle, prefix, buckets):
+        self.process_prefixdir(cycle, prefix, None, buckets, None)
+
     def finished_cycle(self, cycle):
         last_counts = self.state["bucket-counts"].get(cycle, [])
         if len(last_counts) == len(self.prefixes):
@@ -486,3 +855,23 @@ class BucketCountingCrawler(ShareCrawler):
             if old_cycle != cycle:
                 del self.state["storage-index-samples"][prefix]
 
+
+    def process_journal_entries(self, cycle, entries):
+        # keep the counts of the last complete cycle up to date, and the
+        # counts of the prefixes that the current cycle has already listed
+        counts = self.state["bucket-counts"]
+        last_cycle = self.state["last-cycle-finished"]
+        last_done = None
+        if cycle is not None and self.last_complete_prefix_index != -1:
+            last_done = self.prefixes[self.last_complete_prefix_index]
+        for (when, event, si_s, shnum, size, bucket_delta) in entries:
+            if not bucket_delta:
+                continue
+            prefix = si_s[:2]
+            if self.state["last-complete-bucket-count"] is not None:
+                self.state["last-complete-bucket-count"] += bucket_delta
+            if prefix in counts.get(last_cycle, {}):
+                counts[last_cycle][prefix] += bucket_delta
+            if last_done is not None and prefix <= last_done:
+                if prefix in counts.get(cycle, {}):
+                    counts[cycle][prefix] += bucket_delta
@@ -0,0 +1,167 @@
+import threading
+from collections import deque
+
+from twisted.application import service
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure, threadpool
+
+# Every remote method of the storage server touches the disk, and a single
+# slow seek used to stall the reactor (and therefore every other client)
+# until it finished. The DiskIOExecutor runs those operations in a thread
+# pool instead. Each device (a directory that holds shares) has its own
+# queue, so that one slow disk cannot occupy every thread, and operations
+# submitted with the same key run one at a time, in the order they were
+# submitted. The storage server uses the storage index as the key for
+# mutable slot operations, which keeps the test-and-set path atomic, and
+# each BucketWriter uses itself as the key, so writes land before close().
+
+DEFAULT_DISK_IO_THREADS = 10
+
+_thread_state = threading.local()
+
+def in_disk_io_thread():
+    """Return True if the caller is running in a DiskIOExecutor thread,
+    where it must not touch the reactor or foolscap."""
+    return getattr(_thread_state, "in_disk_io", False)
+
+def _run_in_disk_io_thread(f, *args, **kwargs):
+    _thread_state.in_disk_io = True # our pool threads do nothing else
+    return f(*args, **kwargs)
+
+class SynchronousDiskIO:
+    """I run disk operations immediately, in the calling thread. I am used
+    when the disk I/O executor is disabled, and by objects that were created
+    without one (as the unit tests do)."""
+
+    def call(self, key, then, f, *args, **kwargs):
+        return then(f(*args, **kwargs))
+
+    def call_with_cleanup(self, key, then, cleanup, f, *args, **kwargs):
+        try:
+            return then(f(*args, **kwargs))
+        except:
+            cleanup()
+            raise
+
+SYNCHRONOUS = SynchronousDiskIO()
+
+
+class DiskQueue:
+    """I submit disk operations for a single device to a DiskIOExecutor."""
+
+    def __init__(self, executor, device):
+        self._executor = executor
+        self.device = device
+
+    def call(self, key, then, f, *args, **kwargs):
+        """Run f(*args, **kwargs) in a thread, and then run then(result) in
+        the reactor thread. Returns a Deferred that fires with the result of
+        then(). If key is not None, this operation will not start until
+        every earlier operation with an equal key has finished."""
+        d = self._executor.run(self.device, key, f, *args, **kwargs)
+        d.addCallback(then)
+        return d
+
+    def call_with_cleanup(self, key, then, cleanup, f, *args, **kwargs):
+        """Like call(), but if f or then fails, run cleanup() (in the
+        reactor thread) before passing the failure on."""
+        d = self.call(key, then, f, *args, **kwargs)
+        def _failed(fail):
+            cleanup()
+            return fail
+        d.addErrback(_failed)
+        return d
+
+
+class DiskIOExecutor(service.Service):
+    """I run blocking disk operations in a pool of at most 'max_threads'
+    threads, no more than 'max_threads_per_device' of which will be working
+    on any one device at a time. Devices are served round-robin.
+
+    My methods must only be called from the reactor thread.
+    """
+    name = "disk-io"
+
+    def __init__(self, max_threads=DEFAULT_DISK_IO_THREADS,
+                 max_threads_per_device=None):
+        assert max_threads > 0, max_threads
+        self.max_threads = max_threads
+        self.max_threads_per_device = max_threads_per_device or max_threads
+        self._pool = threadpool.ThreadPool(0, max_threads,
+                                           "tahoe-storage-disk-io")
+        self._queues = {} # device -> deque of jobs ready to run
+        self._running = {} # device -> number of jobs in progress
+        self._total_running = 0
+        # key -> deque of jobs waiting for the job that holds this key
+        self._waiting = {}
+
+    def startService(self):
+        service.Service.startService(self)
+        self._pool.start()
+
+    def stopService(self):
+        # this waits for the jobs which are already in a thread
+        self._pool.stop()
+        return service.Service.stopService(self)
+
+    def get_queue(self, device):
+        return DiskQueue(self, device)
+
+    def run(self, device, key, f, *args, **kwargs):
+        d = defer.Deferred()
+        job = (device, key, f, args, kwargs, d)
+        if key is not None:
+            if key in self._waiting:
+                self._waiting[key].append(job)
+                return d
+            self._waiting[key] = deque()
+        self._queues.setdefault(device, deque()).append(job)
+        self._dispatch()
+        return d
+
+    def _dispatch(self):
+        progress = True
+        while progress and self._total_running < self.max_threads:
+            progress = False
+            for device, queue in self._queues.items():
+                if not queue:
+                    continue
+                if self._running.get(device, 0) >= self.max_threads_per_device:
+                    continue
+                if self._total_running >= self.max_threads:
+                    break
+                self._start(queue.popleft())
+                progress = True
+
+    def _start(self, job):
+        (device, key, f, args, kwargs, d) = job
+        self._running[device] = self._running.get(device, 0) + 1
+        self._total_running += 1
+        d2 = threads.deferToThreadPool(reactor, self._pool,
+                                       _run_in_disk_io_thread, f,
+                                       *args, **kwargs)
+        d2.addBoth(self._finished, job)
+
+    def _finished(self, res, job):
+        (device, key, f, args, kwargs, d) = job
+        self._running[device] -= 1
+        self._total_running -= 1
+        if key is not None:
+            waiting = self._waiting[key]
+            if waiting:
+                next_job = waiting.popleft()
+                self._queues.setdefault(next_job[0], deque()).append(next_job)
+            else:
+                del self._waiting[key]
+        self._dispatch()
+        if isinstance(res, failure.Failure):
+            d.errback(res)
+        else:
+            d.callback(res)
+
+    def get_stats(self):
+        queued = sum([len(q) for q in self._queues.values()])
+        queued += sum([len(w) for w in self._waiting.values()])
+        return {"running": self._total_running,
+                "queued": queued,
+                }
@@ -1,10 +1,57 @@
 import time, os, pickle, struct
+from twisted.internet import defer
 from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.diskio import SYNCHRONOUS
 from allmydata.storage.shares import get_share_file
+from allmydata.storage.pack import PackedShareFile
+from allmydata.storage.leasedb import lease_db_share
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
+     UnknownImmutableContainerVersionError, si_a2b
+from allmydata.util.time_format import parse_duration, parse_date
 from twisted.python import log as twlog
 
+def parse_whatif_policies(s):
+    """Parse the value of [storage]expire.whatif: a comma-separated list of
+    expiration policies, each of which is 'age', 'age:DURATION' (with
+    DURATION as the override_lease_duration), or 'cutoff-date:DATE',
+    optionally followed by ':mutable' or ':immutable' to only expire shares
+    of that type. Returns a list of (name, (mode, override_lease_duration,
+    cutoff_date, sharetypes)) tuples."""
+    policies = []
+    for name in s.split(","):
+        name = name.strip()
+        if not name:
+            continue
+        pieces = name.split(":")
+        sharetypes = ("immutable", "mutable")
+        if len(pieces) > 1 and pieces[-1] in sharetypes:
+            sharetypes = (pieces.pop(),)
+        mode = pieces[0]
+        override_lease_duration = None
+        cutoff_date = None
+        if mode == "age" and len(pieces) == 1:
+            pass
+        elif mode == "age" and len(pieces) == 2:
+            override_lease_duration = parse_duration(pieces[1])
+        elif mode == "cutoff-date" and len(pieces) == 2:
+            cutoff_date = parse_date(pieces[1])
+        else:
+            raise ValueError("expire.whatif policy '%s' must be 'age', "
+                             "'age:DURATION', or 'cutoff-date:DATE'" % name)
+        if name in [n for (n, policy) in policies]:
+            raise ValueError("expire.whatif policy '%s' is listed twice"
+                             % name)
+        policies.append((name, (mode, override_lease_duration, cutoff_date,
+                                sharetypes)))
+    return policies
+
+class PackedShareStat:
+    """The part of a stat() result that the lease checker uses, for a
+    share kept in a pack file. With no st_blocks, the share's disk usage is
+    taken to be its size."""
+    def __init__(self, size):
+        self.st_size = size
+
 class LeaseCheckingCrawler(ShareCrawler):
     """I examine the leases on all shares, determining which are still valid
     and which have expired. I can remove the expired leases (if so
@@ -41,6 +88,10 @@ class LeaseCheckingCrawler(ShareCrawler):
      cycle-to-date
      last 10 cycles <-- separate pickle
 
+    Space that each of the 'whatif_policies' would recover:
+     cycle-to-date
+     last 10 cycles <-- separate pickle
+
     All cycle-to-date values remain valid until the start of the next cycle.
 
     """
@@ -52,7 +103,8 @@ class LeaseCheckingCrawler(ShareCrawler):
                  expiration_enabled, mode,
                  override_lease_duration, # used if expiration_mode=="age"
                  cutoff_date, # used if expiration_mode=="cutoff-date"
-                 sharetypes):
+                 sharetypes,
+                 whatif_policies=()):
         self.historyfile = historyfile
         self.expiration_enabled = expiration_enabled
         self.mode = mode
@@ -68,6 +120,17 @@ class LeaseCheckingCrawler(ShareCrawler):
         else:
             raise ValueError("GC mode '%s' must be 'age' or 'cutoff-date'" % mode)
         self.sharetypes_to_expire = sharetypes
+        self.configured_policy = (self.mode, self.override_lease_duration,
+                                  self.cutoff_date, self.sharetypes_to_expire)
+        # (name, policy) for each hypothetical policy: we count the space
+        # that it would recover, but never expire anything because of it
+        self.whatif_policies = list(whatif_policies)
+        # set when packed shares were deleted, so the packs need compacting
+        self.packed_shares_removed = False
+        self.compacting = False
+        # expired leases are cancelled through the server's disk queue, in
+        # order with the other operations on the same storage index
+        self.disk = getattr(server, "disk", SYNCHRONOUS)
         ShareCrawler.__init__(self, server, statefile)
 
     def add_initial_state(self):
@@ -80,6 +143,14 @@ class LeaseCheckingCrawler(ShareCrawler):
         # the keys individually
         for k in so_far:
             self.state["cycle-to-date"].setdefault(k, so_far[k])
+        # the what-if policies may have been changed too. Those that were
+        # added will only count the rest of this cycle.
+        whatif = self.state["cycle-to-date"]["whatif-space-recovered"]
+        for name in whatif.keys():
+            if name not in so_far["whatif-space-recovered"]:
+                del whatif[name]
+        for name in so_far["whatif-space-recovered"]:
+            whatif.setdefault(name, so_far["whatif-space-recovered"][name])
 
         # initialize history
         if not os.path.exists(self.historyfile):
@@ -94,7 +165,11 @@ class LeaseCheckingCrawler(ShareCrawler):
                   "space-recovered": recovered,
                   "lease-age-histogram": {}, # (minage,maxage)->count
                   "leases-per-share-histogram": {}, # leasecount->numshares
+                  "whatif-space-recovered": {}, # policy name->recovered
                   }
+        for (name, policy) in self.whatif_policies:
+            so_far["whatif-space-recovered"][name] = \
+                self.create_empty_whatif_dict()
         return so_far
 
     def create_empty_recovered_dict(self):
@@ -106,6 +181,14 @@ class LeaseCheckingCrawler(ShareCrawler):
                 recovered[a+"-"+b+"-immutable"] = 0
         return recovered
 
+    def create_empty_whatif_dict(self):
+        recovered = {}
+        for b in ("buckets", "shares", "sharebytes", "diskbytes"):
+            recovered["whatif-"+b] = 0
+            recovered["whatif-"+b+"-mutable"] = 0
+            recovered["whatif-"+b+"-immutable"] = 0
+        return recovered
+
     def started_cycle(self, cycle):
         self.state["cycle-to-date"] = self.create_empty_cycle_dict()
 
@@ -114,11 +197,17 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
         bucketdir = os.path.join(prefixdir, storage_index_b32)
-        s = self.stat(bucketdir)
+        try:
+            s = self.stat(bucketdir)
+            filenames = os.listdir(bucketdir)
+        except EnvironmentError:
+            # all of this bucket's shares are in pack files
+            s = None
+            filenames = []
         would_keep_shares = []
         wks = None
 
-        for fn in os.listdir(bucketdir):
+        for fn in filenames:
             try:
                 shnum = int(fn)
             except ValueError:
@@ -133,9 +222,23 @@ class LeaseCheckingCrawler(ShareCrawler):
                 twlog.err()
                 which = (storage_index_b32, shnum)
                 self.state["cycle-to-date"]["corrupt-shares"].append(which)
-                wks = (1, 1, 1, "unknown")
+                wks = self.corrupt_share_would_keep()
             would_keep_shares.append(wks)
 
+        if self.pack_store is not None:
+            storage_index = si_a2b(storage_index_b32)
+            for shnum in self.pack_store.get_shares(storage_index):
+                sf = PackedShareFile(self.pack_store, storage_index, shnum)
+                try:
+                    wks = self.process_packed_share(sf)
+                except (UnknownImmutableContainerVersionError, struct.error):
+                    twlog.msg("lease-checker error processing %s" % sf.home)
+                    twlog.err()
+                    which = (storage_index_b32, shnum)
+                    self.state["cycle-to-date"]["corrupt-shares"].append(which)
+                    wks = self.corrupt_share_would_keep()
+                would_keep_shares.append(wks)
+
         sharetype = None
         if wks:
             # use the last share's sharetype as the buckettype
@@ -149,25 +252,66 @@ class LeaseCheckingCrawler(ShareCrawler):
         try:
             bucket_diskbytes = s.st_blocks * 512
         except AttributeError:
-            bucket_diskbytes = 0 # no stat().st_blocks on windows
+            # no stat().st_blocks on windows, and no directory at all for
+            # buckets that are only in pack files
+            bucket_diskbytes = 0
         if sum([wks[0] for wks in would_keep_shares]) == 0:
             self.increment_bucketspace("original", bucket_diskbytes, sharetype)
         if sum([wks[1] for wks in would_keep_shares]) == 0:
             self.increment_bucketspace("configured", bucket_diskbytes, sharetype)
         if sum([wks[2] for wks in would_keep_shares]) == 0:
             self.increment_bucketspace("actual", bucket_diskbytes, sharetype)
+        whatif = self.state["cycle-to-date"]["whatif-space-recovered"]
+        for (i, (name, policy)) in enumerate(self.whatif_policies):
+            if sum([wks[4][i] for wks in would_keep_shares]) == 0:
+                self.increment_bucketspace("whatif", bucket_diskbytes,
+                                           sharetype, whatif[name])
+
+    def corrupt_share_would_keep(self):
+        # we never expire a share that we cannot read
+        return (1, 1, 1, "unknown", [1] * len(self.whatif_policies))
 
     def process_share(self, sharefilename):
         # first, find out what kind of a share it is
         sf = get_share_file(sharefilename)
+        s = self.stat(sharefilename)
+        bucketdir, shnum_s = os.path.split(sharefilename)
+        storage_index = si_a2b(os.path.basename(bucketdir))
+        shnum = int(shnum_s)
+        if self._lease_db_is_trusted():
+            sf = lease_db_share(self.server.lease_db, storage_index, shnum, sf)
+        (would_keep_share, expired) = self.examine_share(sf, s)
+        if expired:
+            self.expire_leases(storage_index, shnum, sf)
+        return would_keep_share
+
+    def process_packed_share(self, sf):
+        s = PackedShareStat(sf.get_size())
+        storage_index = sf.storage_index
+        shnum = sf.shnum
+        if self._lease_db_is_trusted():
+            sf = lease_db_share(self.server.lease_db, storage_index, shnum, sf)
+        (would_keep_share, expired) = self.examine_share(sf, s)
+        if expired:
+            self.expire_leases(storage_index, shnum, sf, packed=True)
+        return would_keep_share
+
+    def _lease_db_is_trusted(self):
+        lease_db = getattr(self.server, "lease_db", None)
+        return lease_db is not None and lease_db.is_trusted()
+
+    def examine_share(self, sf, s):
+        """Count the leases on a share. Returns (would_keep_share, True if
+        expiration is enabled and some leases have expired). The caller
+        cancels them with expire_leases()."""
         sharetype = sf.sharetype
         now = time.time()
-        s = self.stat(sharefilename)
 
         num_leases = 0
         num_valid_leases_original = 0
         num_valid_leases_configured = 0
-        expired_leases_configured = []
+        num_expired_leases_configured = 0
+        num_valid_leases_whatif = [0] * len(self.whatif_policies)
 
         for li in sf.get_leases():
             num_leases += 1
@@ -181,22 +325,17 @@ class LeaseCheckingCrawler(ShareCrawler):
                 num_valid_leases_original += 1
 
             #  expired-or-not according to our configured age limit
-            expired = False
-            if self.mode == "age":
-                age_limit = original_expiration_time
-                if self.override_lease_duration is not None:
-                    age_limit = self.override_lease_duration
-                if age > age_limit:
-                    expired = True
-            else:
-                assert self.mode == "cutoff-date"
-                if grant_renew_time < self.cutoff_date:
-                    expired = True
-            if sharetype not in self.sharetypes_to_expire:
-                expired = False
+            expired = self.is_expired(self.configured_policy, sharetype, age,
+                                      original_expiration_time,
+                                      grant_renew_time)
+            for (i, (name, policy)) in enumerate(self.whatif_policies):
+                if not self.is_expired(policy, sharetype, age,
+                                       original_expiration_time,
+                                       grant_renew_time):
+                    num_valid_leases_whatif[i] += 1
 
             if expired:
-                expired_leases_configured.append(li)
+                num_expired_leases_configured += 1
             else:
                 num_valid_leases_configured += 1
 
@@ -204,11 +343,11 @@ class LeaseCheckingCrawler(ShareCrawler):
         self.increment(so_far["leases-per-share-histogram"], num_leases, 1)
         self.increment_space("examined", s, sharetype)
 
-        would_keep_share = [1, 1, 1, sharetype]
+        would_keep_share = [1, 1, 1, sharetype,
+                            [1] * len(self.whatif_policies)]
 
-        if self.expiration_enabled:
-            for li in expired_leases_configured:
-                sf.cancel_lease(li.cancel_secret)
+        expired = bool(self.expiration_enabled and
+                       num_expired_leases_configured)
 
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
@@ -221,9 +360,102 @@ class LeaseCheckingCrawler(ShareCrawler):
                 would_keep_share[2] = 0
                 self.increment_space("actual", s, sharetype)
 
-        return would_keep_share
-
-    def increment_space(self, a, s, sharetype):
+        whatif = so_far["whatif-space-recovered"]
+        for (i, (name, policy)) in enumerate(self.whatif_policies):
+            if num_valid_leases_whatif[i] == 0:
+                would_keep_share[4][i] = 0
+                self.increment_space("whatif", s, sharetype, whatif[name])
+
+        return (would_keep_share, expired)
+
+    def is_expired(self, policy, sharetype, age, original_expiration_time,
+                   grant_renew_time):
+        (mode, override_lease_duration, cutoff_date, sharetypes) = policy
+        if sharetype not in sharetypes:
+            return False
+        if mode == "age":
+            age_limit = original_expiration_time
+            if override_lease_duration is not None:
+                age_limit = override_lease_duration
+            return age > age_limit
+        assert mode == "cutoff-date"
+        return grant_renew_time < cutoff_date
+
+    def expire_leases(self, storage_index, shnum, sf, packed=False):
+        # The server changes shares (adding leases, writing slots) in its
+        # disk I/O threads, so the expired leases are cancelled there too,
+        # after the operations on this storage index that came before. A
+        # lease may have been renewed since we examined it, so they are
+        # checked again first.
+        def _cancelled((num_remaining_leases, latest_expiration_time,
+                        bucket_delta)):
+            self.cancelled_leases(storage_index, shnum, num_remaining_leases,
+                                  latest_expiration_time, packed,
+                                  bucket_delta)
+        d = defer.maybeDeferred(self.disk.call, storage_index, _cancelled,
+                                self.cancel_expired_leases, storage_index,
+                                shnum, sf)
+        def _failed(f):
+            twlog.msg("lease-checker error expiring leases of %s" % sf.home)
+            twlog.err(f)
+        d.addErrback(_failed)
+
+    def cancel_expired_leases(self, storage_index, shnum, sf):
+        """Cancel the leases on a share which have expired. This runs in a
+        disk I/O thread. Returns (number of remaining leases, their latest
+        expiration time, change in the number of buckets)."""
+        num_remaining_leases = 0
+        latest_expiration_time = None
+        cancelled = set()
+        for li in list(sf.get_leases()):
+            if self.is_expired(self.configured_policy, sf.sharetype,
+                               li.get_age(), li.get_expiration_time(),
+                               li.get_grant_renew_time_time()):
+                if li.cancel_secret not in cancelled:
+                    sf.cancel_lease(li.cancel_secret)
+                    cancelled.add(li.cancel_secret)
+            else:
+                num_remaining_leases += 1
+                latest_expiration_time = max(latest_expiration_time,
+                                             li.get_expiration_time())
+        bucket_delta = 0
+        if not num_remaining_leases:
+            # cancelling the last lease deleted the share
+            bucket_delta = self.server.get_bucket_delta(storage_index, shnum,
+                                                        added=False)
+        return (num_remaining_leases, latest_expiration_time, bucket_delta)
+
+    def cancelled_leases(self, storage_index, shnum, num_remaining_leases,
+                         latest_expiration_time, packed=False,
+                         bucket_delta=0):
+        # tell the server, so it can keep its share index up to date
+        if num_remaining_leases:
+            self.server.share_leases_changed(storage_index, shnum,
+                                             latest_expiration_time)
+        else:
+            # cancelling the last lease deleted the share
+            if packed:
+                # the share has been removed from its pack
+                self.packed_shares_removed = True
+            self.server.share_removed(storage_index, shnum, bucket_delta)
+
+    def finished_prefix(self, cycle, prefix):
+        if self.packed_shares_removed and not self.compacting:
+            self.packed_shares_removed = False
+            # compaction copies records and waits for the disk, so it runs
+            # in a disk I/O thread. The PackStore does its own locking.
+            self.compacting = True
+            def _compacted(reclaimed):
+                self.compacting = False
+            d = defer.maybeDeferred(self.disk.call, None, _compacted,
+                                    self.pack_store.compact)
+            def _failed(f):
+                self.compacting = False
+                twlog.msg("lease-checker error compacting packs")
+                twlog.err(f)
+            d.addErrback(_failed)
+
+    def increment_space(self, a, s, sharetype, so_far_sr=None):
         sharebytes = s.st_size
         try:
             # note that stat(2) says that st_blocks is 512 bytes, and that
@@ -234,7 +466,8 @@ class LeaseCheckingCrawler(ShareCrawler):
             # the docs say that st_blocks is only on linux. I also see it on
             # MacOS. But it isn't available on windows.
             diskbytes = sharebytes
-        so_far_sr = self.state["cycle-to-date"]["space-recovered"]
+        if so_far_sr is None:
+            so_far_sr = self.state["cycle-to-date"]["space-recovered"]
         self.increment(so_far_sr, a+"-shares", 1)
         self.increment(so_far_sr, a+"-sharebytes", sharebytes)
         self.increment(so_far_sr, a+"-diskbytes", diskbytes)
@@ -243,8 +476,9 @@ class LeaseCheckingCrawler(ShareCrawler):
             self.increment(so_far_sr, a+"-sharebytes-"+sharetype, sharebytes)
             self.increment(so_far_sr, a+"-diskbytes-"+sharetype, diskbytes)
 
-    def increment_bucketspace(self, a, bucket_diskbytes, sharetype):
-        rec = self.state["cycle-to-date"]["space-recovered"]
+    def increment_bucketspace(self, a, bucket_diskbytes, sharetype, rec=None):
+        if rec is None:
+            rec = self.state["cycle-to-date"]["space-recovered"]
         self.increment(rec, a+"-diskbytes", bucket_diskbytes)
         self.increment(rec, a+"-buckets", 1)
         if sharetype:
@@ -282,10 +516,8 @@ class LeaseCheckingCrawler(ShareCrawler):
         now = time.time()
         h["cycle-start-finish-times"] = (start, now)
         h["expiration-enabled"] = self.expiration_enabled
-        h["configured-expiration-mode"] = (self.mode,
-                                           self.override_lease_duration,
-                                           self.cutoff_date,
-                                           self.sharetypes_to_expire)
+        h["configured-expiration-mode"] = self.configured_policy
+        h["whatif-policies"] = self.whatif_policies[:]
 
         s = self.state["cycle-to-date"]
 
@@ -302,6 +534,8 @@ class LeaseCheckingCrawler(ShareCrawler):
         # note: if ["shares-recovered"] ever acquires an internal dict, this
         # copy() needs to become a deepcopy
         h["space-recovered"] = s["space-recovered"].copy()
+        h["whatif-space-recovered"] = dict([(name, sr.copy()) for (name, sr)
+                                            in s["whatif-space-recovered"].items()])
 
         history = pickle.load(open(self.historyfile, "rb"))
         history[cycle] = h
@@ -329,16 +563,23 @@ class LeaseCheckingCrawler(ShareCrawler):
           leases-per-share-histogram
           corrupt-shares (list of (si_b32,shnum) tuples, minimal verification)
           space-recovered
+          whatif-policies (list of (name, expiration mode) tuples)
+          whatif-space-recovered (maps policy name to a dictionary of
+                                  whatif-buckets, whatif-shares,
+                                  whatif-sharebytes, and whatif-diskbytes,
+                                  each also with -mutable and -immutable)
 
          estimated-remaining-cycle:
           # Values may be None if not enough data has been gathered to
           # produce an estimate.
           space-recovered
+          whatif-space-recovered
 
          estimated-current-cycle:
           # cycle-to-date plus estimated-remaining. Values may be None if
           # not enough data has been gathered to produce an estimate.
           space-recovered
+          whatif-space-recovered
 
          history: maps cyclenum to a dict with the following keys:
           cycle-start-finish-times
@@ -348,6 +589,8 @@ class LeaseCheckingCrawler(ShareCrawler):
           leases-per-share-histogram
           corrupt-shares
           space-recovered
+          whatif-policies
+          whatif-space-recovered
 
          The 'space-recovered' structure is a dictionary with the following
          keys:
@@ -392,34 +635,45 @@ class LeaseCheckingCrawler(ShareCrawler):
         lah = so_far["lease-age-histogram"]
         so_far["lease-age-histogram"] = self.convert_lease_age_histogram(lah)
         so_far["expiration-enabled"] = self.expiration_enabled
-        so_far["configured-expiration-mode"] = (self.mode,
-                                                self.override_lease_duration,
-                                                self.cutoff_date,
-                                                self.sharetypes_to_expire)
+        so_far["configured-expiration-mode"] = self.configured_policy
+        so_far["whatif-policies"] = self.whatif_policies[:]
 
         so_far_sr = so_far["space-recovered"]
         remaining_sr = {}
-        remaining = {"space-recovered": remaining_sr}
+        remaining_whatif = {}
+        remaining = {"space-recovered": remaining_sr,
+                     "whatif-space-recovered": remaining_whatif}
         cycle_sr = {}
-        cycle = {"space-recovered": cycle_sr}
+        cycle_whatif = {}
+        cycle = {"space-recovered": cycle_sr,
+                 "whatif-space-recovered": cycle_whatif}
 
+        m = None
         if progress["cycle-complete-percentage"] > 0.0:
             pc = progress["cycle-complete-percentage"] / 100.0
             m = (1-pc)/pc
-            for a in ("actual", "original", "configured", "examined"):
-                for b in ("buckets", "shares", "sharebytes", "diskbytes"):
-                    for c in ("", "-mutable", "-immutable"):
-                        k = a+"-"+b+c
-                        remaining_sr[k] = m * so_far_sr[k]
-                        cycle_sr[k] = so_far_sr[k] + remaining_sr[k]
-        else:
-            for a in ("actual", "original", "configured", "examined"):
-                for b in ("buckets", "shares", "sharebytes", "diskbytes"):
-                    for c in ("", "-mutable", "-immutable"):
-                        k = a+"-"+b+c
-                        remaining_sr[k] = None
-                        cycle_sr[k] = None
+        self.estimate_space(m, ("actual", "original", "configured", "examined"),
+                            so_far_sr, remaining_sr, cycle_sr)
+        for (name, whatif_sr) in so_far["whatif-space-recovered"].items():
+            remaining_whatif[name] = {}
+            cycle_whatif[name] = {}
+            self.estimate_space(m, ("whatif",), whatif_sr,
+                                remaining_whatif[name], cycle_whatif[name])
 
         state["estimated-remaining-cycle"] = remaining
         state["estimated-current-cycle"] = cycle
         return state
+
+    def estimate_space(self, m, prefixes, so_far_sr, remaining_sr, cycle_sr):
+        # 'm' is how much more of the cycle is left than has been done, or
+        # None if nothing has been done yet
+        for a in prefixes:
+            for b in ("buckets", "shares", "sharebytes", "diskbytes"):
+                for c in ("", "-mutable", "-immutable"):
+                    k = a+"-"+b+c
+                    if m is None:
+                        remaining_sr[k] = None
+                        cycle_sr[k] = None
+                    else:
+                        remaining_sr[k] = m * so_far_sr[k]
+                        cycle_sr[k] = so_far_sr[k] + remaining_sr[k]
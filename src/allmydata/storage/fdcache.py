@@ -0,0 +1,156 @@
+import os, sys, stat, threading
+from collections import OrderedDict
+
+# A download makes dozens of small reads from each immutable share (offsets,
+# UEB, hash trees, and each block), and ShareFile used to open() the share
+# file for every one of them. The OpenFileCache keeps a bounded number of
+# read-only file descriptors open, in least-recently-used order, so that
+# those reads only pay for the read itself.
+
+DEFAULT_MAX_OPEN_FILES = 100
+if sys.platform == "win32":
+    # windows will not delete a file while somebody holds it open
+    DEFAULT_MAX_OPEN_FILES = 0
+
+class _OpenFile:
+    def __init__(self, fd):
+        self.fd = fd
+        # only used when we have to emulate pread() with lseek()+read()
+        self.lock = threading.Lock()
+        # these are guarded by the OpenFileCache's lock: a descriptor that
+        # is evicted while a thread is reading from it is only closed when
+        # that read is done, so the number cannot be reused under the read
+        self.users = 0
+        self.retired = False
+
+    def pread(self, offset, length):
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, length, offset)
+        pieces = []
+        self.lock.acquire()
+        try:
+            os.lseek(self.fd, offset, os.SEEK_SET)
+            while length > 0:
+                data = os.read(self.fd, length)
+                if not data:
+                    break
+                pieces.append(data)
+                length -= len(data)
+        finally:
+            self.lock.release()
+        return "".join(pieces)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class OpenFileCache:
+    """I hold up to 'max_open_files' share files open for reading, and
+    perform positional reads on them. Before each read I fstat() the
+    descriptor, and if the file has been unlinked (deleted, or replaced by a
+    rename) I close it and open the path again, so readers never see a
+    share that is no longer on disk. The StorageServer also calls
+    invalidate() when it deletes a share, to release the space promptly.
+
+    My methods may be called from several threads at once.
+    """
+
+    def __init__(self, max_open_files=DEFAULT_MAX_OPEN_FILES):
+        self.max_open_files = max_open_files
+        self._files = OrderedDict() # filename -> _OpenFile, oldest first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, filename):
+        # the caller must pass the result to _release() when it is done
+        # with the descriptor
+        self._lock.acquire()
+        try:
+            of = self._files.pop(filename, None)
+            if of is not None:
+                if os.fstat(of.fd)[stat.ST_NLINK]:
+                    self.hits += 1
+                    self._files[filename] = of
+                    of.users += 1
+                    return of
+                self._retire(of)
+            self.misses += 1
+            of = _OpenFile(os.open(filename, os.O_RDONLY | getattr(os, "O_BINARY", 0)))
+            of.users += 1
+            self._files[filename] = of
+            while len(self._files) > self.max_open_files:
+                (oldname, old) = self._files.popitem(last=False)
+                self._retire(old)
+                self.evictions += 1
+            return of
+        finally:
+            self._lock.release()
+
+    def _release(self, of):
+        self._lock.acquire()
+        try:
+            of.users -= 1
+            if of.retired and not of.users:
+                of.close()
+        finally:
+            self._lock.release()
+
+    def _retire(self, of):
+        # called with self._lock held, after 'of' was removed from _files
+        of.retired = True
+        if not of.users:
+            of.close()
+
+    def pread(self, filename, offset, length):
+        """Return up to 'length' bytes from 'filename', starting at
+        'offset'. Raises EnvironmentError if the file cannot be opened."""
+        if self.max_open_files <= 0:
+            f = open(filename, "rb")
+            try:
+                f.seek(offset)
+                return f.read(length)
+            finally:
+                f.close()
+        of = self._get(filename)
+        try:
+            return of.pread(offset, length)
+        finally:
+            self._release(of)
+
+    def stat(self, filename):
+        """Return the os.stat() results for 'filename', opening it if
+        necessary."""
+        if self.max_open_files <= 0:
+            return os.stat(filename)
+        of = self._get(filename)
+        try:
+            return os.fstat(of.fd)
+        finally:
+            self._release(of)
+
+    def invalidate(self, filename):
+        self._lock.acquire()
+        try:
+            of = self._files.pop(filename, None)
+            if of is not None:
+                self._retire(of)
+        finally:
+            self._lock.release()
+
+    def close_all(self):
+        self._lock.acquire()
+        try:
+            while self._files:
+                (filename, of) = self._files.popitem()
+                self._retire(of)
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "open": len(self._files),
+                }
@@ -9,7 +9,8 @@ from allmydata.util.assertutil import precondition
 from allmydata.util.hashutil import timing_safe_compare
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownImmutableContainerVersionError, \
-     DataTooLargeError
+     DataTooLargeError, si_a2b
+from allmydata.storage.diskio import SYNCHRONOUS
 
 # each share file (in storage/shares/$SI/$SHNUM) contains lease information
 # and share data. The share data is accessed by RIBucketWriter.write and
@@ -40,11 +41,12 @@ class ShareFile:
     LEASE_SIZE = struct.calcsize(">L32s32sL")
     sharetype = "immutable"
 
-    def __init__(self, filename, max_size=None, create=False):
-        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. """
+    def __init__(self, filename, max_size=None, create=False, file_cache=None):
+        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. If file_cache is provided (an OpenFileCache), share data is read through its file descriptors instead of opening the file for each read. """
         precondition((max_size is not None) or (not create), max_size, create)
         self.home = filename
         self._max_size = max_size
+        self._file_cache = file_cache
         if create:
             # touch the file, so later callers will see that we're working on
             # it. Also construct the metadata.
@@ -65,10 +67,15 @@ class ShareFile:
             self._lease_offset = max_size + 0x0c
             self._num_leases = 0
         else:
-            f = open(self.home, 'rb')
-            filesize = os.path.getsize(self.home)
-            (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
-            f.close()
+            if file_cache:
+                filesize = file_cache.stat(self.home)[stat.ST_SIZE]
+                header = file_cache.pread(self.home, 0, 0xc)
+            else:
+                f = open(self.home, 'rb')
+                filesize = os.path.getsize(self.home)
+                header = f.read(0xc)
+                f.close()
+            (version, unused, num_leases) = struct.unpack(">LLL", header)
             if version != 1:
                 msg = "sharefile %s had version %d but we wanted 1" % \
                       (filename, version)
@@ -79,6 +86,8 @@ class ShareFile:
 
     def unlink(self):
         os.unlink(self.home)
+        if self._file_cache:
+            self._file_cache.invalidate(self.home)
 
     def read_share_data(self, offset, length):
         precondition(offset >= 0)
@@ -88,6 +97,8 @@ class ShareFile:
         actuallength = max(0, min(length, self._lease_offset-seekpos))
         if actuallength == 0:
             return ""
+        if self._file_cache:
+            return self._file_cache.pread(self.home, seekpos, actuallength)
         f = open(self.home, 'rb')
         f.seek(seekpos)
         return f.read(actuallength)
@@ -194,22 +205,47 @@ class ShareFile:
         return space_freed
 
 
+def create_share_with_lease(incominghome, max_size, lease_info):
+    sf = ShareFile(incominghome, create=True, max_size=max_size)
+    # also, add our lease to the file now, so that other ones can be
+    # added by simultaneous uploaders
+    sf.add_lease(lease_info)
+    return sf
+
+
 class BucketWriter(Referenceable):
     implements(RIBucketWriter)
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary):
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info,
+                 canary, disk=SYNCHRONOUS, sharefile=None, pack_store=None,
+                 storage_index=None):
+        """If 'sharefile' is provided, it must be a ShareFile that was
+        already created at 'incominghome' (with our lease). All of my disk
+        I/O is performed through 'disk' (a DiskQueue or SynchronousDiskIO),
+        in the order that the remote calls arrive. If 'pack_store' is
+        provided, the finished share is moved into that PackStore instead of
+        to 'finalhome' (which still names the storage index and share
+        number). If 'storage_index' is provided, the share is moved into
+        place under that key, and 'ss' is asked with get_bucket_delta()
+        whether it was the first share of its bucket."""
         self.ss = ss
+        self._storage_index = storage_index
         self.incominghome = incominghome
         self.finalhome = finalhome
+        self._pack_store = pack_store
+        self.packed = False
         self._max_size = max_size # don't allow the client to write more than this
         self._canary = canary
+        self._disk = disk
         self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
         self.closed = False
+        # True while a close or abort is waiting for the disk
+        self._closing = False
         self.throw_out_all_data = False
-        self._sharefile = ShareFile(incominghome, create=True, max_size=max_size)
-        # also, add our lease to the file now, so that other ones can be
-        # added by simultaneous uploaders
-        self._sharefile.add_lease(lease_info)
+        if sharefile is None:
+            sharefile = create_share_with_lease(incominghome, max_size,
+                                                lease_info)
+        self._sharefile = sharefile
 
     def allocated_size(self):
         return self._max_size
@@ -219,16 +255,72 @@ class BucketWriter(Referenceable):
         precondition(not self.closed)
         if self.throw_out_all_data:
             return
-        self._sharefile.write_share_data(offset, data)
-        self.ss.add_latency("write", time.time() - start)
-        self.ss.count("write")
+        def _written(res):
+            self.ss.add_latency("write", time.time() - start)
+            self.ss.count("write")
+        return self._disk.call(self, _written,
+                               self._sharefile.write_share_data, offset, data)
 
     def remote_close(self):
         precondition(not self.closed)
+        precondition(not self._closing)
         start = time.time()
+        self._closing = True
+        def _moved((filelen, bucket_delta)):
+            self._sharefile = None
+            self.closed = True
+            self._closing = False
+            self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
+
+            self.ss.bucket_writer_closed(self, filelen, bucket_delta)
+            self.ss.add_latency("close", time.time() - start)
+            self.ss.count("close")
+        def _failed():
+            # we are still open, and will be aborted if the client goes away
+            self._closing = False
+        if self._storage_index is None:
+            return self._disk.call_with_cleanup(self, _moved, _failed,
+                                                self._move_to_final_home)
+        # Our writes are queued under our own key. Once they are done, the
+        # share is moved under the key of its storage index, so that it is
+        # counted in order with the other shares of the bucket which are
+        # being closed or removed.
+        def _written(ign):
+            return self._disk.call_with_cleanup(self._storage_index, _moved,
+                                                _failed,
+                                                self._move_to_final_home)
+        return self._disk.call_with_cleanup(self, _written, _failed,
+                                            lambda: None)
+
+    def _move_to_final_home(self):
+        # returns (size of the share, change in the number of buckets)
+        if self._pack_store is not None:
+            filelen = self._move_to_pack()
+        else:
+            fileutil.make_dirs(os.path.dirname(self.finalhome))
+            fileutil.rename(self.incominghome, self.finalhome)
+            self._remove_incoming_dirs()
+            filelen = os.stat(self.finalhome)[stat.ST_SIZE]
+        bucket_delta = 0
+        if self._storage_index is not None:
+            shnum = int(os.path.basename(self.finalhome))
+            bucket_delta = self.ss.get_bucket_delta(self._storage_index,
+                                                    shnum, added=True)
+        return (filelen, bucket_delta)
+
+    def _move_to_pack(self):
+        (bucketdir, shnum_s) = os.path.split(self.finalhome)
+        storage_index = si_a2b(os.path.basename(bucketdir))
+        f = open(self.incominghome, 'rb')
+        container = f.read()
+        f.close()
+        self._pack_store.add_share(storage_index, int(shnum_s), container)
+        os.unlink(self.incominghome)
+        self._remove_incoming_dirs()
+        self.packed = True
+        return len(container)
 
-        fileutil.make_dirs(os.path.dirname(self.finalhome))
-        fileutil.rename(self.incominghome, self.finalhome)
+    def _remove_incoming_dirs(self):
         try:
             # self.incominghome is like storage/shares/incoming/ab/abcde/4 .
             # We try to delete the parent (.../ab/abcde) to avoid leaving
@@ -253,54 +345,63 @@ class BucketWriter(Referenceable):
             # exceptions, those are normal consequences of the
             # above-mentioned conditions.
             pass
-        self._sharefile = None
-        self.closed = True
-        self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
-        self.ss.bucket_writer_closed(self, filelen)
-        self.ss.add_latency("close", time.time() - start)
-        self.ss.count("close")
 
     def _disconnected(self):
-        if not self.closed:
+        if not self.closed and not self._closing:
             self._abort()
 
     def remote_abort(self):
         log.msg("storage: aborting sharefile %s" % self.incominghome,
                 facility="tahoe.storage", level=log.UNUSUAL)
-        if not self.closed:
+        if not self.closed and not self._closing:
             self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-        self._abort()
+        res = self._abort()
         self.ss.count("abort")
+        return res
 
     def _abort(self):
-        if self.closed:
+        if self.closed or self._closing:
             return
-
+        self._closing = True
+        def _removed(res):
+            self._sharefile = None
+
+            # We are now considered closed for further writing. We must tell
+            # the storage server about this so that it stops expecting us to
+            # use the space it allocated for us earlier.
+            self.closed = True
+            self._closing = False
+            self.ss.bucket_writer_closed(self, 0)
+        return self._disk.call(self, _removed, self._remove_incoming)
+
+    def _remove_incoming(self):
         os.remove(self.incominghome)
         # if we were the last share to be moved, remove the incoming/
         # directory that was our parent
         parentdir = os.path.split(self.incominghome)[0]
         if not os.listdir(parentdir):
             os.rmdir(parentdir)
-        self._sharefile = None
-
-        # We are now considered closed for further writing. We must tell
-        # the storage server about this so that it stops expecting us to
-        # use the space it allocated for us earlier.
-        self.closed = True
-        self.ss.bucket_writer_closed(self, 0)
 
 
 class BucketReader(Referenceable):
     implements(RIBucketReader)
 
-    def __init__(self, ss, sharefname, storage_index=None, shnum=None):
+    def __init__(self, ss, sharefname, storage_index=None, shnum=None,
+                 file_cache=None, disk=SYNCHRONOUS, share_file=None,
+                 block_cache=None):
+        """If 'share_file' is provided (for example a PackedShareFile), I
+        read from it instead of opening 'sharefname'. If 'block_cache' (a
+        BlockCache) is provided, reads are served from it when possible."""
         self.ss = ss
-        self._share_file = ShareFile(sharefname)
+        if share_file is None:
+            share_file = ShareFile(sharefname, file_cache=file_cache)
+        self._share_file = share_file
         self.storage_index = storage_index
         self.shnum = shnum
+        self._disk = disk
+        self._block_cache = None
+        if storage_index is not None:
+            self._block_cache = block_cache
 
     def __repr__(self):
         return "<%s %s %s>" % (self.__class__.__name__,
@@ -309,11 +410,51 @@ class BucketReader(Referenceable):
 
     def remote_read(self, offset, length):
         start = time.time()
+        def _read(data):
+            self.ss.add_latency("read", time.time() - start)
+            self.ss.count("read")
+            return data
+        cached = self._get_cached([(offset, length)])
+        if cached is not None:
+            return _read(cached[0])
+        return self._disk.call(None, _read, self._read_share_data,
+                               offset, length)
+
+    def remote_readv(self, readv):
+        start = time.time()
+        def _read(datav):
+            self.ss.add_latency("read", time.time() - start)
+            self.ss.count("read", len(readv))
+            return datav
+        cached = self._get_cached(readv)
+        if cached is not None:
+            return _read(cached)
+        return self._disk.call(None, _read, self._read_share_datav, readv)
+
+    def _get_cached(self, readv):
+        # returns the data for every range, or None unless all are cached
+        if self._block_cache is None:
+            return None
+        datav = []
+        for (offset, length) in readv:
+            data = self._block_cache.get(self.storage_index, self.shnum,
+                                         offset, length)
+            if data is None:
+                return None
+            datav.append(data)
+        return datav
+
+    def _read_share_data(self, offset, length):
         data = self._share_file.read_share_data(offset, length)
-        self.ss.add_latency("read", time.time() - start)
-        self.ss.count("read")
+        if self._block_cache is not None:
+            self._block_cache.put(self.storage_index, self.shnum,
+                                  offset, length, data)
         return data
 
+    def _read_share_datav(self, readv):
+        return [self._read_share_data(offset, length)
+                for (offset, length) in readv]
+
     def remote_advise_corrupt_share(self, reason):
         return self.ss.remote_advise_corrupt_share("immutable",
                                                    self.storage_index,
@@ -0,0 +1,198 @@
+import os, time, threading
+
+from allmydata.storage.common import si_b2a
+from allmydata.util import fileutil, base32, log
+
+# The crawlers learn about the shares on a server by listing all 1024
+# prefix directories and every bucket in them, which takes weeks on a server
+# with tens of millions of shares, so anything they count is always out of
+# date. The change journal (storage/change_journal/) is an append-only log,
+# written by the StorageServer, of every share that is created, closed, or
+# deleted. A crawler which remembers how far it has read the journal can
+# keep its totals current by applying the new entries every minute, and
+# only needs a full cycle now and then to correct any drift (from a crash
+# that lost the end of the journal, or from shares that were changed behind
+# the server's back).
+#
+# The journal is a series of segment files (changes.0, changes.1, ..), each
+# holding one line per entry:
+#
+#  TIME EVENT STORAGE_INDEX SHNUM SIZE BUCKET_DELTA
+#
+# where EVENT is one of "created", "closed", or "deleted", STORAGE_INDEX is
+# base32-encoded, and BUCKET_DELTA is 1 when the share was the first one in
+# its bucket, -1 when it was the last one, and 0 otherwise. Segments which
+# every reader has finished with are deleted. The directory also holds a
+# random 'id', so that readers can tell when the journal they were reading
+# has been thrown away (because it was disabled for a while) and they have
+# missed some changes.
+
+CREATED, CLOSED, DELETED = "created", "closed", "deleted"
+
+DEFAULT_SEGMENT_SIZE = 1000000 # bytes
+
+class ChangeJournal:
+    """I append entries to the change journal, and read them back for
+    crawlers. A position in the journal is a tuple of (journal id, segment
+    number, offset). My methods may be called from the storage server's
+    disk I/O threads as well as from the reactor thread."""
+
+    def __init__(self, journaldir, segment_size=DEFAULT_SEGMENT_SIZE):
+        self.journaldir = journaldir
+        self.segment_size = segment_size
+        fileutil.make_dirs(journaldir)
+        idfile = os.path.join(journaldir, "id")
+        if os.path.exists(idfile):
+            self.journal_id = fileutil.read(idfile).strip()
+        else:
+            self.journal_id = base32.b2a(os.urandom(10))
+            fileutil.write_atomically(idfile, self.journal_id + "\n")
+        self._lock = threading.Lock()
+        self._readers = {} # name -> oldest segment that it still needs
+        segments = self._list_segments()
+        if segments:
+            self._segment = segments[-1]
+        else:
+            self._segment = 0
+        self._f = open(self._segment_filename(self._segment), "ab")
+        self._f.seek(0, os.SEEK_END)
+        if self._f.tell() and not self._ends_with_newline():
+            # we crashed in the middle of an entry: end it, so that readers
+            # can skip it
+            self._f.write("\n")
+            self._f.flush()
+        self.entries_written = 0
+
+    def _segment_filename(self, segment):
+        return os.path.join(self.journaldir, "changes.%d" % segment)
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self.journaldir):
+            if name.startswith("changes."):
+                try:
+                    segments.append(int(name[len("changes."):]))
+                except ValueError:
+                    pass
+        segments.sort()
+        return segments
+
+    def _ends_with_newline(self):
+        f = open(self._segment_filename(self._segment), "rb")
+        try:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == "\n"
+        finally:
+            f.close()
+
+    def record(self, event, storage_index, shnum, size=0, bucket_delta=0):
+        entry = "%d %s %s %d %d %d\n" % (time.time(), event,
+                                         si_b2a(storage_index), shnum,
+                                         size, bucket_delta)
+        self._lock.acquire()
+        try:
+            if self._f is None:
+                return
+            self._f.write(entry)
+            self._f.flush()
+            self.entries_written += 1
+            if self._f.tell() >= self.segment_size:
+                self._f.close()
+                self._segment += 1
+                self._f = open(self._segment_filename(self._segment), "ab")
+        finally:
+            self._lock.release()
+
+    def get_position(self):
+        """Return the position just after the last entry."""
+        self._lock.acquire()
+        try:
+            return (self.journal_id, self._segment, self._f.tell())
+        finally:
+            self._lock.release()
+
+    def is_valid_position(self, position):
+        """Return True if nothing that was written after 'position' has been
+        lost."""
+        if position is None:
+            return False
+        (journal_id, segment, offset) = position
+        if journal_id != self.journal_id or segment > self._segment:
+            return False
+        return os.path.exists(self._segment_filename(segment))
+
+    def read(self, position, max_entries=10000):
+        """Return (entries, new_position) for up to max_entries entries
+        which were written after 'position'. Each entry is a tuple of (time,
+        event, base32 storage index, shnum, size, bucket_delta)."""
+        (journal_id, segment, offset) = position
+        entries = []
+        while len(entries) < max_entries:
+            try:
+                f = open(self._segment_filename(segment), "rb")
+            except EnvironmentError:
+                break
+            try:
+                f.seek(offset)
+                while len(entries) < max_entries:
+                    line = f.readline()
+                    if not line.endswith("\n"):
+                        # the rest of the entry has not been written yet
+                        break
+                    offset += len(line)
+                    entry = self._parse(line)
+                    if entry is not None:
+                        entries.append(entry)
+            finally:
+                f.close()
+            if len(entries) >= max_entries or segment >= self._segment:
+                break
+            segment += 1
+            offset = 0
+        return (entries, (journal_id, segment, offset))
+
+    def _parse(self, line):
+        try:
+            (when, event, si_s, shnum, size, delta) = line.split()
+            return (int(when), event, si_s, int(shnum), int(size), int(delta))
+        except ValueError:
+            log.msg(format="change journal: unparseable entry %(line)r",
+                    line=line, facility="tahoe.storage", level=log.WEIRD,
+                    umid="Jd4RkA")
+            return None
+
+    def add_reader(self, name, position):
+        """Start keeping the segments that 'name' has yet to read, from
+        'position' on."""
+        self._lock.acquire()
+        try:
+            self._readers[name] = position[1]
+        finally:
+            self._lock.release()
+
+    def release(self, name, position):
+        """Record that 'name' has read everything up to 'position', and
+        delete the segments that no reader needs any more."""
+        self._lock.acquire()
+        try:
+            self._readers[name] = position[1]
+            oldest = min(self._readers.values() + [self._segment])
+            for segment in self._list_segments():
+                if segment < oldest:
+                    fileutil.remove_if_possible(self._segment_filename(segment))
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        return {"entries_written": self.entries_written,
+                "segment": self._segment,
+                }
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
+        finally:
+            self._lock.release()
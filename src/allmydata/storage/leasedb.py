@@ -0,0 +1,303 @@
+import os, struct, threading, time
+
+from allmydata.storage.common import si_b2a, si_a2b, \
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.pack import PackedShareFile
+from allmydata.storage.shareindex import _locked
+from allmydata.storage.shares import get_share_file
+from allmydata.util import base32, log
+from allmydata.util.dbutil import get_db
+from allmydata.util.hashutil import leasedb_renew_secret_hash, \
+     timing_safe_compare
+
+# Leases used to live only at the end of each share file, so add_lease and
+# renew_lease had to open and rewrite every share of a bucket, and the lease
+# checker had to parse every share file to find out which leases had
+# expired. The lease database (storage/leases.sqlite) holds them instead,
+# keyed by (storage index, share number, hash of the renew secret), with an
+# index on the expiration time. A renewal is then a single indexed update,
+# and the lease checker reads the leases of a share with a single query.
+#
+# When the database is first created on a server that already holds shares,
+# a LeaseDBImporter crawler copies the leases from the share files into it.
+# Until that pass is complete, lease changes are written to the share files
+# as well as to the database, and the lease checker keeps using the share
+# files. Afterwards the database is authoritative: the leases in the share
+# files are no longer updated.
+
+LEASE_DB_SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE leases
+(
+ storage_index VARCHAR(26) NOT NULL,     -- base32(storage_index)
+ shnum INTEGER NOT NULL,
+ renew_secret_hash VARCHAR(52) NOT NULL, -- base32(leasedb_renew_secret_hash())
+ owner_num INTEGER NOT NULL,
+ renew_secret BLOB NOT NULL,
+ cancel_secret BLOB NOT NULL,
+ expiration_time INTEGER NOT NULL,
+ PRIMARY KEY (storage_index, shnum, renew_secret_hash)
+);
+
+CREATE INDEX leases_by_expiration ON leases (expiration_time);
+
+CREATE TABLE status
+(
+ imported INTEGER -- 1 once the leases of all existing shares were copied in
+);
+"""
+
+def _hash_renew_secret(renew_secret):
+    return base32.b2a(leasedb_renew_secret_hash(renew_secret))
+
+class LeaseDB:
+    """I am an on-disk database of the leases on every share that the
+    StorageServer holds. All storage_index arguments are binary storage
+    index strings. My methods may be called from the storage server's disk
+    I/O threads as well as from the reactor thread.
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.is_new = not os.path.exists(dbfile)
+        # the leases are not recorded anywhere else once the import is
+        # complete, so every commit must reach the disk
+        (self._sqlite, self._db) = get_db(dbfile,
+                                          create_version=(LEASE_DB_SCHEMA_v1, 1),
+                                          dbname="lease database",
+                                          journal_mode="WAL",
+                                          synchronous="FULL",
+                                          check_same_thread=False)
+        self._lock = threading.Lock()
+        self._cursor = self._db.cursor()
+        self._cursor.execute("SELECT imported FROM status")
+        row = self._cursor.fetchone()
+        if row is None:
+            self._cursor.execute("INSERT INTO status VALUES (0)")
+            self._db.commit()
+            row = (0,)
+        self._imported = bool(row[0])
+
+    def is_trusted(self):
+        """Return True if I hold the leases of every share, so that the
+        leases in the share files can be ignored."""
+        return self._imported
+
+    @_locked
+    def mark_imported(self):
+        self._imported = True
+        self._cursor.execute("UPDATE status SET imported=1")
+        self._db.commit()
+
+    @_locked
+    def mark_stale(self):
+        """Record that lease changes may have been made to the share files
+        without me (because the server ran with the lease database
+        disabled), so the leases must be imported again before I can be
+        trusted."""
+        self._imported = False
+        self._cursor.execute("UPDATE status SET imported=0")
+        self._db.commit()
+
+    @_locked
+    def close(self):
+        if self._db is None:
+            return
+        self._db.close()
+        self._db = None
+
+    def _add_or_renew(self, si_s, shnum, lease_info):
+        # like ShareFile.add_or_renew_lease(), a lease is never shortened
+        self._cursor.execute("INSERT OR IGNORE INTO leases VALUES (?,?,?,?,?,?,?)",
+                             (si_s, shnum,
+                              _hash_renew_secret(lease_info.renew_secret),
+                              lease_info.owner_num,
+                              buffer(lease_info.renew_secret),
+                              buffer(lease_info.cancel_secret),
+                              int(lease_info.expiration_time)))
+        self._cursor.execute("UPDATE leases SET expiration_time=?"
+                             " WHERE storage_index=? AND shnum=?"
+                             " AND renew_secret_hash=? AND expiration_time < ?",
+                             (int(lease_info.expiration_time), si_s, shnum,
+                              _hash_renew_secret(lease_info.renew_secret),
+                              int(lease_info.expiration_time)))
+
+    @_locked
+    def add_or_renew_leases(self, storage_index, shnums, lease_info):
+        """Add 'lease_info' to each of the given shares, or extend the
+        existing lease with the same renew secret."""
+        si_s = si_b2a(storage_index)
+        for shnum in shnums:
+            self._add_or_renew(si_s, shnum, lease_info)
+        self._db.commit()
+
+    @_locked
+    def import_leases(self, storage_index, shnum, leases):
+        """Merge 'leases' (LeaseInfo instances read from a share file) into
+        the leases I hold for that share."""
+        si_s = si_b2a(storage_index)
+        for lease_info in leases:
+            self._add_or_renew(si_s, shnum, lease_info)
+        self._db.commit()
+
+    @_locked
+    def renew_leases(self, storage_index, renew_secret, new_expire_time):
+        """Extend the lease with the given renew secret on every share of
+        'storage_index' to 'new_expire_time'. Returns a sorted list of the
+        share numbers which have such a lease."""
+        si_s = si_b2a(storage_index)
+        renew_secret_hash = _hash_renew_secret(renew_secret)
+        self._cursor.execute("SELECT shnum FROM leases"
+                             " WHERE storage_index=? AND renew_secret_hash=?"
+                             " ORDER BY shnum",
+                             (si_s, renew_secret_hash))
+        shnums = [shnum for (shnum,) in self._cursor.fetchall()]
+        self._cursor.execute("UPDATE leases SET expiration_time=?"
+                             " WHERE storage_index=? AND renew_secret_hash=?"
+                             " AND expiration_time < ?",
+                             (int(new_expire_time), si_s, renew_secret_hash,
+                              int(new_expire_time)))
+        self._db.commit()
+        return shnums
+
+    @_locked
+    def get_leases(self, storage_index, shnum):
+        """Return a list of LeaseInfo instances for the leases on a share."""
+        self._cursor.execute("SELECT owner_num, renew_secret, cancel_secret,"
+                             " expiration_time FROM leases"
+                             " WHERE storage_index=? AND shnum=?"
+                             " ORDER BY rowid",
+                             (si_b2a(storage_index), shnum))
+        return [LeaseInfo(owner_num, str(renew_secret), str(cancel_secret),
+                          expiration_time)
+                for (owner_num, renew_secret, cancel_secret, expiration_time)
+                in self._cursor.fetchall()]
+
+    @_locked
+    def get_share_numbers(self, storage_index):
+        self._cursor.execute("SELECT DISTINCT shnum FROM leases"
+                             " WHERE storage_index=? ORDER BY shnum",
+                             (si_b2a(storage_index),))
+        return [shnum for (shnum,) in self._cursor.fetchall()]
+
+    @_locked
+    def cancel_lease(self, storage_index, shnum, cancel_secret):
+        """Remove the leases on a share which have the given cancel secret.
+        Returns the number of leases that remain. Raises IndexError if there
+        was no such lease."""
+        si_s = si_b2a(storage_index)
+        self._cursor.execute("SELECT renew_secret_hash, cancel_secret"
+                             " FROM leases WHERE storage_index=? AND shnum=?",
+                             (si_s, shnum))
+        rows = self._cursor.fetchall()
+        cancelled = [renew_secret_hash
+                     for (renew_secret_hash, secret) in rows
+                     if timing_safe_compare(str(secret), cancel_secret)]
+        if not cancelled:
+            raise IndexError("unable to find matching lease to cancel")
+        for renew_secret_hash in cancelled:
+            self._cursor.execute("DELETE FROM leases"
+                                 " WHERE storage_index=? AND shnum=?"
+                                 " AND renew_secret_hash=?",
+                                 (si_s, shnum, renew_secret_hash))
+        self._db.commit()
+        return len(rows) - len(cancelled)
+
+    @_locked
+    def remove_share(self, storage_index, shnum):
+        self._cursor.execute("DELETE FROM leases"
+                             " WHERE storage_index=? AND shnum=?",
+                             (si_b2a(storage_index), shnum))
+        self._db.commit()
+
+
+class LeaseDBShare:
+    """I present a share whose leases are held in a LeaseDB with the
+    interface that the lease checker uses for share files. 'share' is the
+    ShareFile, MutableShareFile, or PackedShareFile that holds its data,
+    which is removed when the last lease is cancelled."""
+
+    def __init__(self, lease_db, storage_index, shnum, share):
+        self._lease_db = lease_db
+        self.storage_index = storage_index
+        self.shnum = shnum
+        self._share = share
+        self.sharetype = share.sharetype
+        self.home = share.home
+
+    def get_leases(self):
+        return iter(self._lease_db.get_leases(self.storage_index, self.shnum))
+
+    def cancel_lease(self, cancel_secret):
+        """Unlike ShareFile.cancel_lease(), I do not report the number of
+        bytes freed."""
+        remaining = self._lease_db.cancel_lease(self.storage_index, self.shnum,
+                                                cancel_secret)
+        if not remaining:
+            self._share.unlink()
+
+
+def lease_db_share(lease_db, storage_index, shnum, share):
+    """Return a LeaseDBShare for 'share', first copying the leases from the
+    share itself if the database knows of none. That happens for shares
+    that were added to the share directories behind the server's back: they
+    must not look as if all of their leases had expired."""
+    if not lease_db.get_leases(storage_index, shnum):
+        lease_db.import_leases(storage_index, shnum, share.get_leases())
+    return LeaseDBShare(lease_db, storage_index, shnum, share)
+
+
+class LeaseDBImporter(ShareCrawler):
+    """I walk all of the buckets once, copying the leases of every share
+    into the LeaseDB, and then tell it that it can be trusted. The
+    StorageServer records lease changes in both places while I run."""
+
+    slow_start = 30
+    minimum_cycle_time = 0
+    examine_in_threads = True # the LeaseDB has its own lock
+
+    def __init__(self, server, statefile, lease_db):
+        self.lease_db = lease_db
+        ShareCrawler.__init__(self, server, statefile)
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        storage_index = si_a2b(storage_index_b32)
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        try:
+            filenames = os.listdir(bucketdir)
+        except EnvironmentError:
+            filenames = []
+        for fn in filenames:
+            try:
+                shnum = int(fn)
+            except ValueError:
+                continue # non-numeric means not a sharefile
+            sharefile = os.path.join(bucketdir, fn)
+            try:
+                sf = get_share_file(sharefile)
+                self.lease_db.import_leases(storage_index, shnum,
+                                            sf.get_leases())
+            except (UnknownMutableContainerVersionError,
+                    UnknownImmutableContainerVersionError,
+                    struct.error, EnvironmentError):
+                self.server.log(format="lease database: unable to read"
+                                " %(sharefile)s", sharefile=sharefile,
+                                level=log.WEIRD, umid="k2J0Rw")
+        if self.pack_store is not None:
+            for shnum in self.pack_store.get_shares(storage_index):
+                sf = PackedShareFile(self.pack_store, storage_index, shnum)
+                self.lease_db.import_leases(storage_index, shnum,
+                                            sf.get_leases())
+
+    def finished_cycle(self, cycle):
+        log.msg(format="lease database imported in %(elapsed)d seconds",
+                elapsed=time.time() - self.state["current-cycle-start-time"],
+                facility="tahoe.storage", level=log.OPERATIONAL)
+        self.lease_db.mark_imported()
+        self.disownServiceParent()
@@ -53,20 +53,39 @@ class MutableShareFile:
     MAX_SIZE = MAX_MUTABLE_SHARE_SIZE
     # TODO: decide upon a policy for max share size
 
-    def __init__(self, filename, parent=None):
+    def __init__(self, filename, parent=None, metadata_cache=None):
         self.home = filename
-        if os.path.exists(self.home):
-            # we don't cache anything, just check the magic
+        # Without a MutableMetadataCache, every access reads the header from
+        # disk. With one, self._metadata holds the parsed header (and the
+        # number of extra leases, once we have read it), our own writes keep
+        # it current, and each completed modification is stored back into
+        # the cache.
+        self._metadata_cache = metadata_cache
+        self._metadata = None
+        if metadata_cache is not None:
+            self._metadata = metadata_cache.get(filename)
+        if self._metadata is None and os.path.exists(self.home):
+            # check the magic
             f = open(self.home, 'rb')
+            s = os.fstat(f.fileno())
             data = f.read(self.HEADER_SIZE)
+            f.close()
             (magic,
              write_enabler_nodeid, write_enabler,
-             data_length, extra_least_offset) = \
+             data_length, extra_lease_offset) = \
              struct.unpack(">32s20s32sQQ", data)
             if magic != self.MAGIC:
                 msg = "sharefile %s had magic '%r' but we wanted '%r'" % \
                       (filename, magic, self.MAGIC)
                 raise UnknownMutableContainerVersionError(msg)
+            if metadata_cache is not None:
+                self._metadata = {"write_enabler": write_enabler,
+                                  "write_enabler_nodeid": write_enabler_nodeid,
+                                  "data_length": data_length,
+                                  "extra_lease_offset": extra_lease_offset,
+                                  "num_extra_leases": None,
+                                  }
+                metadata_cache.put(filename, s, self._metadata)
         self.parent = parent # for logging
 
     def log(self, *args, **kwargs):
@@ -91,11 +110,33 @@ class MutableShareFile:
         f.write(struct.pack(">L", num_extra_leases))
         # extra leases go here, none at creation
         f.close()
+        if self._metadata_cache is not None:
+            self._metadata = {"write_enabler": write_enabler,
+                              "write_enabler_nodeid": my_nodeid,
+                              "data_length": data_length,
+                              "extra_lease_offset": extra_lease_offset,
+                              "num_extra_leases": num_extra_leases,
+                              }
+            self._store_metadata()
 
     def unlink(self):
+        if self._metadata_cache is not None:
+            self._metadata_cache.invalidate(self.home)
         os.unlink(self.home)
 
+    def _set_metadata(self, name, value):
+        if self._metadata is not None:
+            self._metadata[name] = value
+
+    def _store_metadata(self):
+        # called after a modification of the share file is complete
+        if self._metadata_cache is not None and self._metadata is not None:
+            self._metadata_cache.put(self.home, os.stat(self.home),
+                                     self._metadata)
+
     def _read_data_length(self, f):
+        if self._metadata is not None:
+            return self._metadata["data_length"]
         f.seek(self.DATA_LENGTH_OFFSET)
         (data_length,) = struct.unpack(">Q", f.read(8))
         return data_length
@@ -103,6 +144,7 @@ class MutableShareFile:
     def _write_data_length(self, f, data_length):
         f.seek(self.DATA_LENGTH_OFFSET)
         f.write(struct.pack(">Q", data_length))
+        self._set_metadata("data_length", data_length)
 
     def _read_share_data(self, f, offset, length):
         precondition(offset >= 0)
@@ -119,6 +161,8 @@ class MutableShareFile:
         return data
 
     def _read_extra_lease_offset(self, f):
+        if self._metadata is not None:
+            return self._metadata["extra_lease_offset"]
         f.seek(self.EXTRA_LEASE_OFFSET)
         (extra_lease_offset,) = struct.unpack(">Q", f.read(8))
         return extra_lease_offset
@@ -126,17 +170,23 @@ class MutableShareFile:
     def _write_extra_lease_offset(self, f, offset):
         f.seek(self.EXTRA_LEASE_OFFSET)
         f.write(struct.pack(">Q", offset))
+        self._set_metadata("extra_lease_offset", offset)
 
     def _read_num_extra_leases(self, f):
+        if (self._metadata is not None
+            and self._metadata["num_extra_leases"] is not None):
+            return self._metadata["num_extra_leases"]
         offset = self._read_extra_lease_offset(f)
         f.seek(offset)
         (num_extra_leases,) = struct.unpack(">L", f.read(4))
+        self._set_metadata("num_extra_leases", num_extra_leases)
         return num_extra_leases
 
     def _write_num_extra_leases(self, f, num_leases):
         extra_lease_offset = self._read_extra_lease_offset(f)
         f.seek(extra_lease_offset)
         f.write(struct.pack(">L", num_leases))
+        self._set_metadata("num_extra_leases", num_leases)
 
     def _change_container_size(self, f, new_container_size):
         if new_container_size > self.MAX_SIZE:
@@ -285,6 +335,7 @@ class MutableShareFile:
         else:
             self._write_lease_record(f, num_lease_slots, lease_info)
         f.close()
+        self._store_metadata()
 
     def renew_lease(self, renew_secret, new_expire_time):
         accepting_nodeids = set()
@@ -297,6 +348,7 @@ class MutableShareFile:
                     lease.expiration_time = new_expire_time
                     self._write_lease_record(f, leasenum, lease)
                 f.close()
+                self._store_metadata()
                 return
             accepting_nodeids.add(lease.nodeid)
         f.close()
@@ -347,6 +399,8 @@ class MutableShareFile:
             if not remaining:
                 freed_space += os.stat(self.home)[stat.ST_SIZE]
                 self.unlink()
+            else:
+                self._store_metadata()
             return freed_space
 
         msg = ("Unable to cancel non-existent lease. I have leases "
@@ -361,6 +415,9 @@ class MutableShareFile:
         return 0
 
     def _read_write_enabler_and_nodeid(self, f):
+        if self._metadata is not None:
+            return (self._metadata["write_enabler"],
+                    self._metadata["write_enabler_nodeid"])
         f.seek(0)
         data = f.read(self.HEADER_SIZE)
         (magic,
@@ -385,10 +442,14 @@ class MutableShareFile:
 #        return data_length
 
     def check_write_enabler(self, write_enabler, si_s):
-        f = open(self.home, 'rb+')
-        (real_write_enabler, write_enabler_nodeid) = \
-                             self._read_write_enabler_and_nodeid(f)
-        f.close()
+        if self._metadata is not None:
+            (real_write_enabler, write_enabler_nodeid) = \
+                                 self._read_write_enabler_and_nodeid(None)
+        else:
+            f = open(self.home, 'rb+')
+            (real_write_enabler, write_enabler_nodeid) = \
+                                 self._read_write_enabler_and_nodeid(f)
+            f.close()
         # avoid a timing attack
         #if write_enabler != real_write_enabler:
         if not timing_safe_compare(write_enabler, real_write_enabler):
@@ -426,6 +487,7 @@ class MutableShareFile:
                 # share data has shrunk, then call
                 # self._change_container_size() here.
         f.close()
+        self._store_metadata()
 
 def testv_compare(a, op, b):
     assert op in ("lt", "le", "eq", "ne", "ge", "gt")
@@ -454,9 +516,10 @@ class EmptyShare:
                 break
         return test_good
 
-def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent):
-    ms = MutableShareFile(filename, parent)
+def create_mutable_sharefile(filename, my_nodeid, write_enabler, parent,
+                             metadata_cache=None):
+    ms = MutableShareFile(filename, parent, metadata_cache)
     ms.create(my_nodeid, write_enabler)
     del ms
-    return MutableShareFile(filename, parent)
+    return MutableShareFile(filename, parent, metadata_cache)
 
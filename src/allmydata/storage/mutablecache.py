@@ -0,0 +1,80 @@
+import os, threading
+from collections import OrderedDict
+
+# Every slot_testv_and_readv_and_writev used to construct a new
+# MutableShareFile for each share in the slot, which re-read the container
+# header (write enabler, data length, lease offsets) from disk, often
+# several times per request. Dirnode-heavy workloads modify the same few
+# slots over and over, so the MutableMetadataCache remembers the parsed
+# header of recently-used mutable shares. An entry is only used while the
+# file's inode, size, and timestamps are unchanged, so a share modified by
+# anything that bypasses the cache is simply read again.
+
+DEFAULT_MAX_CACHED_SHARES = 1000
+
+def _stat_key(s):
+    return (s.st_ino, s.st_size, s.st_mtime, s.st_ctime)
+
+class MutableMetadataCache:
+    """I remember the container metadata of up to 'max_entries' mutable
+    share files, in least-recently-used order. The metadata is a dict
+    created and interpreted by MutableShareFile. I am used from the disk
+    I/O threads, so every method takes my lock."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_CACHED_SHARES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # filename -> (stat key, metadata)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, filename):
+        """Return a copy of the cached metadata for 'filename', or None if
+        there is none or the file has changed since it was cached."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(filename, None)
+            if entry is not None:
+                try:
+                    key = _stat_key(os.stat(filename))
+                except EnvironmentError:
+                    key = None
+                if key == entry[0]:
+                    self._entries[filename] = entry
+                    self.hits += 1
+                    return dict(entry[1])
+            self.misses += 1
+            return None
+        finally:
+            self._lock.release()
+
+    def put(self, filename, stat_result, metadata):
+        """Remember 'metadata' for 'filename', which is valid for as long as
+        the file still matches 'stat_result' (from os.stat or os.fstat,
+        taken before the metadata was read or after it was written)."""
+        if self.max_entries <= 0:
+            return
+        self._lock.acquire()
+        try:
+            self._entries.pop(filename, None)
+            self._entries[filename] = (_stat_key(stat_result), dict(metadata))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def invalidate(self, filename):
+        self._lock.acquire()
+        try:
+            self._entries.pop(filename, None)
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                }
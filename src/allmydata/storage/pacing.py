@@ -0,0 +1,124 @@
+import time
+from twisted.application import service
+from allmydata.stats import LoadMonitor
+from allmydata.util import log
+from allmydata.util.histogram import LatencyHistogram
+
+# The crawlers are limited to a fixed fraction of the CPU (or, with
+# CrawlerWorkers, to a fixed budget of thread time), which has to be set low
+# enough not to hurt clients when the server is at its busiest. Most of the
+# time it is not, and the crawlers could go much faster; and when it is, even
+# the fixed fraction can be too much. The CrawlerPacer watches how the
+# server is doing for its clients -- the recent latency of their share
+# reads and writes, and how late the reactor runs its timers (as measured by
+# a LoadMonitor) -- and scales the speed of every crawler on the server by
+# a factor: it halves the factor whenever the server looks busy, grows it
+# back towards normal while clients are being served well, and lets the
+# crawlers go faster than normal while no clients are using the server at
+# all.
+
+DEFAULT_MAX_CLIENT_LATENCY = 0.1 # seconds, at the 90th percentile
+DEFAULT_MAX_REACTOR_DELAY = 0.05 # seconds, on average
+
+# the operations whose latency the clients notice
+CLIENT_CATEGORIES = ["allocate", "write", "close", "read", "get",
+                     "writev", "readv"]
+
+class CrawlerPacer(service.MultiService):
+    """I tell a StorageServer's crawlers how fast to go, as a factor of
+    their normal speed, between 'min_factor' and 'max_factor'. I make a new
+    decision at most once every 'update_interval' seconds, from the client
+    latencies of the last 'latency_window' seconds and the reactor delays
+    of the last 'delay_samples' seconds. If the node does not give me a
+    LoadMonitor, I run my own."""
+
+    name = "crawler-pacer"
+    min_factor = 0.1
+    max_factor = 5.0
+    update_interval = 10
+    latency_window = 120
+    delay_samples = 10
+
+    def __init__(self, server, max_latency=DEFAULT_MAX_CLIENT_LATENCY,
+                 max_reactor_delay=DEFAULT_MAX_REACTOR_DELAY,
+                 load_monitor=None, clock=time.time):
+        service.MultiService.__init__(self)
+        self.server = server
+        self.max_latency = max_latency
+        self.max_reactor_delay = max_reactor_delay
+        if load_monitor is None:
+            load_monitor = LoadMonitor(None)
+            load_monitor.setServiceParent(self)
+        self.load_monitor = load_monitor
+        self.clock = clock
+        self.factor = 1.0
+        self.reason = "no decision yet"
+        self.client_latency = None
+        self.client_operations = 0
+        self.reactor_delay = None
+        self.last_update = None
+
+    def get_factor(self):
+        now = self.clock()
+        if (self.last_update is None
+            or now - self.last_update >= self.update_interval):
+            self.update(now)
+        return self.factor
+
+    def _get_client_latency(self):
+        # returns (operations, 90th percentile latency or None)
+        h = LatencyHistogram()
+        for category in CLIENT_CATEGORIES:
+            window = self.server.latencies[category]
+            h.merge(window.get_window(self.latency_window))
+        if not h.count:
+            return (0, None)
+        return (h.count, h.get_percentile(0.9))
+
+    def _get_reactor_delay(self):
+        samples = list(self.load_monitor.stats)[-self.delay_samples:]
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+
+    def update(self, now):
+        self.last_update = now
+        (count, latency) = self._get_client_latency()
+        delay = self._get_reactor_delay()
+        self.client_operations = count
+        self.client_latency = latency
+        self.reactor_delay = delay
+        old_factor = self.factor
+        if delay is not None and delay > self.max_reactor_delay:
+            self.factor = max(self.min_factor, self.factor / 2)
+            self.reason = "backing off: reactor delay %.0fms" % (delay * 1000)
+        elif latency is not None and latency > self.max_latency:
+            self.factor = max(self.min_factor, self.factor / 2)
+            self.reason = ("backing off: client latency %.0fms"
+                           % (latency * 1000))
+        elif count == 0:
+            self.factor = min(self.max_factor, self.factor * 1.5)
+            self.reason = "speeding up: no client operations"
+        else:
+            # clients are being served well: recover from any backing off,
+            # but do not compete with them
+            self.factor = min(1.0, self.factor * 1.5)
+            self.reason = ("clients served well: client latency %.0fms"
+                           % (latency * 1000))
+        if self.factor != old_factor:
+            log.msg(format="crawler pace now %(factor).2f (%(reason)s)",
+                    factor=self.factor, reason=self.reason,
+                    facility="tahoe.storage", level=log.NOISY)
+
+    def get_status(self):
+        return {"factor": self.factor,
+                "reason": self.reason,
+                "client-operations": self.client_operations,
+                "client-latency": self.client_latency,
+                "reactor-delay": self.reactor_delay,
+                }
+
+    def get_stats(self):
+        return {"factor": self.factor,
+                "client_operations": self.client_operations,
+                }
@@ -0,0 +1,470 @@
+import os, struct, threading, errno
+
+from allmydata.storage.common import si_b2a, si_a2b, \
+     UnknownImmutableContainerVersionError
+from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.fdcache import OpenFileCache, DEFAULT_MAX_OPEN_FILES
+from allmydata.storage.shareindex import _locked
+from allmydata.util import fileutil
+from allmydata.util.assertutil import precondition
+from allmydata.util.dbutil import get_db
+from allmydata.util.hashutil import timing_safe_compare
+
+# Every share used to be a file of its own, in a bucket directory of its
+# own. Directories and small mutable files produce millions of immutable
+# shares of a few kilobytes, each of which costs an inode, a directory
+# entry, and (usually) a mostly-empty filesystem block. When packing is
+# enabled, the StorageServer moves small immutable shares into a PackStore
+# instead of into shares/ when their upload is closed. A PackStore is a
+# directory (storage/packs/) of append-only pack files and an sqlite index
+# that records where each share lives. Each share is stored in a record
+# that holds the complete immutable container (the same bytes that a
+# ShareFile would hold, leases included), so lease renewals can be written
+# in place. Changes that alter the size of a container append a new record,
+# and records whose share has been deleted are left behind as dead space:
+# compact() rewrites the pack files which are mostly dead, which the lease
+# checker does after it has expired leases.
+
+# Each record in a pack file is a 36-byte header followed by the container:
+#  0x00: magic, 8 bytes
+#  0x08: storage index, 16 bytes
+#  0x18: share number, 4 bytes big-endian
+#  0x1c: container length, 8 bytes big-endian
+# The headers are not needed to serve shares, but they allow a pack file to
+# be examined (or its index rebuilt) without the database.
+
+PACK_RECORD_MAGIC = "TahoePk1"
+PACK_RECORD_HEADER = ">8s16sLQ"
+PACK_RECORD_HEADER_SIZE = struct.calcsize(PACK_RECORD_HEADER)
+
+# a pack file is not appended to once it is larger than this
+MAX_PACK_SIZE = 64*1024*1024
+# compact() rewrites packs in which at least this fraction is dead
+COMPACTION_THRESHOLD = 0.5
+# at most this many pack files are held open for reading
+DEFAULT_MAX_OPEN_PACKS = min(20, DEFAULT_MAX_OPEN_FILES)
+
+PACK_INDEX_SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE packed_shares
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32(storage_index)
+ shnum INTEGER NOT NULL,
+ pack INTEGER NOT NULL,              -- number of the pack file
+ offset INTEGER NOT NULL,            -- of the container, after the header
+ length INTEGER NOT NULL,            -- of the container
+ data_length INTEGER NOT NULL,       -- of the share data in the container
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE INDEX packed_shares_by_pack ON packed_shares (pack);
+
+CREATE TABLE packs
+(
+ pack INTEGER PRIMARY KEY,
+ live_bytes INTEGER NOT NULL -- records of shares which still exist
+);
+"""
+
+IMMUTABLE_HEADER = ">LLL"
+IMMUTABLE_HEADER_SIZE = struct.calcsize(IMMUTABLE_HEADER)
+LEASE_SIZE = struct.calcsize(">L32s32sL")
+
+def parse_container(container):
+    """Split the bytes of an immutable share container into
+    (share data, list of LeaseInfo, the header's data length field)."""
+    (version, length_field, num_leases) = \
+              struct.unpack(IMMUTABLE_HEADER, container[:IMMUTABLE_HEADER_SIZE])
+    if version != 1:
+        msg = "packed share had version %d but we wanted 1" % version
+        raise UnknownImmutableContainerVersionError(msg)
+    lease_offset = len(container) - num_leases * LEASE_SIZE
+    data = container[IMMUTABLE_HEADER_SIZE:lease_offset]
+    leases = []
+    for i in range(num_leases):
+        start = lease_offset + i * LEASE_SIZE
+        leases.append(LeaseInfo().from_immutable_data(
+            container[start:start+LEASE_SIZE]))
+    return (data, leases, length_field)
+
+def build_container(data, leases, length_field):
+    return "".join([struct.pack(IMMUTABLE_HEADER, 1, length_field, len(leases)),
+                    data] +
+                   [lease.to_immutable_data() for lease in leases])
+
+
+class PackStore:
+    """I hold small immutable shares in append-only pack files, with an
+    sqlite index that maps (storage index, share number) to a record in one
+    of them. My methods may be called from the storage server's disk I/O
+    threads as well as from the reactor thread. Only the pack that is being
+    appended to is always open: the others are read through an
+    OpenFileCache of at most 'max_open_packs' files.
+    """
+
+    def __init__(self, packdir, max_pack_size=MAX_PACK_SIZE,
+                 max_open_packs=DEFAULT_MAX_OPEN_PACKS):
+        self.packdir = packdir
+        self.max_pack_size = max_pack_size
+        fileutil.make_dirs(packdir)
+        dbfile = os.path.join(packdir, "index.sqlite")
+        # unlike the share index, this database is the only record of where
+        # the shares are, so every commit must reach the disk
+        (self._sqlite, self._db) = get_db(dbfile,
+                                          create_version=(PACK_INDEX_SCHEMA_v1, 1),
+                                          dbname="pack index",
+                                          journal_mode="WAL",
+                                          synchronous="FULL",
+                                          check_same_thread=False)
+        self._lock = threading.Lock()
+        self._cursor = self._db.cursor()
+        self._reads = OpenFileCache(max_open_packs)
+        # the pack that is being appended to, and its open file
+        self._writer_pack = None
+        self._writer = None
+        self._sizes = {} # pack number -> size of the pack file
+        self._cursor.execute("SELECT MAX(pack) FROM packs")
+        current = self._cursor.fetchone()[0]
+        if current is None:
+            current = self._new_pack(0)
+        self._current = current
+        self.compactions = 0
+
+    def _pack_filename(self, pack):
+        return os.path.join(self.packdir, "pack-%08d" % pack)
+
+    def _new_pack(self, pack):
+        self._cursor.execute("INSERT INTO packs VALUES (?,0)", (pack,))
+        self._db.commit()
+        return pack
+
+    def _pack_size(self, pack):
+        if pack not in self._sizes:
+            try:
+                size = os.path.getsize(self._pack_filename(pack))
+            except EnvironmentError:
+                size = 0 # nothing has been appended to it yet
+            self._sizes[pack] = size
+        return self._sizes[pack]
+
+    def _read(self, pack, offset, length):
+        return self._reads.pread(self._pack_filename(pack), offset, length)
+
+    def _sync_writer(self):
+        if self._writer is not None:
+            self._writer.flush()
+            os.fsync(self._writer.fileno())
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._sync_writer()
+            self._writer.close()
+            self._writer = None
+            self._writer_pack = None
+
+    def _lookup(self, storage_index, shnum):
+        self._cursor.execute("SELECT pack, offset, length, data_length"
+                             " FROM packed_shares"
+                             " WHERE storage_index=? AND shnum=?",
+                             (si_b2a(storage_index), shnum))
+        row = self._cursor.fetchone()
+        if row is None:
+            # the same error that opening a missing share file would raise
+            raise IOError(errno.ENOENT, "no packed share %s/%d"
+                          % (si_b2a(storage_index), shnum))
+        return row
+
+    def _append(self, storage_index, shnum, container, sync=True):
+        # returns (pack, offset) of the container, without committing. With
+        # sync=False the caller must call _sync_writer() before committing.
+        if self._pack_size(self._current) >= self.max_pack_size:
+            self._current = self._new_pack(self._current + 1)
+        pack = self._current
+        if self._writer_pack != pack:
+            self._close_writer()
+            self._writer = open(self._pack_filename(pack), "ab")
+            self._writer_pack = pack
+        size = self._pack_size(pack)
+        try:
+            self._writer.write(struct.pack(PACK_RECORD_HEADER,
+                                           PACK_RECORD_MAGIC, storage_index,
+                                           shnum, len(container)))
+            self._writer.write(container)
+            if sync:
+                self._sync_writer()
+            else:
+                self._writer.flush()
+        except EnvironmentError:
+            # we no longer know how much of the record was written
+            del self._sizes[pack]
+            raise
+        self._sizes[pack] = size + PACK_RECORD_HEADER_SIZE + len(container)
+        return (pack, size + PACK_RECORD_HEADER_SIZE)
+
+    def _add_live(self, pack, delta):
+        self._cursor.execute("UPDATE packs SET live_bytes=live_bytes+?"
+                             " WHERE pack=?", (delta, pack))
+
+    def _store(self, storage_index, shnum, container, sync=True):
+        (pack, offset) = self._append(storage_index, shnum, container, sync)
+        (data, leases, length_field) = parse_container(container)
+        self._cursor.execute("INSERT OR REPLACE INTO packed_shares"
+                             " VALUES (?,?,?,?,?,?)",
+                             (si_b2a(storage_index), shnum, pack, offset,
+                              len(container), len(data)))
+        self._add_live(pack, PACK_RECORD_HEADER_SIZE + len(container))
+
+    def _forget(self, storage_index, shnum):
+        (pack, offset, length, data_length) = self._lookup(storage_index,
+                                                           shnum)
+        self._cursor.execute("DELETE FROM packed_shares"
+                             " WHERE storage_index=? AND shnum=?",
+                             (si_b2a(storage_index), shnum))
+        self._add_live(pack, -(PACK_RECORD_HEADER_SIZE + length))
+
+    @_locked
+    def add_share(self, storage_index, shnum, container):
+        """Store 'container' (the contents of an immutable share file) as
+        share 'shnum' of 'storage_index', replacing any previous copy."""
+        try:
+            self._forget(storage_index, shnum)
+        except EnvironmentError:
+            pass
+        self._store(storage_index, shnum, container)
+        self._db.commit()
+
+    @_locked
+    def get_shares(self, storage_index):
+        """Return a sorted list of the share numbers held for
+        'storage_index'."""
+        self._cursor.execute("SELECT shnum FROM packed_shares"
+                             " WHERE storage_index=? ORDER BY shnum",
+                             (si_b2a(storage_index),))
+        return [shnum for (shnum,) in self._cursor.fetchall()]
+
+    @_locked
+    def has_shares(self):
+        self._cursor.execute("SELECT 1 FROM packed_shares LIMIT 1")
+        return self._cursor.fetchone() is not None
+
+    @_locked
+    def get_storage_indexes_with_prefix(self, prefix):
+        """Return a set of base32 storage index strings which start with
+        the given two-character prefix."""
+        self._cursor.execute("SELECT DISTINCT storage_index FROM packed_shares"
+                             " WHERE storage_index >= ? AND storage_index < ?",
+                             (prefix, prefix + "~"))
+        return set([str(row[0]) for row in self._cursor.fetchall()])
+
+    @_locked
+    def read_share_data(self, storage_index, shnum, offset, length):
+        """Read share data, like ShareFile.read_share_data(). Like every
+        method that takes a share number, this raises IOError(ENOENT) if the
+        share is not here."""
+        (pack, record_offset, record_length, data_length) = \
+               self._lookup(storage_index, shnum)
+        actuallength = max(0, min(length, data_length - offset))
+        if actuallength == 0:
+            return ""
+        return self._read(pack, record_offset + IMMUTABLE_HEADER_SIZE + offset,
+                          actuallength)
+
+    @_locked
+    def get_container(self, storage_index, shnum):
+        (pack, offset, length, data_length) = self._lookup(storage_index,
+                                                           shnum)
+        return self._read(pack, offset, length)
+
+    @_locked
+    def update(self, storage_index, shnum, modify):
+        """Call modify(container) with the current contents of the share,
+        which must return (new_container, result). If new_container is None
+        the share is deleted, and if it has the same length as before it is
+        written in place. Returns 'result'."""
+        (pack, offset, length, data_length) = self._lookup(storage_index,
+                                                           shnum)
+        (new_container, result) = modify(self._read(pack, offset, length))
+        if new_container is None:
+            self._forget(storage_index, shnum)
+        elif len(new_container) == length:
+            if pack == self._writer_pack:
+                # this one is buffered
+                self._writer.flush()
+            f = open(self._pack_filename(pack), "rb+")
+            try:
+                f.seek(offset)
+                f.write(new_container)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+        else:
+            self._forget(storage_index, shnum)
+            self._store(storage_index, shnum, new_container)
+        self._db.commit()
+        return result
+
+    def compact(self, threshold=COMPACTION_THRESHOLD):
+        """Rewrite every pack file in which at least 'threshold' of the
+        space is taken by records of deleted shares, and remove the old
+        files. Returns the number of bytes reclaimed. This copies data and
+        waits for the disk, so the lease checker runs it in a disk I/O
+        thread. Other operations only wait for one pack at a time."""
+        reclaimed = 0
+        for pack in self._get_packs():
+            reclaimed += self._compact_pack(pack, threshold)
+        return reclaimed
+
+    @_locked
+    def _get_packs(self):
+        self._cursor.execute("SELECT pack FROM packs")
+        return [pack for (pack,) in self._cursor.fetchall()]
+
+    @_locked
+    def _compact_pack(self, pack, threshold):
+        self._cursor.execute("SELECT live_bytes FROM packs WHERE pack=?",
+                             (pack,))
+        row = self._cursor.fetchone()
+        if row is None:
+            return 0
+        (live_bytes,) = row
+        size = self._pack_size(pack)
+        if not size or size - live_bytes < threshold * size:
+            return 0
+        if pack == self._current:
+            # the live records must be copied somewhere else
+            self._current = self._new_pack(self._current + 1)
+        self._cursor.execute("SELECT storage_index, shnum, offset, length"
+                             " FROM packed_shares WHERE pack=?", (pack,))
+        for (si_s, shnum, offset, length) in self._cursor.fetchall():
+            container = self._read(pack, offset, length)
+            storage_index = si_a2b(str(si_s))
+            self._forget(storage_index, shnum)
+            # the copies reach the disk together, before the index points
+            # at them
+            self._store(storage_index, shnum, container, sync=False)
+        self._sync_writer()
+        self._cursor.execute("DELETE FROM packs WHERE pack=?", (pack,))
+        self._db.commit()
+        if pack == self._writer_pack:
+            self._close_writer()
+        filename = self._pack_filename(pack)
+        self._reads.invalidate(filename)
+        self._sizes.pop(pack, None)
+        os.unlink(filename)
+        self.compactions += 1
+        return size - live_bytes
+
+    @_locked
+    def get_stats(self):
+        self._cursor.execute("SELECT COUNT(*) FROM packed_shares")
+        (shares,) = self._cursor.fetchone()
+        self._cursor.execute("SELECT pack, live_bytes FROM packs")
+        packs = self._cursor.fetchall()
+        live = sum([live_bytes for (pack, live_bytes) in packs])
+        total = sum([self._pack_size(pack) for (pack, live_bytes) in packs])
+        return {"shares": shares,
+                "packs": len(packs),
+                "live_bytes": live,
+                "dead_bytes": total - live,
+                "compactions": self.compactions,
+                }
+
+    @_locked
+    def close(self):
+        if self._db is None:
+            return
+        self._close_writer()
+        self._reads.close_all()
+        self._db.close()
+        self._db = None
+
+
+class PackedShareFile:
+    """I provide the ShareFile interface for an immutable share that is
+    held in a PackStore. I look the share up again for every operation, so I
+    keep working when compaction moves it."""
+    LEASE_SIZE = LEASE_SIZE
+    sharetype = "immutable"
+
+    def __init__(self, pack_store, storage_index, shnum):
+        self._pack_store = pack_store
+        self.storage_index = storage_index
+        self.shnum = shnum
+        # for log messages
+        self.home = "%s:%s/%d" % (pack_store.packdir, si_b2a(storage_index),
+                                  shnum)
+
+    def get_size(self):
+        return len(self._pack_store.get_container(self.storage_index,
+                                                  self.shnum))
+
+    def read_share_data(self, offset, length):
+        precondition(offset >= 0)
+        return self._pack_store.read_share_data(self.storage_index, self.shnum,
+                                                offset, length)
+
+    def get_leases(self):
+        container = self._pack_store.get_container(self.storage_index,
+                                                   self.shnum)
+        (data, leases, length_field) = parse_container(container)
+        return iter(leases)
+
+    def _update_leases(self, modify):
+        # modify(leases) returns (new list of leases, or None, result)
+        def _modify(container):
+            (data, leases, length_field) = parse_container(container)
+            (leases, result) = modify(leases)
+            if leases is None:
+                return (None, result)
+            return (build_container(data, leases, length_field), result)
+        return self._pack_store.update(self.storage_index, self.shnum, _modify)
+
+    def unlink(self):
+        self._update_leases(lambda leases: (None, None))
+
+    def add_lease(self, lease_info):
+        self._update_leases(lambda leases: (leases + [lease_info], None))
+
+    def renew_lease(self, renew_secret, new_expire_time):
+        def _renew(leases):
+            for lease in leases:
+                if timing_safe_compare(lease.renew_secret, renew_secret):
+                    if new_expire_time > lease.expiration_time:
+                        lease.expiration_time = new_expire_time
+                    return (leases, None)
+            raise IndexError("unable to renew non-existent lease")
+        self._update_leases(_renew)
+
+    def add_or_renew_lease(self, lease_info):
+        try:
+            self.renew_lease(lease_info.renew_secret,
+                             lease_info.expiration_time)
+        except IndexError:
+            self.add_lease(lease_info)
+
+    def cancel_lease(self, cancel_secret):
+        """Remove a lease with the given cancel_secret, like
+        ShareFile.cancel_lease(). If the last lease is cancelled, the share
+        is removed from the pack (its space is reclaimed by compaction).
+        Returns the number of bytes that were freed."""
+        def _cancel(leases):
+            remaining = [l for l in leases
+                         if not timing_safe_compare(l.cancel_secret,
+                                                    cancel_secret)]
+            removed = len(leases) - len(remaining)
+            if not removed:
+                raise IndexError("unable to find matching lease to cancel")
+            if not remaining:
+                return (None, None)
+            return (remaining, self.LEASE_SIZE * removed)
+        size = self.get_size()
+        freed = self._update_leases(_cancel)
+        if freed is None:
+            # the share is gone
+            freed = PACK_RECORD_HEADER_SIZE + size
+        return freed
@@ -0,0 +1,254 @@
+from collections import deque
+
+from twisted.internet import defer
+
+# The storage server used to start every request as soon as it arrived, so
+# a single client uploading a large tree could fill the disk queues with
+# remote_write calls and make every other client's reads wait behind them.
+# The IOScheduler admits requests before they are given to the disk. At
+# most 'max_outstanding' admitted requests may be unfinished at once; when
+# there are more, reads are admitted before mutable writes, and mutable
+# writes before immutable uploads. Clients that can be identified (an
+# uploader's tub ID is known from the canary it passes to allocate_buckets)
+# also get a token bucket, which limits how many requests per second they
+# can have admitted, and the clients within a priority class take turns.
+#
+# Requests that are given a key (the storage index, for mutable slot
+# operations) are admitted in the order in which they arrived, whatever
+# their priority: a slot_readv must not overtake an earlier writev on the
+# same slot. Each one only waits for the one before it to be admitted and
+# handed to its DiskQueue, which keeps requests with equal keys in order
+# from then on.
+
+READ, MUTABLE_WRITE, IMMUTABLE_WRITE = range(3)
+PRIORITY_NAMES = {READ: "read",
+                  MUTABLE_WRITE: "mutable_write",
+                  IMMUTABLE_WRITE: "immutable_write",
+                  }
+
+DEFAULT_CLIENT_REQUEST_RATE = 100 # requests per second
+DEFAULT_CLIENT_REQUEST_BURST = 200
+DEFAULT_MAX_OUTSTANDING_REQUESTS = 20
+
+# once we know about this many clients, the idle ones are forgotten
+MAX_IDLE_CLIENTS = 1000
+
+class TokenBucket:
+    """I hold up to 'burst' tokens, and gain 'rate' of them per second."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def _refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self, now):
+        """Take a token if I have one, and return 0. Otherwise return the
+        number of seconds until I will have one."""
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class IOScheduler:
+    """I decide when each storage server request may go to the disk.
+
+    admit() returns a Deferred that fires when the request may start, and
+    the caller must call release() when it has finished. If the request was
+    admitted with a key, the caller must also call handed_off() once it has
+    given the request to the disk. Requests from the client None are not
+    rate-limited. client_request_rate=0 turns off the per-client limits
+    altogether. My methods must be called from the reactor thread.
+    """
+
+    def __init__(self, client_request_rate=DEFAULT_CLIENT_REQUEST_RATE,
+                 client_request_burst=DEFAULT_CLIENT_REQUEST_BURST,
+                 max_outstanding=DEFAULT_MAX_OUTSTANDING_REQUESTS,
+                 clock=None):
+        assert max_outstanding > 0, max_outstanding
+        self.client_request_rate = client_request_rate
+        self.client_request_burst = max(1, client_request_burst)
+        self.max_outstanding = max_outstanding
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._clock = clock
+        self.outstanding = 0
+        # for each priority class, the clients with queued requests in the
+        # order in which they will be served, and client -> deque of
+        # [Deferred, throttled] for their requests
+        self._turns = dict([(p, deque()) for p in PRIORITY_NAMES])
+        self._pending = dict([(p, {}) for p in PRIORITY_NAMES])
+        self._buckets = {} # client -> TokenBucket
+        # key -> deque of (Deferred, priority, client_id) for the requests
+        # that wait for an earlier request with this key to be handed off
+        self._keyed = {}
+        self._timer = None
+        self._dispatching = False
+        self.admitted = 0
+        self.throttled = 0
+
+    def admit(self, priority, client_id=None, key=None):
+        d = defer.Deferred()
+        if key is not None:
+            if key in self._keyed:
+                self._keyed[key].append((d, priority, client_id))
+                return d
+            self._keyed[key] = deque()
+        self._enqueue(d, priority, client_id)
+        return d
+
+    def handed_off(self, key):
+        """Record that the request that was admitted with 'key' has been
+        given to the disk, so the next request with that key may be
+        admitted."""
+        if key is None:
+            return
+        waiting = self._keyed[key]
+        if waiting:
+            self._enqueue(*waiting.popleft())
+        else:
+            del self._keyed[key]
+
+    def _enqueue(self, d, priority, client_id):
+        pending = self._pending[priority]
+        if client_id not in pending:
+            pending[client_id] = deque()
+            self._turns[priority].append(client_id)
+        pending[client_id].append([d, False])
+        self._dispatch()
+
+    def release(self, res=None):
+        """Record that an admitted request has finished. I return 'res', so
+        that I can be added to the request's Deferred chain."""
+        self.outstanding -= 1
+        self._dispatch()
+        return res
+
+    def _dispatch(self):
+        # a request that runs synchronously is released from within
+        # d.callback(), and the loop below will then admit the next one
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            while self.outstanding < self.max_outstanding:
+                (d, delay) = self._next_request()
+                if d is None:
+                    if delay is not None and self._timer is None:
+                        self._timer = self._clock.callLater(delay, self._wake)
+                    return
+                self.outstanding += 1
+                self.admitted += 1
+                d.callback(None)
+        finally:
+            self._dispatching = False
+
+    def _wake(self):
+        self._timer = None
+        self._dispatch()
+
+    def _next_request(self):
+        """Returns (Deferred, None) for the request that should be admitted
+        next. If there is none, returns (None, delay), where delay is the
+        number of seconds until a throttled client may continue, or None if
+        nothing is throttled."""
+        now = self._clock.seconds()
+        min_delay = None
+        for priority in sorted(PRIORITY_NAMES):
+            turns = self._turns[priority]
+            pending = self._pending[priority]
+            for i in range(len(turns)):
+                client_id = turns[0]
+                turns.rotate(-1)
+                request = pending[client_id][0]
+                delay = self._take_token(client_id, now)
+                if delay:
+                    if not request[1]:
+                        request[1] = True
+                        self.throttled += 1
+                    if min_delay is None or delay < min_delay:
+                        min_delay = delay
+                    continue
+                pending[client_id].popleft()
+                if not pending[client_id]:
+                    del pending[client_id]
+                    turns.remove(client_id)
+                return (request[0], None)
+        return (None, min_delay)
+
+    def _take_token(self, client_id, now):
+        if client_id is None or not self.client_request_rate:
+            return 0
+        if client_id not in self._buckets:
+            if len(self._buckets) >= MAX_IDLE_CLIENTS:
+                self._forget_idle_clients(now)
+            self._buckets[client_id] = TokenBucket(self.client_request_rate,
+                                                   self.client_request_burst,
+                                                   now)
+        return self._buckets[client_id].take(now)
+
+    def _forget_idle_clients(self, now):
+        # a client whose bucket has refilled would get a new, full one anyway
+        for client_id, bucket in self._buckets.items():
+            if bucket.is_full(now):
+                del self._buckets[client_id]
+
+    def get_stats(self):
+        stats = {"outstanding": self.outstanding,
+                 "admitted": self.admitted,
+                 "throttled": self.throttled,
+                 "clients": len(self._buckets),
+                 "waiting_for_key": sum([len(w) for w in
+                                         self._keyed.values()]),
+                 }
+        for priority, name in PRIORITY_NAMES.items():
+            stats["queued.%s" % name] = sum([len(q) for q in
+                                             self._pending[priority].values()])
+        return stats
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+class ScheduledDiskQueue:
+    """I look like a DiskQueue (or SynchronousDiskIO), but I only hand each
+    operation to the disk once the IOScheduler has admitted it."""
+
+    def __init__(self, scheduler, disk, priority, client_id=None):
+        self._scheduler = scheduler
+        self._disk = disk
+        self._priority = priority
+        self._client_id = client_id
+
+    def call(self, key, then, f, *args, **kwargs):
+        return self._call(key, self._disk.call, key, then, f, *args, **kwargs)
+
+    def call_with_cleanup(self, key, then, cleanup, f, *args, **kwargs):
+        return self._call(key, self._disk.call_with_cleanup, key, then,
+                          cleanup, f, *args, **kwargs)
+
+    def _call(self, key, submit, *args, **kwargs):
+        d = self._scheduler.admit(self._priority, self._client_id, key)
+        def _admitted(ign):
+            try:
+                return submit(*args, **kwargs)
+            finally:
+                self._scheduler.handed_off(key)
+        d.addCallback(_admitted)
+        d.addBoth(self._scheduler.release)
+        return d
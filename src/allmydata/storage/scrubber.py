@@ -0,0 +1,264 @@
+import os, time, errno
+from twisted.internet import defer
+from allmydata import hashtree, uri
+from allmydata.immutable.layout import ReadBucketProxy
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.shares import get_share_file
+from allmydata.storage.pack import PackedShareFile
+from allmydata.storage.common import si_a2b
+from allmydata.util import log, mathutil
+from allmydata.util.deferredutil import result_of_fired
+from allmydata.util.hashutil import block_hash
+
+# The only way to find shares that have rotted on disk used to be a client's
+# 'tahoe deep-check --verify', which downloads every block of every share
+# over the network to check its hashes. The ShareScrubber does the same
+# checks on the server itself, reading each immutable share from local disk
+# (at the slow pace of a crawler, so it costs disk bandwidth on the server
+# instead of bandwidth between the client and the server), and writes a
+# corruption advisory, just as a client would, for each share that fails
+# them.
+#
+# A share is parsed with the ReadBucketProxy that downloaders use (reading
+# through a local stand-in for the remote bucket), so the scrubber and the
+# downloader agree about the share layout. Each block is hashed and checked
+# against the block hash tree stored in the share, and the root of that tree
+# against the share hash chain, up to the share_root_hash in the URI
+# extension block. The server does not know the verify-cap, so it cannot
+# check the URI extension block itself, nor the ciphertext hashes: damage to
+# those is only found by a client. Mutable shares are not checked.
+
+class LocalBucket:
+    """I stand in for the remote bucket that a ReadBucketProxy reads from,
+    and read from a local share instead. My Deferreds have fired before they
+    are returned."""
+
+    def __init__(self, sf):
+        self._sf = sf
+
+    def callRemote(self, methname, *args, **kwargs):
+        meth = getattr(self, "remote_" + methname)
+        return defer.maybeDeferred(meth, *args, **kwargs)
+
+    def remote_read(self, offset, length):
+        return self._sf.read_share_data(offset, length)
+
+class CorruptShare(Exception):
+    pass
+
+class ShareScrubber(ShareCrawler):
+    """I read every immutable share on the server, check its blocks against
+    its block hash tree and share hash chain, and write a corruption
+    advisory for each share that fails. I keep these keys in my state:
+
+     cycle-to-date:
+      examined-shares, examined-bytes
+      corrupt-shares (list of (si_b32, shnum) tuples)
+     last-complete-cycle: the cycle-to-date values of the last complete
+                          cycle, plus cycle-start-finish-times, or None
+
+    If the server has CrawlerWorkers, shares are read and checked in the
+    workers' threads.
+    """
+
+    slow_start = 15*60 # wait 15 minutes after startup
+    allowed_cpu_percentage = .05
+    minimum_cycle_time = 30*24*60*60 # not more than once a month
+    examine_in_threads = True
+
+    def __init__(self, server, statefile):
+        ShareCrawler.__init__(self, server, statefile)
+        self.advisories_written = 0
+
+    def add_initial_state(self):
+        self.state.setdefault("cycle-to-date", self.create_empty_cycle_dict())
+        self.state.setdefault("last-complete-cycle", None)
+
+    def create_empty_cycle_dict(self):
+        return {"examined-shares": 0,
+                "examined-bytes": 0,
+                "corrupt-shares": [],
+                }
+
+    def started_cycle(self, cycle):
+        self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        results = self.scrub_bucket(prefixdir, storage_index_b32)
+        self.record_results(storage_index_b32, results)
+
+    def examine_prefix(self, cycle, prefix, prefixdir, buckets, elsewhere):
+        # this runs in a worker thread
+        return [(bucket,
+                 self.scrub_bucket(elsewhere.get(bucket, prefixdir), bucket))
+                for bucket in buckets]
+
+    def process_prefix_result(self, cycle, prefix, result):
+        for (storage_index_b32, results) in result:
+            self.record_results(storage_index_b32, results)
+
+    def scrub_bucket(self, prefixdir, storage_index_b32):
+        """Check the immutable shares of a bucket. Returns a list of
+        (shnum, size, reason) for each of them, where 'reason' is None for
+        good shares. This may be run in a worker thread."""
+        results = []
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        try:
+            filenames = os.listdir(bucketdir)
+        except EnvironmentError:
+            # all of this bucket's shares are in pack files
+            filenames = []
+        storage_index = si_a2b(storage_index_b32)
+        for fn in filenames:
+            try:
+                shnum = int(fn)
+            except ValueError:
+                continue # non-numeric means not a sharefile
+            sharefile = os.path.join(bucketdir, fn)
+            try:
+                sf = get_share_file(sharefile)
+            except EnvironmentError, e:
+                if e.errno == errno.ENOENT:
+                    continue # deleted while we were looking
+                results.append((shnum, 0, "unable to read share: %s" % (e,)))
+                continue
+            except Exception, e:
+                results.append((shnum, 0, "unable to parse share container:"
+                                " %s" % (e,)))
+                continue
+            if sf.sharetype != "immutable":
+                continue
+            results.append(self.scrub_share(sf, storage_index, shnum))
+        if self.pack_store is not None:
+            for shnum in self.pack_store.get_shares(storage_index):
+                sf = PackedShareFile(self.pack_store, storage_index, shnum)
+                results.append(self.scrub_share(sf, storage_index, shnum))
+        return [r for r in results if r is not None]
+
+    def scrub_share(self, sf, storage_index, shnum):
+        """Check one immutable share. Returns (shnum, bytes read, reason),
+        or None if the share was deleted before it could be read."""
+        reader = ShareChecker(sf, storage_index, shnum)
+        try:
+            reader.check()
+        except EnvironmentError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            return (shnum, reader.bytes_read, "unable to read share: %s" % (e,))
+        except CorruptShare, e:
+            return (shnum, reader.bytes_read, str(e))
+        except Exception, e:
+            return (shnum, reader.bytes_read,
+                    "unable to parse share: %s: %s" % (e.__class__.__name__, e))
+        return (shnum, reader.bytes_read, None)
+
+    def record_results(self, storage_index_b32, results):
+        so_far = self.state["cycle-to-date"]
+        for (shnum, size, reason) in results:
+            so_far["examined-shares"] += 1
+            so_far["examined-bytes"] += size
+            if reason is None:
+                continue
+            so_far["corrupt-shares"].append((storage_index_b32, shnum))
+            log.msg(format=("share scrubber found corruption in (immutable) "
+                            "%(si)s-%(shnum)d: %(reason)s"),
+                    si=storage_index_b32, shnum=shnum, reason=reason,
+                    facility="tahoe.storage", level=log.SCARY, umid="n8YkVw")
+            self.server._write_corruption_advisory("immutable",
+                                                   si_a2b(storage_index_b32),
+                                                   shnum, reason)
+            self.advisories_written += 1
+
+    def finished_cycle(self, cycle):
+        last = self.state["cycle-to-date"].copy()
+        last["corrupt-shares"] = last["corrupt-shares"][:]
+        last["cycle-start-finish-times"] = (self.state["current-cycle-start-time"],
+                                            time.time())
+        self.state["last-complete-cycle"] = last
+
+    def get_stats(self):
+        so_far = self.state["cycle-to-date"]
+        return {"examined_shares": so_far["examined-shares"],
+                "examined_bytes": so_far["examined-bytes"],
+                "corrupt_shares": len(so_far["corrupt-shares"]),
+                "advisories_written": self.advisories_written,
+                }
+
+class ShareChecker:
+    """I check the hashes of one immutable share, raising CorruptShare if
+    any of them are wrong."""
+
+    def __init__(self, sf, storage_index, shnum):
+        self.shnum = shnum
+        self.rbp = ReadBucketProxy(LocalBucket(sf), None, storage_index)
+        self.bytes_read = 0
+
+    def check(self):
+        ueb = uri.unpack_extension(result_of_fired(self.rbp.get_uri_extension()))
+        for key in ("size", "segment_size", "needed_shares", "total_shares",
+                    "share_root_hash"):
+            if key not in ueb:
+                raise CorruptShare("URI extension block has no %s" % key)
+        if ueb["segment_size"] <= 0 or ueb["needed_shares"] <= 0:
+            raise CorruptShare("URI extension block has bad encoding"
+                               " parameters")
+        if not 0 <= self.shnum < ueb["total_shares"]:
+            raise CorruptShare("share number %d is out of range for %d shares"
+                               % (self.shnum, ueb["total_shares"]))
+        k = ueb["needed_shares"]
+        block_size = mathutil.div_ceil(ueb["segment_size"], k)
+        share_size = mathutil.div_ceil(ueb["size"], k)
+        num_blocks = mathutil.div_ceil(ueb["size"], ueb["segment_size"])
+        if num_blocks == 0:
+            return # an empty file has no blocks to check
+        if "num_segments" in ueb and ueb["num_segments"] != num_blocks:
+            raise CorruptShare("URI extension block has %d segments, but its"
+                               " size implies %d" % (ueb["num_segments"],
+                                                     num_blocks))
+
+        # the share hash chain leads from our share hash to the root
+        share_hash_tree = hashtree.IncompleteHashTree(ueb["total_shares"])
+        share_hash_tree.set_hashes({0: ueb["share_root_hash"]})
+        share_hashes = dict(result_of_fired(self.rbp.get_share_hashes()))
+        try:
+            share_hash_tree.set_hashes(share_hashes)
+        except (IndexError, hashtree.BadHashError,
+                hashtree.NotEnoughHashesError), e:
+            raise CorruptShare("bad share hash chain: %s" % (e,))
+        share_hash = share_hash_tree.get_leaf(self.shnum)
+        if share_hash is None:
+            raise CorruptShare("share hash chain does not include this share")
+
+        # and the share hash is the root of the block hash tree
+        block_hash_tree = hashtree.IncompleteHashTree(num_blocks)
+        block_hash_tree.set_hashes({0: share_hash})
+        needed = range(len(block_hash_tree))
+        block_hashes = result_of_fired(self.rbp.get_block_hashes(needed))
+        if len(block_hashes) < len(block_hash_tree):
+            raise CorruptShare("block hash tree truncated: %d of %d hashes"
+                               % (len(block_hashes), len(block_hash_tree)))
+        try:
+            block_hash_tree.set_hashes(dict(enumerate(block_hashes)))
+        except (IndexError, hashtree.BadHashError,
+                hashtree.NotEnoughHashesError), e:
+            raise CorruptShare("bad block hash tree: %s" % (e,))
+
+        for blocknum in range(num_blocks):
+            if blocknum < num_blocks-1:
+                thisblocksize = block_size
+            else:
+                thisblocksize = share_size % block_size
+                if thisblocksize == 0:
+                    thisblocksize = block_size
+            data = result_of_fired(self.rbp.get_block_data(blocknum,
+                                                           block_size,
+                                                           thisblocksize))
+            self.bytes_read += len(data)
+            if len(data) != thisblocksize:
+                raise CorruptShare("block %d truncated: %d of %d bytes"
+                                   % (blocknum, len(data), thisblocksize))
+            try:
+                block_hash_tree.set_hashes(leaves={blocknum:
+                                                   block_hash(data)})
+            except hashtree.BadHashError, e:
+                raise CorruptShare("bad hash for block %d: %s" % (blocknum, e))
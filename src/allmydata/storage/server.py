@@ -1,11 +1,14 @@
-import os, re, weakref, struct, time
+import os, re, weakref, struct, time, errno
 
 from foolscap.api import Referenceable
 from twisted.application import service
+from twisted.internet import reactor, defer
 
 from zope.interface import implements
-from allmydata.interfaces import RIStorageServer, IStatsProducer
+from allmydata.interfaces import RIStorageServer, IStatsProducer, \
+     MAX_GET_BUCKETS_MANY, MAX_ADD_LEASES_MANY, MAX_ADD_LEASE_ERROR_LENGTH
 from allmydata.util import fileutil, idlib, log, time_format
+from allmydata.util.histogram import WindowedLatencyHistogram
 import allmydata # for __full_version__
 
 from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
@@ -14,9 +17,29 @@ from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
      create_mutable_sharefile
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
-from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
-from allmydata.storage.crawler import BucketCountingCrawler
+from allmydata.storage.immutable import ShareFile, BucketWriter, \
+     BucketReader, create_share_with_lease
+from allmydata.storage.crawler import BucketCountingCrawler, CrawlerWorkers, \
+     DEFAULT_CRAWLER_CPU_BUDGET
 from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.shareindex import ShareIndex, ShareIndexReconciler
+from allmydata.storage.fdcache import OpenFileCache, DEFAULT_MAX_OPEN_FILES
+from allmydata.storage.mutablecache import MutableMetadataCache, \
+     DEFAULT_MAX_CACHED_SHARES
+from allmydata.storage.diskio import DiskIOExecutor, SYNCHRONOUS, \
+     in_disk_io_thread
+from allmydata.storage.space import SpaceAccountant
+from allmydata.storage.pack import PackStore, PackedShareFile
+from allmydata.storage.leasedb import LeaseDB, LeaseDBImporter
+from allmydata.storage.blockcache import BlockCache, \
+     DEFAULT_BLOCK_CACHE_SIZE
+from allmydata.storage.journal import ChangeJournal, CREATED, CLOSED, \
+     DELETED
+from allmydata.storage.scheduler import IOScheduler, ScheduledDiskQueue, \
+     READ, MUTABLE_WRITE, IMMUTABLE_WRITE, DEFAULT_CLIENT_REQUEST_RATE, \
+     DEFAULT_CLIENT_REQUEST_BURST, DEFAULT_MAX_OUTSTANDING_REQUESTS
+from allmydata.storage.pacing import CrawlerPacer, \
+     DEFAULT_MAX_CLIENT_LATENCY, DEFAULT_MAX_REACTOR_DELAY
 
 # storage/
 # storage/shares/incoming
@@ -24,6 +47,16 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 #   be moved to storage/shares/$START/$STORAGEINDEX/$SHARENUM upon success
 # storage/shares/$START/$STORAGEINDEX
 # storage/shares/$START/$STORAGEINDEX/$SHARENUM
+# storage/share_index.sqlite (optional)
+# storage/packs/pack-$NUMBER (optional, holds small immutable shares)
+# storage/packs/index.sqlite
+# storage/leases.sqlite (optional)
+# storage/change_journal/changes.$NUMBER (optional)
+
+# A server may be given several share directories (usually one per disk)
+# instead of storage/shares . Each of them has the same layout, including
+# its own incoming/ . All shares of a bucket live in the same directory:
+# new buckets go to the directory with the most available space.
 
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
@@ -45,15 +78,44 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 expiration_whatif_policies=(),
+                 share_index_enabled=False,
+                 share_fd_cache_size=DEFAULT_MAX_OPEN_FILES,
+                 mutable_metadata_cache_size=DEFAULT_MAX_CACHED_SHARES,
+                 disk_io_threads=0,
+                 sharedirs=None,
+                 space_refresh_interval=0,
+                 packed_share_max_size=0,
+                 lease_db_enabled=False,
+                 io_scheduler_enabled=False,
+                 client_request_rate=DEFAULT_CLIENT_REQUEST_RATE,
+                 client_request_burst=DEFAULT_CLIENT_REQUEST_BURST,
+                 max_outstanding_requests=DEFAULT_MAX_OUTSTANDING_REQUESTS,
+                 block_cache_size=DEFAULT_BLOCK_CACHE_SIZE,
+                 change_journal_enabled=False,
+                 crawler_threads=0,
+                 crawler_cpu_budget=DEFAULT_CRAWLER_CPU_BUDGET,
+                 crawler_pacing_enabled=False,
+                 crawler_max_client_latency=DEFAULT_MAX_CLIENT_LATENCY,
+                 crawler_max_reactor_delay=DEFAULT_MAX_REACTOR_DELAY,
+                 share_scrubber_enabled=False):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, str)
         assert len(nodeid) == 20
         self.my_nodeid = nodeid
         self.storedir = storedir
-        sharedir = os.path.join(storedir, "shares")
-        fileutil.make_dirs(sharedir)
-        self.sharedir = sharedir
+        if not sharedirs:
+            sharedirs = [os.path.join(storedir, "shares")]
+        self.sharedirs = list(sharedirs)
+        for sharedir in self.sharedirs:
+            fileutil.make_dirs(sharedir)
+        # the first share directory is the default one
+        self.sharedir = self.sharedirs[0]
+        # directories on the same filesystem are only counted once in the
+        # aggregate space statistics
+        self._sharedir_devices = [os.stat(sharedir).st_dev
+                                  for sharedir in self.sharedirs]
         # we don't actually create the corruption-advisory dir until necessary
         self.corruption_advisory_dir = os.path.join(storedir,
                                                     "corruption-advisories")
@@ -63,10 +125,59 @@ class StorageServer(service.MultiService, Referenceable):
         self.stats_provider = stats_provider
         if self.stats_provider:
             self.stats_provider.register_producer(self)
-        self.incomingdir = os.path.join(sharedir, 'incoming')
+        self.incomingdir = os.path.join(self.sharedir, 'incoming')
         self._clean_incomplete()
-        fileutil.make_dirs(self.incomingdir)
+        for sharedir in self.sharedirs:
+            fileutil.make_dirs(os.path.join(sharedir, 'incoming'))
+        # maps BucketWriter to (storage_index, shnum, lease expiration time)
         self._active_writers = weakref.WeakKeyDictionary()
+        # free and promised space, without a statvfs for every allocation
+        self.space = SpaceAccountant(self.sharedirs, self.reserved_space,
+                                     self.readonly_storage,
+                                     space_refresh_interval)
+        self.space.setServiceParent(self)
+        # immutable share reads go through a bounded set of open files
+        self.share_file_cache = None
+        if share_fd_cache_size > 0:
+            self.share_file_cache = OpenFileCache(share_fd_cache_size)
+        # and mutable share headers are parsed once, not on every request
+        self.mutable_metadata_cache = None
+        if mutable_metadata_cache_size > 0:
+            self.mutable_metadata_cache = \
+                MutableMetadataCache(mutable_metadata_cache_size)
+        # and the data of popular immutable shares is kept in memory
+        self.block_cache = None
+        if block_cache_size > 0:
+            self.block_cache = BlockCache(block_cache_size)
+        # with disk_io_threads=0, disk I/O happens in the reactor thread and
+        # the remote_ methods return their results directly
+        self.disk_io_executor = None
+        # maps each share directory to the DiskQueue for its device
+        self.disks = dict([(sharedir, SYNCHRONOUS)
+                           for sharedir in self.sharedirs])
+        if disk_io_threads > 0:
+            self.disk_io_executor = DiskIOExecutor(disk_io_threads)
+            self.disk_io_executor.setServiceParent(self)
+            for sharedir in self.sharedirs:
+                self.disks[sharedir] = self.disk_io_executor.get_queue(sharedir)
+        # operations which may touch any share directory (like get_buckets,
+        # or anything on a mutable slot) use the default directory's queue
+        self.disk = self.disks[self.sharedir]
+        # reads, mutable writes and uploads are admitted to those queues in
+        # order of priority, and uploaders are rate-limited
+        self.io_scheduler = None
+        if io_scheduler_enabled:
+            self.io_scheduler = IOScheduler(client_request_rate,
+                                            client_request_burst,
+                                            max_outstanding_requests)
+        # immutable shares of up to packed_share_max_size bytes are kept in
+        # pack files. Shares that were packed earlier are still served after
+        # packing has been turned off.
+        self.packed_share_max_size = packed_share_max_size
+        self.pack_store = None
+        packdir = os.path.join(storedir, "packs")
+        if packed_share_max_size > 0 or os.path.exists(packdir):
+            self.pack_store = PackStore(packdir)
         log.msg("StorageServer created", facility="tahoe.storage")
 
         if reserved_space:
@@ -74,19 +185,52 @@ class StorageServer(service.MultiService, Referenceable):
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
-                          }
+        self.latencies = {}
+        for category in ["allocate", "write", "close", "read", "get", # immutable
+                         "writev", "readv", # mutable
+                         "add-lease", "renew", "cancel", # both
+                         ]:
+            self.latencies[category] = WindowedLatencyHistogram()
+
+        # crawlers which can examine several prefixes at once share these
+        # threads, and their budget
+        self.crawler_workers = None
+        if crawler_threads > 0:
+            self.crawler_workers = CrawlerWorkers(crawler_threads,
+                                                  crawler_cpu_budget)
+            self.crawler_workers.setServiceParent(self)
+        # and they all go faster or slower depending upon how well the
+        # clients are being served
+        self.crawler_pacer = None
+        if crawler_pacing_enabled:
+            load_monitor = getattr(stats_provider, "load_monitor", None)
+            self.crawler_pacer = CrawlerPacer(self,
+                                              crawler_max_client_latency,
+                                              crawler_max_reactor_delay,
+                                              load_monitor)
+            self.crawler_pacer.setServiceParent(self)
+
+        # the crawlers keep up with the journal between cycles
+        self.change_journal = None
+        journaldir = os.path.join(self.storedir, "change_journal")
+        if change_journal_enabled:
+            self.change_journal = ChangeJournal(journaldir)
+        elif os.path.exists(journaldir):
+            # changes made while it is disabled are not recorded, so the
+            # crawlers must not go on reading it if it is re-enabled
+            fileutil.rm_dir(journaldir)
         self.add_bucket_counter()
 
+        self.share_index = None
+        if share_index_enabled:
+            self.add_share_index()
+
+        self.lease_db = None
+        if lease_db_enabled:
+            self.add_lease_db()
+        else:
+            self._forget_lease_db()
+
         statefile = os.path.join(self.storedir, "lease_checker.state")
         historyfile = os.path.join(self.storedir, "lease_checker.history")
         klass = self.LeaseCheckerClass
@@ -94,79 +238,180 @@ class StorageServer(service.MultiService, Referenceable):
                                    expiration_enabled, expiration_mode,
                                    expiration_override_lease_duration,
                                    expiration_cutoff_date,
-                                   expiration_sharetypes)
+                                   expiration_sharetypes,
+                                   expiration_whatif_policies)
         self.lease_checker.setServiceParent(self)
 
+        self.share_scrubber = None
+        if share_scrubber_enabled:
+            self.add_share_scrubber()
+
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
 
     def have_shares(self):
         # quick test to decide if we need to commit to an implicit
         # permutation-seed or if we should use a new one
-        return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
+        if self.pack_store is not None and self.pack_store.has_shares():
+            return True
+        if self._share_index_is_trusted():
+            return self.share_index.has_shares()
+        return self._sharedirs_have_buckets()
+
+    def _sharedirs_have_buckets(self):
+        for sharedir in self.sharedirs:
+            if set(os.listdir(sharedir)) - set(["incoming"]):
+                return True
+        return False
 
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
         self.bucket_counter = BucketCountingCrawler(self, statefile)
         self.bucket_counter.setServiceParent(self)
 
+    def add_share_scrubber(self):
+        # imported here because allmydata.immutable.layout, which the
+        # scrubber uses to parse shares, imports this module
+        from allmydata.storage.scrubber import ShareScrubber
+        statefile = os.path.join(self.storedir, "share_scrubber.state")
+        self.share_scrubber = ShareScrubber(self, statefile)
+        self.share_scrubber.setServiceParent(self)
+
+    def add_share_index(self):
+        dbfile = os.path.join(self.storedir, "share_index.sqlite")
+        statefile = os.path.join(self.storedir, "share_index_reconciler.state")
+        self.share_index = ShareIndex(dbfile)
+        if self.share_index.is_trusted():
+            return
+        if self.share_index.is_new and not self._sharedirs_have_buckets():
+            # a brand new server has nothing to reconcile
+            self.share_index.mark_reconciled()
+            return
+        if not self.share_index.was_clean:
+            # updates made since the last reconciliation may have been
+            # lost, so any partial pass must be started again
+            fileutil.remove_if_possible(statefile)
+        self.share_index_reconciler = ShareIndexReconciler(self, statefile,
+                                                           self.share_index)
+        self.share_index_reconciler.setServiceParent(self)
+
+    def _share_index_is_trusted(self):
+        return self.share_index is not None and self.share_index.is_trusted()
+
+    def add_lease_db(self):
+        dbfile = os.path.join(self.storedir, "leases.sqlite")
+        statefile = os.path.join(self.storedir, "lease_db_importer.state")
+        self.lease_db = LeaseDB(dbfile)
+        if self.lease_db.is_trusted():
+            return
+        if self.lease_db.is_new and not self.have_shares():
+            # a brand new server has no leases to import
+            self.lease_db.mark_imported()
+            return
+        self.lease_db_importer = LeaseDBImporter(self, statefile,
+                                                 self.lease_db)
+        self.lease_db_importer.setServiceParent(self)
+
+    def _forget_lease_db(self):
+        # lease changes made while the lease database is disabled only reach
+        # the share files, so it must be imported again if it is re-enabled
+        dbfile = os.path.join(self.storedir, "leases.sqlite")
+        if not os.path.exists(dbfile):
+            return
+        lease_db = LeaseDB(dbfile)
+        if lease_db.is_trusted():
+            log.msg("the lease database is disabled, so the leases in the"
+                    " share files are used again: leases that were renewed"
+                    " while it was enabled may have been forgotten",
+                    level=log.UNUSUAL, umid="fK3Qew")
+            lease_db.mark_stale()
+        lease_db.close()
+
+    def _lease_db_is_trusted(self):
+        return self.lease_db is not None and self.lease_db.is_trusted()
+
+    def stopService(self):
+        d = service.MultiService.stopService(self)
+        if self.io_scheduler is not None:
+            self.io_scheduler.stop()
+        if self.share_file_cache is not None:
+            self.share_file_cache.close_all()
+        if self.share_index is not None:
+            # wait until the reconciler (if any) has saved its state
+            def _close_share_index(res):
+                self.share_index.close()
+                return res
+            d.addBoth(_close_share_index)
+        if self.pack_store is not None:
+            def _close_pack_store(res):
+                self.pack_store.close()
+                return res
+            d.addBoth(_close_pack_store)
+        if self.lease_db is not None:
+            def _close_lease_db(res):
+                self.lease_db.close()
+                return res
+            d.addBoth(_close_lease_db)
+        if self.change_journal is not None:
+            # the crawlers save their journal positions when they stop
+            def _close_change_journal(res):
+                self.change_journal.close()
+                return res
+            d.addBoth(_close_change_journal)
+        return d
+
     def count(self, name, delta=1):
         if self.stats_provider:
             self.stats_provider.count("storage_server." + name, delta)
 
     def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+        self.latencies[category].add(latency)
+
+    def get_latency_histograms(self):
+        """Return a dict, indexed by category, of LatencyHistograms that
+        hold the latencies measured in the last ten minutes. Categories
+        with no recent samples are omitted."""
+        output = {}
+        for category in self.latencies:
+            h = self.latencies[category].get_window()
+            if h.count:
+                output[category] = h
+        return output
 
     def get_latencies(self):
         """Return a dict, indexed by category, that contains a dict of
-        latency numbers for each category. If there are sufficient samples
-        for unambiguous interpretation, each dict will contain the
-        following keys: mean, 01_0_percentile, 10_0_percentile,
-        50_0_percentile (median), 90_0_percentile, 95_0_percentile,
-        99_0_percentile, 99_9_percentile.  If there are insufficient
-        samples for a given percentile to be interpreted unambiguously
-        that percentile will be reported as None. If no samples have been
-        collected for the given category, then that category name will
-        not be present in the return value. """
+        latency numbers for each category, computed from the samples of the
+        last ten minutes. If there are sufficient samples for unambiguous
+        interpretation, each dict will contain the following keys: mean,
+        01_0_percentile, 10_0_percentile, 50_0_percentile (median),
+        90_0_percentile, 95_0_percentile, 99_0_percentile, 99_9_percentile.
+        If there are insufficient samples for a given percentile to be
+        interpreted unambiguously that percentile will be reported as None.
+        Each dict also has 'samplesize' (the number of recent samples) and
+        'count' (the number of samples since the server started). If no
+        samples have been collected for the given category in the last ten
+        minutes, then that category name will not be present in the return
+        value. The percentiles come from a log-bucketed histogram, and are
+        accurate to within about 3%."""
         # note that Amazon's Dynamo paper says they use 99.9% percentile.
         output = {}
-        for category in self.latencies:
-            if not self.latencies[category]:
-                continue
-            stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
-            stats["samplesize"] = count
-            samples.sort()
-            if count > 1:
-                stats["mean"] = sum(samples) / count
-            else:
-                stats["mean"] = None
-
-            orderstatlist = [(0.01, "01_0_percentile", 100), (0.1, "10_0_percentile", 10),\
-                             (0.50, "50_0_percentile", 10), (0.90, "90_0_percentile", 10),\
-                             (0.95, "95_0_percentile", 20), (0.99, "99_0_percentile", 100),\
-                             (0.999, "99_9_percentile", 1000)]
-
-            for percentile, percentilestring, minnumtoobserve in orderstatlist:
-                if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
-                else:
-                    stats[percentilestring] = None
-
+        for category, h in self.get_latency_histograms().items():
+            stats = h.get_summary()
+            stats["count"] = self.latencies[category].since_start.count
             output[category] = stats
         return output
 
     def log(self, *args, **kwargs):
         if "facility" not in kwargs:
             kwargs["facility"] = "tahoe.storage"
+        if in_disk_io_thread():
+            reactor.callFromThread(log.msg, *args, **kwargs)
+            return None
         return log.msg(*args, **kwargs)
 
     def _clean_incomplete(self):
-        fileutil.rm_dir(self.incomingdir)
+        for sharedir in self.sharedirs:
+            fileutil.rm_dir(os.path.join(sharedir, 'incoming'))
 
     def get_stats(self):
         # remember: RIStatsProvider requires that our return dict
@@ -176,9 +421,22 @@ class StorageServer(service.MultiService, Referenceable):
         for category,ld in self.get_latencies().items():
             for name,v in ld.items():
                 stats['storage_server.latencies.%s.%s' % (category, name)] = v
+        # the raw buckets let a stats gatherer merge several servers
+        for category,h in self.get_latency_histograms().items():
+            stats.update(h.get_stats('storage_server.latencies.%s.' % category))
 
         try:
-            disk = fileutil.get_disk_stats(self.sharedir, self.reserved_space)
+            per_dir = self.space.get_disk_stats_per_dir()
+            disk = {}
+            for name in ("total", "used", "free_for_root",
+                         "free_for_nonroot", "avail"):
+                disk[name] = self._sum_over_filesystems([d[name]
+                                                         for d in per_dir])
+            if len(self.sharedirs) > 1:
+                for i,d in enumerate(per_dir):
+                    for name,v in d.items():
+                        stats['storage_server.sharedirs.%d.disk_%s'
+                              % (i, name)] = v
             writeable = disk['avail'] > 0
 
             # spacetime predictors should use disk_avail / (d(disk_used)/dt)
@@ -202,36 +460,135 @@ class StorageServer(service.MultiService, Referenceable):
         bucket_count = s.get("last-complete-bucket-count")
         if bucket_count:
             stats['storage_server.total_bucket_count'] = bucket_count
+        if self.share_file_cache is not None:
+            for name,v in self.share_file_cache.get_stats().items():
+                stats['storage_server.share_fd_cache.%s' % name] = v
+        if self.mutable_metadata_cache is not None:
+            for name,v in self.mutable_metadata_cache.get_stats().items():
+                stats['storage_server.mutable_metadata_cache.%s' % name] = v
+        if self.block_cache is not None:
+            for name,v in self.block_cache.get_stats().items():
+                stats['storage_server.block_cache.%s' % name] = v
+        if self.change_journal is not None:
+            for name,v in self.change_journal.get_stats().items():
+                stats['storage_server.change_journal.%s' % name] = v
+        if self.crawler_workers is not None:
+            for name,v in self.crawler_workers.get_stats().items():
+                stats['storage_server.crawler_workers.%s' % name] = v
+        if self.crawler_pacer is not None:
+            for name,v in self.crawler_pacer.get_stats().items():
+                stats['storage_server.crawler_pacer.%s' % name] = v
+        if self.share_scrubber is not None:
+            for name,v in self.share_scrubber.get_stats().items():
+                stats['storage_server.share_scrubber.%s' % name] = v
+        if self.disk_io_executor is not None:
+            for name,v in self.disk_io_executor.get_stats().items():
+                stats['storage_server.disk_io.%s' % name] = v
+        if self.io_scheduler is not None:
+            for name,v in self.io_scheduler.get_stats().items():
+                stats['storage_server.io_scheduler.%s' % name] = v
+        for name,v in self.space.get_stats().items():
+            stats['storage_server.space.%s' % name] = v
+        if self.pack_store is not None:
+            for name,v in self.pack_store.get_stats().items():
+                stats['storage_server.packs.%s' % name] = v
         return stats
 
     def get_available_space(self):
         """Returns available space for share storage in bytes, or None if no
         API to get this information is available."""
 
-        if self.readonly_storage:
-            return 0
-        return fileutil.get_available_space(self.sharedir, self.reserved_space)
+        per_dir = self.get_available_space_per_dir()
+        if None in per_dir:
+            return None
+        return self._sum_over_filesystems(per_dir)
+
+    def get_available_space_per_dir(self):
+        """Returns a list with the available space (or None) in each of
+        self.sharedirs, in the same order."""
+        return self.space.get_available_space_per_dir()
+
+    def _sum_over_filesystems(self, per_dir_values):
+        seen = set()
+        total = 0
+        for device, value in zip(self._sharedir_devices, per_dir_values):
+            if device not in seen:
+                seen.add(device)
+                total += value
+        return total
+
+    def _sharedir_of(self, filename):
+        for sharedir in self.sharedirs:
+            if filename.startswith(sharedir + os.sep):
+                return sharedir
+        return self.sharedir
 
     def allocated_size(self):
-        space = 0
-        for bw in self._active_writers:
-            space += bw.allocated_size()
-        return space
+        return self.space.allocated_size()
+
+    def _should_pack(self, max_size):
+        return (self.pack_store is not None and
+                max_size <= self.packed_share_max_size)
+
+    def _get_placement_candidates(self):
+        """Return a list of (sharedir, remaining_space) tuples, with the
+        directory that has the most room first. remaining_space is None if
+        this platform cannot tell us how much space there is."""
+        candidates = []
+        for sharedir, avail, allocated in zip(self.sharedirs,
+                                   self.get_available_space_per_dir(),
+                                   self.space.get_allocated_per_dir()):
+            if avail is not None:
+                # this is a bit conservative, since some of this
+                # allocated_size() has already been written to disk, where
+                # it will show up in get_available_space.
+                avail -= allocated
+            candidates.append((sharedir, avail))
+        if None not in [a for (d, a) in candidates]:
+            candidates.sort(key=lambda c: -c[1])
+        return candidates
+
+    def _choose_sharedir(self, si_dir, candidates=None):
+        """Return (sharedir, remaining_space) for the directory that should
+        hold new shares of the bucket 'si_dir'. That is the directory which
+        already holds this bucket, if any, or else the first candidate."""
+        if len(self.sharedirs) == 1:
+            if candidates is None:
+                return (self.sharedir, None)
+            return candidates[0]
+        if candidates is None:
+            candidates = zip(self.sharedirs,
+                             self.get_available_space_per_dir())
+            if None not in [a for (d, a) in candidates]:
+                candidates.sort(key=lambda c: -c[1])
+        for (sharedir, remaining) in candidates:
+            if (os.path.isdir(os.path.join(sharedir, si_dir)) or
+                os.path.isdir(os.path.join(sharedir, "incoming", si_dir))):
+                return (sharedir, remaining)
+        return candidates[0]
 
     def remote_get_version(self):
-        remaining_space = self.get_available_space()
-        if remaining_space is None:
+        per_dir = self.get_available_space_per_dir()
+        if None in per_dir:
             # We're on a platform that has no API to get disk stats.
             remaining_space = 2**64
+            max_share_size = 2**64
+        else:
+            remaining_space = self._sum_over_filesystems(per_dir)
+            # a share has to fit in a single directory
+            max_share_size = max(per_dir)
 
         version = { "http://allmydata.org/tahoe/protocols/storage/v1" :
-                    { "maximum-immutable-share-size": remaining_space,
+                    { "maximum-immutable-share-size": max_share_size,
                       "maximum-mutable-share-size": MAX_MUTABLE_SHARE_SIZE,
                       "available-space": remaining_space,
                       "tolerates-immutable-read-overrun": True,
                       "delete-mutable-shares-with-zero-length-writev": True,
                       "fills-holes-with-zero-bytes": True,
                       "prevents-read-past-end-of-share-data": True,
+                      "supports-immutable-readv": True,
+                      "maximum-get-buckets-many": MAX_GET_BUCKETS_MANY,
+                      "maximum-add-leases-many": MAX_ADD_LEASES_MANY,
                       },
                     "application-version": str(allmydata.__full_version__),
                     }
@@ -246,9 +603,6 @@ class StorageServer(service.MultiService, Referenceable):
         # to a particular owner.
         start = time.time()
         self.count("allocate")
-        alreadygot = set()
-        bucketwriters = {} # k: shnum, v: BucketWriter
-        si_dir = storage_index_to_dir(storage_index)
         si_s = si_b2a(storage_index)
 
         log.msg("storage: allocate_buckets %s" % si_s)
@@ -264,28 +618,99 @@ class StorageServer(service.MultiService, Referenceable):
 
         max_space_per_bucket = allocated_size
 
-        remaining_space = self.get_available_space()
-        limited = remaining_space is not None
-        if limited:
-            # this is a bit conservative, since some of this allocated_size()
-            # has already been written to disk, where it will show up in
-            # get_available_space.
-            remaining_space -= self.allocated_size()
+        candidates = self._get_placement_candidates()
+        pending = 0
+        remaining_space = candidates[0][1]
+        if remaining_space is not None:
+            # hold on to the most we might use until the shares exist, so
+            # that concurrent allocations cannot promise the same space
+            pending = max(0, min(remaining_space,
+                                 len(sharenums) * max_space_per_bucket))
         # self.readonly_storage causes remaining_space <= 0
+        self.space.reserve_pending(pending)
+
+        pack_store = None
+        if self._should_pack(max_space_per_bucket):
+            pack_store = self.pack_store
+        client_id = self._client_id(canary)
+        def _allocated((alreadygot, created)):
+            self.space.release_pending(pending)
+            bucketwriters = {} # k: shnum, v: BucketWriter
+            for shnum, (incominghome, finalhome, sf) in created.items():
+                disk = self._scheduled(self.disks[self._sharedir_of(finalhome)],
+                                       IMMUTABLE_WRITE, client_id)
+                bw = BucketWriter(self, incominghome, finalhome,
+                                  max_space_per_bucket, lease_info, canary,
+                                  disk=disk, sharefile=sf,
+                                  pack_store=pack_store,
+                                  storage_index=storage_index)
+                if self.no_storage:
+                    bw.throw_out_all_data = True
+                bucketwriters[shnum] = bw
+                self._active_writers[bw] = (storage_index, shnum, lease_info)
+                self.space.writer_opened(bw, self._sharedir_of(finalhome))
+                self._record_change(CREATED, storage_index, shnum)
+            self.add_latency("allocate", time.time() - start)
+            return alreadygot, bucketwriters
+        def _failed():
+            self.space.release_pending(pending)
+        disk = self._scheduled(self.disk, IMMUTABLE_WRITE, client_id)
+        return disk.call_with_cleanup(storage_index, _allocated, _failed,
+                                      self._allocate_buckets_on_disk,
+                                      storage_index, sharenums,
+                                      max_space_per_bucket, lease_info,
+                                      candidates)
+
+    def _client_id(self, canary):
+        # the canary is a RemoteReference to an object in the client's Tub
+        try:
+            return canary.getRemoteTubID()
+        except AttributeError:
+            return None
+
+    def _scheduled(self, disk, priority, client_id=None):
+        if self.io_scheduler is None:
+            return disk
+        return ScheduledDiskQueue(self.io_scheduler, disk, priority, client_id)
+
+    def _allocate_buckets_on_disk(self, storage_index, sharenums,
+                                  max_space_per_bucket, lease_info,
+                                  candidates):
+        # candidates is from _get_placement_candidates(). Returns
+        # (alreadygot, created), where 'created' maps shnum to a tuple of
+        # (incominghome, finalhome, ShareFile) for the new incoming shares.
+        si_dir = storage_index_to_dir(storage_index)
+        (sharedir, remaining_space) = self._choose_sharedir(si_dir, candidates)
+        limited = remaining_space is not None
+        alreadygot = set()
+        created = {}
 
         # fill alreadygot with all shares that we have, not just the ones
         # they asked about: this will save them a lot of work. Add or update
         # leases for all of them: if they want us to hold shares for this
         # file, they'll want us to hold leases for this file.
         for (shnum, fn) in self._get_bucket_shares(storage_index):
+            try:
+                sf = ShareFile(fn)
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._share_vanished(storage_index, shnum)
+                continue
             alreadygot.add(shnum)
-            sf = ShareFile(fn)
-            sf.add_or_renew_lease(lease_info)
+            self._add_or_renew_lease(storage_index, shnum, sf, lease_info)
+            self._share_lease_renewed(storage_index, shnum,
+                                      lease_info.expiration_time)
+        for (shnum, sf) in self._iter_packed_shares(storage_index):
+            if shnum not in alreadygot:
+                alreadygot.add(shnum)
+                self._add_or_renew_lease(storage_index, shnum, sf, lease_info)
 
         for shnum in sharenums:
-            incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
-            finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
-            if os.path.exists(finalhome):
+            incominghome = os.path.join(sharedir, "incoming", si_dir,
+                                        "%d" % shnum)
+            finalhome = os.path.join(sharedir, si_dir, "%d" % shnum)
+            if shnum in alreadygot or os.path.exists(finalhome):
                 # great! we already have it. easy.
                 pass
             elif os.path.exists(incominghome):
@@ -296,31 +721,52 @@ class StorageServer(service.MultiService, Referenceable):
                 pass
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
-                bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
-                if self.no_storage:
-                    bw.throw_out_all_data = True
-                bucketwriters[shnum] = bw
-                self._active_writers[bw] = 1
+                sf = create_share_with_lease(incominghome,
+                                             max_space_per_bucket, lease_info)
+                created[shnum] = (incominghome, finalhome, sf)
                 if limited:
                     remaining_space -= max_space_per_bucket
             else:
                 # bummer! not enough space to accept this bucket
                 pass
 
-        if bucketwriters:
-            fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
-
-        self.add_latency("allocate", time.time() - start)
-        return alreadygot, bucketwriters
+        if created and not self._should_pack(max_space_per_bucket):
+            fileutil.make_dirs(os.path.join(sharedir, si_dir))
+        return alreadygot, created
 
     def _iter_share_files(self, storage_index):
+        for shnum, sf in self._iter_shares(storage_index):
+            yield sf
+
+    def _iter_shares(self, storage_index):
+        seen = set()
+        for shnum, sf in self._iter_share_files_on_disk(storage_index):
+            seen.add(shnum)
+            yield shnum, sf
+        for shnum, sf in self._iter_packed_shares(storage_index):
+            if shnum not in seen:
+                yield shnum, sf
+
+    def _iter_packed_shares(self, storage_index):
+        if self.pack_store is None:
+            return
+        for shnum in self.pack_store.get_shares(storage_index):
+            yield shnum, PackedShareFile(self.pack_store, storage_index, shnum)
+
+    def _iter_share_files_on_disk(self, storage_index):
         for shnum, filename in self._get_bucket_shares(storage_index):
-            f = open(filename, 'rb')
+            try:
+                f = open(filename, 'rb')
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._share_vanished(storage_index, shnum)
+                continue
             header = f.read(32)
             f.close()
             if header[:32] == MutableShareFile.MAGIC:
-                sf = MutableShareFile(filename, self)
+                sf = MutableShareFile(filename, self,
+                                      self.mutable_metadata_cache)
                 # note: if the share has been migrated, the renew_lease()
                 # call will throw an exception, with information to help the
                 # client update the lease.
@@ -328,7 +774,7 @@ class StorageServer(service.MultiService, Referenceable):
                 sf = ShareFile(filename)
             else:
                 continue # non-sharefile
-            yield sf
+            yield shnum, sf
 
     def remote_add_lease(self, storage_index, renew_secret, cancel_secret,
                          owner_num=1):
@@ -338,52 +784,314 @@ class StorageServer(service.MultiService, Referenceable):
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
-        for sf in self._iter_share_files(storage_index):
+        def _added(res):
+            self.add_latency("add-lease", time.time() - start)
+            return None
+        return self.disk.call(storage_index, _added,
+                              self._add_lease_on_disk, storage_index,
+                              lease_info)
+
+    def remote_add_leases_many(self, leases, owner_num=1):
+        start = time.time()
+        self.count("add-lease", len(leases))
+        log.msg("storage: add_leases_many (%d storage indexes)" % len(leases))
+        new_expire_time = time.time() + 31*24*60*60
+        # each storage index goes through the disk queue under its own key,
+        # like add_lease(), so it stays in order with slot writes and lease
+        # expiry on the same shares
+        dl = []
+        for (storage_index, renew_secret, cancel_secret) in leases:
+            lease_info = LeaseInfo(owner_num, renew_secret, cancel_secret,
+                                   new_expire_time, self.my_nodeid)
+            d = defer.maybeDeferred(self.disk.call, storage_index,
+                                    lambda num_shares: num_shares,
+                                    self._add_lease_on_disk, storage_index,
+                                    lease_info)
+            # one bad bucket must not cost the client the other leases
+            d.addErrback(self._add_lease_failed, storage_index)
+            d.addCallback(lambda res, storage_index=storage_index:
+                          (storage_index, res))
+            dl.append(d)
+        def _added(pairs):
+            self.add_latency("add-lease", time.time() - start)
+            results = {}
+            for (storage_index, res) in pairs:
+                if not isinstance(results.get(storage_index), str):
+                    results[storage_index] = res
+            return results
+        d = defer.gatherResults(dl)
+        d.addCallback(_added)
+        return d
+
+    def _add_lease_failed(self, f, storage_index):
+        self.log(format="add_leases_many: unable to add lease to %(si)s",
+                 si=si_b2a(storage_index), failure=f,
+                 level=log.WEIRD, umid="Lq7vTg")
+        # the client turns this into an errback for this storage index
+        return ("%s: %s" % (f.type.__name__,
+                            f.getErrorMessage()))[:MAX_ADD_LEASE_ERROR_LENGTH]
+
+    def _add_lease_on_disk(self, storage_index, lease_info):
+        # returns the number of shares that now hold the lease
+        if self._lease_db_is_trusted():
+            # the share files do not need to be opened at all
+            shnums = self._get_share_numbers(storage_index)
+            self.lease_db.add_or_renew_leases(storage_index, shnums,
+                                              lease_info)
+            for shnum in shnums:
+                self._share_lease_renewed(storage_index, shnum,
+                                          lease_info.expiration_time)
+            return len(shnums)
+        num_shares = 0
+        for shnum, sf in self._iter_shares(storage_index):
+            self._add_or_renew_lease(storage_index, shnum, sf, lease_info)
+            self._share_lease_renewed(storage_index, shnum,
+                                      lease_info.expiration_time)
+            num_shares += 1
+        return num_shares
+
+    def _add_or_renew_lease(self, storage_index, shnum, sf, lease_info):
+        # once the lease database is trusted, the leases in the share files
+        # are left alone
+        if not self._lease_db_is_trusted():
             sf.add_or_renew_lease(lease_info)
-        self.add_latency("add-lease", time.time() - start)
-        return None
+        if self.lease_db is not None:
+            self.lease_db.add_or_renew_leases(storage_index, [shnum],
+                                              lease_info)
 
     def remote_renew_lease(self, storage_index, renew_secret):
         start = time.time()
         self.count("renew")
         new_expire_time = time.time() + 31*24*60*60
+        def _renewed(found_buckets):
+            self.add_latency("renew", time.time() - start)
+            if not found_buckets:
+                raise IndexError("no such lease to renew")
+        return self.disk.call(storage_index, _renewed,
+                              self._renew_lease_on_disk, storage_index,
+                              renew_secret, new_expire_time)
+
+    def _renew_lease_on_disk(self, storage_index, renew_secret,
+                             new_expire_time):
+        if self._lease_db_is_trusted():
+            shnums = self.lease_db.renew_leases(storage_index, renew_secret,
+                                                new_expire_time)
+            for shnum in shnums:
+                self._share_lease_renewed(storage_index, shnum,
+                                          new_expire_time)
+            return bool(shnums)
         found_buckets = False
-        for sf in self._iter_share_files(storage_index):
+        for shnum, sf in self._iter_shares(storage_index):
             found_buckets = True
             sf.renew_lease(renew_secret, new_expire_time)
-        self.add_latency("renew", time.time() - start)
-        if not found_buckets:
-            raise IndexError("no such lease to renew")
+            self._share_lease_renewed(storage_index, shnum, new_expire_time)
+        if self.lease_db is not None:
+            self.lease_db.renew_leases(storage_index, renew_secret,
+                                       new_expire_time)
+        return found_buckets
 
-    def bucket_writer_closed(self, bw, consumed_size):
+    def bucket_writer_closed(self, bw, consumed_size, bucket_delta=0):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
-        del self._active_writers[bw]
+        (storage_index, shnum, lease_info) = self._active_writers.pop(bw)
+        self.space.writer_closed(bw, consumed_size)
+        if self.share_file_cache is not None:
+            self.share_file_cache.invalidate(bw.finalhome)
+        if not consumed_size:
+            return
+        # the share was closed (rather than aborted), and has been moved into
+        # its final home
+        if self.share_index is not None and not bw.packed:
+            self.share_index.add_share(storage_index, shnum, "immutable",
+                                       consumed_size,
+                                       lease_info.expiration_time)
+        if self.lease_db is not None:
+            self.lease_db.add_or_renew_leases(storage_index, [shnum],
+                                              lease_info)
+        # the BucketWriter worked out bucket_delta when it moved the share
+        self._record_change(CLOSED, storage_index, shnum, consumed_size,
+                            bucket_delta)
+
+    def _record_change(self, event, storage_index, shnum, size=0,
+                       bucket_delta=0):
+        if self.change_journal is not None:
+            self.change_journal.record(event, storage_index, shnum, size,
+                                       bucket_delta)
+
+    def _share_lease_renewed(self, storage_index, shnum, expire_time):
+        if self.share_index is not None:
+            self.share_index.update_expiration(storage_index, shnum,
+                                               expire_time)
+
+    def _share_vanished(self, storage_index, shnum):
+        # the share index told us about a share that is no longer on disk
+        self.log(format="share %(si)s-%(shnum)d vanished from disk",
+                 si=si_b2a(storage_index), shnum=shnum, level=log.UNUSUAL)
+        self.share_removed(storage_index, shnum)
+
+    def share_removed(self, storage_index, shnum, bucket_delta=None):
+        """Forget about a share which has been deleted (for example by the
+        lease expirer). 'bucket_delta' is what get_bucket_delta() returned
+        when the share was removed. If it is None, I call get_bucket_delta()
+        myself, so I must be called in the disk I/O thread that removed the
+        share."""
+        for sharedir in self.sharedirs:
+            filename = os.path.join(sharedir,
+                                    storage_index_to_dir(storage_index),
+                                    "%d" % shnum)
+            if self.share_file_cache is not None:
+                self.share_file_cache.invalidate(filename)
+            if self.mutable_metadata_cache is not None:
+                self.mutable_metadata_cache.invalidate(filename)
+        if self.block_cache is not None:
+            self.block_cache.invalidate_share(storage_index, shnum)
+        if self.share_index is not None:
+            self.share_index.remove_share(storage_index, shnum)
+        if self.lease_db is not None:
+            self.lease_db.remove_share(storage_index, shnum)
+        if bucket_delta is None:
+            bucket_delta = self.get_bucket_delta(storage_index, shnum,
+                                                 added=False)
+        self._record_change(DELETED, storage_index, shnum, 0, bucket_delta)
+
+    def get_bucket_delta(self, storage_index, shnum, added):
+        """Return 1 if share 'shnum' was just added and is the only share of
+        its bucket, -1 if it was just removed and was the last one, and 0
+        otherwise. This must be called in the disk I/O thread that added or
+        removed the share, under the key of its storage index, so that each
+        change to the bucket is counted in turn. It looks at the share
+        directories and the pack store rather than at the share index, which
+        is only brought up to date afterwards."""
+        if self.change_journal is None:
+            return 0
+        shnums = self._get_share_numbers_on_disk(storage_index)
+        if added:
+            return int(shnums == [shnum])
+        return -int(not shnums)
+
+    def share_leases_changed(self, storage_index, shnum, expire_time):
+        """Record the new latest lease expiration time of a share after some
+        of its leases were cancelled."""
+        if self.share_index is not None:
+            self.share_index.set_expiration(storage_index, shnum, expire_time)
 
     def _get_bucket_shares(self, storage_index):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
-        the integer form of the last component of 'pathname'."""
-        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
-        try:
-            for f in os.listdir(storagedir):
-                if NUM_RE.match(f):
-                    filename = os.path.join(storagedir, f)
-                    yield (int(f), filename)
-        except OSError:
-            # Commonly caused by there being no buckets at all.
-            pass
+        the integer form of the last component of 'pathname'.
+
+        If the share index is trusted, it is used instead of listing the
+        bucket directory, so callers must tolerate files which have been
+        deleted behind the server's back: they should catch ENOENT and call
+        self._share_vanished().
+
+        With several share directories, each of them is searched, and a
+        share number found in more than one is only reported once.
+        """
+        si_dir = storage_index_to_dir(storage_index)
+        if self._share_index_is_trusted():
+            for shnum in sorted(self.share_index.get_shares(storage_index)):
+                yield (shnum, self._find_share(si_dir, shnum))
+            return
+        seen = set()
+        for sharedir in self.sharedirs:
+            storagedir = os.path.join(sharedir, si_dir)
+            try:
+                for f in os.listdir(storagedir):
+                    if NUM_RE.match(f) and int(f) not in seen:
+                        seen.add(int(f))
+                        filename = os.path.join(storagedir, f)
+                        yield (int(f), filename)
+            except OSError:
+                # Commonly caused by there being no buckets at all.
+                pass
+
+    def _get_share_numbers_on_disk(self, storage_index):
+        shnums = set()
+        si_dir = storage_index_to_dir(storage_index)
+        for sharedir in self.sharedirs:
+            try:
+                filenames = os.listdir(os.path.join(sharedir, si_dir))
+            except OSError:
+                continue
+            shnums.update([int(f) for f in filenames if NUM_RE.match(f)])
+        if self.pack_store is not None:
+            shnums.update(self.pack_store.get_shares(storage_index))
+        return sorted(shnums)
+
+    def _get_share_numbers(self, storage_index):
+        shnums = [shnum for (shnum, filename)
+                  in self._get_bucket_shares(storage_index)]
+        if self.pack_store is not None:
+            for shnum in self.pack_store.get_shares(storage_index):
+                if shnum not in shnums:
+                    shnums.append(shnum)
+        return shnums
+
+    def _find_share(self, si_dir, shnum):
+        # the index does not say which directory holds the share
+        filenames = [os.path.join(sharedir, si_dir, "%d" % shnum)
+                     for sharedir in self.sharedirs]
+        if len(filenames) > 1:
+            for filename in filenames:
+                if os.path.exists(filename):
+                    return filename
+        return filenames[0]
 
     def remote_get_buckets(self, storage_index):
         start = time.time()
         self.count("get")
         si_s = si_b2a(storage_index)
         log.msg("storage: get_buckets %s" % si_s)
+        def _got(bucketreaders):
+            self.add_latency("get", time.time() - start)
+            return bucketreaders
+        disk = self._scheduled(self.disk, READ)
+        return disk.call(storage_index, _got,
+                         self._get_bucket_readers, storage_index)
+
+    def remote_get_buckets_many(self, storage_indexes):
+        start = time.time()
+        self.count("get", len(storage_indexes))
+        log.msg("storage: get_buckets_many (%d storage indexes)"
+                % len(storage_indexes))
+        def _got(results):
+            self.add_latency("get", time.time() - start)
+            return results
+        disk = self._scheduled(self.disk, READ)
+        return disk.call(None, _got,
+                         self._get_bucket_readers_many, storage_indexes)
+
+    def _get_bucket_readers_many(self, storage_indexes):
+        results = {}
+        for storage_index in storage_indexes:
+            bucketreaders = self._get_bucket_readers(storage_index)
+            if bucketreaders:
+                results[storage_index] = bucketreaders
+        return results
+
+    def _get_bucket_readers(self, storage_index):
         bucketreaders = {} # k: sharenum, v: BucketReader
         for shnum, filename in self._get_bucket_shares(storage_index):
-            bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
-        self.add_latency("get", time.time() - start)
+            try:
+                disk = self._scheduled(self.disks[self._sharedir_of(filename)],
+                                       READ)
+                bucketreaders[shnum] = BucketReader(self, filename,
+                                                    storage_index, shnum,
+                                                    self.share_file_cache,
+                                                    disk=disk,
+                                                    block_cache=self.block_cache)
+            except EnvironmentError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._share_vanished(storage_index, shnum)
+        for shnum, sf in self._iter_packed_shares(storage_index):
+            if shnum not in bucketreaders:
+                disk = self._scheduled(self.disk, READ)
+                bucketreaders[shnum] = BucketReader(self, None, storage_index,
+                                                    shnum, disk=disk,
+                                                    share_file=sf,
+                                                    block_cache=self.block_cache)
         return bucketreaders
 
     def get_leases(self, storage_index):
@@ -395,11 +1103,18 @@ class StorageServer(service.MultiService, Referenceable):
 
         # since all shares get the same lease data, we just grab the leases
         # from the first share
+        if self._lease_db_is_trusted():
+            shnums = self._get_share_numbers(storage_index)
+            if not shnums:
+                return iter([])
+            return iter(self.lease_db.get_leases(storage_index, shnums[0]))
         try:
             shnum, filename = self._get_bucket_shares(storage_index).next()
             sf = ShareFile(filename)
             return sf.get_leases()
         except StopIteration:
+            for shnum, sf in self._iter_packed_shares(storage_index):
+                return sf.get_leases()
             return iter([])
 
     def remote_slot_testv_and_readv_and_writev(self, storage_index,
@@ -410,23 +1125,40 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("writev")
         si_s = si_b2a(storage_index)
         log.msg("storage: slot_writev %s" % si_s)
+        def _written(res):
+            self.add_latency("writev", time.time() - start)
+            return res
+        # all slot operations on this storage index happen in the order they
+        # arrived, so the test vectors see the results of earlier writes
+        disk = self._scheduled(self.disk, MUTABLE_WRITE)
+        return disk.call(storage_index, _written,
+                         self._slot_testv_and_readv_and_writev,
+                         storage_index, secrets,
+                         test_and_write_vectors, read_vector)
+
+    def _slot_testv_and_readv_and_writev(self, storage_index, secrets,
+                                         test_and_write_vectors,
+                                         read_vector):
+        si_s = si_b2a(storage_index)
         si_dir = storage_index_to_dir(storage_index)
         (write_enabler, renew_secret, cancel_secret) = secrets
         # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
         shares = {}
-        if os.path.isdir(bucketdir):
-            for sharenum_s in os.listdir(bucketdir):
-                try:
-                    sharenum = int(sharenum_s)
-                except ValueError:
-                    continue
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
-                shares[sharenum] = msf
+        for (sharenum, filename) in self._get_bucket_shares(storage_index):
+            msf = self._open_mutable_share(storage_index, sharenum, filename)
+            if msf is None:
+                continue
+            msf.check_write_enabler(write_enabler, si_s)
+            shares[sharenum] = msf
         # write_enabler is good for all existing shares.
 
+        # new shares go next to the existing ones
+        if shares:
+            bucketdir = os.path.dirname(shares.values()[0].home)
+        else:
+            (sharedir, remaining_space) = self._choose_sharedir(si_dir)
+            bucketdir = os.path.join(sharedir, si_dir)
+
         # Now evaluate test vectors.
         testv_is_good = True
         for sharenum in test_and_write_vectors:
@@ -463,18 +1195,28 @@ class StorageServer(service.MultiService, Referenceable):
                 if new_length == 0:
                     if sharenum in shares:
                         shares[sharenum].unlink()
+                        self.share_removed(storage_index, sharenum)
                 else:
                     if sharenum not in shares:
                         # allocate a new share
+                        new_bucket = not shares
                         allocated_size = 2000 # arbitrary, really
                         share = self._allocate_slot_share(bucketdir, secrets,
                                                           sharenum,
                                                           allocated_size,
                                                           owner_num=0)
                         shares[sharenum] = share
+                        self._record_change(CREATED, storage_index, sharenum,
+                                            0, int(new_bucket))
                     shares[sharenum].writev(datav, new_length)
                     # and update the lease
-                    shares[sharenum].add_or_renew_lease(lease_info)
+                    self._add_or_renew_lease(storage_index, sharenum,
+                                             shares[sharenum], lease_info)
+                    if self.share_index is not None:
+                        size = os.path.getsize(shares[sharenum].home)
+                        self.share_index.add_share(storage_index, sharenum,
+                                                   "mutable", size,
+                                                   expire_time)
 
             if new_length == 0:
                 # delete empty bucket directories
@@ -483,7 +1225,6 @@ class StorageServer(service.MultiService, Referenceable):
 
 
         # all done
-        self.add_latency("writev", time.time() - start)
         return (testv_is_good, read_data)
 
     def _allocate_slot_share(self, bucketdir, secrets, sharenum,
@@ -493,38 +1234,58 @@ class StorageServer(service.MultiService, Referenceable):
         fileutil.make_dirs(bucketdir)
         filename = os.path.join(bucketdir, "%d" % sharenum)
         share = create_mutable_sharefile(filename, my_nodeid, write_enabler,
-                                         self)
+                                         self, self.mutable_metadata_cache)
         return share
 
+    def _open_mutable_share(self, storage_index, shnum, filename):
+        # returns None if the share index was out of date
+        if not os.path.exists(filename):
+            self._share_vanished(storage_index, shnum)
+            return None
+        return MutableShareFile(filename, self, self.mutable_metadata_cache)
+
     def remote_slot_readv(self, storage_index, shares, readv):
         start = time.time()
         self.count("readv")
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %s %s" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
-        # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
+        def _read(datavs):
+            log.msg("returning shares %s" % (datavs.keys(),),
+                    facility="tahoe.storage", level=log.NOISY, parent=lp)
             self.add_latency("readv", time.time() - start)
-            return {}
+            return datavs
+        disk = self._scheduled(self.disk, READ)
+        return disk.call(storage_index, _read,
+                         self._slot_readv, storage_index, shares, readv)
+
+    def _slot_readv(self, storage_index, shares, readv):
+        # shares exist if there is a file for them
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        for (sharenum, filename) in self._get_bucket_shares(storage_index):
             if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
+                msf = self._open_mutable_share(storage_index, sharenum,
+                                               filename)
+                if msf is None:
+                    continue
                 datavs[sharenum] = msf.readv(readv)
-        log.msg("returning shares %s" % (datavs.keys(),),
-                facility="tahoe.storage", level=log.NOISY, parent=lp)
-        self.add_latency("readv", time.time() - start)
         return datavs
 
     def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
                                     reason):
+        def _written(res):
+            log.msg(format=("client claims corruption in (%(share_type)s) " +
+                            "%(si)s-%(shnum)d: %(reason)s"),
+                    share_type=share_type, si=si_b2a(storage_index),
+                    shnum=shnum, reason=reason, level=log.SCARY,
+                    umid="SGx2fA")
+            return None
+        return self.disk.call(None, _written,
+                              self._write_corruption_advisory, share_type,
+                              storage_index, shnum, reason)
+
+    def _write_corruption_advisory(self, share_type, storage_index, shnum,
+                                   reason):
         fileutil.make_dirs(self.corruption_advisory_dir)
         now = time_format.iso_utc(sep="T")
         si_s = si_b2a(storage_index)
@@ -540,8 +1301,3 @@ class StorageServer(service.MultiService, Referenceable):
         f.write(reason)
         f.write("\n")
         f.close()
-        log.msg(format=("client claims corruption in (%(share_type)s) " +
-                        "%(si)s-%(shnum)d: %(reason)s"),
-                share_type=share_type, si=si_s, shnum=shnum, reason=reason,
-                level=log.SCARY, umid="SGx2fA")
-        return None
@@ -0,0 +1,277 @@
+import os, struct, time, threading
+
+from allmydata.storage.common import si_b2a, si_a2b
+from allmydata.storage.crawler import ShareCrawler
+from allmydata.storage.shares import get_share_file
+from allmydata.storage.common import UnknownMutableContainerVersionError, \
+     UnknownImmutableContainerVersionError
+from allmydata.util import log
+from allmydata.util.dbutil import get_db
+
+# The share index is a local database (storage/share_index.sqlite) which
+# records every share that the StorageServer holds, so that DYHB
+# (get_buckets) and slot_readv queries can be answered without listing the
+# bucket directory. The StorageServer updates it as shares are created,
+# written, leased, and deleted. The index is only trusted when it was closed
+# cleanly and a full reconciliation pass has completed since it was created:
+# otherwise the server falls back to listing the filesystem while a
+# ShareIndexReconciler crawler rebuilds it from shares/ .
+
+SHARE_INDEX_SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32(storage_index)
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(9) NOT NULL,      -- "immutable" or "mutable"
+ size INTEGER NOT NULL,              -- os.stat(sharefile)[stat.ST_SIZE]
+ expiration_time INTEGER,            -- latest lease expiration, or NULL
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE INDEX shares_by_expiration ON shares (expiration_time);
+
+CREATE TABLE status
+(
+ clean_shutdown INTEGER, -- 1 if the index was closed cleanly
+ reconciled INTEGER      -- 1 once a full pass over shares/ has completed
+);
+"""
+
+def _locked(method):
+    def _call_with_lock(self, *args, **kwargs):
+        self._lock.acquire()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._lock.release()
+    _call_with_lock.__name__ = method.__name__
+    _call_with_lock.__doc__ = method.__doc__
+    return _call_with_lock
+
+class ShareIndex:
+    """I am an on-disk index from storage index to the shares held for it.
+    Each entry records the share number, share type ('immutable' or
+    'mutable'), the size of the share file, and the latest lease expiration
+    time, if known.
+
+    All storage_index arguments are binary storage index strings. My methods
+    may be called from the storage server's disk I/O threads as well as from
+    the reactor thread.
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.is_new = not os.path.exists(dbfile)
+        # The index can always be rebuilt from shares/, so we don't need
+        # every commit to reach the disk before we return.
+        (self._sqlite, self._db) = get_db(dbfile,
+                                          create_version=(SHARE_INDEX_SCHEMA_v1, 1),
+                                          dbname="share index",
+                                          journal_mode="WAL",
+                                          synchronous="NORMAL",
+                                          check_same_thread=False)
+        self._lock = threading.Lock()
+        self._cursor = self._db.cursor()
+        self._cursor.execute("SELECT clean_shutdown, reconciled FROM status")
+        row = self._cursor.fetchone()
+        if row is None:
+            (clean, reconciled) = (0, 0)
+            self._cursor.execute("INSERT INTO status VALUES (0,0)")
+        else:
+            (clean, reconciled) = row
+        # If we crash before close() is called, the next process will see
+        # clean_shutdown=0 and rebuild the index from scratch.
+        self.was_clean = bool(clean)
+        self._reconciled = bool(reconciled) and bool(clean)
+        self._cursor.execute("UPDATE status SET clean_shutdown=0, reconciled=?",
+                             (int(self._reconciled),))
+        self._db.commit()
+
+    def is_trusted(self):
+        """Return True if my contents are believed to match shares/ ."""
+        return self._reconciled
+
+    @_locked
+    def mark_reconciled(self):
+        self._reconciled = True
+        self._cursor.execute("UPDATE status SET reconciled=1")
+        self._db.commit()
+
+    @_locked
+    def close(self):
+        if self._db is None:
+            return
+        self._cursor.execute("UPDATE status SET clean_shutdown=1")
+        self._db.commit()
+        self._db.close()
+        self._db = None
+
+    @_locked
+    def add_share(self, storage_index, shnum, sharetype, size,
+                  expiration_time=None):
+        self._cursor.execute("INSERT OR REPLACE INTO shares VALUES (?,?,?,?,?)",
+                             (si_b2a(storage_index), shnum, sharetype, size,
+                              expiration_time))
+        self._db.commit()
+
+    @_locked
+    def update_size(self, storage_index, shnum, size):
+        self._cursor.execute("UPDATE shares SET size=?"
+                             " WHERE storage_index=? AND shnum=?",
+                             (size, si_b2a(storage_index), shnum))
+        self._db.commit()
+
+    @_locked
+    def update_expiration(self, storage_index, shnum, expiration_time):
+        """Record that a lease on this share will last until at least
+        expiration_time. Leases are only ever extended by clients, so the
+        stored value never decreases here: use set_expiration() after leases
+        have been cancelled."""
+        self._cursor.execute("UPDATE shares SET expiration_time=?"
+                             " WHERE storage_index=? AND shnum=?"
+                             " AND (expiration_time IS NULL"
+                             "      OR expiration_time < ?)",
+                             (int(expiration_time), si_b2a(storage_index),
+                              shnum, int(expiration_time)))
+        self._db.commit()
+
+    @_locked
+    def set_expiration(self, storage_index, shnum, expiration_time):
+        self._cursor.execute("UPDATE shares SET expiration_time=?"
+                             " WHERE storage_index=? AND shnum=?",
+                             (expiration_time, si_b2a(storage_index), shnum))
+        self._db.commit()
+
+    @_locked
+    def remove_share(self, storage_index, shnum):
+        self._cursor.execute("DELETE FROM shares"
+                             " WHERE storage_index=? AND shnum=?",
+                             (si_b2a(storage_index), shnum))
+        self._db.commit()
+
+    @_locked
+    def get_shares(self, storage_index):
+        """Return a dict mapping shnum to a (sharetype, size,
+        expiration_time) tuple for all shares of the given storage index."""
+        self._cursor.execute("SELECT shnum, sharetype, size, expiration_time"
+                             " FROM shares WHERE storage_index=?",
+                             (si_b2a(storage_index),))
+        shares = {}
+        for (shnum, sharetype, size, expiration_time) in self._cursor.fetchall():
+            shares[shnum] = (str(sharetype), size, expiration_time)
+        return shares
+
+    @_locked
+    def has_shares(self):
+        self._cursor.execute("SELECT 1 FROM shares LIMIT 1")
+        return self._cursor.fetchone() is not None
+
+    @_locked
+    def get_storage_indexes_with_prefix(self, prefix):
+        """Return a set of base32 storage index strings (like the bucket
+        directory names) which start with the given two-character prefix."""
+        # base32 uses only lowercase letters and digits, so every string
+        # that starts with 'prefix' sorts before prefix+'~'.
+        self._cursor.execute("SELECT DISTINCT storage_index FROM shares"
+                             " WHERE storage_index >= ? AND storage_index < ?",
+                             (prefix, prefix + "~"))
+        return set([str(row[0]) for row in self._cursor.fetchall()])
+
+    @_locked
+    def replace_bucket(self, storage_index, shares):
+        """Replace all entries for this storage index with 'shares', a dict
+        in the form returned by get_shares()."""
+        si_s = si_b2a(storage_index)
+        self._cursor.execute("DELETE FROM shares WHERE storage_index=?",
+                             (si_s,))
+        for shnum, (sharetype, size, expiration_time) in shares.items():
+            self._cursor.execute("INSERT INTO shares VALUES (?,?,?,?,?)",
+                                 (si_s, shnum, sharetype, size,
+                                  expiration_time))
+        self._db.commit()
+
+
+def read_share_metadata(filename):
+    """Return (sharetype, size, expiration_time) for the share file at
+    'filename', where expiration_time is the latest expiration time of any
+    lease on the share (or None if there are no leases)."""
+    sf = get_share_file(filename)
+    size = os.stat(filename).st_size
+    expiration_time = None
+    for li in sf.get_leases():
+        expiration_time = max(expiration_time, li.get_expiration_time())
+    return (sf.sharetype, size, expiration_time)
+
+
+class ShareIndexReconciler(ShareCrawler):
+    """I walk all of the buckets in shares/ once, making the ShareIndex
+    agree with what is on disk, and then tell the StorageServer that it can
+    start trusting the index. The StorageServer keeps updating the index
+    while I run, so any bucket that I have already visited stays correct.
+    """
+
+    slow_start = 30 # the server answers from the filesystem meanwhile
+    minimum_cycle_time = 0
+    examine_in_threads = True # the ShareIndex has its own lock
+
+    def __init__(self, server, statefile, share_index):
+        self.share_index = share_index
+        ShareCrawler.__init__(self, server, statefile)
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        self._forget_vanished_buckets(prefix, buckets)
+        ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                       buckets, start_slice)
+
+    def examine_prefix(self, cycle, prefix, prefixdir, buckets, elsewhere):
+        self._forget_vanished_buckets(prefix, buckets)
+        ShareCrawler.examine_prefix(self, cycle, prefix, prefixdir, buckets,
+                                    elsewhere)
+
+    def _forget_vanished_buckets(self, prefix, buckets):
+        # forget about buckets which have vanished from this prefixdir
+        for si_s in self.share_index.get_storage_indexes_with_prefix(prefix):
+            # 'buckets' may have been listed in an earlier timeslice, so
+            # look again before discarding anything
+            if si_s in buckets:
+                continue
+            bucketdirs = [os.path.join(sharedir, prefix, si_s)
+                          for sharedir in self.sharedirs]
+            if not [d for d in bucketdirs if os.path.isdir(d)]:
+                self.share_index.replace_bucket(si_a2b(si_s), {})
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        shares = {}
+        try:
+            filenames = os.listdir(bucketdir)
+        except EnvironmentError:
+            filenames = []
+        for fn in filenames:
+            try:
+                shnum = int(fn)
+            except ValueError:
+                continue # non-numeric means not a sharefile
+            sharefile = os.path.join(bucketdir, fn)
+            try:
+                shares[shnum] = read_share_metadata(sharefile)
+            except (UnknownMutableContainerVersionError,
+                    UnknownImmutableContainerVersionError,
+                    struct.error, EnvironmentError):
+                self.server.log(format="share index: unable to read"
+                                " %(sharefile)s", sharefile=sharefile,
+                                level=log.WEIRD, umid="Vb1LZg")
+                continue
+        self.share_index.replace_bucket(si_a2b(storage_index_b32), shares)
+
+    def finished_cycle(self, cycle):
+        log.msg(format="share index reconciled in %(elapsed)d seconds",
+                elapsed=time.time() - self.state["current-cycle-start-time"],
+                facility="tahoe.storage", level=log.OPERATIONAL)
+        self.share_index.mark_reconciled()
+        self.disownServiceParent()
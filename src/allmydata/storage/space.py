@@ -0,0 +1,154 @@
+import time, weakref
+
+from twisted.application import service
+from twisted.application.internet import TimerService
+
+from allmydata.util import fileutil
+
+# Every allocate_buckets and get_version call used to run statvfs on each
+# share directory, and then walk the list of active BucketWriters to find
+# out how much of that space had already been promised to uploads. During
+# an upload storm both costs were paid for every allocation. The
+# SpaceAccountant keeps running totals instead: it adds a writer's
+# allocation when the writer is created, removes it when the writer is
+# closed or aborted, and (when given a refresh interval) re-reads the disk
+# statistics on a timer, subtracting the bytes written by shares that were
+# completed since the last refresh.
+
+DEFAULT_SPACE_REFRESH_INTERVAL = 30 # seconds
+
+class SpaceAccountant(service.MultiService):
+    """I keep track of the space available in each share directory, and
+    of the space that has been promised to BucketWriters and to allocations
+    that are still in progress.
+
+    If refresh_interval is 0, every query reads the disk statistics again,
+    just as the storage server used to. Otherwise they are read when I
+    start, and then every refresh_interval seconds. The methods that
+    change my totals must be called from the reactor thread, but the
+    get_available_space_per_dir() query is also used by the disk I/O
+    threads.
+    """
+    name = "space-accountant"
+
+    def __init__(self, sharedirs, reserved_space=0, readonly=False,
+                 refresh_interval=0):
+        service.MultiService.__init__(self)
+        self.sharedirs = list(sharedirs)
+        self.reserved_space = reserved_space
+        self.readonly = readonly
+        self.refresh_interval = refresh_interval
+        # space promised to allocate_buckets calls that are still waiting
+        # for the disk. We do not yet know which directory it will be taken
+        # from, so it counts against all of them.
+        self.pending = 0
+        # sharedir -> space promised to open BucketWriters
+        self._allocated = dict([(sharedir, 0) for sharedir in self.sharedirs])
+        # weakref(BucketWriter) -> (sharedir, allocated size)
+        self._writers = {}
+        # sharedir -> bytes added by shares completed since the last refresh
+        self._written = dict([(sharedir, 0) for sharedir in self.sharedirs])
+        self._avail = None # list, from fileutil.get_available_space
+        self._disk_stats = None # list of dicts, or the exception raised
+        self.last_refresh = None
+        self.refreshes = 0
+        if refresh_interval > 0:
+            t = TimerService(refresh_interval, self.refresh)
+            t.setServiceParent(self)
+
+    def refresh(self):
+        self._avail = [self._read_available_space(sharedir)
+                       for sharedir in self.sharedirs]
+        self._disk_stats = [self._read_disk_stats(sharedir)
+                            for sharedir in self.sharedirs]
+        for sharedir in self.sharedirs:
+            self._written[sharedir] = 0
+        self.last_refresh = time.time()
+        self.refreshes += 1
+
+    def _read_available_space(self, sharedir):
+        return fileutil.get_available_space(sharedir, self.reserved_space)
+
+    def _read_disk_stats(self, sharedir):
+        try:
+            return fileutil.get_disk_stats(sharedir, self.reserved_space)
+        except (AttributeError, EnvironmentError), e:
+            return e
+
+    def _cached(self):
+        if self._avail is None:
+            self.refresh()
+
+    def reserve_pending(self, size):
+        self.pending += size
+
+    def release_pending(self, size):
+        self.pending -= size
+
+    def writer_opened(self, writer, sharedir):
+        size = writer.allocated_size()
+        self._allocated[sharedir] += size
+        def _abandoned(ref):
+            # the writer was thrown away without being closed or aborted
+            if self._writers.pop(ref, None) is not None:
+                self._allocated[sharedir] -= size
+        self._writers[weakref.ref(writer, _abandoned)] = (sharedir, size)
+
+    def writer_closed(self, writer, consumed_size):
+        """The BucketWriter 'writer' has been closed (after adding
+        consumed_size bytes to its share directory) or aborted
+        (consumed_size == 0)."""
+        (sharedir, size) = self._writers.pop(weakref.ref(writer))
+        self._allocated[sharedir] -= size
+        self._written[sharedir] += consumed_size
+
+    def allocated_size(self):
+        return self.pending + sum(self._allocated.values())
+
+    def get_allocated_per_dir(self):
+        return [self.pending + self._allocated[sharedir]
+                for sharedir in self.sharedirs]
+
+    def get_available_space_per_dir(self):
+        """Returns a list with the available space (or None) in each of my
+        sharedirs, in the same order."""
+        if self.readonly:
+            return [0] * len(self.sharedirs)
+        if not self.refresh_interval:
+            return [self._read_available_space(sharedir)
+                    for sharedir in self.sharedirs]
+        self._cached()
+        per_dir = []
+        for sharedir, avail in zip(self.sharedirs, self._avail):
+            if avail is not None:
+                avail = max(0, avail - self._written[sharedir])
+            per_dir.append(avail)
+        return per_dir
+
+    def get_disk_stats_per_dir(self):
+        """Returns a list with the fileutil.get_disk_stats() dict for each
+        of my sharedirs. Raises AttributeError or EnvironmentError like
+        get_disk_stats() does."""
+        if not self.refresh_interval:
+            return [fileutil.get_disk_stats(sharedir, self.reserved_space)
+                    for sharedir in self.sharedirs]
+        self._cached()
+        per_dir = []
+        for sharedir, disk in zip(self.sharedirs, self._disk_stats):
+            if isinstance(disk, Exception):
+                raise disk
+            disk = disk.copy()
+            written = min(self._written[sharedir], disk['free_for_root'])
+            disk['used'] += written
+            for name in ('free_for_root', 'free_for_nonroot', 'avail'):
+                disk[name] = max(0, disk[name] - written)
+            per_dir.append(disk)
+        return per_dir
+
+    def get_stats(self):
+        stats = {"pending": self.pending,
+                 "refreshes": self.refreshes,
+                 }
+        if self.last_refresh is not None:
+            stats["seconds_since_refresh"] = time.time() - self.last_refresh
+        return stats
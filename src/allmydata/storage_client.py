@@ -29,10 +29,12 @@ the foolscap-based server implemented in src/allmydata/storage/*.py .
 # 6: implement other sorts of IStorageClient classes: S3, etc
 
 
-import re, time
+import re, time, weakref
 from zope.interface import implements
+from twisted.internet import defer
 from foolscap.api import eventually
-from allmydata.interfaces import IStorageBroker, IDisplayableServer, IServer
+from allmydata.interfaces import IStorageBroker, IDisplayableServer, IServer, \
+     MAX_GET_BUCKETS_MANY, MAX_ADD_LEASES_MANY, AddLeaseError
 from allmydata.util import log, base32
 from allmydata.util.assertutil import precondition
 from allmydata.util.rrefutil import add_version_to_remote_reference
@@ -335,3 +337,117 @@ class NativeStorageServer:
 
 class UnknownServerTypeError(Exception):
     pass
+
+
+# maps rref to a dict of storage_index -> [Deferred], for get_buckets()
+# queries that will be sent at the end of the current reactor turn
+_pending_get_buckets = weakref.WeakKeyDictionary()
+
+def get_buckets(server, storage_index):
+    """Ask the given IServer which shares it holds for storage_index, and
+    return a Deferred that fires with a dict mapping shnum to a
+    RemoteReference for an RIBucketReader, just like
+    callRemote('get_buckets').
+
+    If the server offers get_buckets_many(), all queries made to it during
+    the same reactor turn (for example by a deep-check which checks many
+    files at once) are sent together, in as few messages as its batch limit
+    allows.
+    """
+    rref = server.get_rref()
+    v = getattr(rref, "version", None) or {}
+    ver = v.get("http://allmydata.org/tahoe/protocols/storage/v1", {})
+    if not ver.get("maximum-get-buckets-many"):
+        return rref.callRemote("get_buckets", storage_index)
+    if rref not in _pending_get_buckets:
+        _pending_get_buckets[rref] = {}
+        eventually(_send_get_buckets_many, rref,
+                   min(ver["maximum-get-buckets-many"], MAX_GET_BUCKETS_MANY))
+    d = defer.Deferred()
+    _pending_get_buckets[rref].setdefault(storage_index, []).append(d)
+    return d
+
+def _send_get_buckets_many(rref, batch_size):
+    pending = _pending_get_buckets.pop(rref)
+    def _got_buckets(results, batch):
+        for storage_index in batch:
+            for waiter in pending[storage_index]:
+                waiter.callback(results.get(storage_index, {}))
+    def _failed(f, batch):
+        for storage_index in batch:
+            for waiter in pending[storage_index]:
+                waiter.errback(f)
+    storage_indexes = sorted(pending)
+    for i in range(0, len(storage_indexes), batch_size):
+        batch = storage_indexes[i:i+batch_size]
+        if len(batch) == 1:
+            # no point in using the fancy form
+            d = rref.callRemote("get_buckets", batch[0])
+            d.addCallback(lambda buckets, si=batch[0]: {si: buckets})
+        else:
+            d = rref.callRemote("get_buckets_many", batch)
+        d.addCallbacks(_got_buckets, _failed,
+                       callbackArgs=(batch,), errbackArgs=(batch,))
+        d.addErrback(log.err, facility="tahoe.storage_broker",
+                     level=log.WEIRD, umid="0Fv5gQ")
+
+
+# maps rref to a dict of (storage_index, renew_secret, cancel_secret) ->
+# [Deferred], for add_lease() requests that will be sent at the end of the
+# current reactor turn
+_pending_add_leases = weakref.WeakKeyDictionary()
+
+def add_lease(server, storage_index, renew_secret, cancel_secret):
+    """Ask the given IServer to add (or renew) a lease on the shares it holds
+    for storage_index, like callRemote('add_lease'). I return a Deferred
+    that fires with the number of shares that hold the lease, or with None
+    if the server did not say. If the server reports that it could not add
+    the lease, the Deferred errbacks with AddLeaseError.
+
+    If the server offers add_leases_many(), all leases requested from it
+    during the same reactor turn (for example by a deep-check --add-lease
+    which checks many files at once) are sent together, in as few messages
+    as its batch limit allows.
+    """
+    rref = server.get_rref()
+    v = getattr(rref, "version", None) or {}
+    ver = v.get("http://allmydata.org/tahoe/protocols/storage/v1", {})
+    if not ver.get("maximum-add-leases-many"):
+        return rref.callRemote("add_lease", storage_index,
+                               renew_secret, cancel_secret)
+    if rref not in _pending_add_leases:
+        _pending_add_leases[rref] = {}
+        eventually(_send_add_leases_many, rref,
+                   min(ver["maximum-add-leases-many"], MAX_ADD_LEASES_MANY))
+    d = defer.Deferred()
+    lease = (storage_index, renew_secret, cancel_secret)
+    _pending_add_leases[rref].setdefault(lease, []).append(d)
+    return d
+
+def _send_add_leases_many(rref, batch_size):
+    pending = _pending_add_leases.pop(rref)
+    def _added(results, batch):
+        for lease in batch:
+            res = results.get(lease[0])
+            for waiter in pending[lease]:
+                if isinstance(res, str):
+                    waiter.errback(AddLeaseError(res))
+                else:
+                    waiter.callback(res)
+    def _failed(f, batch):
+        for lease in batch:
+            for waiter in pending[lease]:
+                waiter.errback(f)
+    leases = sorted(pending)
+    for i in range(0, len(leases), batch_size):
+        batch = leases[i:i+batch_size]
+        if len(batch) == 1:
+            # no point in using the fancy form
+            d = rref.callRemote("add_lease", *batch[0])
+            d.addCallback(lambda ign: {})
+        else:
+            d = rref.callRemote("add_leases_many", batch)
+        d.addCallbacks(_added, _failed,
+                       callbackArgs=(batch,), errbackArgs=(batch,))
+        d.addErrback(log.err, facility="tahoe.storage_broker",
+                     level=log.WEIRD, umid="vB3nJw")
@@ -0,0 +1,374 @@
+"""
+Measure the throughput of a StorageServer in isolation.
+
+This drives a StorageServer in the same process, through the loopback
+RemoteReferences of allmydata.test.no_network (so each call goes through
+an eventual-send, much as it would through foolscap, but nothing is
+serialized and there is no network). It runs a set of synthetic workloads
+and prints the results as JSON, so that runs on different versions (or
+with different [storage] settings) can be compared:
+
+ upload:  allocate_buckets, write the share in --write-size pieces, close
+ read-N:  remote_read of N bytes at random offsets of the uploaded shares,
+          for each N in --read-sizes
+ mutable: slot_testv_and_readv_and_writev followed by slot_readv
+ lease:   add_lease and renew_lease on the uploaded shares
+ crawl:   full cycles of the bucket counter and the lease checker
+
+For each workload it reports the number of operations, the elapsed time,
+operations per second, and the latency percentiles of each kind of remote
+call. StorageServer constructor arguments can be set with
+--server-option, e.g. --server-option disk_io_threads=10 .
+
+Run it with 'make bench-storage', or as
+  bin/tahoe @src/allmydata/test/bench_storage.py [options]
+"""
+
+import os, sys, time, random, shutil, tempfile, itertools, simplejson
+
+from twisted.python import usage
+from twisted.internet import defer, reactor
+from twisted.application import service
+from foolscap.api import Referenceable
+
+from allmydata.storage.server import StorageServer
+from allmydata.test.no_network import wrap_storage_server
+from allmydata.util import hashutil
+from allmydata.util.histogram import LatencyHistogram
+
+WORKLOADS = ["upload", "read", "mutable", "lease", "crawl"]
+
+class Options(usage.Options):
+    optFlags = [
+        ("quiet", "q", "don't print the progress of each workload"),
+        ]
+    optParameters = [
+        ("workloads", "w", ",".join(WORKLOADS),
+         "comma-separated list of workloads to run"),
+        ("count", "n", 1000, "number of operations in each workload", int),
+        ("concurrency", "c", 10, "operations kept in flight", int),
+        ("share-size", None, 65536, "size of each uploaded share", int),
+        ("write-size", None, 131072, "size of each remote_write", int),
+        ("read-sizes", None, "1024,16384,131072",
+         "comma-separated sizes for the read-N workloads"),
+        ("mutable-size", None, 4096, "size of each mutable write", int),
+        ("crawler-cycles", None, 3, "number of crawler cycles to run", int),
+        ("seed", None, 0, "seed for the random offsets", int),
+        ("basedir", None, None,
+         "directory for the server (a temporary one is used and removed "
+         "if not given)"),
+        ("output", "o", None, "write the JSON results to this file"),
+        ]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self["server-options"] = {}
+
+    def opt_server_option(self, option):
+        """Pass NAME=VALUE to the StorageServer constructor (may be given
+        more than once). Integer values are converted."""
+        name, value = option.split("=", 1)
+        try:
+            value = int(value)
+        except ValueError:
+            pass
+        self["server-options"][name] = value
+
+    def postOptions(self):
+        self["workloads"] = [w.strip() for w in self["workloads"].split(",")
+                             if w.strip()]
+        for w in self["workloads"]:
+            if w not in WORKLOADS:
+                raise usage.UsageError("unknown workload %r" % (w,))
+        self["read-sizes"] = [int(s) for s in self["read-sizes"].split(",")]
+
+
+class Canary(Referenceable):
+    pass
+
+class Workload:
+    """I time the remote calls made by one workload."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = {} # remote method -> LatencyHistogram
+        self.ops = 0
+        self.bytes = 0
+        self.started = None
+        self.elapsed = None
+
+    def timed(self, methname, d_factory, *args):
+        start = time.time()
+        d = d_factory(*args)
+        def _done(res):
+            if methname not in self.latencies:
+                self.latencies[methname] = LatencyHistogram()
+            self.latencies[methname].add(time.time() - start)
+            return res
+        d.addCallback(_done)
+        return d
+
+    def run(self, op, count, concurrency):
+        """Call op(i) for each i in range(count), keeping up to
+        'concurrency' of the Deferreds it returns in flight."""
+        sem = defer.DeferredSemaphore(concurrency)
+        self.started = time.time()
+        ds = [sem.run(op, i) for i in range(count)]
+        d = defer.gatherResults(ds)
+        def _finished(res):
+            self.elapsed = time.time() - self.started
+            self.ops += count
+            return res
+        d.addCallback(_finished)
+        return d
+
+    def get_results(self):
+        results = {"ops": self.ops,
+                   "seconds": self.elapsed,
+                   "latencies": dict([(methname, h.get_summary())
+                                      for (methname, h)
+                                      in self.latencies.items()]),
+                   }
+        if self.elapsed:
+            results["ops_per_second"] = self.ops / self.elapsed
+            if self.bytes:
+                results["bytes_per_second"] = self.bytes / self.elapsed
+        return results
+
+
+class StorageBenchmark:
+    def __init__(self, options, basedir):
+        self.options = options
+        self.basedir = basedir
+        self.random = random.Random(options["seed"])
+        self._secret_counter = itertools.count()
+        self.parent = service.MultiService()
+        self.server = StorageServer(os.path.join(basedir, "storage"),
+                                    "\x00" * 20,
+                                    **options["server-options"])
+        self.server.setServiceParent(self.parent)
+        self.rref = wrap_storage_server(self.server)
+        self.storage_indexes = [] # of uploaded shares
+        self.lease_secrets = {} # storage index -> (renew, cancel)
+        self.results = {}
+
+    def secret(self):
+        return hashutil.tagged_hash("bench", "%d" % self._secret_counter.next())
+
+    def si(self, kind, i):
+        return hashutil.tagged_hash("bench-si-%s" % kind, "%d" % i)[:16]
+
+    def run(self):
+        self.parent.startService()
+        d = defer.succeed(None)
+        for name in self.options["workloads"]:
+            d.addCallback(lambda ign, name=name:
+                          getattr(self, "bench_%s" % name)())
+        def _stop(res):
+            d2 = defer.maybeDeferred(self.parent.stopService)
+            d2.addCallback(lambda ign: res)
+            return d2
+        d.addBoth(_stop)
+        d.addCallback(lambda ign: self.results)
+        return d
+
+    def _upload(self, workload, storage_index):
+        size = self.options["share-size"]
+        write_size = self.options["write-size"]
+        renew, cancel = self.secret(), self.secret()
+        self.lease_secrets[storage_index] = (renew, cancel)
+        d = workload.timed("allocate_buckets", self.rref.callRemote,
+                           "allocate_buckets", storage_index, renew, cancel,
+                           set([0]), size, Canary())
+        def _allocated((alreadygot, writers)):
+            bw = writers[0]
+            d2 = defer.succeed(None)
+            for offset in range(0, size, write_size):
+                data = "a" * min(write_size, size - offset)
+                d2.addCallback(lambda ign, offset=offset, data=data:
+                               workload.timed("write", bw.callRemote,
+                                              "write", offset, data))
+            d2.addCallback(lambda ign: workload.timed("close", bw.callRemote,
+                                                      "close"))
+            return d2
+        d.addCallback(_allocated)
+        def _uploaded(ign):
+            self.storage_indexes.append(storage_index)
+            workload.bytes += size
+        d.addCallback(_uploaded)
+        return d
+
+    def _ensure_shares(self):
+        # the read and lease workloads need something to work on, even
+        # when the upload workload was not run
+        if self.storage_indexes:
+            return defer.succeed(None)
+        setup = Workload("setup")
+        count = min(self.options["count"], 100)
+        return setup.run(lambda i: self._upload(setup, self.si("setup", i)),
+                         count, self.options["concurrency"])
+
+    def bench_upload(self):
+        w = Workload("upload")
+        d = w.run(lambda i: self._upload(w, self.si("upload", i)),
+                  self.options["count"], self.options["concurrency"])
+        d.addCallback(lambda ign: self._record(w))
+        return d
+
+    def bench_read(self):
+        d = self._ensure_shares()
+        d.addCallback(lambda ign: self._get_readers())
+        for size in self.options["read-sizes"]:
+            d.addCallback(self._bench_read_size, size)
+        return d
+
+    def _get_readers(self):
+        ds = [self.rref.callRemote("get_buckets", si)
+              for si in self.storage_indexes]
+        d = defer.gatherResults(ds)
+        d.addCallback(lambda bucketss: [buckets[0] for buckets in bucketss])
+        return d
+
+    def _bench_read_size(self, readers, size):
+        w = Workload("read-%d" % size)
+        share_size = self.options["share-size"]
+        size = min(size, share_size)
+        def _read(i):
+            reader = self.random.choice(readers)
+            offset = self.random.randrange(0, share_size - size + 1)
+            d = w.timed("read", reader.callRemote, "read", offset, size)
+            def _got(data):
+                w.bytes += len(data)
+            d.addCallback(_got)
+            return d
+        d = w.run(_read, self.options["count"], self.options["concurrency"])
+        d.addCallback(lambda ign: self._record(w))
+        d.addCallback(lambda ign: readers)
+        return d
+
+    def bench_mutable(self):
+        w = Workload("mutable")
+        size = self.options["mutable-size"]
+        num_slots = min(self.options["count"], 100)
+        slots = [(self.si("mutable", i),
+                  (self.secret(), self.secret(), self.secret()))
+                 for i in range(num_slots)]
+        def _write_and_read(i):
+            storage_index, secrets = slots[i % num_slots]
+            data = chr(ord("a") + i % 26) * size
+            d = w.timed("slot_testv_and_readv_and_writev",
+                        self.rref.callRemote,
+                        "slot_testv_and_readv_and_writev", storage_index,
+                        secrets, {0: ([], [(0, data)], None)}, [])
+            d.addCallback(lambda ign:
+                          w.timed("slot_readv", self.rref.callRemote,
+                                  "slot_readv", storage_index, [0],
+                                  [(0, size)]))
+            def _done(ign):
+                w.bytes += 2 * size
+            d.addCallback(_done)
+            return d
+        d = w.run(_write_and_read, self.options["count"],
+                  self.options["concurrency"])
+        d.addCallback(lambda ign: self._record(w))
+        return d
+
+    def bench_lease(self):
+        w = Workload("lease")
+        d = self._ensure_shares()
+        def _add_and_renew(i):
+            storage_index = self.storage_indexes[i % len(self.storage_indexes)]
+            renew, cancel = self.lease_secrets[storage_index]
+            d = w.timed("add_lease", self.rref.callRemote, "add_lease",
+                        storage_index, renew, cancel)
+            d.addCallback(lambda ign:
+                          w.timed("renew_lease", self.rref.callRemote,
+                                  "renew_lease", storage_index, renew))
+            return d
+        d.addCallback(lambda ign: w.run(_add_and_renew, self.options["count"],
+                                        self.options["concurrency"]))
+        d.addCallback(lambda ign: self._record(w))
+        return d
+
+    def bench_crawl(self):
+        w = Workload("crawl")
+        d = self._ensure_shares()
+        def _crawl(ign):
+            w.started = time.time()
+            for crawler in (self.server.bucket_counter,
+                            self.server.lease_checker):
+                # do a whole cycle at once, instead of a slice at a time
+                crawler.cpu_slice = sys.maxint
+                for i in range(self.options["crawler-cycles"]):
+                    start = time.time()
+                    crawler.start_current_prefix(start)
+                    name = crawler.__class__.__name__
+                    if name not in w.latencies:
+                        w.latencies[name] = LatencyHistogram()
+                    w.latencies[name].add(time.time() - start)
+                    w.ops += 1
+            w.elapsed = time.time() - w.started
+            self._record(w)
+            self.results["crawl"]["buckets"] = len(self.storage_indexes)
+        d.addCallback(_crawl)
+        return d
+
+    def _record(self, workload):
+        self.results[workload.name] = workload.get_results()
+        if not self.options["quiet"]:
+            print >>sys.stderr, "%s: %d ops in %.2fs" % (workload.name,
+                                                         workload.ops,
+                                                         workload.elapsed)
+
+
+def run(options):
+    basedir = options["basedir"]
+    remove_basedir = False
+    if basedir is None:
+        basedir = tempfile.mkdtemp(prefix="bench_storage")
+        remove_basedir = True
+    b = StorageBenchmark(options, basedir)
+    d = b.run()
+    def _write(results):
+        output = {"parameters": dict([(k, v) for (k, v) in options.items()
+                                      if k not in ("basedir", "output", "quiet")]),
+                  "results": results,
+                  }
+        s = simplejson.dumps(output, indent=1, sort_keys=True) + "\n"
+        if options["output"]:
+            f = open(options["output"], "w")
+            f.write(s)
+            f.close()
+        else:
+            sys.stdout.write(s)
+    d.addCallback(_write)
+    def _cleanup(res):
+        if remove_basedir:
+            shutil.rmtree(basedir)
+        return res
+    d.addBoth(_cleanup)
+    return d
+
+def main(argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        print >>sys.stderr, "%s\n%s" % (e, options)
+        return 1
+    rc = []
+    def _start():
+        d = run(options)
+        def _done(res):
+            rc.append(0)
+        def _failed(f):
+            f.printTraceback(sys.stderr)
+            rc.append(1)
+        d.addCallbacks(_done, _failed)
+        d.addBoth(lambda ign: reactor.stop())
+    reactor.callWhenRunning(_start)
+    reactor.run()
+    return rc[0]
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
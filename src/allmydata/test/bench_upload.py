@@ -0,0 +1,155 @@
+"""
+Measure immutable upload throughput for different segment size policies.
+
+This uploads files through a client of an in-process grid (from
+allmydata.test.no_network: ten real StorageServers, reached through
+loopback RemoteReferences) and delays the response to every remote call
+by --rtt seconds, to simulate the round-trip time of a real network. Each
+file size in --file-sizes is uploaded once with the fixed 128KiB segment
+size, and once for each --max-segment-sizes value with the adaptive
+policy of [client]upload.max_segment_size set to it.
+
+For each upload it reports the segment size and number of segments that
+were used, the elapsed time and the throughput, as JSON:
+
+  bin/tahoe @src/allmydata/test/bench_upload.py --rtt 0.05 \\
+      --file-sizes 4MiB,64MiB --max-segment-sizes 1MiB,4MiB
+
+Run it with 'make bench-upload', or as shown above.
+"""
+
+import os, sys, time, shutil, tempfile, simplejson
+
+from twisted.python import usage
+from twisted.internet import defer, reactor
+from twisted.application import service
+
+from allmydata.immutable import upload
+from allmydata.test.no_network import NoNetworkGrid
+from allmydata.util.abbreviate import parse_abbreviated_size
+
+class Options(usage.Options):
+    optParameters = [
+        ("file-sizes", "f", "4MiB,64MiB",
+         "comma-separated sizes of the files to upload"),
+        ("max-segment-sizes", "m", "1MiB,4MiB",
+         "comma-separated values of [client]upload.max_segment_size to "
+         "compare with the fixed segment size"),
+        ("rtt", None, 0.05, "simulated round-trip time, in seconds", float),
+        ("basedir", None, None,
+         "directory for the grid (a temporary one is used and removed if "
+         "not given)"),
+        ("output", "o", None, "write the JSON results to this file"),
+        ]
+
+    def postOptions(self):
+        for name in ("file-sizes", "max-segment-sizes"):
+            self[name] = [parse_abbreviated_size(s.strip())
+                          for s in self[name].split(",") if s.strip()]
+
+
+class UploadBenchmark:
+    def __init__(self, options, basedir):
+        self.options = options
+        self.parent = service.MultiService()
+        self.grid = NoNetworkGrid(basedir)
+        self.grid.setServiceParent(self.parent)
+        for wrapper in self.grid.wrappers_by_id.values():
+            wrapper.delay = options["rtt"]
+        self.client = self.grid.clients[0]
+        self.results = []
+
+    def run(self):
+        self.parent.startService()
+        d = defer.succeed(None)
+        for file_size in self.options["file-sizes"]:
+            for adaptive in [None] + self.options["max-segment-sizes"]:
+                d.addCallback(lambda ign, file_size=file_size,
+                              adaptive=adaptive:
+                              self.upload(file_size, adaptive))
+        def _stop(res):
+            d2 = defer.maybeDeferred(self.parent.stopService)
+            d2.addCallback(lambda ign: res)
+            return d2
+        d.addBoth(_stop)
+        d.addCallback(lambda ign: self.results)
+        return d
+
+    def upload(self, file_size, adaptive_max_segsize):
+        params = self.client.encoding_params
+        params.pop("adaptive_max_segment_size", None)
+        if adaptive_max_segsize:
+            params["adaptive_max_segment_size"] = adaptive_max_segsize
+        # a random key, so that every upload pushes all of its shares
+        u = upload.Data(os.urandom(file_size), convergence=None)
+        start = time.time()
+        d = self.client.upload(u)
+        def _done(results):
+            elapsed = time.time() - start
+            ueb = results.get_uri_extension_data()
+            result = {"file_size": file_size,
+                      "max_segment_size": adaptive_max_segsize,
+                      "segment_size": ueb["segment_size"],
+                      "num_segments": ueb["num_segments"],
+                      "seconds": elapsed,
+                      "bytes_per_second": file_size / elapsed,
+                      }
+            self.results.append(result)
+            print >>sys.stderr, ("%d bytes in %d segments of %d: %.2fs"
+                                 % (file_size, ueb["num_segments"],
+                                    ueb["segment_size"], elapsed))
+        d.addCallback(_done)
+        return d
+
+
+def run(options):
+    basedir = options["basedir"]
+    remove_basedir = False
+    if basedir is None:
+        basedir = tempfile.mkdtemp(prefix="bench_upload")
+        remove_basedir = True
+    b = UploadBenchmark(options, basedir)
+    d = b.run()
+    def _write(results):
+        output = {"parameters": dict([(k, v) for (k, v) in options.items()
+                                      if k not in ("basedir", "output")]),
+                  "results": results,
+                  }
+        s = simplejson.dumps(output, indent=1, sort_keys=True) + "\n"
+        if options["output"]:
+            f = open(options["output"], "w")
+            f.write(s)
+            f.close()
+        else:
+            sys.stdout.write(s)
+    d.addCallback(_write)
+    def _cleanup(res):
+        if remove_basedir:
+            shutil.rmtree(basedir)
+        return res
+    d.addBoth(_cleanup)
+    return d
+
+def main(argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        print >>sys.stderr, "%s\n%s" % (e, options)
+        return 1
+    rc = []
+    def _start():
+        d = run(options)
+        def _done(res):
+            rc.append(0)
+        def _failed(f):
+            f.printTraceback(sys.stderr)
+            rc.append(1)
+        d.addCallbacks(_done, _failed)
+        d.addBoth(lambda ign: reactor.stop())
+    reactor.callWhenRunning(_start)
+    reactor.run()
+    return rc[0]
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
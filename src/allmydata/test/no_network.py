@@ -16,7 +16,7 @@
 import os
 from zope.interface import implements
 from twisted.application import service
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
 from twisted.python.failure import Failure
 from foolscap.api import Referenceable, fireEventually, RemoteException
 from base64 import b32encode
@@ -42,6 +42,8 @@ class LocalWrapper:
         self.broken = False
         self.hung_until = None
         self.post_call_notifier = None
+        # simulated network round-trip time, in seconds
+        self.delay = 0
         self.disconnectors = {}
         self.counter_by_methname = {}
 
@@ -62,6 +64,10 @@ class LocalWrapper:
                 return LocalWrapper(a)
             else:
                 return a
+        def wrap_result(r):
+            w = LocalWrapper(r)
+            w.delay = self.delay
+            return w
         args = tuple([wrap(a) for a in args])
         kwargs = dict([(k,wrap(kwargs[k])) for k in kwargs])
 
@@ -101,12 +107,19 @@ class LocalWrapper:
             if methname == "allocate_buckets":
                 (alreadygot, allocated) = res
                 for shnum in allocated:
-                    allocated[shnum] = LocalWrapper(allocated[shnum])
+                    allocated[shnum] = wrap_result(allocated[shnum])
             if methname == "get_buckets":
                 for shnum in res:
-                    res[shnum] = LocalWrapper(res[shnum])
+                    res[shnum] = wrap_result(res[shnum])
+            if methname == "get_buckets_many":
+                for buckets in res.values():
+                    for shnum in buckets:
+                        buckets[shnum] = wrap_result(buckets[shnum])
             return res
         d.addCallback(_return_membrane)
+        if self.delay:
+            d.addCallback(lambda res: task.deferLater(reactor, self.delay,
+                                                      lambda: res))
         if self.post_call_notifier:
             d.addCallback(self.post_call_notifier, self, methname)
         return d
@@ -159,7 +172,9 @@ class NoNetworkServer:
     def get_rref(self):
         return self.rref
     def get_version(self):
-        return self.rref.version
+        if self.rref:
+            return self.rref.version
+        return None
 
 class NoNetworkStorageBroker:
     implements(IStorageBroker)
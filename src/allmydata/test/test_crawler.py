@@ -1,6 +1,7 @@
 
-import time
+import time, threading
 import os.path
+import cPickle as pickle
 from twisted.trial import unittest
 from twisted.application import service
 from twisted.internet import defer
@@ -8,7 +9,9 @@ from foolscap.api import eventually, fireEventually
 
 from allmydata.util import fileutil, hashutil, pollmixin
 from allmydata.storage.server import StorageServer, si_b2a
-from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded, \
+     CrawlerWorkers
+from allmydata.storage.checkpoint import CheckpointLog
 
 from allmydata.test.test_storage import FakeCanary
 from allmydata.test.common_util import StallMixin
@@ -82,6 +85,39 @@ class OneShotCrawler(ShareCrawler):
         self.finished_d.callback(None)
         self.disownServiceParent()
 
+class ThreadedCrawler(ShareCrawler):
+    slow_start = 0
+    examine_in_threads = True
+    def __init__(self, *args, **kwargs):
+        ShareCrawler.__init__(self, *args, **kwargs)
+        self.all_buckets = []
+        self.threads = set()
+        self.prefixes_done = []
+        self.finished_d = defer.Deferred()
+    def examine_prefix(self, cycle, prefix, prefixdir, buckets, elsewhere):
+        self.threads.add(threading.currentThread())
+        return buckets
+    def process_prefix_result(self, cycle, prefix, buckets):
+        self.all_buckets.extend(buckets)
+        self.prefixes_done.append(prefix)
+    def finished_cycle(self, cycle):
+        eventually(self.finished_d.callback, None)
+
+class SlowPrefixCrawler(ShareCrawler):
+    cpu_slice = 0 # yield after every prefix
+    allowed_cpu_percentage = 0.5
+    slow_start = 0
+    def __init__(self, *args, **kwargs):
+        ShareCrawler.__init__(self, *args, **kwargs)
+        self.sleep_times = []
+        self.yield_cb = None
+    def finished_prefix(self, cycle, prefix):
+        time.sleep(0.1)
+    def yielding(self, sleep_time):
+        self.sleep_times.append(sleep_time)
+        if self.yield_cb:
+            self.yield_cb()
+
 class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
     def setUp(self):
         self.s = service.MultiService()
@@ -137,6 +173,36 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         c2.start_current_prefix(time.time())
         self.failUnlessEqual(sorted(sis), sorted(c2.all_buckets))
 
+    def test_multiple_sharedirs(self):
+        self.basedir = "crawler/Basic/multiple_sharedirs"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        sharedirs = [os.path.join(self.basedir, "disk%d" % i)
+                     for i in range(2)]
+        ss = StorageServer(self.basedir, serverid, sharedirs=sharedirs)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+        # move every other bucket to the second disk
+        for si_s in sis[::2]:
+            old = os.path.join(sharedirs[0], si_s[:2], si_s)
+            new = os.path.join(sharedirs[1], si_s[:2], si_s)
+            fileutil.make_dirs(os.path.dirname(new))
+            os.rename(old, new)
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        prefixdirs = {}
+        def _process_bucket(cycle, prefix, prefixdir, storage_index_b32):
+            prefixdirs[storage_index_b32] = prefixdir
+        c.process_bucket = _process_bucket
+        c.load_state()
+        c.start_current_prefix(time.time())
+        self.failUnlessEqual(sorted(sis), sorted(prefixdirs.keys()))
+        for i, si_s in enumerate(sis):
+            self.failUnlessEqual(prefixdirs[si_s],
+                                 os.path.join(sharedirs[(i+1) % 2], si_s[:2]))
+
     def test_service(self):
         self.basedir = "crawler/Basic/service"
         fileutil.make_dirs(self.basedir)
@@ -407,6 +473,112 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         return d
 
 
+    def test_threads(self):
+        self.basedir = "crawler/Basic/threads"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid, crawler_threads=4,
+                           crawler_cpu_budget=100.0)
+        ss.setServiceParent(self.s)
+
+        sis = [self.write(i, ss, serverid) for i in range(10)]
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ThreadedCrawler(ss, statefile)
+        self.failUnlessIdentical(c.workers, ss.crawler_workers)
+        c.setServiceParent(self.s)
+
+        d = c.finished_d
+        def _check(ignored):
+            self.failUnlessEqual(sorted(sis), sorted(c.all_buckets))
+            # the results were applied in order, but examined in threads
+            self.failUnlessEqual(c.prefixes_done, c.prefixes)
+            self.failIf(threading.currentThread() in c.threads)
+            s = c.get_state()
+            self.failUnlessEqual(s["last-cycle-finished"], 0)
+            self.failUnlessEqual(s["last-complete-prefix"], None)
+            self.failUnlessEqual(c.get_progress()["cycle-in-progress"], False)
+            stats = ss.get_stats()
+            self.failUnlessEqual(stats["storage_server.crawler_workers.jobs"],
+                                 len(c.prefixes))
+        d.addCallback(_check)
+        return d
+
+    def test_threads_stopped(self):
+        self.basedir = "crawler/Basic/threads_stopped"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid, crawler_threads=4,
+                           crawler_cpu_budget=100.0)
+        ss.setServiceParent(self.s)
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ThreadedCrawler(ss, statefile)
+        # examine the first batch of prefixes, then stop the crawler while
+        # the second one is being examined
+        c._examine_next_prefixes()
+        d = c._examining
+        def _first_batch(ignored):
+            self.failUnlessEqual(c.prefixes_done, c.prefixes[:4])
+            c._examine_next_prefixes()
+            d2 = c._examining
+            c.stopService()
+            return d2
+        d.addCallback(_first_batch)
+        def _check(ignored):
+            # the second batch was not applied, so it will be examined again
+            self.failUnlessEqual(c.prefixes_done, c.prefixes[:4])
+            c2 = ThreadedCrawler(ss, statefile)
+            self.failUnlessEqual(c2.last_complete_prefix_index, 3)
+            self.failUnlessEqual(c2.state["current-cycle"], 0)
+        d.addCallback(_check)
+        return d
+
+    def test_budget(self):
+        w = CrawlerWorkers(2, cpu_budget=0.5)
+        self.failUnlessEqual(w.get_delay(), 0)
+        w.spent(1.0)
+        # one second of work at half a second per second
+        self.failUnless(1.9 < w.get_delay() <= 2.0, w.get_delay())
+        w._last -= 10
+        self.failUnlessEqual(w.get_delay(), 0)
+        # the budget does not accumulate for long
+        w.spent(1.0)
+        self.failUnless(0.9 < w.get_delay() <= 1.0, w.get_delay())
+        self.failUnlessEqual(w.get_stats()["busy_time"], 2.0)
+
+    def test_pacer(self):
+        self.basedir = "crawler/Basic/pacer"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid, crawler_pacing_enabled=True)
+        ss.setServiceParent(self.s)
+        factor = [0.25]
+        ss.crawler_pacer.get_factor = lambda: factor[0]
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = SlowPrefixCrawler(ss, statefile)
+        self.failUnlessIdentical(c.pacer, ss.crawler_pacer)
+        d = defer.Deferred()
+        def _yielded():
+            if len(c.sleep_times) == 1:
+                # don't wait for the long sleep: the timer is set right
+                # after yielding() returns
+                factor[0] = 4.0
+                eventually(lambda: c.timer.reset(0))
+            else:
+                c.yield_cb = None
+                eventually(d.callback, None)
+        c.yield_cb = _yielded
+        c.setServiceParent(self.s)
+        def _check(ignored):
+            # a quarter of 50%: it sleeps for seven times as long as the
+            # prefix took
+            self.failUnless(c.sleep_times[0] >= 0.7, c.sleep_times)
+            # but it never uses more than 100%
+            self.failUnlessEqual(c.sleep_times[1], 0.0)
+        d.addCallback(_check)
+        return d
+
     def test_oneshot(self):
         self.basedir = "crawler/Basic/oneshot"
         fileutil.make_dirs(self.basedir)
@@ -437,3 +609,86 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_check)
         return d
 
+
+class Checkpoint(unittest.TestCase):
+    def test_log(self):
+        basedir = "crawler/Checkpoint/log"
+        fileutil.make_dirs(basedir)
+        statefile = os.path.join(basedir, "statefile")
+        cl = CheckpointLog(statefile, min_compaction_size=1000)
+        self.failUnlessEqual(cl.load(), None)
+        state = {"version": 1, "counts": {"aa": 1}, "corrupt": [],
+                 "gone": True}
+        cl.save(state)
+        self.failUnlessEqual(cl.snapshots_written, 1)
+        snapshot = fileutil.read(statefile)
+
+        state["counts"]["bb"] = 2
+        state["corrupt"].append(("si", 0))
+        del state["gone"]
+        cl.save(state)
+        cl.save(state) # nothing changed
+        self.failUnlessEqual(cl.entries_written, 1)
+        # only the log was written
+        self.failUnlessEqual(fileutil.read(statefile), snapshot)
+        self.failUnlessEqual(CheckpointLog(statefile).load(), state)
+
+        # an entry that was cut short is ignored
+        state["counts"]["aa"] = 3
+        cl.save(state)
+        f = open(cl.logfile, "rb+")
+        f.seek(-1, os.SEEK_END)
+        f.truncate()
+        f.close()
+        expected = {"version": 1, "counts": {"aa": 1, "bb": 2},
+                    "corrupt": [("si", 0)]}
+        cl2 = CheckpointLog(statefile, min_compaction_size=1000)
+        self.failUnlessEqual(cl2.load(), expected)
+        # and the next checkpoint starts a new log after a snapshot
+        expected["counts"]["cc"] = 4
+        cl2.save(expected)
+        self.failUnlessEqual(cl2.snapshots_written, 1)
+        self.failUnlessEqual(CheckpointLog(statefile).load(), expected)
+
+        # once the log is larger than the snapshot, it is compacted
+        for i in range(40):
+            expected["counts"]["cc"] = i
+            cl2.save(expected)
+        self.failUnlessEqual(cl2.snapshots_written, 2)
+        self.failUnlessEqual(CheckpointLog(statefile).load(), expected)
+
+    def test_stale_log(self):
+        basedir = "crawler/Checkpoint/stale_log"
+        fileutil.make_dirs(basedir)
+        statefile = os.path.join(basedir, "statefile")
+        cl = CheckpointLog(statefile)
+        cl.save({"a": 1})
+        cl.save({"a": 2})
+        # a statefile written by an older version has no log, and one that
+        # was written without the log being replaced does not use it
+        old_log = fileutil.read(cl.logfile)
+        fileutil.write(statefile, pickle.dumps({"a": 3}))
+        self.failUnlessEqual(CheckpointLog(statefile).load(), {"a": 3})
+        cl = CheckpointLog(statefile)
+        cl.save({"a": 4})
+        fileutil.write(cl.logfile, old_log)
+        self.failUnlessEqual(CheckpointLog(statefile).load(), {"a": 4})
+
+    def test_crawler(self):
+        basedir = "crawler/Checkpoint/crawler"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        statefile = os.path.join(basedir, "statefile")
+        c = BucketEnumeratingCrawler(ss, statefile)
+        c.cpu_slice = 0 # yield after every prefix
+        for i in range(10):
+            try:
+                c.start_current_prefix(time.time())
+            except TimeSliceExceeded:
+                pass
+            c.save_state()
+        self.failUnlessEqual(c.checkpoint.snapshots_written, 1)
+        self.failUnlessEqual(c.checkpoint.entries_written, 9)
+        c2 = BucketEnumeratingCrawler(ss, statefile)
+        self.failUnlessEqual(c2.state, c.state)
+        self.failUnlessEqual(c2.last_complete_prefix_index, 9)
@@ -1252,3 +1252,67 @@ class Large(DeepCheckBase, unittest.TestCase):
         d.addCallback(_check)
 
         return d
+
+    def test_batched_share_queries(self):
+        self.basedir = "deepcheck/Large/batched_share_queries"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        d = c0.create_dirnode()
+        def _created_root(n):
+            self.root = n
+            return n
+        d.addCallback(_created_root)
+        for i in range(5):
+            up = upload.Data("large enough for CHK %d" % i * 100, "")
+            d.addCallback(lambda ign, i=i, up=up:
+                          self.root.add_file(u"%d-large" % i, up))
+        def _start_deepcheck(ignored):
+            for s in c0.storage_broker.get_connected_servers():
+                s.get_rref()._clear_counters()
+            return self.root.start_deep_check().when_done()
+        d.addCallback(_start_deepcheck)
+        def _check(res):
+            c = res.get_counters()
+            self.failUnlessEqual(c["count-objects-checked"], 6)
+            self.failUnlessEqual(c["count-objects-healthy"], 6)
+            # the five files were checked at the same time, so each server
+            # was asked about all of them in one message
+            servers = c0.storage_broker.get_connected_servers()
+            for s in servers:
+                counters = s.get_rref().counter_by_methname
+                self.failUnlessEqual(counters.get("get_buckets_many"), 1)
+                self.failIf("get_buckets" in counters, counters)
+        d.addCallback(_check)
+        return d
+
+    def test_batched_add_leases(self):
+        self.basedir = "deepcheck/Large/batched_add_leases"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        d = c0.create_dirnode()
+        def _created_root(n):
+            self.root = n
+            return n
+        d.addCallback(_created_root)
+        for i in range(5):
+            up = upload.Data("large enough for CHK %d" % i * 100, "")
+            d.addCallback(lambda ign, i=i, up=up:
+                          self.root.add_file(u"%d-large" % i, up))
+        def _start_deepcheck(ignored):
+            for s in c0.storage_broker.get_connected_servers():
+                s.get_rref()._clear_counters()
+            return self.root.start_deep_check(add_lease=True).when_done()
+        d.addCallback(_start_deepcheck)
+        def _check(res):
+            c = res.get_counters()
+            self.failUnlessEqual(c["count-objects-checked"], 6)
+            self.failUnlessEqual(c["count-objects-healthy"], 6)
+            # the leases on the five files were sent to each server in one
+            # message. The root directory is checked on its own.
+            servers = c0.storage_broker.get_connected_servers()
+            for s in servers:
+                counters = s.get_rref().counter_by_methname
+                self.failUnlessEqual(counters.get("add_leases_many"), 1)
+                self.failUnless(counters.get("add_lease", 0) <= 1, counters)
+        d.addCallback(_check)
+        return d
@@ -609,6 +609,27 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(_got_data)
         return d
 
+    def test_download_no_readv(self):
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+
+        self.load_shares()
+
+        # make the client believe that the servers are too old to offer
+        # readv(), so it must send a separate read() for each span
+        for s in self.c0.storage_broker.get_connected_servers():
+            rref = s.get_rref()
+            v1 = rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+            del v1["supports-immutable-readv"]
+
+        n = self.c0.create_node_from_uri(immutable_uri)
+        d = download_to_data(n)
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+        d.addCallback(_got_data)
+        return d
+
     def test_download_segment(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
@@ -5,6 +5,7 @@ from twisted.python.failure import Failure
 from foolscap.api import fireEventually
 from allmydata import uri
 from allmydata.immutable import encode, upload, checker
+from allmydata.immutable.workers import EncodingWorkers, SYNCHRONOUS
 from allmydata.util import hashutil
 from allmydata.util.assertutil import _assert
 from allmydata.util.consumer import download_to_data
@@ -350,6 +351,68 @@ class Encode(unittest.TestCase):
         return self.do_encode(25, 101, 100, 5, 15, 8)
 
 
+class Pipeline(unittest.TestCase):
+    def setUp(self):
+        self.workers = EncodingWorkers(2)
+        self.workers.startService()
+
+    def tearDown(self):
+        return self.workers.stopService()
+
+    def encode(self, data, **kwargs):
+        e = encode.Encoder(**kwargs)
+        u = upload.Data(data, convergence="some convergence string")
+        u.set_default_encoding_parameters({'max_segment_size': 25,
+                                           'k': 3, 'happy': 7, 'n': 10})
+        eu = upload.EncryptAnUploadable(u, workers=kwargs.get("workers",
+                                                              SYNCHRONOUS))
+        d = e.set_encrypted_uploadable(eu)
+        shareholders = {}
+        def _ready(res):
+            servermap = {}
+            for shnum in range(10):
+                peer = FakeBucketReaderWriterProxy()
+                shareholders[shnum] = peer
+                servermap.setdefault(shnum, set()).add(peer.get_peerid())
+            e.set_shareholders(shareholders, servermap)
+            return e.start()
+        d.addCallback(_ready)
+        def _done(verifycap):
+            self.failUnlessEqual(e._pipeline, [])
+            return (verifycap.to_string(),
+                    dict([(shnum, peer.blocks)
+                          for (shnum, peer) in shareholders.items()]))
+        d.addCallback(_done)
+        return d
+
+    def do_compare(self, **kwargs):
+        # 5 segments (25, 25, 25, 25, 2)
+        data = make_data(102)
+        results = []
+        d = self.encode(data)
+        d.addCallback(results.append)
+        d.addCallback(lambda ign: self.encode(data, **kwargs))
+        d.addCallback(results.append)
+        def _check(ign):
+            (serial, pipelined) = results
+            self.failUnlessEqual(pipelined[0], serial[0])
+            self.failUnlessEqual(pipelined[1], serial[1])
+            self.failUnless(self.workers.get_stats()["jobs_run"] > 0)
+        d.addCallback(_check)
+        return d
+
+    def test_threads(self):
+        return self.do_compare(workers=self.workers)
+
+    def test_pipeline(self):
+        return self.do_compare(workers=self.workers, pipeline_depth=2)
+
+    def test_memory_limit(self):
+        # the memory limit is too small for even one segment, so the
+        # pipeline must still make progress one segment at a time
+        return self.do_compare(workers=self.workers, pipeline_depth=3,
+                               pipeline_max_memory=0)
+
 class Roundtrip(GridTestMixin, unittest.TestCase):
 
     # a series of 3*3 tests to check out edge conditions. One axis is how the
@@ -1,8 +1,9 @@
+import os, simplejson
 
 from twisted.trial import unittest
 from twisted.application import service
-from allmydata.stats import CPUUsageMonitor
-from allmydata.util import pollmixin
+from allmydata.stats import CPUUsageMonitor, PickleStatsGatherer
+from allmydata.util import pollmixin, fileutil, histogram
 import allmydata.test.common_util as testutil
 
 class FasterMonitor(CPUUsageMonitor):
@@ -37,3 +38,31 @@ class CPUUsage(unittest.TestCase, pollmixin.PollMixin, testutil.StallMixin):
         d.addCallback(_check)
         return d
 
+class Gatherer(unittest.TestCase):
+    def test_merged_latencies(self):
+        basedir = "stats/Gatherer/merged_latencies"
+        fileutil.make_dirs(basedir)
+        g = PickleStatsGatherer(basedir, verbose=False)
+        for (tubid, latencies) in [("tub1", range(0, 50)),
+                                   ("tub2", range(50, 100))]:
+            h = histogram.LatencyHistogram()
+            for l in latencies:
+                h.add(l / 1000.0)
+            stats = h.get_stats("storage_server.latencies.read.")
+            stats["storage_server.latencies.read.samplesize"] = h.count
+            stats["storage_server.allocated"] = 0
+            g.got_stats({"counters": {}, "stats": stats}, tubid, tubid)
+        # a node that runs no storage server
+        g.got_stats({"counters": {}, "stats": {}}, "tub3", "tub3")
+
+        merged = g.get_merged_latencies()
+        self.failUnlessEqual(merged.keys(), ["read"])
+        self.failUnlessEqual(merged["read"]["samplesize"], 100)
+        self.failUnlessAlmostEqual(merged["read"]["mean"], 0.0495)
+        median = merged["read"]["50_0_percentile"]
+        self.failUnless(abs(median - 0.050) < 0.002, median)
+
+        # the gatherer writes them out along with stats.pickle
+        f = open(os.path.join(basedir, "latencies.json"), "rb")
+        self.failUnlessEqual(simplejson.loads(f.read()), merged)
+        f.close()
@@ -1,22 +1,36 @@
 
-import time, os.path, platform, stat, re, simplejson, struct, shutil
+import time, os.path, platform, stat, re, simplejson, struct, shutil, threading
 
 from twisted.trial import unittest
 
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.application import service
 from foolscap.api import fireEventually
 import itertools
-from allmydata import interfaces
+from allmydata import interfaces, uri
 from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format
+from allmydata.util import histogram
 from allmydata.storage.server import StorageServer
 from allmydata.storage.mutable import MutableShareFile
-from allmydata.storage.immutable import BucketWriter, BucketReader
+from allmydata.storage.immutable import BucketWriter, BucketReader, ShareFile
 from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
-     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
+     si_b2a
 from allmydata.storage.lease import LeaseInfo
-from allmydata.storage.crawler import BucketCountingCrawler
-from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.crawler import BucketCountingCrawler, TimeSliceExceeded
+from allmydata.storage.expirer import LeaseCheckingCrawler, \
+     parse_whatif_policies
+from allmydata.storage.shareindex import ShareIndexReconciler
+from allmydata.storage.leasedb import LeaseDBImporter, lease_db_share
+from allmydata.storage.fdcache import OpenFileCache
+from allmydata.storage.pack import PackStore, build_container
+from allmydata.storage.blockcache import BlockCache
+from allmydata.storage.journal import ChangeJournal, CREATED, CLOSED, DELETED
+from allmydata.storage.diskio import DiskIOExecutor
+from allmydata.storage.scrubber import ShareScrubber
+from allmydata.stats import LoadMonitor
+from allmydata.storage.scheduler import IOScheduler, READ, MUTABLE_WRITE, \
+     IMMUTABLE_WRITE
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
 from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
@@ -27,10 +41,13 @@ from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
                                      SIGNATURE_SIZE, \
                                      VERIFICATION_KEY_SIZE, \
                                      SHARE_HASH_CHAIN_SIZE
+from allmydata.immutable import upload
 from allmydata.interfaces import BadWriteEnablerError
-from allmydata.test.common import LoggingServiceParent, ShouldFailMixin
+from allmydata.test.common import LoggingServiceParent, ShouldFailMixin, \
+     TEST_DATA, _corrupt_share_data, _corrupt_block_hashes
 from allmydata.test.common_web import WebRenderingMixin
-from allmydata.test.no_network import NoNetworkServer
+from allmydata.test.no_network import NoNetworkServer, GridTestMixin
+from allmydata.test import bench_storage
 from allmydata.web.storage import StorageStatus, remove_prefix
 
 class Marker:
@@ -50,6 +67,43 @@ class FakeCanary:
             return
         del self.disconnectors[marker]
 
+class StorageServerMixin:
+    """Start and stop a service parent for StorageServers, and write shares
+    to them. 'server_options' are passed to each StorageServer made by
+    create(), along with its keyword arguments."""
+    server_options = {}
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+        self._lease_secret = itertools.count()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", self.__class__.__name__, name)
+        return basedir
+
+    def create(self, name, parent=None, **kwargs):
+        options = dict(self.server_options)
+        options.update(kwargs)
+        ss = StorageServer(self.workdir(name), "\x00" * 20, **options)
+        ss.setServiceParent(parent or self.sparent)
+        return ss
+
+    def secret(self):
+        return hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+
+    def write_immutable(self, ss, storage_index, sharenums, data="a"*25):
+        already, writers = ss.remote_allocate_buckets(storage_index,
+                                                      self.secret(),
+                                                      self.secret(),
+                                                      sharenums, len(data),
+                                                      FakeCanary())
+        for wb in writers.values():
+            wb.remote_write(0, data)
+            wb.remote_close()
+
 class FakeStatsProvider:
     def count(self, name, delta=1):
         pass
@@ -65,7 +119,7 @@ class Bucket(unittest.TestCase):
         fileutil.make_dirs(os.path.join(basedir, "tmp"))
         return incoming, final
 
-    def bucket_writer_closed(self, bw, consumed):
+    def bucket_writer_closed(self, bw, consumed, bucket_delta=0):
         pass
     def add_latency(self, category, latency):
         pass
@@ -105,6 +159,89 @@ class Bucket(unittest.TestCase):
         self.failUnlessEqual(br.remote_read(25, 25), "b"*25)
         self.failUnlessEqual(br.remote_read(50, 7), "c"*7)
 
+    def test_readv(self):
+        incoming, final = self.make_workdir("test_readv")
+        bw = BucketWriter(self, incoming, final, 60, self.make_lease(),
+                          FakeCanary())
+        bw.remote_write(0, "a"*25)
+        bw.remote_write(25, "b"*25)
+        bw.remote_write(50, "c"*10)
+        bw.remote_close()
+
+        br = BucketReader(self, bw.finalhome)
+        self.failUnlessEqual(br.remote_readv([]), [])
+        # spans may overlap, and are truncated at the end of the share data
+        self.failUnlessEqual(br.remote_readv([(0, 25), (20, 10), (55, 10),
+                                              (60, 5), (25, 25)]),
+                             ["a"*25, "a"*5+"b"*5, "c"*5, "", "b"*25])
+
+    def test_readwrite_cached(self):
+        fc = OpenFileCache(2)
+        finals = []
+        for i in range(3):
+            incoming, final = self.make_workdir("test_readwrite_cached_%d" % i)
+            bw = BucketWriter(self, incoming, final, 50, self.make_lease(),
+                              FakeCanary())
+            bw.remote_write(0, "%d" % i * 50)
+            bw.remote_close()
+            finals.append(final)
+
+        br = BucketReader(self, finals[0], file_cache=fc)
+        self.failUnlessEqual(br.remote_read(0, 25), "0"*25)
+        self.failUnlessEqual(br.remote_read(25, 100), "0"*25)
+        self.failUnlessEqual(fc.get_stats(),
+                             {"hits": 3, "misses": 1, "evictions": 0, "open": 1})
+
+        # opening more files than the budget closes the oldest ones
+        br1 = BucketReader(self, finals[1], file_cache=fc)
+        br2 = BucketReader(self, finals[2], file_cache=fc)
+        self.failUnlessEqual(br2.remote_read(0, 5), "22222")
+        self.failUnlessEqual(br1.remote_read(0, 5), "11111")
+        self.failUnlessEqual(br.remote_read(0, 5), "00000")
+        stats = fc.get_stats()
+        self.failUnlessEqual(stats["open"], 2)
+        self.failUnlessEqual(stats["evictions"], 2)
+
+        # files which are replaced or deleted behind our back are noticed
+        fileutil.write(finals[0] + ".new", open(finals[1], "rb").read())
+        os.rename(finals[0] + ".new", finals[0])
+        self.failUnlessEqual(br.remote_read(0, 5), "11111")
+        br = BucketReader(self, finals[0], file_cache=fc)
+        self.failUnlessEqual(br.remote_read(0, 5), "11111")
+        os.unlink(finals[1])
+        self.failUnlessRaises(EnvironmentError, br1.remote_read, 0, 5)
+        os.unlink(finals[2])
+        fc.invalidate(finals[2])
+        self.failUnlessRaises(EnvironmentError, br2.remote_read, 0, 5)
+        self.failUnlessRaises(EnvironmentError,
+                              BucketReader, self, finals[2], file_cache=fc)
+
+        fc.close_all()
+        self.failUnlessEqual(fc.get_stats()["open"], 0)
+
+    def test_cached_file_in_use(self):
+        # a descriptor that is evicted or invalidated while another thread
+        # is reading from it stays open until that read is done
+        fc = OpenFileCache(1)
+        finals = []
+        for i in range(2):
+            incoming, final = self.make_workdir("test_cached_file_in_use_%d" % i)
+            fileutil.write(final, "%d" % i * 10)
+            finals.append(final)
+
+        of = fc._get(finals[0])
+        self.failUnlessEqual(fc.pread(finals[1], 0, 5), "11111") # evicts it
+        self.failUnlessEqual(of.pread(0, 5), "00000")
+        fc._release(of)
+        self.failUnlessRaises(EnvironmentError, os.fstat, of.fd)
+
+        of = fc._get(finals[1])
+        fc.invalidate(finals[1])
+        self.failUnlessEqual(of.pread(5, 5), "11111")
+        fc._release(of)
+        self.failUnlessRaises(EnvironmentError, os.fstat, of.fd)
+        self.failUnlessEqual(fc.get_stats()["open"], 0)
+
     def test_read_past_end_of_share_data(self):
         # test vector for immutable files (hard-coded contents of an immutable share
         # file):
@@ -164,6 +301,7 @@ class RemoteBucket:
     def __init__(self):
         self.read_count = 0
         self.write_count = 0
+        self.immutable_read_count = 0
 
     def callRemote(self, methname, *args, **kwargs):
         def _call():
@@ -172,6 +310,8 @@ class RemoteBucket:
 
         if methname == "slot_readv":
             self.read_count += 1
+        if methname in ("read", "readv"):
+            self.immutable_read_count += 1
         if "writev" in methname:
             self.write_count += 1
 
@@ -199,7 +339,7 @@ class BucketProxy(unittest.TestCase):
         return LeaseInfo(owner_num, renew_secret, cancel_secret,
                          expiration_time, "\x00" * 20)
 
-    def bucket_writer_closed(self, bw, consumed):
+    def bucket_writer_closed(self, bw, consumed, bucket_delta=0):
         pass
     def add_latency(self, category, latency):
         pass
@@ -216,7 +356,8 @@ class BucketProxy(unittest.TestCase):
                               uri_extension_size_max=500)
         self.failUnless(interfaces.IStorageBucketWriter.providedBy(bp), bp)
 
-    def _do_test_readwrite(self, name, header_size, wbp_class, rbp_class):
+    def _do_test_readwrite(self, name, header_size, wbp_class, rbp_class,
+                           server_readv=False):
         # Let's pretend each share has 100 bytes of data, and that there are
         # 4 segments (25 bytes each), and 8 shares total. So the two
         # per-segment merkle trees (crypttext_hash_tree,
@@ -263,6 +404,11 @@ class BucketProxy(unittest.TestCase):
             rb = RemoteBucket()
             rb.target = br
             server = NoNetworkServer("abc", None)
+            if server_readv:
+                class FakeServerRref:
+                    version = {"http://allmydata.org/tahoe/protocols/storage/v1":
+                               {"supports-immutable-readv": True}}
+                server = NoNetworkServer("abc", FakeServerRref())
             rbp = rbp_class(rb, server, storage_index="")
             self.failUnlessIn("to peer", repr(rbp))
             self.failUnless(interfaces.IStorageBucketReader.providedBy(rbp), rbp)
@@ -286,6 +432,13 @@ class BucketProxy(unittest.TestCase):
             d1.addCallback(lambda res: rbp.get_uri_extension())
             d1.addCallback(lambda res:
                            self.failUnlessEqual(res, uri_extension))
+            # header, four blocks, two hash trees, and then the share hashes
+            # and UEB, which take three reads unless they come from a
+            # single readv
+            expected_reads = 7 + (server_readv and 1 or 3)
+            d1.addCallback(lambda res:
+                           self.failUnlessEqual(rb.immutable_read_count,
+                                                expected_reads))
 
             return d1
 
@@ -301,6 +454,16 @@ class BucketProxy(unittest.TestCase):
         return self._do_test_readwrite("test_readwrite_v2",
                                        0x44, WriteBucketProxy_v2, ReadBucketProxy)
 
+    def test_readwrite_v1_readv(self):
+        return self._do_test_readwrite("test_readwrite_v1_readv",
+                                       0x24, WriteBucketProxy, ReadBucketProxy,
+                                       server_readv=True)
+
+    def test_readwrite_v2_readv(self):
+        return self._do_test_readwrite("test_readwrite_v2_readv",
+                                       0x44, WriteBucketProxy_v2, ReadBucketProxy,
+                                       server_readv=True)
+
 class Server(unittest.TestCase):
 
     def setUp(self):
@@ -337,6 +500,98 @@ class Server(unittest.TestCase):
         self.failUnlessIn('maximum-immutable-share-size', sv1)
         self.failUnlessIn('maximum-mutable-share-size', sv1)
 
+    def test_declares_immutable_readv(self):
+        ss = self.create("test_declares_immutable_readv")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('supports-immutable-readv'), sv1)
+
+    def test_get_buckets_many(self):
+        ss = self.create("test_get_buckets_many")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('maximum-get-buckets-many'), sv1)
+
+        for si, shnums in [("si0", [0,1]), ("si2", [4])]:
+            already,writers = self.allocate(ss, si, shnums, 75)
+            for wb in writers.values():
+                wb.remote_write(0, "data")
+                wb.remote_close()
+        # a share that is still being uploaded is not visible yet
+        already,writers = self.allocate(ss, "si3", [0], 75)
+
+        res = ss.remote_get_buckets_many(["si0", "si1", "si2", "si3"])
+        self.failUnlessEqual(set(res.keys()), set(["si0", "si2"]))
+        self.failUnlessEqual(set(res["si0"].keys()), set([0,1]))
+        self.failUnlessEqual(res["si2"][4].remote_read(0, 4), "data")
+        self.failUnlessEqual(ss.remote_get_buckets_many([]), {})
+
+    def test_add_leases_many(self):
+        ss = self.create("test_add_leases_many")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('maximum-add-leases-many'), sv1)
+
+        for si, shnums in [("si0", [0,1]), ("si2", [4])]:
+            already,writers = self.allocate(ss, si, shnums, 75)
+            for wb in writers.values():
+                wb.remote_write(0, "data")
+                wb.remote_close()
+        rs0,cs0 = (hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                   hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()))
+        rs1,cs1 = (hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                   hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()))
+
+        d = ss.remote_add_leases_many([("si0", rs0, cs0), ("si1", rs1, cs1),
+                                       ("si2", rs1, cs1)])
+        def _added(res):
+            self.failUnlessEqual(res, {"si0": 2, "si1": 0, "si2": 1})
+            leases = list(ss.get_leases("si0"))
+            self.failUnlessEqual(len(leases), 2)
+            self.failUnlessEqual(set([l.renew_secret for l in leases]),
+                                 set([leases[0].renew_secret, rs0]))
+            self.failUnlessEqual(len(list(ss.get_leases("si2"))), 2)
+            # renewing the same leases does not add more of them
+            return ss.remote_add_leases_many([("si0", rs0, cs0)])
+        d.addCallback(_added)
+        def _renewed(res):
+            self.failUnlessEqual(res, {"si0": 2})
+            self.failUnlessEqual(len(list(ss.get_leases("si0"))), 2)
+            return ss.remote_add_leases_many([])
+        d.addCallback(_renewed)
+        d.addCallback(self.failUnlessEqual, {})
+        return d
+
+    def test_add_leases_many_error(self):
+        ss = self.create("test_add_leases_many_error")
+        already,writers = self.allocate(ss, "si0", [0], 75)
+        writers[0].remote_write(0, "data")
+        writers[0].remote_close()
+        calls = []
+        class RecordingDiskQueue:
+            def call(self, key, then, f, *args, **kwargs):
+                calls.append(key)
+                return then(f(*args, **kwargs))
+        ss.disk = RecordingDiskQueue()
+        real_add_lease_on_disk = ss._add_lease_on_disk
+        def _add_lease_on_disk(storage_index, lease_info):
+            if storage_index == "si1":
+                raise EnvironmentError("disk on fire")
+            return real_add_lease_on_disk(storage_index, lease_info)
+        ss._add_lease_on_disk = _add_lease_on_disk
+        rs,cs = (hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()),
+                 hashutil.tagged_hash("blah", "%d" % self._lease_secret.next()))
+        d = ss.remote_add_leases_many([("si0", rs, cs), ("si1", rs, cs)])
+        def _added(res):
+            # each storage index is queued under its own key, and an error
+            # is reported for its storage index alone
+            self.failUnlessEqual(calls, ["si0", "si1"])
+            self.failUnlessEqual(res["si0"], 1)
+            self.failUnless(isinstance(res["si1"], str), res)
+            self.failUnlessIn("disk on fire", res["si1"])
+        d.addCallback(_added)
+        return d
+
     def test_declares_available_space(self):
         ss = self.create("test_declares_available_space")
         ver = ss.remote_get_version()
@@ -582,6 +837,219 @@ class Server(unittest.TestCase):
         ss.disownServiceParent()
         del ss
 
+    def test_space_accounting(self):
+        calls = []
+        def call_get_disk_stats(whichdir, reserved_space=0):
+            calls.append(whichdir)
+            return {'total': 20000, 'used': 10000,
+                    'free_for_root': 10000, 'free_for_nonroot': 10000,
+                    'avail': 10000 - reserved_space}
+        self.patch(fileutil, 'get_disk_stats', call_get_disk_stats)
+        workdir = self.workdir("test_space_accounting")
+        ss = StorageServer(workdir, "\x00" * 20, reserved_space=1000,
+                           space_refresh_interval=3600)
+        ss.setServiceParent(self.sparent)
+        # the disk statistics were read when the server started, and are
+        # not read again until the next refresh
+        self.failUnless(calls)
+        ncalls = len(calls)
+
+        canary = FakeCanary(True)
+        already, writers = self.allocate(ss, "vid1", [0, 1, 2], 1000, canary)
+        self.failUnlessEqual(len(writers), 3)
+        self.failUnlessEqual(ss.allocated_size(), 3000)
+        sv1 = ss.remote_get_version()['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnlessEqual(sv1["available-space"], 9000)
+        # only 6000 of those 9000 are still free
+        already2, writers2 = self.allocate(ss, "vid2", range(10), 1000)
+        self.failUnlessEqual(len(writers2), 6)
+        self.failUnlessEqual(ss.allocated_size(), 9000)
+        self.failUnlessEqual(len(calls), ncalls)
+
+        # aborted and abandoned writers give their space back
+        for bw in writers2.values():
+            bw.remote_abort()
+        del already2, writers2, bw
+        self.failUnlessEqual(ss.allocated_size(), 3000)
+        del writers[2]
+        self.failUnlessEqual(ss.allocated_size(), 2000)
+
+        # closed shares count as used, until the next refresh measures them
+        for bw in writers.values():
+            bw.remote_write(0, "a"*100)
+            bw.remote_close()
+        del already, writers, bw
+        self.failUnlessEqual(ss.allocated_size(), 0)
+        consumed = 2 * os.path.getsize(os.path.join(ss.sharedir,
+                                                    storage_index_to_dir("vid1"),
+                                                    "0"))
+        self.failUnlessEqual(ss.get_available_space(), 9000 - consumed)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.disk_avail"], 9000 - consumed)
+        self.failUnlessEqual(stats["storage_server.disk_used"], 10000 + consumed)
+        self.failUnlessEqual(stats["storage_server.allocated"], 0)
+        self.failUnlessEqual(len(calls), ncalls)
+
+        ss.space.refresh()
+        self.failUnless(len(calls) > ncalls)
+        self.failUnlessEqual(ss.get_available_space(), 9000)
+
+    def test_packed_shares(self):
+        workdir = self.workdir("test_packed_shares")
+        ss = StorageServer(workdir, "\x00" * 20, packed_share_max_size=1000)
+        ss.setServiceParent(self.sparent)
+        already, writers = self.allocate(ss, "si1", [0, 1], 100)
+        # larger shares still get a file of their own
+        already2, writers2 = self.allocate(ss, "si2", [0], 2000)
+        for bw in writers.values() + writers2.values():
+            bw.remote_write(0, "a"*100)
+            bw.remote_close()
+        self.failIf(os.path.exists(os.path.join(ss.sharedir,
+                                                storage_index_to_dir("si1"))))
+        self.failUnless(os.path.exists(os.path.join(ss.sharedir,
+                                                    storage_index_to_dir("si2"),
+                                                    "0")))
+        self.failUnlessEqual(ss.pack_store.get_shares("si1"), [0, 1])
+        self.failUnlessEqual(os.listdir(os.path.join(ss.sharedir, "incoming")),
+                             [])
+
+        readers = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(sorted(readers.keys()), [0, 1])
+        self.failUnlessEqual(readers[0].remote_read(0, 200), "a"*100)
+        self.failUnlessEqual(readers[1].remote_readv([(10, 5), (98, 10)]),
+                             ["aaaaa", "aa"])
+
+        # a second upload finds the packed shares, and adds its lease
+        already, writers = self.allocate(ss, "si1", [0, 1, 2], 100)
+        self.failUnlessEqual(already, set([0, 1]))
+        self.failUnlessEqual(writers.keys(), [2])
+        writers[2].remote_abort()
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 2)
+
+        rs = hashutil.tagged_hash("blah", "packed-renew")
+        cs = hashutil.tagged_hash("blah", "packed-cancel")
+        ss.remote_add_lease("si1", rs, cs)
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 3)
+        ss.remote_renew_lease("si1", rs)
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si1",
+                              hashutil.tagged_hash("blah", "nope"))
+        # readers follow a share that a new lease moved to another record
+        self.failUnlessEqual(readers[0].remote_read(0, 4), "aaaa")
+
+        # cancelling the last lease removes the share from its pack
+        for shnum, sf in ss._iter_shares("si1"):
+            for lease in list(sf.get_leases()):
+                sf.cancel_lease(lease.cancel_secret)
+        self.failUnlessEqual(ss.pack_store.get_shares("si1"), [])
+        self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.packs.shares"], 0)
+        self.failUnless(stats["storage_server.packs.dead_bytes"] > 0)
+
+        self.failUnless(ss.pack_store.compact() > 0)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.packs.dead_bytes"], 0)
+        self.failUnlessEqual(stats["storage_server.packs.compactions"], 1)
+        self.failUnlessEqual(ss.remote_get_buckets("si2")[0].remote_read(0, 4),
+                             "aaaa")
+
+    def test_pack_open_files(self):
+        workdir = self.workdir("test_pack_open_files")
+        ps = PackStore(os.path.join(workdir, "packs"), max_pack_size=100,
+                       max_open_packs=2)
+        self.addCleanup(ps.close)
+        # each share fills a pack of its own
+        for i in range(5):
+            ps.add_share("si%d" % i, 0, build_container(chr(65+i)*100, [], 0))
+        for i in range(5):
+            self.failUnlessEqual(ps.read_share_data("si%d" % i, 0, 0, 3),
+                                 chr(65+i)*3)
+        self.failUnlessEqual(ps._reads.get_stats()["open"], 2)
+        self.failUnlessEqual(ps.get_stats()["packs"], 5)
+
+        # compaction removes the packs of the deleted shares, and closes
+        # their files
+        for i in range(4):
+            ps.update("si%d" % i, 0, lambda container: (None, None))
+        self.failUnless(ps.compact() > 0)
+        stats = ps.get_stats()
+        self.failUnlessEqual(stats["packs"], 1)
+        self.failUnlessEqual(stats["dead_bytes"], 0)
+        self.failUnlessEqual(ps.read_share_data("si4", 0, 0, 3), "EEE")
+        self.failUnlessEqual([n for n in os.listdir(os.path.join(workdir,
+                                                                 "packs"))
+                              if n.startswith("pack-")], ["pack-00000004"])
+        self.failUnlessEqual(ps._reads.get_stats()["open"], 1)
+
+    def test_multiple_sharedirs(self):
+        workdir = self.workdir("test_multiple_sharedirs")
+        sharedirs = [os.path.join(workdir, "disk%d" % i) for i in range(2)]
+        space = {sharedirs[0]: 5000, sharedirs[1]: 8000}
+        def call_get_available_space(whichdir, reserved_space):
+            return space[whichdir]
+        self.patch(fileutil, 'get_available_space', call_get_available_space)
+        def call_get_disk_stats(whichdir, reserved_space=0):
+            return {'total': 10000, 'used': 10000 - space[whichdir],
+                    'free_for_root': space[whichdir],
+                    'free_for_nonroot': space[whichdir],
+                    'avail': space[whichdir]}
+        self.patch(fileutil, 'get_disk_stats', call_get_disk_stats)
+        ss = StorageServer(workdir, "\x00" * 20, sharedirs=sharedirs)
+        ss.setServiceParent(self.sparent)
+
+        sv1 = ss.remote_get_version()['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnlessEqual(sv1["maximum-immutable-share-size"], 8000)
+        # both directories are on the same filesystem here, so the aggregate
+        # only counts it once
+        self.failUnlessEqual(sv1["available-space"], 5000)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.sharedirs.0.disk_avail"],
+                             5000)
+        self.failUnlessEqual(stats["storage_server.sharedirs.1.disk_avail"],
+                             8000)
+
+        # the new bucket goes to the directory with the most space
+        already, writers = self.allocate(ss, "vid", [0, 1], 10)
+        for i, wb in writers.items():
+            wb.remote_write(0, "%10d" % i)
+            wb.remote_close()
+        bucketdir = os.path.join(sharedirs[1], storage_index_to_dir("vid"))
+        self.failUnlessEqual(sorted(os.listdir(bucketdir)), ["0", "1"])
+
+        # more shares of the same bucket stay with it, even when the other
+        # directory has more room
+        space[sharedirs[0]] = 9000
+        already, writers = self.allocate(ss, "vid", [0, 1, 2], 10)
+        self.failUnlessEqual(already, set([0, 1]))
+        self.failUnlessEqual(writers.keys(), [2])
+        writers[2].remote_write(0, "%10d" % 2)
+        writers[2].remote_close()
+        self.failUnlessEqual(sorted(os.listdir(bucketdir)), ["0", "1", "2"])
+
+        # while a different bucket goes to the other directory
+        already, writers = self.allocate(ss, "vid2", [0], 10)
+        writers[0].remote_write(0, "%10d" % 0)
+        writers[0].remote_close()
+        self.failUnless(os.path.exists(os.path.join(sharedirs[0],
+                                           storage_index_to_dir("vid2"), "0")))
+
+        for si, shnums in [("vid", [0, 1, 2]), ("vid2", [0])]:
+            readers = ss.remote_get_buckets(si)
+            self.failUnlessEqual(sorted(readers.keys()), shnums)
+            for shnum, br in readers.items():
+                self.failUnlessEqual(br.remote_read(0, 10), "%10d" % shnum)
+
+        # mutable slots are placed the same way
+        secrets = (hashutil.tagged_hash("we_blah", "we1"),
+                   hashutil.tagged_hash("blah", "renew"),
+                   hashutil.tagged_hash("blah", "cancel"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        writev("slot", secrets, {0: ([], [(0, "data")], None)}, [])
+        self.failUnless(os.path.exists(os.path.join(sharedirs[0],
+                                           storage_index_to_dir("slot"), "0")))
+        self.failUnlessEqual(ss.remote_slot_readv("slot", [], [(0, 4)]),
+                             {0: ["data"]})
+
     def test_seek(self):
         basedir = self.workdir("test_seek_behavior")
         fileutil.make_dirs(basedir)
@@ -777,6 +1245,580 @@ class Server(unittest.TestCase):
 
 
 
+    def test_share_fd_cache(self):
+        ss = self.create("test_share_fd_cache")
+        already,writers = self.allocate(ss, "si1", [0,1], 75)
+        for i,wb in writers.items():
+            wb.remote_write(0, "%25d" % i)
+            wb.remote_close()
+
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(b[0].remote_read(0, 25), "%25d" % 0)
+        self.failUnlessEqual(b[0].remote_read(0, 25), "%25d" % 0)
+        self.failUnlessEqual(b[1].remote_read(0, 25), "%25d" % 1)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.share_fd_cache.open"], 2)
+        self.failUnlessEqual(stats["storage_server.share_fd_cache.misses"], 2)
+        self.failUnless(stats["storage_server.share_fd_cache.hits"] >= 3,
+                        stats)
+
+        # deleting a share (as the lease expirer does) closes its file
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        os.unlink(fn)
+        ss.share_removed("si1", 0)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.share_fd_cache.open"], 1)
+        self.failUnlessEqual(set(ss.remote_get_buckets("si1").keys()), set([1]))
+
+    def test_share_fd_cache_disabled(self):
+        workdir = self.workdir("test_share_fd_cache_disabled")
+        ss = StorageServer(workdir, "\x00" * 20, share_fd_cache_size=0)
+        ss.setServiceParent(self.sparent)
+        already,writers = self.allocate(ss, "si1", [0], 75)
+        writers[0].remote_write(0, "data")
+        writers[0].remote_close()
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(b[0].remote_read(0, 4), "data")
+        self.failIf([k for k in ss.get_stats() if "share_fd_cache" in k])
+
+    def test_block_cache(self):
+        c = BlockCache(100)
+        c.put("si1", 0, 0, 20, "a" * 20)
+        c.put("si1", 1, 0, 20, "b" * 20)
+        c.put("si2", 0, 0, 20, "c" * 20)
+        self.failUnlessEqual(c.get("si1", 0, 0, 20), "a" * 20)
+        # only exactly the same range is served
+        self.failUnlessEqual(c.get("si1", 0, 0, 10), None)
+        # reads larger than a quarter of the budget are not kept
+        c.put("si3", 0, 0, 30, "d" * 30)
+        self.failUnlessEqual(c.get("si3", 0, 0, 30), None)
+        # si1-1 is the least recently used, so it goes first
+        c.put("si3", 0, 0, 25, "e" * 25)
+        c.put("si3", 0, 25, 25, "f" * 25)
+        self.failUnlessEqual(c.get("si1", 1, 0, 20), None)
+        self.failUnlessEqual(c.get("si1", 0, 0, 20), "a" * 20)
+        self.failUnlessEqual(c.get_stats(),
+                             {"hits": 2, "misses": 3, "evictions": 1,
+                              "entries": 4, "bytes": 90, "max_bytes": 100})
+        c.invalidate_share("si3", 0)
+        self.failUnlessEqual(c.get("si3", 0, 0, 25), None)
+        self.failUnlessEqual(c.get_stats()["bytes"], 40)
+
+    def test_server_block_cache(self):
+        workdir = self.workdir("test_server_block_cache")
+        ss = StorageServer(workdir, "\x00" * 20, block_cache_size=1000)
+        ss.setServiceParent(self.sparent)
+        already,writers = self.allocate(ss, "si1", [0], 75)
+        writers[0].remote_write(0, "%25d" % 0)
+        writers[0].remote_close()
+
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(b[0].remote_read(0, 25), "%25d" % 0)
+        self.failUnlessEqual(b[0].remote_readv([(0, 5), (0, 25)]),
+                             [" " * 5, "%25d" % 0])
+        # a second downloader is served from memory
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(b[0].remote_read(0, 25), "%25d" % 0)
+        self.failUnlessEqual(b[0].remote_readv([(0, 5), (0, 25)]),
+                             [" " * 5, "%25d" % 0])
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.block_cache.hits"], 3)
+        self.failUnlessEqual(stats["storage_server.block_cache.entries"], 2)
+        self.failUnlessEqual(stats["storage_server.block_cache.bytes"], 30)
+
+        # deleting the share (as the lease expirer does) drops its data
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        os.unlink(fn)
+        ss.share_removed("si1", 0)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.block_cache.entries"], 0)
+        self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+
+
+class ShareIndexing(StorageServerMixin, unittest.TestCase,
+                    pollmixin.PollMixin):
+    server_options = {"share_index_enabled": True}
+
+    def write_mutable(self, ss, storage_index, sharenums, new_length=None):
+        secrets = (hashutil.tagged_hash("we_blah", "we1"),
+                   self.secret(), self.secret())
+        tw_vectors = dict([(shnum, ([], [(0, "data"*5)], new_length))
+                           for shnum in sharenums])
+        return ss.remote_slot_testv_and_readv_and_writev(storage_index,
+                                                         secrets, tw_vectors,
+                                                         [])
+
+    def forbid_listdir(self):
+        def _listdir(path):
+            self.fail("listed %s" % (path,))
+        return self.patch(os, "listdir", _listdir)
+
+    def test_new_server_trusts_index(self):
+        ss = self.create("test_new_server_trusts_index")
+        self.failUnless(ss.share_index.is_trusted())
+        self.failIf(ss.have_shares())
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        self.write_immutable(ss, "si1", [0,1,2])
+        shares = ss.share_index.get_shares("si1")
+        self.failUnlessEqual(sorted(shares.keys()), [0,1,2])
+        (sharetype, size, expiration_time) = shares[0]
+        self.failUnlessEqual(sharetype, "immutable")
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        self.failUnlessEqual(size, os.path.getsize(fn))
+        self.failUnless(expiration_time > time.time())
+
+        # aborted uploads are not indexed
+        already, writers = ss.remote_allocate_buckets("si2", self.secret(),
+                                                      self.secret(), [0], 25,
+                                                      FakeCanary())
+        writers[0].remote_abort()
+        self.failUnlessEqual(ss.share_index.get_shares("si2"), {})
+
+        self.forbid_listdir()
+        self.failUnless(ss.have_shares())
+        b = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(sorted(b.keys()), [0,1,2])
+        self.failUnlessEqual(b[1].remote_read(0, 25), "a"*25)
+        self.failUnlessEqual(ss.remote_get_buckets("si2"), {})
+
+        # a second allocation sees the existing shares, and extends leases
+        already, writers = ss.remote_allocate_buckets("si1", self.secret(),
+                                                      self.secret(), [3], 25,
+                                                      FakeCanary())
+        self.failUnlessEqual(already, set([0,1,2]))
+        self.failUnlessEqual(sorted(writers.keys()), [3])
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        self.write_mutable(ss, "si1", [0,1])
+        shares = ss.share_index.get_shares("si1")
+        self.failUnlessEqual(sorted(shares.keys()), [0,1])
+        self.failUnlessEqual(shares[0][0], "mutable")
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        self.failUnlessEqual(shares[0][1], os.path.getsize(fn))
+
+        patcher = self.forbid_listdir()
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [], [(0, 8)]),
+                             {0: ["datadata"], 1: ["datadata"]})
+        self.failUnlessEqual(ss.remote_slot_readv("si2", [], [(0, 8)]), {})
+        self.failUnlessEqual(self.write_mutable(ss, "si1", [0]),
+                             (True, {0: [], 1: []}))
+        patcher.restore()
+
+        # deleting a share removes it from the index
+        self.write_mutable(ss, "si1", [1], new_length=0)
+        self.failUnlessEqual(sorted(ss.share_index.get_shares("si1").keys()),
+                             [0])
+
+    def test_vanished_share(self):
+        ss = self.create("test_vanished_share")
+        self.write_immutable(ss, "si1", [0,1])
+        self.write_mutable(ss, "si2", [0])
+        os.unlink(os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0"))
+        os.unlink(os.path.join(ss.sharedir, storage_index_to_dir("si2"), "0"))
+
+        self.failUnlessEqual(sorted(ss.remote_get_buckets("si1").keys()), [1])
+        self.failUnlessEqual(sorted(ss.share_index.get_shares("si1").keys()),
+                             [1])
+        self.failUnlessEqual(ss.remote_slot_readv("si2", [], [(0, 8)]), {})
+        self.failUnlessEqual(ss.share_index.get_shares("si2"), {})
+
+    def test_reconcile_existing_shares(self):
+        self.patch(ShareIndexReconciler, "slow_start", 0)
+        ss = self.create("test_reconcile_existing_shares",
+                         share_index_enabled=False)
+        self.write_immutable(ss, "si1", [0,1])
+        self.write_mutable(ss, "si2", [3])
+        d = defer.succeed(None)
+        d.addCallback(lambda ign: ss.disownServiceParent())
+        def _restart(ign):
+            ss2 = self.create("test_reconcile_existing_shares")
+            self.failIf(ss2.share_index.is_trusted())
+            # until the index is reconciled, the filesystem is used
+            self.failUnlessEqual(sorted(ss2.remote_get_buckets("si1").keys()),
+                                 [0,1])
+            self.ss2 = ss2
+            return self.poll(ss2.share_index.is_trusted)
+        d.addCallback(_restart)
+        def _reconciled(ign):
+            ss2 = self.ss2
+            self.failIf(ss2.share_index_reconciler.running)
+            self.failUnlessEqual(sorted(ss2.share_index.get_shares("si1")),
+                                 [0,1])
+            shares = ss2.share_index.get_shares("si2")
+            self.failUnlessEqual(shares.keys(), [3])
+            self.failUnlessEqual(shares[3][0], "mutable")
+            patcher = self.forbid_listdir()
+            self.failUnlessEqual(sorted(ss2.remote_get_buckets("si1").keys()),
+                                 [0,1])
+            patcher.restore()
+            return ss2.disownServiceParent()
+        d.addCallback(_reconciled)
+        def _restart_cleanly(ign):
+            # a clean shutdown means no further reconciliation is needed
+            ss3 = self.create("test_reconcile_existing_shares")
+            self.failUnless(ss3.share_index.is_trusted())
+            self.failUnlessEqual(sorted(ss3.share_index.get_shares("si1")),
+                                 [0,1])
+        d.addCallback(_restart_cleanly)
+        return d
+
+    def test_reconcile_after_crash(self):
+        self.patch(ShareIndexReconciler, "slow_start", 0)
+        ss = self.create("test_reconcile_after_crash")
+        self.write_immutable(ss, "si1", [0,1])
+        self.write_immutable(ss, "si2", [0])
+        # simulate updates that the index missed
+        ss.share_index.remove_share("si1", 1)
+        ss.share_index.add_share("si3", 0, "immutable", 100)
+        # a second server on the same directory without a clean shutdown of
+        # the first one should rebuild the index
+        parent = LoggingServiceParent()
+        parent.startService()
+        self.addCleanup(parent.stopService)
+        ss2 = self.create("test_reconcile_after_crash", parent=parent)
+        self.failIf(ss2.share_index.was_clean)
+        self.failIf(ss2.share_index.is_trusted())
+        d = self.poll(ss2.share_index.is_trusted)
+        def _reconciled(ign):
+            self.failUnlessEqual(sorted(ss2.share_index.get_shares("si1")),
+                                 [0,1])
+            self.failUnlessEqual(sorted(ss2.share_index.get_shares("si2")),
+                                 [0])
+            self.failUnlessEqual(ss2.share_index.get_shares("si3"), {})
+        d.addCallback(_reconciled)
+        return d
+
+
+class LeaseDatabase(StorageServerMixin, unittest.TestCase,
+                    pollmixin.PollMixin):
+    server_options = {"lease_db_enabled": True}
+
+    def file_leases(self, ss, storage_index, shnum):
+        fn = os.path.join(ss.sharedir, storage_index_to_dir(storage_index),
+                          "%d" % shnum)
+        return list(ShareFile(fn).get_leases())
+
+    def test_leases(self):
+        ss = self.create("test_leases")
+        self.failUnless(ss.lease_db.is_trusted())
+        self.write_immutable(ss, "si1", [0,1])
+        self.failUnlessEqual(len(ss.lease_db.get_leases("si1", 0)), 1)
+
+        rs, cs = self.secret(), self.secret()
+        ss.remote_add_lease("si1", rs, cs)
+        leases = ss.lease_db.get_leases("si1", 1)
+        self.failUnlessEqual(len(leases), 2)
+        self.failUnlessEqual(leases[1].renew_secret, rs)
+        self.failUnlessEqual(leases[1].cancel_secret, cs)
+        self.failUnlessEqual(len(list(ss.get_leases("si1"))), 2)
+        # the share files are left alone
+        self.failUnlessEqual(len(self.file_leases(ss, "si1", 0)), 1)
+
+        old_expiration = leases[1].expiration_time
+        ss.lease_db.import_leases("si1", 1,
+                                  [LeaseInfo(0, rs, cs, old_expiration - 10)])
+        self.failUnlessEqual(ss.lease_db.get_leases("si1", 1)[1].expiration_time,
+                             old_expiration)
+        ss.remote_renew_lease("si1", rs)
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si1",
+                              self.secret())
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si2", rs)
+
+        # cancelling the last lease in the database deletes the share
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        share = lease_db_share(ss.lease_db, "si1", 0, ShareFile(fn))
+        for lease in list(share.get_leases()):
+            share.cancel_lease(lease.cancel_secret)
+        self.failIf(os.path.exists(fn))
+        ss.share_removed("si1", 0)
+        self.failUnlessEqual(ss.lease_db.get_share_numbers("si1"), [1])
+
+    def test_expire_packed_share(self):
+        # every lease is older than the cutoff date
+        ss = self.create("test_expire_packed_share",
+                         packed_share_max_size=1000,
+                         expiration_enabled=True,
+                         expiration_mode="cutoff-date",
+                         expiration_cutoff_date=int(time.time()) + 1000)
+        self.failUnless(ss.lease_db.is_trusted())
+        self.write_immutable(ss, "si1", [0])
+        self.failUnlessEqual(ss.pack_store.get_shares("si1"), [0])
+        lc = ss.lease_checker
+        [sf] = list(ss._iter_share_files("si1"))
+        lc.process_packed_share(sf)
+        # the share is removed from its pack as well as from the database,
+        # so the next cycle does not import its leases again
+        self.failUnlessEqual(ss.pack_store.get_shares("si1"), [])
+        self.failUnlessEqual(ss.lease_db.get_leases("si1", 0), [])
+        self.failUnless(lc.packed_shares_removed)
+
+    def test_import_existing_leases(self):
+        self.patch(LeaseDBImporter, "slow_start", 0)
+        ss = self.create("test_import_existing_leases", lease_db_enabled=False)
+        self.write_immutable(ss, "si1", [0,1])
+        d = defer.succeed(None)
+        d.addCallback(lambda ign: ss.disownServiceParent())
+        def _restart(ign):
+            ss2 = self.create("test_import_existing_leases")
+            self.failIf(ss2.lease_db.is_trusted())
+            # until the import is complete, the share files are updated too
+            ss2.remote_add_lease("si1", self.secret(), self.secret())
+            self.failUnlessEqual(len(self.file_leases(ss2, "si1", 0)), 2)
+            self.ss2 = ss2
+            return self.poll(ss2.lease_db.is_trusted)
+        d.addCallback(_restart)
+        def _imported(ign):
+            ss2 = self.ss2
+            self.failIf(ss2.lease_db_importer.running)
+            self.failUnlessEqual(ss2.lease_db.get_share_numbers("si1"), [0,1])
+            self.failUnlessEqual(len(ss2.lease_db.get_leases("si1", 0)), 2)
+            ss2.remote_add_lease("si1", self.secret(), self.secret())
+            self.failUnlessEqual(len(self.file_leases(ss2, "si1", 0)), 2)
+            self.failUnlessEqual(len(ss2.lease_db.get_leases("si1", 0)), 3)
+            return ss2.disownServiceParent()
+        d.addCallback(_imported)
+        def _disabled(ign):
+            # running without the database makes it untrusted again
+            ss3 = self.create("test_import_existing_leases",
+                              lease_db_enabled=False)
+            self.failUnlessEqual(ss3.lease_db, None)
+            return ss3.disownServiceParent()
+        d.addCallback(_disabled)
+        def _reenabled(ign):
+            ss4 = self.create("test_import_existing_leases")
+            self.failIf(ss4.lease_db.is_trusted())
+        d.addCallback(_reenabled)
+        return d
+
+
+class DiskIO(StorageServerMixin, unittest.TestCase):
+
+    def test_same_key_is_ordered(self):
+        ex = DiskIOExecutor(3)
+        ex.setServiceParent(self.sparent)
+        events = []
+        b_has_run = threading.Event()
+        def _first():
+            # only finishes if the job with another key runs meanwhile
+            b_has_run.wait(10)
+            events.append("a1")
+        def _second():
+            events.append("a2")
+        def _other():
+            events.append("b")
+            b_has_run.set()
+        d1 = ex.run("disk", "a", _first)
+        d2 = ex.run("disk", "a", _second)
+        d3 = ex.run("disk", "b", _other)
+        d = defer.gatherResults([d1, d2, d3])
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(events, ["b", "a1", "a2"]))
+        return d
+
+    def test_per_device_limit(self):
+        ex = DiskIOExecutor(4, max_threads_per_device=1)
+        ex.setServiceParent(self.sparent)
+        lock = threading.Lock()
+        running = {"now": 0, "max": 0}
+        def _job():
+            lock.acquire()
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+            lock.release()
+            time.sleep(0.01)
+            lock.acquire()
+            running["now"] -= 1
+            lock.release()
+        ds = [ex.run("disk1", None, _job) for i in range(4)]
+        self.failUnlessEqual(ex.get_stats(), {"running": 1, "queued": 3})
+        d = defer.gatherResults(ds)
+        d.addCallback(lambda ign: self.failUnlessEqual(running["max"], 1))
+        return d
+
+    def test_server(self):
+        ss = self.create("test_server", disk_io_threads=2)
+        canary = FakeCanary()
+        d = ss.remote_allocate_buckets("si1", self.secret(), self.secret(),
+                                       set([0, 1]), 25, canary)
+        def _allocated((already, writers)):
+            self.failUnlessEqual(already, set())
+            self.failUnlessEqual(set(writers.keys()), set([0, 1]))
+            self.failUnlessEqual(ss.allocated_size(), 50)
+            # writes and close are queued behind each other
+            ds = []
+            for shnum, bw in writers.items():
+                ds.append(bw.remote_write(0, "%d" % shnum * 25))
+                ds.append(bw.remote_close())
+            return defer.gatherResults(ds)
+        d.addCallback(_allocated)
+        d.addCallback(lambda ign: ss.remote_get_buckets("si1"))
+        def _got(readers):
+            self.failUnlessEqual(set(readers.keys()), set([0, 1]))
+            self.failUnlessEqual(ss.allocated_size(), 0)
+            return readers[1].remote_readv([(0, 5), (20, 10)])
+        d.addCallback(_got)
+        d.addCallback(lambda datav: self.failUnlessEqual(datav,
+                                                         ["11111", "11111"]))
+
+        secrets = (hashutil.tagged_hash("we_blah", "we1"),
+                   self.secret(), self.secret())
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        def _write_mutable(ign):
+            # the second test vector can only pass if the first write has
+            # been applied before it is evaluated
+            d1 = writev("si2", secrets, {0: ([], [(0, "first")], None)}, [])
+            d2 = writev("si2", secrets,
+                        {0: ([(0, 5, "eq", "first")], [(0, "again")], None)},
+                        [(0, 5)])
+            d3 = ss.remote_slot_readv("si2", [0], [(0, 5)])
+            return defer.gatherResults([d1, d2, d3])
+        d.addCallback(_write_mutable)
+        def _written((r1, r2, r3)):
+            self.failUnlessEqual(r1, (True, {}))
+            self.failUnlessEqual(r2, (True, {0: ["first"]}))
+            self.failUnlessEqual(r3, {0: ["again"]})
+        d.addCallback(_written)
+        return d
+
+class ClientCanary(FakeCanary):
+    def __init__(self, tubid):
+        FakeCanary.__init__(self)
+        self.tubid = tubid
+    def getRemoteTubID(self):
+        return self.tubid
+
+class IOScheduling(StorageServerMixin, unittest.TestCase):
+
+    def test_priorities(self):
+        s = IOScheduler(max_outstanding=1, clock=task.Clock())
+        admitted = []
+        def _admit(priority, name):
+            d = s.admit(priority)
+            d.addCallback(lambda ign: admitted.append(name))
+        _admit(IMMUTABLE_WRITE, "upload1")
+        _admit(IMMUTABLE_WRITE, "upload2")
+        _admit(MUTABLE_WRITE, "writev")
+        _admit(READ, "read")
+        self.failUnlessEqual(admitted, ["upload1"])
+        stats = s.get_stats()
+        self.failUnlessEqual(stats["outstanding"], 1)
+        self.failUnlessEqual(stats["queued.immutable_write"], 1)
+        self.failUnlessEqual(stats["queued.mutable_write"], 1)
+        self.failUnlessEqual(stats["queued.read"], 1)
+        for i in range(4):
+            s.release()
+        self.failUnlessEqual(admitted,
+                             ["upload1", "read", "writev", "upload2"])
+        self.failUnlessEqual(s.get_stats()["outstanding"], 0)
+
+    def test_keyed_order(self):
+        # a read of a slot must not overtake an earlier write to it, even
+        # though reads are admitted first
+        s = IOScheduler(max_outstanding=1, clock=task.Clock())
+        admitted = []
+        def _admit(priority, name, key=None):
+            d = s.admit(priority, key=key)
+            d.addCallback(lambda ign: admitted.append(name))
+            d.addCallback(lambda ign: s.handed_off(key))
+        _admit(IMMUTABLE_WRITE, "upload")
+        _admit(MUTABLE_WRITE, "writev-si1", "si1")
+        _admit(READ, "readv-si1", "si1")
+        _admit(READ, "readv-si2", "si2")
+        self.failUnlessEqual(s.get_stats()["waiting_for_key"], 1)
+        for i in range(4):
+            s.release()
+        self.failUnlessEqual(admitted, ["upload", "readv-si2", "writev-si1",
+                                        "readv-si1"])
+        self.failUnlessEqual(s.get_stats()["waiting_for_key"], 0)
+
+    def test_client_rate(self):
+        clock = task.Clock()
+        s = IOScheduler(client_request_rate=1, client_request_burst=2,
+                        clock=clock)
+        admitted = []
+        def _admit(client_id, name):
+            d = s.admit(IMMUTABLE_WRITE, client_id)
+            d.addCallback(lambda ign: admitted.append(name))
+            d.addCallback(s.release)
+        for i in range(3):
+            _admit("tub1", "a%d" % i)
+        _admit("tub2", "b0")
+        _admit(None, "anonymous")
+        # tub1 has used up its burst, the others are not held back by it
+        self.failUnlessEqual(admitted, ["a0", "a1", "b0", "anonymous"])
+        self.failUnlessEqual(s.get_stats()["throttled"], 1)
+        self.failUnlessEqual(s.get_stats()["queued.immutable_write"], 1)
+        clock.advance(1)
+        self.failUnlessEqual(admitted, ["a0", "a1", "b0", "anonymous", "a2"])
+        self.failUnlessEqual(s.get_stats()["queued.immutable_write"], 0)
+
+    def test_server(self):
+        ss = self.create("test_server", io_scheduler_enabled=True,
+                         client_request_rate=1000)
+        canary = ClientCanary("tub1")
+        d = ss.remote_allocate_buckets("si1", self.secret(), self.secret(),
+                                       set([0]), 25, canary)
+        def _allocated((already, writers)):
+            bw = writers[0]
+            d2 = bw.remote_write(0, "a" * 25)
+            d2.addCallback(lambda ign: bw.remote_close())
+            return d2
+        d.addCallback(_allocated)
+        d.addCallback(lambda ign: ss.remote_get_buckets("si1"))
+        d.addCallback(lambda readers: readers[0].remote_read(0, 25))
+        def _read(data):
+            self.failUnlessEqual(data, "a" * 25)
+            stats = ss.get_stats()
+            # allocate, write, close, get_buckets, read
+            self.failUnlessEqual(stats["storage_server.io_scheduler.admitted"],
+                                 5)
+            self.failUnlessEqual(stats["storage_server.io_scheduler.outstanding"],
+                                 0)
+            self.failUnlessEqual(stats["storage_server.io_scheduler.clients"],
+                                 1)
+        d.addCallback(_read)
+        return d
+
+
+class Benchmark(unittest.TestCase):
+    def test_run(self):
+        # make sure bench_storage.py keeps working
+        basedir = os.path.join("storage", "Benchmark", "run")
+        fileutil.make_dirs(basedir)
+        output = os.path.join(basedir, "results.json")
+        options = bench_storage.Options()
+        options.parseOptions(["--quiet", "--count=5", "--share-size=1000",
+                              "--write-size=300", "--read-sizes=100,2000",
+                              "--crawler-cycles=1",
+                              "--basedir=%s" % os.path.join(basedir, "node"),
+                              "--output=%s" % output,
+                              "--server-option", "block_cache_size=10000"])
+        d = bench_storage.run(options)
+        def _check(ign):
+            data = simplejson.loads(open(output, "rb").read())
+            self.failUnlessEqual(data["parameters"]["server-options"],
+                                 {"block_cache_size": 10000})
+            results = data["results"]
+            self.failUnlessEqual(sorted(results.keys()),
+                                 ["crawl", "lease", "mutable", "read-100",
+                                  "read-2000", "upload"])
+            upload = results["upload"]
+            self.failUnlessEqual(upload["ops"], 5)
+            self.failUnlessEqual(upload["latencies"]["write"]["samplesize"],
+                                 20)
+            self.failUnless(upload["ops_per_second"] > 0, upload)
+            # reads are limited to the share size
+            self.failUnlessEqual(results["read-2000"]["latencies"]["read"]
+                                 ["samplesize"], 5)
+            self.failUnlessEqual(results["crawl"]["buckets"], 5)
+            self.failUnlessEqual(results["crawl"]["ops"], 2)
+        d.addCallback(_check)
+        return d
+
+
 class MutableServer(unittest.TestCase):
 
     def setUp(self):
@@ -838,6 +1880,58 @@ class MutableServer(unittest.TestCase):
         self.failUnlessIn(" had magic ", str(e))
         self.failUnlessIn(" but we wanted ", str(e))
 
+    def test_metadata_cache(self):
+        ss = self.create("test_metadata_cache")
+        cache = ss.mutable_metadata_cache
+        self.allocate(ss, "si1", "we1", self._lease_secret.next(), set([0]), 10)
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"), "0")
+        rstaraw = ss.remote_slot_testv_and_readv_and_writev
+        secrets = ( self.write_enabler("we1"),
+                    self.renew_secret("we1"),
+                    self.cancel_secret("we1") )
+        hits = cache.hits
+        for i in range(5):
+            data = chr(ord("a")+i) * (10*(i+1))
+            answer = rstaraw("si1", secrets,
+                             {0: ([], [(0,data)], None)},
+                             [(0,5)])
+            self.failUnlessEqual(answer[0], True)
+        # every write after the first found the header left by the previous
+        # one, even though each of them changed the data length
+        self.failUnlessEqual(cache.hits, hits+5)
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(0,60)]),
+                             {0: ["e"*50]})
+
+        # the cached header must agree with the one on disk
+        msf = MutableShareFile(fn)
+        f = open(fn, "rb")
+        self.failUnlessEqual(msf._read_data_length(f), 50)
+        f.close()
+
+        # a modification that bypasses the cache (like the lease expirer
+        # adding a lease) is noticed
+        for i in range(4):
+            msf.add_lease(LeaseInfo(1, self.renew_secret(100+i),
+                                    self.cancel_secret(100+i), 0, "\x00"*20))
+        misses = cache.misses
+        answer = rstaraw("si1", secrets,
+                         {0: ([], [(50,"f"*20)], None)},
+                         [(45,10)])
+        self.failUnlessEqual(answer, (True, {0: ["eeeee"]}))
+        self.failUnlessEqual(cache.misses, misses+1)
+        self.failUnlessEqual(len(list(MutableShareFile(fn).get_leases())), 6)
+        self.failUnlessEqual(ss.remote_slot_readv("si1", [0], [(45,30)]),
+                             {0: ["eeeee"+"f"*20]})
+
+        # bad write enablers are still rejected when the header is cached
+        bad_secrets = (self.write_enabler("we2"),) + secrets[1:]
+        self.failUnlessRaises(BadWriteEnablerError,
+                              rstaraw, "si1", bad_secrets, {}, [])
+
+        # deleting the share forgets it
+        answer = rstaraw("si1", secrets, {0: ([], [], 0)}, [])
+        self.failUnlessEqual(cache.get_stats()["entries"], 0)
+
     def test_container_size(self):
         ss = self.create("test_container_size")
         self.allocate(ss, "si1", "we1", self._lease_secret.next(),
@@ -2805,6 +3899,11 @@ class Stats(unittest.TestCase):
         ss.setServiceParent(self.sparent)
         return ss
 
+    def failUnlessClose(self, value, expected, output):
+        # the latency histograms are accurate to within about 3%
+        self.failUnless(abs(value - expected) <= 0.03*expected + 0.001,
+                        (value, expected, output))
+
     def test_latencies(self):
         ss = self.create("test_latencies")
         for i in range(10000):
@@ -2821,47 +3920,48 @@ class Stats(unittest.TestCase):
 
         self.failUnlessEqual(sorted(output.keys()),
                              sorted(["allocate", "renew", "cancel", "write", "get"]))
-        self.failUnlessEqual(len(ss.latencies["allocate"]), 1000)
-        self.failUnless(abs(output["allocate"]["mean"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["01_0_percentile"] - 9010) < 1, output)
-        self.failUnless(abs(output["allocate"]["10_0_percentile"] - 9100) < 1, output)
-        self.failUnless(abs(output["allocate"]["50_0_percentile"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["90_0_percentile"] - 9900) < 1, output)
-        self.failUnless(abs(output["allocate"]["95_0_percentile"] - 9950) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_0_percentile"] - 9990) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_9_percentile"] - 9999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["renew"]), 1000)
-        self.failUnless(abs(output["renew"]["mean"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["01_0_percentile"] -  10) < 1, output)
-        self.failUnless(abs(output["renew"]["10_0_percentile"] - 100) < 1, output)
-        self.failUnless(abs(output["renew"]["50_0_percentile"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["90_0_percentile"] - 900) < 1, output)
-        self.failUnless(abs(output["renew"]["95_0_percentile"] - 950) < 1, output)
-        self.failUnless(abs(output["renew"]["99_0_percentile"] - 990) < 1, output)
-        self.failUnless(abs(output["renew"]["99_9_percentile"] - 999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["write"]), 20)
-        self.failUnless(abs(output["write"]["mean"] - 9) < 1, output)
+        self.failUnlessEqual(output["allocate"]["samplesize"], 10000)
+        self.failUnlessEqual(output["allocate"]["count"], 10000)
+        self.failUnless(abs(output["allocate"]["mean"] - 4999.5) < 1, output)
+        self.failUnlessClose(output["allocate"]["01_0_percentile"], 100, output)
+        self.failUnlessClose(output["allocate"]["10_0_percentile"], 1000, output)
+        self.failUnlessClose(output["allocate"]["50_0_percentile"], 5000, output)
+        self.failUnlessClose(output["allocate"]["90_0_percentile"], 9000, output)
+        self.failUnlessClose(output["allocate"]["95_0_percentile"], 9500, output)
+        self.failUnlessClose(output["allocate"]["99_0_percentile"], 9900, output)
+        self.failUnlessClose(output["allocate"]["99_9_percentile"], 9990, output)
+
+        self.failUnlessEqual(output["renew"]["samplesize"], 1000)
+        self.failUnless(abs(output["renew"]["mean"] - 499.5) < 1, output)
+        self.failUnlessClose(output["renew"]["01_0_percentile"],  10, output)
+        self.failUnlessClose(output["renew"]["10_0_percentile"], 100, output)
+        self.failUnlessClose(output["renew"]["50_0_percentile"], 500, output)
+        self.failUnlessClose(output["renew"]["90_0_percentile"], 900, output)
+        self.failUnlessClose(output["renew"]["95_0_percentile"], 950, output)
+        self.failUnlessClose(output["renew"]["99_0_percentile"], 990, output)
+        self.failUnlessClose(output["renew"]["99_9_percentile"], 999, output)
+
+        self.failUnlessEqual(output["write"]["samplesize"], 20)
+        self.failUnless(abs(output["write"]["mean"] - 9.5) < 1, output)
         self.failUnless(output["write"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["write"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["write"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["write"]["90_0_percentile"] - 18) < 1, output)
-        self.failUnless(abs(output["write"]["95_0_percentile"] - 19) < 1, output)
+        self.failUnlessClose(output["write"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["write"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["write"]["90_0_percentile"], 18, output)
+        self.failUnlessClose(output["write"]["95_0_percentile"], 19, output)
         self.failUnless(output["write"]["99_0_percentile"] is None, output)
         self.failUnless(output["write"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["cancel"]), 10)
+        self.failUnlessEqual(output["cancel"]["samplesize"], 10)
         self.failUnless(abs(output["cancel"]["mean"] - 9) < 1, output)
         self.failUnless(output["cancel"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["cancel"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["cancel"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["cancel"]["90_0_percentile"] - 18) < 1, output)
+        self.failUnlessClose(output["cancel"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["cancel"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["cancel"]["90_0_percentile"], 18, output)
         self.failUnless(output["cancel"]["95_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["get"]), 1)
+        self.failUnlessEqual(output["get"]["samplesize"], 1)
         self.failUnless(output["get"]["mean"] is None, output)
         self.failUnless(output["get"]["01_0_percentile"] is None, output)
         self.failUnless(output["get"]["10_0_percentile"] is None, output)
@@ -2871,6 +3971,39 @@ class Stats(unittest.TestCase):
         self.failUnless(output["get"]["99_0_percentile"] is None, output)
         self.failUnless(output["get"]["99_9_percentile"] is None, output)
 
+        # the histograms are exported too, and can be rebuilt from the stats
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.latencies.get.buckets.%d"
+                                   % histogram.bucket_index(5000000)], 1)
+        h = histogram.from_stats(stats, "storage_server.latencies.allocate.")
+        self.failUnlessEqual(h.count, 10000)
+        self.failUnlessClose(h.get_percentile(0.5), 5000, stats)
+
+    def test_latency_window(self):
+        ss = self.create("test_latency_window")
+        now = [1000.0]
+        for category in ss.latencies:
+            ss.latencies[category].clock = lambda: now[0]
+        for i in range(100):
+            ss.add_latency("read", 0.5)
+        now[0] += 300
+        for i in range(100):
+            ss.add_latency("read", 1.5)
+        output = ss.get_latencies()
+        self.failUnlessEqual(output["read"]["samplesize"], 200)
+        self.failUnless(abs(output["read"]["mean"] - 1.0) < 0.001, output)
+
+        # the older samples fall out of the window, but are still counted
+        now[0] += 400
+        output = ss.get_latencies()
+        self.failUnlessEqual(output["read"]["samplesize"], 100)
+        self.failUnlessEqual(output["read"]["count"], 200)
+        self.failUnless(abs(output["read"]["mean"] - 1.5) < 0.001, output)
+
+        now[0] += 600
+        self.failIf("read" in ss.get_latencies())
+        self.failIf("storage_server.latencies.read.samplesize" in ss.get_stats())
+
 def remove_tags(s):
     s = re.sub(r'<[^>]*>', ' ', s)
     s = re.sub(r'\s+', ' ', s)
@@ -3034,6 +4167,372 @@ class BucketCounter(unittest.TestCase, pollmixin.PollMixin):
         ss.setServiceParent(self.s)
         return d
 
+    def write_bucket(self, ss, storage_index, sharenums=(0,)):
+        already, writers = ss.remote_allocate_buckets(storage_index,
+                                                      "\x00" * 32, "\x00" * 32,
+                                                      set(sharenums), 100,
+                                                      FakeCanary())
+        for bw in writers.values():
+            bw.remote_write(0, "a" * 100)
+            bw.remote_close()
+
+    def delete_share(self, ss, storage_index, shnum):
+        # the way the lease checker does it
+        os.unlink(os.path.join(ss.sharedir, storage_index_to_dir(storage_index),
+                               "%d" % shnum))
+        ss.share_removed(storage_index, shnum)
+
+    def test_bucket_counter_journal(self):
+        basedir = "storage/BucketCounter/bucket_counter_journal"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, change_journal_enabled=True)
+        c = ss.bucket_counter
+        self.failUnless(c.journal)
+        # nothing has been counted yet, so a full cycle is due
+        self.failUnlessEqual(c.state["journal-position"], None)
+        self.failUnlessEqual(c._next_cycle_time(), 0)
+
+        # storage indexes in the first and last prefixes
+        first = lambda i: "\xd6\x80" + "\x00" * 13 + chr(i)
+        last = lambda i: "\xce\x40" + "\x00" * 13 + chr(i)
+        self.failUnlessEqual(si_b2a(first(0))[:2], c.prefixes[0])
+        self.failUnlessEqual(si_b2a(last(0))[:2], c.prefixes[-1])
+
+        self.write_bucket(ss, first(0), [0, 1])
+        c.cpu_slice = 100.0
+        c.start_current_prefix(time.time())
+        self.failUnlessEqual(c.state["last-complete-bucket-count"], 1)
+        self.failUnless(c._next_cycle_time() > time.time() + 24*60*60)
+
+        # new buckets are counted from the journal, and so is a bucket
+        # whose last share is deleted, but not one that keeps a share
+        self.write_bucket(ss, first(1))
+        self.write_bucket(ss, last(0))
+        self.write_bucket(ss, last(1))
+        self.delete_share(ss, last(0), 0)
+        self.delete_share(ss, first(0), 0)
+        c.read_journal()
+        self.failUnlessEqual(c.state["last-complete-bucket-count"], 3)
+        counts = c.state["bucket-counts"][0]
+        self.failUnlessEqual(counts[c.prefixes[0]], 2)
+        self.failUnlessEqual(counts[c.prefixes[-1]], 1)
+        self.failUnlessEqual(sum(counts.values()), 3)
+
+        # during a cycle, changes to prefixes which have already been
+        # listed are applied to the new counts too, and the rest are left
+        # for the cycle to find. (The empty bucket directory of last(0) is
+        # still there, and the cycle counts it.)
+        c.cpu_slice = -1.0
+        self.failUnlessRaises(TimeSliceExceeded,
+                              c.start_current_prefix, time.time())
+        self.failUnlessEqual(c.last_complete_prefix_index, 0)
+        self.failUnlessEqual(c.state["bucket-counts"][1][c.prefixes[0]], 2)
+        self.write_bucket(ss, first(2))
+        self.write_bucket(ss, last(2))
+        c.read_journal()
+        self.failUnlessEqual(c.state["last-complete-bucket-count"], 5)
+        self.failUnlessEqual(c.state["bucket-counts"][1][c.prefixes[0]], 3)
+        c.cpu_slice = 100.0
+        c.start_current_prefix(time.time())
+        self.failUnlessEqual(c.state["last-cycle-finished"], 1)
+        self.failUnlessEqual(c.state["bucket-counts"][1][c.prefixes[-1]], 3)
+        self.failUnlessEqual(c.state["last-complete-bucket-count"], 6)
+
+        # a restarted server goes on reading the journal where it left off
+        c.save_state()
+        ss.change_journal.close()
+        ss = StorageServer(basedir, "\x00" * 20, change_journal_enabled=True)
+        c = ss.bucket_counter
+        self.failIfEqual(c.state["journal-position"], None)
+        self.write_bucket(ss, first(3))
+        c.read_journal()
+        self.failUnlessEqual(c.state["last-complete-bucket-count"], 7)
+        c.save_state()
+        ss.change_journal.close()
+
+        # but if the journal was disabled for a while, changes may have been
+        # missed, so a full cycle is due again
+        ss = StorageServer(basedir, "\x00" * 20)
+        self.failIf(os.path.exists(os.path.join(basedir, "change_journal")))
+        ss = StorageServer(basedir, "\x00" * 20, change_journal_enabled=True)
+        c = ss.bucket_counter
+        self.failUnlessEqual(c.state["journal-position"], None)
+        self.failUnlessEqual(c._next_cycle_time(), 0)
+        ss.change_journal.close()
+
+    def test_bucket_counter_journal_delayed(self):
+        # the disk I/O threads may move or delete several shares of a bucket
+        # before the reactor hears about any of them
+        basedir = "storage/BucketCounter/bucket_counter_journal_delayed"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, change_journal_enabled=True,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=-1000)
+        c = ss.bucket_counter
+        c.cpu_slice = 100.0
+        c.start_current_prefix(time.time())
+        self.failUnlessEqual(c.state["last-complete-bucket-count"], 0)
+
+        pending = []
+        class DelayedDiskQueue:
+            def call(self, key, then, f, *args, **kwargs):
+                pending.append((then, f(*args, **kwargs)))
+            def call_with_cleanup(self, key, then, cleanup, f, *args, **kwargs):
+                self.call(key, then, f, *args, **kwargs)
+        def run_callbacks():
+            while pending:
+                (then, res) = pending.pop(0)
+                then(res)
+
+        storage_index = "\x00" * 16
+        already, writers = ss.remote_allocate_buckets(storage_index,
+                                                      "\x00" * 32, "\x00" * 32,
+                                                      set([0, 1]), 100,
+                                                      FakeCanary())
+        for bw in writers.values():
+            bw.remote_write(0, "a" * 100)
+            bw._disk = DelayedDiskQueue()
+            bw.remote_close()
+        run_callbacks()
+        c.read_journal()
+        self.failUnlessEqual(c.state["last-complete-bucket-count"], 1)
+
+        lc = ss.lease_checker
+        lc.disk = DelayedDiskQueue()
+        for shnum in [0, 1]:
+            lc.process_share(os.path.join(ss.sharedir,
+                                          storage_index_to_dir(storage_index),
+                                          "%d" % shnum))
+        run_callbacks()
+        self.failUnlessEqual(list(ss._iter_share_files(storage_index)), [])
+        c.read_journal()
+        self.failUnlessEqual(c.state["last-complete-bucket-count"], 0)
+
+    def test_bucket_counter_journal_service(self):
+        basedir = "storage/BucketCounter/bucket_counter_journal_service"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, change_journal_enabled=True)
+        ss.bucket_counter.slow_start = 0
+        ss.bucket_counter.journal_interval = 0.1
+        ss.setServiceParent(self.s)
+        w = StorageStatus(ss)
+
+        def _counted():
+            return ss.bucket_counter.state["last-cycle-finished"] is not None
+        d = self.poll(_counted)
+        def _check(ignored):
+            html = w.renderSynchronously()
+            s = remove_tags(html)
+            self.failUnlessIn("Total buckets: 0 (the number of", s)
+            self.failUnlessIn("Next crawl in 6 days", s)
+            self.write_bucket(ss, "\x00" * 16)
+            def _updated():
+                state = ss.bucket_counter.state
+                return state["last-complete-bucket-count"] == 1
+            return self.poll(_updated)
+        d.addCallback(_check)
+        def _check2(ignored):
+            # the bucket was counted from the journal, without a new cycle
+            state = ss.bucket_counter.get_state()
+            self.failUnlessEqual(state["last-cycle-finished"], 0)
+            self.failUnlessEqual(state["current-cycle"], None)
+        d.addCallback(_check2)
+        return d
+
+
+class Journal(unittest.TestCase):
+    def test_journal(self):
+        basedir = "storage/Journal/journal"
+        j = ChangeJournal(basedir, segment_size=100)
+        start = j.get_position()
+        self.failUnless(j.is_valid_position(start))
+        self.failIf(j.is_valid_position(None))
+        j.add_reader("reader", start)
+        j.record(CREATED, "\x00" * 16, 0)
+        j.record(CLOSED, "\x00" * 16, 0, 1234, 1)
+        j.record(DELETED, "\xff" * 16, 3, 0, -1)
+        (entries, position) = j.read(start)
+        self.failUnlessEqual([e[1:] for e in entries],
+                             [("created", "a" * 26, 0, 0, 0),
+                              ("closed", "a" * 26, 0, 1234, 1),
+                              ("deleted", si_b2a("\xff" * 16), 3, 0, -1)])
+        # the entries filled more than one segment
+        self.failUnless(position[1] > start[1], position)
+        self.failUnlessEqual(position, j.get_position())
+        self.failUnlessEqual(j.read(position), ([], position))
+        self.failUnlessEqual(j.read(start, max_entries=2)[0], entries[:2])
+
+        # segments are kept until every reader is done with them
+        j.add_reader("other", start)
+        j.release("reader", position)
+        self.failUnless(os.path.exists(os.path.join(basedir, "changes.0")))
+        j.release("other", position)
+        self.failIf(os.path.exists(os.path.join(basedir, "changes.0")))
+        self.failIf(j.is_valid_position(start))
+        self.failUnlessEqual(j.get_stats()["entries_written"], 3)
+
+        # an entry that was cut short by a crash is skipped
+        j.close()
+        f = open(os.path.join(basedir, "changes.%d" % position[1]), "ab")
+        f.write("12345 closed aaaa")
+        f.close()
+        j = ChangeJournal(basedir, segment_size=100)
+        self.failUnless(j.is_valid_position(position))
+        j.record(DELETED, "\x00" * 16, 1)
+        (entries, position2) = j.read(position)
+        self.failUnlessEqual([e[1:] for e in entries],
+                             [("deleted", "a" * 26, 1, 0, 0)])
+        j.close()
+
+        # a new journal is not a continuation of the old one
+        fileutil.rm_dir(basedir)
+        j = ChangeJournal(basedir, segment_size=100)
+        self.failIf(j.is_valid_position(position2))
+        j.close()
+
+
+class Pacing(unittest.TestCase):
+    def test_pacer(self):
+        basedir = "storage/Pacing/pacer"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, crawler_pacing_enabled=True,
+                           crawler_max_client_latency=0.1,
+                           crawler_max_reactor_delay=0.05)
+        p = ss.crawler_pacer
+        now = [1000.0]
+        p.clock = lambda: now[0]
+
+        # while there are no clients, the crawlers speed up
+        self.failUnlessEqual(p.get_factor(), 1.5)
+        self.failUnlessIn("no client operations", p.get_status()["reason"])
+        for i in range(10):
+            p.update(now[0])
+        self.failUnlessEqual(p.factor, p.max_factor)
+
+        # slow client operations make them back off, but only once the next
+        # decision is due
+        ss.add_latency("read", 0.5)
+        self.failUnlessEqual(p.get_factor(), p.max_factor)
+        now[0] += p.update_interval
+        self.failUnlessEqual(p.get_factor(), p.max_factor / 2)
+        status = p.get_status()
+        self.failUnlessIn("backing off: client latency", status["reason"])
+        self.failUnlessEqual(status["client-operations"], 1)
+        for i in range(10):
+            p.update(now[0])
+        self.failUnlessEqual(p.factor, p.min_factor)
+
+        # fast ones let them recover, but not go faster than normal
+        for i in range(100):
+            ss.add_latency("write", 0.001)
+        for i in range(10):
+            p.update(now[0])
+        self.failUnlessEqual(p.factor, 1.0)
+        self.failUnlessIn("clients served well", p.get_status()["reason"])
+
+        # and so does a busy reactor
+        p.load_monitor.stats.extend([0.2] * p.delay_samples)
+        p.update(now[0])
+        self.failUnlessEqual(p.factor, 0.5)
+        self.failUnlessEqual(p.get_status()["reason"],
+                             "backing off: reactor delay 200ms")
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.crawler_pacer.factor"], 0.5)
+        self.failUnlessEqual(
+            stats["storage_server.crawler_pacer.client_operations"], 101)
+
+    def test_node_load_monitor(self):
+        basedir = "storage/Pacing/node_load_monitor"
+        fileutil.make_dirs(basedir)
+        sp = FakeStatsProvider()
+        sp.load_monitor = LoadMonitor(sp)
+        ss = StorageServer(basedir, "\x00" * 20, stats_provider=sp,
+                           crawler_pacing_enabled=True)
+        self.failUnlessIdentical(ss.crawler_pacer.load_monitor,
+                                 sp.load_monitor)
+        ss = StorageServer(os.path.join(basedir, "disabled"), "\x00" * 20)
+        self.failUnlessEqual(ss.crawler_pacer, None)
+        self.failIf("storage_server.crawler_pacer.factor" in ss.get_stats())
+
+
+class Scrubbing(GridTestMixin, unittest.TestCase, pollmixin.PollMixin):
+    def test_scrub(self):
+        self.basedir = "storage/Scrubbing/scrub"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        c0.encoding_params['max_segment_size'] = 12
+        d = c0.upload(upload.Data(TEST_DATA, convergence=""))
+        def _uploaded(ur):
+            self.uri = ur.get_uri()
+            si = uri.from_string(self.uri).get_storage_index()
+            self.si_b32 = base32.b2a(si)
+            shares = self.find_uri_shares(self.uri)
+            self.failUnlessEqual(len(shares), 10)
+            # damage the data of share 0, and the block hashes of share 1
+            self.corrupt_share(shares[0], _corrupt_share_data)
+            self.corrupt_share(shares[1], _corrupt_block_hashes)
+            self.holders = dict([(shnum, serverid)
+                                 for (shnum, serverid, fn) in shares])
+            self.scrubbers = {}
+            for (i, ss, storedir) in self.iterate_servers():
+                statefile = os.path.join(storedir, "share_scrubber.state")
+                scrubber = ShareScrubber(ss, statefile)
+                scrubber.slow_start = 0
+                scrubber.cpu_slice = 500
+                ss.share_scrubber = scrubber
+                scrubber.setServiceParent(ss)
+                self.scrubbers[ss.my_nodeid] = scrubber
+            def _finished():
+                for scrubber in self.scrubbers.values():
+                    if scrubber.get_state()["last-complete-cycle"] is None:
+                        return False
+                return True
+            return self.poll(_finished)
+        d.addCallback(_uploaded)
+        def _check(ignored):
+            examined = 0
+            corrupt = []
+            for scrubber in self.scrubbers.values():
+                last = scrubber.get_state()["last-complete-cycle"]
+                examined += last["examined-shares"]
+                corrupt.extend(last["corrupt-shares"])
+            self.failUnlessEqual(examined, 10)
+            self.failUnlessEqual(sorted(corrupt),
+                                 [(self.si_b32, 0), (self.si_b32, 1)])
+
+            for (shnum, reason) in [(0, "bad hash for block"),
+                                    (1, "bad block hash tree")]:
+                ss = self.scrubbers[self.holders[shnum]].server
+                advisories = os.listdir(ss.corruption_advisory_dir)
+                self.failUnlessEqual(len(advisories), 1)
+                f = open(os.path.join(ss.corruption_advisory_dir,
+                                      advisories[0]), "r")
+                report = f.read()
+                f.close()
+                self.failUnlessIn("type: immutable\n", report)
+                self.failUnlessIn("storage_index: %s\n" % self.si_b32, report)
+                self.failUnlessIn("share_number: %d\n" % shnum, report)
+                self.failUnlessIn(reason, report)
+                stats = ss.get_stats()
+                self.failUnlessEqual(
+                    stats["storage_server.share_scrubber.advisories_written"],
+                    1)
+
+            # the servers with good shares have nothing to report
+            ss = self.scrubbers[self.holders[2]].server
+            self.failIf(os.path.exists(ss.corruption_advisory_dir))
+            html = StorageStatus(ss).renderSynchronously()
+            self.failUnlessIn("checked 1 immutable shares", remove_tags(html))
+            self.failUnlessIn("found 0 corrupt", remove_tags(html))
+            ss = self.scrubbers[self.holders[0]].server
+            s = remove_tags(StorageStatus(ss).renderSynchronously())
+            self.failUnlessIn("found 1 corrupt", s)
+            self.failUnlessIn("SI %s shnum 0" % self.si_b32, s)
+        d.addCallback(_check)
+        return d
+
+
 class InstrumentedLeaseCheckingCrawler(LeaseCheckingCrawler):
     stop_after_first_bucket = False
     def process_bucket(self, *args, **kwargs):
@@ -3437,6 +4936,43 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addCallback(_check_html)
         return d
 
+    def test_expire_in_disk_queue(self):
+        # expired leases are cancelled through the server's disk queue, in
+        # order with the other operations on their storage index, and are
+        # checked again when their turn comes
+        basedir = "storage/LeaseCrawler/expire_in_disk_queue"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=-1000)
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        calls = []
+        class RecordingDiskQueue:
+            def call(self, key, then, f, *args, **kwargs):
+                calls.append((key, then, f, args, kwargs))
+        lc = ss.lease_checker
+        lc.disk = RecordingDiskQueue()
+        sf0 = list(ss._iter_share_files(immutable_si_0))[0]
+        sf1 = list(ss._iter_share_files(immutable_si_1))[0]
+        lc.process_share(sf0.home)
+        lc.process_share(sf1.home)
+        self.failUnlessEqual([key for (key, then, f, args, kwargs) in calls],
+                             [immutable_si_0, immutable_si_1])
+        self.failUnless(os.path.exists(sf0.home))
+
+        (key, then, f, args, kwargs) = calls[0]
+        then(f(*args, **kwargs))
+        self.failIf(os.path.exists(sf0.home))
+
+        # pretend that the leases of the other share were renewed before
+        # its turn came: they are no longer expired, so they are kept
+        lc.configured_policy = ("age", None, None, ("mutable", "immutable"))
+        (key, then, f, args, kwargs) = calls[1]
+        then(f(*args, **kwargs))
+        self.failUnlessEqual(len(list(sf1.get_leases())), 2)
+
     def test_expire_cutoff_date(self):
         basedir = "storage/LeaseCrawler/expire_cutoff_date"
         fileutil.make_dirs(basedir)
@@ -3700,6 +5236,98 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addCallback(_check_html)
         return d
 
+    def test_whatif(self):
+        basedir = "storage/LeaseCrawler/whatif"
+        fileutil.make_dirs(basedir)
+        policies = [("age:2000s", ("age", 2000, None,
+                                   ("immutable", "mutable"))),
+                    ("age:2000s:mutable", ("age", 2000, None, ("mutable",))),
+                    ("cutoff-date:1970-01-01", ("cutoff-date", None, 0,
+                                                ("immutable", "mutable"))),
+                    ]
+        ss = StorageServer(basedir, "\x00" * 20,
+                           expiration_whatif_policies=policies)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        webstatus = StorageStatus(ss)
+
+        self.make_shares(ss)
+        [immutable_si_0, immutable_si_1, mutable_si_2, mutable_si_3] = self.sis
+        def count_shares(si):
+            return len(list(ss._iter_share_files(si)))
+        def _get_sharefile(si):
+            return list(ss._iter_share_files(si))[0]
+
+        # the same leases as in test_expire_age: the first lease of each
+        # share is more than 2000s old, and two shares have another one
+        now = time.time()
+        sf0 = _get_sharefile(immutable_si_0)
+        self.backdate_lease(sf0, self.renew_secrets[0], now - 1000)
+        sf0_size = os.stat(sf0.home).st_size
+        sf1 = _get_sharefile(immutable_si_1)
+        self.backdate_lease(sf1, self.renew_secrets[1], now - 1000)
+        sf2 = _get_sharefile(mutable_si_2)
+        self.backdate_lease(sf2, self.renew_secrets[3], now - 1000)
+        sf2_size = os.stat(sf2.home).st_size
+        sf3 = _get_sharefile(mutable_si_3)
+        self.backdate_lease(sf3, self.renew_secrets[4], now - 1000)
+
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+
+        def _after_first_cycle(ignored):
+            # nothing was expired
+            for si in self.sis:
+                self.failUnlessEqual(count_shares(si), 1)
+            last = lc.get_state()["history"][0]
+            self.failUnlessEqual(last["whatif-policies"], policies)
+            self.failUnlessEqual(last["space-recovered"]["configured-shares"],
+                                 0)
+            rec = last["whatif-space-recovered"]
+            both = rec["age:2000s"]
+            self.failUnlessEqual(both["whatif-buckets"], 2)
+            self.failUnlessEqual(both["whatif-shares"], 2)
+            self.failUnlessEqual(both["whatif-shares-immutable"], 1)
+            self.failUnlessEqual(both["whatif-sharebytes"],
+                                 sf0_size + sf2_size)
+            mutable = rec["age:2000s:mutable"]
+            self.failUnlessEqual(mutable["whatif-buckets"], 1)
+            self.failUnlessEqual(mutable["whatif-shares"], 1)
+            self.failUnlessEqual(mutable["whatif-shares-immutable"], 0)
+            self.failUnlessEqual(mutable["whatif-sharebytes"], sf2_size)
+            none = rec["cutoff-date:1970-01-01"]
+            self.failUnlessEqual(none["whatif-buckets"], 0)
+            self.failUnlessEqual(none["whatif-shares"], 0)
+        d.addCallback(_after_first_cycle)
+        d.addCallback(lambda ign: self.render1(webstatus))
+        def _check_html(html):
+            s = remove_tags(html)
+            self.failUnlessIn("These expiration policies would recover:", s)
+            self.failUnlessIn("age:2000s:mutable - - 1 shares, 1 buckets "
+                              "(1 mutable / 0 immutable)", s)
+        d.addCallback(_check_html)
+        return d
+
+    def test_parse_whatif_policies(self):
+        DAY = 24*60*60
+        p = parse_whatif_policies
+        self.failUnlessEqual(p(""), [])
+        self.failUnlessEqual(p("age, age:7days:immutable,cutoff-date:2009-03-18"),
+                             [("age", ("age", None, None,
+                                       ("immutable", "mutable"))),
+                              ("age:7days:immutable",
+                               ("age", 7*DAY, None, ("immutable",))),
+                              ("cutoff-date:2009-03-18",
+                               ("cutoff-date", None, 1237334400,
+                                ("immutable", "mutable")))])
+        e = self.failUnlessRaises(ValueError, p, "cutoff-date")
+        self.failUnlessIn("must be 'age', 'age:DURATION', or "
+                          "'cutoff-date:DATE'", str(e))
+        e = self.failUnlessRaises(ValueError, p, "age:7days, age:7days")
+        self.failUnlessIn("listed twice", str(e))
+
     def test_bad_mode(self):
         basedir = "storage/LeaseCrawler/bad_mode"
         fileutil.make_dirs(basedir)
@@ -3966,6 +5594,19 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d = self.render1(page, args={"t": ["json"]})
         return d
 
+    def test_status_latencies(self):
+        basedir = "storage/WebStatus/status_latencies"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        ss.setServiceParent(self.s)
+        for i in range(100):
+            ss.add_latency("readv", 0.002)
+        w = StorageStatus(ss)
+        html = w.renderSynchronously()
+        s = remove_tags(html)
+        self.failUnlessIn("Operation Recent Total Mean", s)
+        self.failUnlessIn("readv 100 100 2.0ms 2.0ms 2.0ms 2.0ms 2.0ms -", s)
+
 class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
 
     def setUp(self):
@@ -3994,6 +5635,9 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
             self.failUnlessIn("Server Nodeid: %s"  % base32.b2a(nodeid), s)
             self.failUnlessIn("Accepting new shares: Yes", s)
             self.failUnlessIn("Reserved space: - 0 B (0)", s)
+            self.failUnlessIn("No operations in the last ten minutes.", s)
+            self.failUnlessIn("Share Data Cache Disabled.", s)
+            self.failUnlessIn("Crawler Pacing Fixed", s)
         d.addCallback(_check_html)
         d.addCallback(lambda ign: self.render_json(w))
         def _check_json(json):
@@ -4003,6 +5647,7 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
             self.failUnlessEqual(s["storage_server.reserved_space"], 0)
             self.failUnlessIn("bucket-counter", data)
             self.failUnlessIn("lease-checker", data)
+            self.failUnlessEqual(data["crawler-pacing"], None)
         d.addCallback(_check_json)
         return d
 
@@ -4010,6 +5655,53 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d = self.render1(page, args={"t": ["json"]})
         return d
 
+    def test_status_latencies(self):
+        basedir = "storage/WebStatus/status_latencies"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        ss.setServiceParent(self.s)
+        for i in range(100):
+            ss.add_latency("readv", 0.002)
+        w = StorageStatus(ss)
+        html = w.renderSynchronously()
+        s = remove_tags(html)
+        self.failUnlessIn("Operation Recent Total Mean", s)
+        self.failUnlessIn("readv 100 100 2.0ms 2.0ms 2.0ms 2.0ms 2.0ms -", s)
+
+    def test_status_block_cache(self):
+        basedir = "storage/WebStatus/status_block_cache"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, block_cache_size=2000)
+        ss.setServiceParent(self.s)
+        ss.block_cache.put("si1", 0, 0, 100, "a" * 100)
+        ss.block_cache.get("si1", 0, 0, 100)
+        ss.block_cache.get("si1", 0, 0, 10)
+        w = StorageStatus(ss)
+        html = w.renderSynchronously()
+        s = remove_tags(html)
+        self.failUnlessIn("Hit ratio: 50.0% (1 of 2 reads)", s)
+        self.failUnlessIn("Memory used: 100 B of 2.00 kB (1 ranges)", s)
+
+    def test_status_crawler_pacing(self):
+        basedir = "storage/WebStatus/status_crawler_pacing"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, crawler_pacing_enabled=True)
+        ss.setServiceParent(self.s)
+        for i in range(10):
+            ss.add_latency("read", 0.5)
+        ss.crawler_pacer.get_factor()
+        w = StorageStatus(ss)
+        html = w.renderSynchronously()
+        s = remove_tags(html)
+        self.failUnlessIn("Speed: 0.50 times normal (backing off: client latency", s)
+        self.failUnlessIn("Client operations in the last 2 minutes: 10 (90% within", s)
+        d = self.render_json(w)
+        def _check_json(json):
+            data = simplejson.loads(json)
+            self.failUnlessEqual(data["crawler-pacing"]["factor"], 0.5)
+        d.addCallback(_check_json)
+        return d
+
     def test_status_no_disk_stats(self):
         def call_get_disk_stats(whichdir, reserved_space=0):
             raise AttributeError()
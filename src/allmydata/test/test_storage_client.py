@@ -1,6 +1,10 @@
 
 from twisted.trial import unittest
-from allmydata.storage_client import NativeStorageServer
+from twisted.internet import defer
+from foolscap.api import flushEventualQueue
+from allmydata.storage_client import NativeStorageServer, get_buckets, \
+     add_lease
+from allmydata.interfaces import AddLeaseError
 
 
 class NativeStorageServerWithVersion(NativeStorageServer):
@@ -28,3 +32,133 @@ class TestNativeStorageServer(unittest.TestCase):
             })
         self.failUnlessEqual(nss.get_available_space(), 111)
 
+
+
+class FakeStorageServerRref:
+    def __init__(self, version, shares, errors=None):
+        self.version = version
+        self.shares = shares
+        self.errors = errors or {} # storage index -> add_leases_many error
+        self.calls = []
+    def callRemote(self, methname, *args):
+        self.calls.append( (methname,) + args )
+        if methname == "get_buckets":
+            return defer.succeed(self.shares.get(args[0], {}))
+        if methname == "get_buckets_many":
+            return defer.succeed(dict([(si, self.shares[si])
+                                       for si in args[0]
+                                       if si in self.shares]))
+        if methname == "add_lease":
+            return defer.succeed(None)
+        if methname == "add_leases_many":
+            results = {}
+            for (si, rs, cs) in args[0]:
+                if si in self.errors:
+                    results[si] = self.errors[si]
+                else:
+                    results[si] = len(self.shares.get(si, {}))
+            return defer.succeed(results)
+        return defer.fail(NameError(methname))
+
+class FakeServer:
+    def __init__(self, rref):
+        self.rref = rref
+    def get_rref(self):
+        return self.rref
+
+class GetBuckets(unittest.TestCase):
+    def _get_buckets(self, server, storage_indexes):
+        d = defer.gatherResults([get_buckets(server, si)
+                                 for si in storage_indexes])
+        d.addCallback(lambda res: flushEventualQueue().addCallback(lambda ign: res))
+        return d
+
+    def test_batched(self):
+        v1 = {"maximum-get-buckets-many": 2}
+        rref = FakeStorageServerRref(
+            {"http://allmydata.org/tahoe/protocols/storage/v1": v1},
+            {"si1": {0: "b0", 1: "b1"}, "si3": {2: "b2"}})
+        d = self._get_buckets(FakeServer(rref), ["si1", "si2", "si3", "si1"])
+        def _check(res):
+            self.failUnlessEqual(res, [{0: "b0", 1: "b1"}, {}, {2: "b2"},
+                                       {0: "b0", 1: "b1"}])
+            # each storage index is only asked for once, and the server's
+            # limit is respected
+            self.failUnlessEqual(rref.calls,
+                                 [("get_buckets_many", ["si1", "si2"]),
+                                  ("get_buckets", "si3")])
+        d.addCallback(_check)
+        return d
+
+    def test_old_server(self):
+        rref = FakeStorageServerRref(
+            {"http://allmydata.org/tahoe/protocols/storage/v1": {}},
+            {"si1": {0: "b0"}})
+        d = self._get_buckets(FakeServer(rref), ["si1", "si2"])
+        def _check(res):
+            self.failUnlessEqual(res, [{0: "b0"}, {}])
+            self.failUnlessEqual(rref.calls, [("get_buckets", "si1"),
+                                              ("get_buckets", "si2")])
+        d.addCallback(_check)
+        return d
+
+
+class AddLease(unittest.TestCase):
+    def _add_leases(self, server, leases):
+        d = defer.gatherResults([add_lease(server, *lease)
+                                 for lease in leases])
+        d.addCallback(lambda res: flushEventualQueue().addCallback(lambda ign: res))
+        return d
+
+    def test_batched(self):
+        v1 = {"maximum-add-leases-many": 2}
+        rref = FakeStorageServerRref(
+            {"http://allmydata.org/tahoe/protocols/storage/v1": v1},
+            {"si1": {0: "b0", 1: "b1"}, "si3": {2: "b2"}})
+        d = self._add_leases(FakeServer(rref),
+                             [("si1", "rs1", "cs1"), ("si2", "rs2", "cs2"),
+                              ("si3", "rs3", "cs3"), ("si1", "rs1", "cs1")])
+        def _check(res):
+            self.failUnlessEqual(res, [2, 0, None, 2])
+            # each lease is only sent once, and the server's limit is
+            # respected
+            self.failUnlessEqual(rref.calls,
+                                 [("add_leases_many", [("si1", "rs1", "cs1"),
+                                                       ("si2", "rs2", "cs2")]),
+                                  ("add_lease", "si3", "rs3", "cs3")])
+        d.addCallback(_check)
+        return d
+
+    def test_error(self):
+        v1 = {"maximum-add-leases-many": 2}
+        rref = FakeStorageServerRref(
+            {"http://allmydata.org/tahoe/protocols/storage/v1": v1},
+            {"si1": {0: "b0"}}, {"si2": "IOError: broken"})
+        server = FakeServer(rref)
+        d1 = add_lease(server, "si1", "rs1", "cs1")
+        d2 = add_lease(server, "si2", "rs2", "cs2")
+        d = flushEventualQueue()
+        d.addCallback(lambda ign: d1)
+        d.addCallback(self.failUnlessEqual, 1)
+        # the error for one storage index fails only its own lease
+        d.addCallback(lambda ign: d2)
+        def _failed(f):
+            f.trap(AddLeaseError)
+            self.failUnlessEqual(str(f.value), "IOError: broken")
+        d.addCallbacks(lambda res: self.fail("should have failed: %r" % (res,)),
+                       _failed)
+        return d
+
+    def test_old_server(self):
+        rref = FakeStorageServerRref(
+            {"http://allmydata.org/tahoe/protocols/storage/v1": {}},
+            {"si1": {0: "b0"}})
+        d = self._add_leases(FakeServer(rref),
+                             [("si1", "rs1", "cs1"), ("si2", "rs2", "cs2")])
+        def _check(res):
+            self.failUnlessEqual(res, [None, None])
+            self.failUnlessEqual(rref.calls,
+                                 [("add_lease", "si1", "rs1", "cs1"),
+                                  ("add_lease", "si2", "rs2", "cs2")])
+        d.addCallback(_check)
+        return d
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import os, shutil
+import os, shutil, time
 from cStringIO import StringIO
 from twisted.trial import unittest
 from twisted.python.failure import Failure
@@ -10,8 +10,9 @@ from foolscap.api import fireEventually
 import allmydata # for __full_version__
 from allmydata import uri, monitor, client
 from allmydata.immutable import upload, encode
+from allmydata.immutable.convergence_cache import ConvergenceCache
 from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError
-from allmydata.util import log, base32
+from allmydata.util import log, base32, fileutil
 from allmydata.util.assertutil import precondition
 from allmydata.util.deferredutil import DeferredListShouldSucceed
 from allmydata.test.no_network import GridTestMixin
@@ -22,7 +23,9 @@ from allmydata.storage_client import StorageFarmBroker
 from allmydata.storage.server import storage_index_to_dir
 from allmydata.client import Client
 
+KiB = 1024
 MiB = 1024*1024
+GiB = 1024*MiB
 
 def extract_uri(results):
     return results.get_uri()
@@ -76,6 +79,50 @@ class Uploadable(unittest.TestCase):
         d.addCallback(lambda res: u.close())
         return d
 
+    def test_filename_convergence_cache(self):
+        basedir = "upload/Uploadable/test_filename_convergence_cache"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "file")
+        fileutil.write(fn, "a"*41)
+        # files are only cached once they are a few seconds old
+        cache = ConvergenceCache(os.path.join(basedir, "cache.sqlite"),
+                                 clock=lambda: time.time() + 60)
+        self.addCleanup(cache.close)
+        params = {"k": 3, "happy": 5, "n": 10, "max_segment_size": 1024}
+        convergence = "some convergence string"
+        def _get_key(u):
+            u.set_default_encoding_parameters(params)
+            d = u.get_encryption_key()
+            def _got(key):
+                u.close()
+                return key
+            d.addCallback(_got)
+            return d
+        keys = []
+        d = _get_key(upload.FileName(fn, convergence, cache))
+        d.addCallback(keys.append)
+        d.addCallback(lambda ign: _get_key(upload.FileName(fn, convergence,
+                                                           cache)))
+        d.addCallback(keys.append)
+        d.addCallback(lambda ign: _get_key(upload.Data("a"*41, convergence)))
+        d.addCallback(keys.append)
+        def _check_hit(ign):
+            self.failUnlessEqual(keys[0], keys[2])
+            self.failUnlessEqual(keys[1], keys[2])
+            self.failUnlessEqual(cache.get_stats(), {"hits": 1, "misses": 1})
+            fileutil.write(fn, "b"*42)
+            return _get_key(upload.FileName(fn, convergence, cache))
+        d.addCallback(_check_hit)
+        d.addCallback(keys.append)
+        d.addCallback(lambda ign: _get_key(upload.Data("b"*42, convergence)))
+        d.addCallback(keys.append)
+        def _check_changed(ign):
+            self.failUnlessEqual(keys[3], keys[4])
+            self.failIfEqual(keys[3], keys[0])
+            self.failUnlessEqual(cache.get_stats(), {"hits": 1, "misses": 2})
+        d.addCallback(_check_changed)
+        return d
+
     def test_data(self):
         s = "a"*41
         u = upload.Data(s, convergence=None)
@@ -88,6 +135,50 @@ class Uploadable(unittest.TestCase):
         d.addCallback(lambda res: u.close())
         return d
 
+class SegmentSize(unittest.TestCase):
+    def test_choose(self):
+        choose = upload.choose_segment_size
+        segments = upload.ADAPTIVE_SEGMENTS
+        # without an adaptive limit, the segment size is fixed
+        self.failUnlessEqual(choose(10*GiB, 128*KiB), 128*KiB)
+        self.failUnlessEqual(choose(10*GiB, 128*KiB, None), 128*KiB)
+        self.failUnlessEqual(choose(10*GiB, 128*KiB, 64*KiB), 128*KiB)
+        # small files keep the normal size
+        self.failUnlessEqual(choose(1000, 128*KiB, 4*MiB), 128*KiB)
+        self.failUnlessEqual(choose(segments*128*KiB, 128*KiB, 4*MiB),
+                             128*KiB)
+        # larger files get the smallest power-of-two multiple that keeps
+        # them to ADAPTIVE_SEGMENTS segments
+        self.failUnlessEqual(choose(segments*128*KiB+1, 128*KiB, 4*MiB),
+                             256*KiB)
+        self.failUnlessEqual(choose(segments*MiB, 128*KiB, 4*MiB), 1*MiB)
+        # up to the limit
+        self.failUnlessEqual(choose(10*GiB, 128*KiB, 4*MiB), 4*MiB)
+        self.failUnlessEqual(choose(10*GiB, 128*KiB, 3*MiB), 3*MiB)
+
+    def _get_params(self, size, default_params, max_segment_size=None):
+        u = upload.FileHandle(StringIO(""), convergence=None)
+        u._size = size
+        u.max_segment_size = max_segment_size
+        u.set_default_encoding_parameters(default_params)
+        return u.get_all_encoding_parameters()
+
+    def test_encoding_parameters(self):
+        params = {"k": 3, "happy": 7, "n": 10, "max_segment_size": 128*KiB}
+        adaptive_params = params.copy()
+        adaptive_params["adaptive_max_segment_size"] = 4*MiB
+        d = self._get_params(1*GiB, params)
+        d.addCallback(self.failUnlessEqual, (3, 7, 10, 128*KiB+1))
+        d.addCallback(lambda ign: self._get_params(1*GiB, adaptive_params))
+        d.addCallback(self.failUnlessEqual, (3, 7, 10, 4*MiB+2))
+        d.addCallback(lambda ign: self._get_params(1000, adaptive_params))
+        d.addCallback(self.failUnlessEqual, (3, 7, 10, 1002))
+        # an explicit max_segment_size turns the policy off
+        d.addCallback(lambda ign: self._get_params(1*GiB, adaptive_params,
+                                                   max_segment_size=64*KiB))
+        d.addCallback(self.failUnlessEqual, (3, 7, 10, 64*KiB+2))
+        return d
+
 class ServerError(Exception):
     pass
 
@@ -104,6 +195,7 @@ class FakeStorageServer:
     def __init__(self, mode):
         self.mode = mode
         self.allocated = []
+        self.bucket_writers = {} # shnum -> list of FakeBucketWriters
         self.queries = 0
         self.version = { "http://allmydata.org/tahoe/protocols/storage/v1" :
                          { "maximum-immutable-share-size": 2**32 - 1 },
@@ -139,18 +231,19 @@ class FakeStorageServer:
         elif self.mode == "already got them":
             return (set(sharenums), {},)
         else:
+            buckets = {}
             for shnum in sharenums:
                 self.allocated.append( (storage_index, shnum) )
-            return (set(),
-                    dict([( shnum, FakeBucketWriter(share_size) )
-                          for shnum in sharenums]),
-                    )
+                buckets[shnum] = FakeBucketWriter(share_size)
+                self.bucket_writers.setdefault(shnum, []).append(buckets[shnum])
+            return (set(), buckets)
 
 class FakeBucketWriter:
     # a diagnostic version of storageserver.BucketWriter
     def __init__(self, size):
         self.data = StringIO()
         self.closed = False
+        self.aborted = False
         self._size = size
 
     def callRemote(self, methname, *args, **kwargs):
@@ -182,7 +275,7 @@ class FakeBucketWriter:
         self.closed = True
 
     def remote_abort(self):
-        pass
+        self.aborted = True
 
 class FakeClient:
     DEFAULT_ENCODING_PARAMETERS = {"k":25,
@@ -475,9 +568,9 @@ class FullServer(unittest.TestCase):
 
 class ServerSelection(unittest.TestCase):
 
-    def make_client(self, num_servers=50):
-        self.node = FakeClient(mode="good", num_servers=num_servers)
-        self.u = upload.Uploader()
+    def make_client(self, num_servers=50, mode="good", placement_overask=0):
+        self.node = FakeClient(mode=mode, num_servers=num_servers)
+        self.u = upload.Uploader(placement_overask=placement_overask)
         self.u.running = True
         self.u.parent = self.node
 
@@ -634,6 +727,60 @@ class ServerSelection(unittest.TestCase):
         d.addCallback(_check)
         return d
 
+    def test_parallel_one_each(self):
+        # with as many servers as shares, asking them in parallel should
+        # still put exactly one share on each, with one query each
+        self.make_client(placement_overask=1.5)
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(25, 30, 50)
+        d = upload_data(self.u, data)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        def _check(res):
+            for s in self.node.last_servers:
+                self.failUnlessEqual(len(s.allocated), 1)
+                self.failUnlessEqual(s.queries, 1)
+        d.addCallback(_check)
+        return d
+
+    def test_parallel_overask(self):
+        # 10 shares, 20 servers of which 4 are full, over-asking by 1.5: 15
+        # servers are asked at once, spares are asked for the same shares
+        # as other servers, and every share must end up with exactly one
+        # bucket that was written and closed. The surplus buckets must be
+        # aborted, and the servers beyond the first batch never asked.
+        mode = dict([(i, "good") for i in range(20)])
+        for i in (1, 5, 8, 13):
+            mode[i] = "full"
+        self.make_client(20, mode, placement_overask=1.5)
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(3, 7, 10)
+        d = upload_data(self.u, data)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        d.addCallback(fireEventually) # let the aborts arrive
+        def _check(res):
+            kept = {}
+            queries = 0
+            for s in self.node.last_servers:
+                self.failUnless(s.queries <= 2, s.queries)
+                queries += s.queries
+                for (shnum, writers) in s.bucket_writers.items():
+                    for w in writers:
+                        if w.aborted:
+                            self.failIf(w.closed)
+                        else:
+                            self.failUnless(w.closed)
+                            kept.setdefault(shnum, []).append(w)
+            self.failUnlessEqual(sorted(kept.keys()), range(10))
+            for (shnum, writers) in kept.items():
+                self.failUnlessEqual(len(writers), 1, shnum)
+            # the first batch is 15 queries; any shares that it could not
+            # place are asked of the remaining servers
+            self.failUnless(queries >= 15, queries)
+        d.addCallback(_check)
+        return d
+
 
 class StorageIndex(unittest.TestCase):
     def test_params_must_matter(self):
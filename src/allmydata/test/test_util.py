@@ -12,7 +12,7 @@ from pycryptopp.hash.sha256 import SHA256 as _hash
 from allmydata.util import base32, idlib, humanreadable, mathutil, hashutil
 from allmydata.util import assertutil, fileutil, deferredutil, abbreviate
 from allmydata.util import limiter, time_format, pollmixin, cachedir
-from allmydata.util import statistics, dictutil, pipeline
+from allmydata.util import statistics, dictutil, pipeline, histogram
 from allmydata.util import log as tahoe_log
 from allmydata.util.spans import Spans, overlap, DataSpans
 from allmydata.test.common_util import ReallyEqualMixin, TimezoneMixin
@@ -313,6 +313,114 @@ class Statistics(unittest.TestCase):
         self.failUnlessEqual(f(plist, .5, 3), .02734375)
 
 
+class Histogram(unittest.TestCase):
+    def test_buckets(self):
+        for value in range(0, 100000, 7) + [2**40-1, 2**40, 2**40+1]:
+            (low, high) = histogram.bucket_range(histogram.bucket_index(value))
+            self.failUnless(low <= value <= high, (value, low, high))
+            self.failUnless(high - low <= max(1, value / histogram.SUB_BUCKETS),
+                            (value, low, high))
+        # small values are exact
+        for value in range(2*histogram.SUB_BUCKETS):
+            self.failUnlessEqual(histogram.bucket_range(value), (value, value))
+        # bucket indices grow with the values they hold
+        indices = [histogram.bucket_index(v) for v in range(100000)]
+        self.failUnlessEqual(indices, sorted(indices))
+
+    def test_percentiles(self):
+        h = histogram.LatencyHistogram()
+        self.failUnlessEqual(h.get_mean(), None)
+        self.failUnlessEqual(h.get_percentile(0.5), None)
+        for i in range(1000):
+            h.add(i / 1000.0)
+        self.failUnlessEqual(h.count, 1000)
+        self.failUnlessAlmostEqual(h.get_mean(), 0.4995)
+        for fraction in (0.01, 0.1, 0.5, 0.9, 0.99):
+            p = h.get_percentile(fraction)
+            self.failUnless(abs(p - fraction) <= 0.03 * fraction, (fraction, p))
+        self.failUnlessEqual(h.get_percentile(0.0), 0.0)
+        self.failUnlessEqual(h.get_percentile(1.0), 0.999)
+        # the number of buckets does not grow with the number of samples
+        nbuckets = len(h.buckets)
+        for i in range(1000):
+            h.add(i / 1000.0)
+        self.failUnlessEqual(len(h.buckets), nbuckets)
+
+    def test_summary(self):
+        h = histogram.LatencyHistogram()
+        h.add(1.0)
+        s = h.get_summary()
+        self.failUnlessEqual(s["samplesize"], 1)
+        self.failUnlessEqual(s["mean"], None)
+        self.failUnlessEqual(s["50_0_percentile"], None)
+        for i in range(19):
+            h.add(1.0)
+        s = h.get_summary()
+        self.failUnlessEqual(s["mean"], 1.0)
+        self.failUnlessEqual(s["50_0_percentile"], 1.0)
+        self.failUnlessEqual(s["95_0_percentile"], 1.0)
+        self.failUnlessEqual(s["99_0_percentile"], None)
+
+    def test_merge(self):
+        a = histogram.LatencyHistogram()
+        b = histogram.LatencyHistogram()
+        both = histogram.LatencyHistogram()
+        for i in range(500):
+            a.add(i / 100.0)
+            both.add(i / 100.0)
+        for i in range(500, 1000):
+            b.add(i / 100.0)
+            both.add(i / 100.0)
+        merged = histogram.LatencyHistogram()
+        merged.merge(a)
+        merged.merge(b)
+        self.failUnlessEqual(merged.buckets, both.buckets)
+        self.failUnlessEqual(merged.get_summary(), both.get_summary())
+
+        # the stats form loses only the minimum and maximum
+        rebuilt = histogram.from_stats(merged.get_stats("x."), "x.")
+        self.failUnlessEqual(rebuilt.buckets, both.buckets)
+        self.failUnlessEqual(rebuilt.count, both.count)
+        self.failUnlessAlmostEqual(rebuilt.get_mean(), both.get_mean())
+
+    def test_window(self):
+        now = [0.0]
+        w = histogram.WindowedLatencyHistogram(window=60, slots=6,
+                                               clock=lambda: now[0])
+        w.add(1.0)
+        now[0] = 35
+        w.add(2.0)
+        self.failUnlessEqual(w.get_window().count, 2)
+        now[0] = 65
+        window = w.get_window()
+        self.failUnlessEqual(window.count, 1)
+        self.failUnlessEqual(window.get_percentile(0.5), 2.0)
+        now[0] = 100
+        self.failUnlessEqual(w.get_window().count, 0)
+        self.failUnlessEqual(w.since_start.count, 2)
+        self.failUnlessEqual(w.since_start.get_mean(), 1.5)
+
+    def test_window_seconds(self):
+        now = [0.0]
+        w = histogram.WindowedLatencyHistogram(window=60, slots=6,
+                                               clock=lambda: now[0])
+        now[0] = 35
+        w.add(2.0)
+        now[0] = 65
+        w.add(3.0)
+        # the last 10 seconds are the current slot, the last 40 reach back
+        # to the slot of t=35
+        self.failUnlessEqual(w.get_window(seconds=10).count, 1)
+        self.failUnlessEqual(w.get_window(seconds=40).count, 2)
+        self.failUnlessEqual(w.get_window().count, 2)
+        now[0] = 100
+        self.failUnlessEqual(w.get_window().count, 1)
+        self.failUnlessEqual(w.get_window(seconds=30).count, 0)
+        now[0] = 126
+        self.failUnlessEqual(w.get_window().count, 0)
+        self.failUnlessEqual(w.since_start.count, 2)
+
+
 class Asserts(unittest.TestCase):
     def should_assert(self, func, *args, **kwargs):
         try:
@@ -215,6 +215,7 @@ class FakeLeaseChecker(object):
         self.mode = "age"
         self.override_lease_duration = None
         self.sharetypes_to_expire = {}
+        self.whatif_policies = []
     def get_state(self):
         return {"history": None}
     def get_progress(self):
@@ -230,8 +231,13 @@ class FakeStorageServer(service.MultiService):
         self.nickname = nickname
         self.bucket_counter = FakeBucketCounter()
         self.lease_checker = FakeLeaseChecker()
+        self.block_cache = None
+        self.crawler_pacer = None
+        self.share_scrubber = None
     def get_stats(self):
         return {"storage_server.accepting_immutable_shares": False}
+    def get_latencies(self):
+        return {}
 
 class FakeClient(Client):
     def __init__(self):
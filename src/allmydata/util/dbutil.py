@@ -12,7 +12,7 @@ class DBError(Exception):
 
 def get_db(dbfile, stderr=sys.stderr,
            create_version=(None, None), updaters={}, just_create=False, dbname="db",
-           journal_mode=None, synchronous=None):
+           journal_mode=None, synchronous=None, check_same_thread=True):
     """Open or create the given db file. The parent directory must exist.
     create_version=(SCHEMA, VERNUM), and SCHEMA must have a 'version' table.
     Updaters is a {newver: commands} mapping, where e.g. updaters[2] is used
@@ -21,7 +21,7 @@ def get_db(dbfile, stderr=sys.stderr,
     """
     must_create = not os.path.exists(dbfile)
     try:
-        db = sqlite3.connect(dbfile)
+        db = sqlite3.connect(dbfile, check_same_thread=check_same_thread)
     except (EnvironmentError, sqlite3.OperationalError), e:
         raise DBError("Unable to create/open %s file %s: %s" % (dbname, dbfile, e))
 
@@ -3,6 +3,7 @@ import time
 
 from foolscap.api import eventually, fireEventually
 from twisted.internet import defer, reactor
+from twisted.python import failure
 
 from allmydata.util import log
 from allmydata.util.pollmixin import PollMixin
@@ -42,6 +43,18 @@ def gatherResults(deferredList):
     d.addCallbacks(_parseDListResult, _unwrapFirstError)
     return d
 
+def result_of_fired(d):
+    """Return the result of a Deferred which has already fired, or raise
+    its failure. This is for code (such as a worker thread, which must not
+    wait for the reactor) that uses an API which returns Deferreds, but
+    knows that they fire immediately."""
+    results = []
+    d.addBoth(results.append)
+    assert results, "%r has not fired" % (d,)
+    if isinstance(results[0], failure.Failure):
+        results[0].raiseException()
+    return results[0]
+
 
 def _with_log(op, res):
     """
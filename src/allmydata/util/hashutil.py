@@ -209,3 +209,11 @@ def timing_safe_compare(a, b):
 BACKUPDB_DIRHASH_TAG = "allmydata_backupdb_dirhash_v1"
 def backupdb_dirhash(contents):
     return tagged_hash(BACKUPDB_DIRHASH_TAG, contents)
+
+LEASEDB_RENEW_SECRET_TAG = "allmydata_leasedb_renew_secret_v1"
+def leasedb_renew_secret_hash(renew_secret):
+    return tagged_hash(LEASEDB_RENEW_SECRET_TAG, renew_secret)
+
+CONVERGENCE_CACHE_SECRET_TAG = "allmydata_convergence_cache_secret_v1"
+def convergence_cache_secret_hash(convergence):
+    return tagged_hash(CONVERGENCE_CACHE_SECRET_TAG, convergence)
@@ -0,0 +1,199 @@
+
+import time, math
+from collections import deque
+
+# Latencies are recorded in whole microseconds, in logarithmic buckets:
+# values below 2*SUB_BUCKETS get a bucket each, and every power of two above
+# that is divided into SUB_BUCKETS equal buckets. A bucket is therefore never
+# wider than 1/SUB_BUCKETS of the values it holds (about 3%), and a
+# histogram needs only a few hundred buckets to cover everything from one
+# microsecond to several hours, no matter how many samples are added.
+# Histograms with the same layout can be merged by adding their counts,
+# which lets the stats gatherer combine the histograms of many servers.
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+# (fraction, key, minimum number of samples) for each percentile we report.
+# With fewer samples than the minimum, the percentile cannot be interpreted
+# unambiguously, and is reported as None.
+PERCENTILES = [(0.01, "01_0_percentile", 100),
+               (0.10, "10_0_percentile", 10),
+               (0.50, "50_0_percentile", 10),
+               (0.90, "90_0_percentile", 10),
+               (0.95, "95_0_percentile", 20),
+               (0.99, "99_0_percentile", 100),
+               (0.999, "99_9_percentile", 1000)]
+
+def bucket_index(value):
+    """Return the index of the bucket that holds 'value', a non-negative
+    integer."""
+    shift = max(0, value.bit_length() - SUB_BUCKET_BITS - 1)
+    return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+def bucket_range(index):
+    """Return (lowest, highest), the smallest and largest values that
+    bucket_index() would put in bucket 'index'."""
+    if index < 2*SUB_BUCKETS:
+        return (index, index)
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    low = (index - (shift << SUB_BUCKET_BITS)) << shift
+    return (low, low + (1 << shift) - 1)
+
+
+class LatencyHistogram:
+    """I count latency samples (in seconds) in logarithmic buckets. I use a
+    constant amount of memory, and can report approximate percentiles (to
+    within about 3%) and an exact mean."""
+
+    def __init__(self):
+        self.buckets = {} # bucket index -> number of samples
+        self.count = 0
+        self.total = 0 # sum of all samples, in microseconds
+        self.min = None # in microseconds, None if unknown
+        self.max = None
+
+    def add(self, latency):
+        value = max(0, int(latency * 1000000))
+        index = bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add every sample counted by 'other' to me."""
+        for index, n in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + n
+        if other.count:
+            if self.count:
+                self.min = _min_or_none(self.min, other.min)
+                self.max = _max_or_none(self.max, other.max)
+            else:
+                self.min, self.max = other.min, other.max
+        self.count += other.count
+        self.total += other.total
+
+    def get_mean(self):
+        if not self.count:
+            return None
+        return self.total / 1000000.0 / self.count
+
+    def get_percentile(self, fraction):
+        """Return the latency (in seconds) below which 'fraction' of the
+        samples fall, or None if there are no samples."""
+        if not self.count:
+            return None
+        rank = min(int(fraction * self.count), self.count - 1)
+        # the samples at either end are known exactly
+        if rank == 0 and self.min is not None:
+            return self.min / 1000000.0
+        if rank == self.count - 1 and self.max is not None:
+            return self.max / 1000000.0
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                break
+        (low, high) = bucket_range(index)
+        if self.min is not None:
+            low = max(low, self.min)
+            high = max(min(high, self.max), low)
+        return (low + high) / 2.0 / 1000000.0
+
+    def get_summary(self):
+        """Return a dict with 'samplesize', 'mean', and the percentile keys
+        listed in PERCENTILES. The mean is None if there is only one sample,
+        and each percentile is None if there are not enough samples to
+        interpret it unambiguously."""
+        summary = {"samplesize": self.count}
+        if self.count > 1:
+            summary["mean"] = self.get_mean()
+        else:
+            summary["mean"] = None
+        for fraction, key, minnumtoobserve in PERCENTILES:
+            if self.count >= minnumtoobserve:
+                summary[key] = self.get_percentile(fraction)
+            else:
+                summary[key] = None
+        return summary
+
+    def get_stats(self, prefix):
+        """Return my contents as a flat dict of numbers, suitable for
+        IStatsProducer.get_stats(), with every key starting with 'prefix'.
+        from_stats() turns this back into a histogram."""
+        stats = {prefix + "sum": self.total / 1000000.0}
+        for index, n in self.buckets.items():
+            stats[prefix + "buckets.%d" % index] = n
+        return stats
+
+def from_stats(stats, prefix):
+    """Rebuild the LatencyHistogram that get_stats(prefix) was called on,
+    from a dict that contains its return value (possibly among other
+    keys). The minimum and maximum are not recorded in the stats, so the
+    percentiles of the rebuilt histogram may be slightly less exact."""
+    h = LatencyHistogram()
+    bucket_prefix = prefix + "buckets."
+    for key, n in stats.items():
+        if key.startswith(bucket_prefix):
+            h.buckets[int(key[len(bucket_prefix):])] = n
+            h.count += n
+    h.total = int(stats.get(prefix + "sum", 0) * 1000000)
+    return h
+
+def _min_or_none(a, b):
+    if a is None or b is None:
+        return None
+    return min(a, b)
+
+def _max_or_none(a, b):
+    if a is None or b is None:
+        return None
+    return max(a, b)
+
+
+class WindowedLatencyHistogram:
+    """I record latency samples twice: in a LatencyHistogram that counts
+    everything since I was created (self.since_start), and in a series of
+    short-lived histograms that together cover the last 'window' seconds,
+    which get_window() merges on demand."""
+
+    def __init__(self, window=600, slots=10, clock=time.time):
+        self.since_start = LatencyHistogram()
+        self.slot_length = float(window) / slots
+        self.slots = slots
+        self.clock = clock
+        self._recent = deque() # (slot number, LatencyHistogram)
+
+    def _current_slot(self):
+        return int(self.clock() // self.slot_length)
+
+    def _expire(self, current):
+        while self._recent and self._recent[0][0] <= current - self.slots:
+            self._recent.popleft()
+
+    def add(self, latency):
+        self.since_start.add(latency)
+        current = self._current_slot()
+        self._expire(current)
+        if not self._recent or self._recent[-1][0] != current:
+            self._recent.append((current, LatencyHistogram()))
+        self._recent[-1][1].add(latency)
+
+    def get_window(self, seconds=None):
+        """Merge the samples of the whole window, or of only the last
+        'seconds' of it (rounded up to whole slots, including the current
+        one)."""
+        current = self._current_slot()
+        self._expire(current)
+        first = None
+        if seconds is not None:
+            first = current - int(math.ceil(seconds / self.slot_length)) + 1
+        h = LatencyHistogram()
+        for (slot, recent) in self._recent:
+            if first is None or slot >= first:
+                h.merge(recent)
+        return h
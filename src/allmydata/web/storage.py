@@ -32,7 +32,13 @@ class StorageStatus(rend.Page):
              "bucket-counter": self.storage.bucket_counter.get_state(),
              "lease-checker": self.storage.lease_checker.get_state(),
              "lease-checker-progress": self.storage.lease_checker.get_progress(),
+             "crawler-pacing": None,
+             "share-scrubber": None,
              }
+        if self.storage.crawler_pacer is not None:
+            d["crawler-pacing"] = self.storage.crawler_pacer.get_status()
+        if self.storage.share_scrubber is not None:
+            d["share-scrubber"] = self.storage.share_scrubber.get_state()
         return simplejson.dumps(d, indent=1) + "\n"
 
     def data_nickname(self, ctx, storage):
@@ -92,6 +98,70 @@ class StorageStatus(rend.Page):
         d.setdefault("disk_avail", None)
         return d
 
+    def render_latencies(self, ctx, storage):
+        latencies = self.storage.get_latencies()
+        if not latencies:
+            return ctx.tag["No operations in the last ten minutes."]
+        columns = [("samplesize", "Recent"), ("count", "Total"),
+                   ("mean", "Mean"), ("10_0_percentile", "10%"),
+                   ("50_0_percentile", "50%"), ("90_0_percentile", "90%"),
+                   ("99_0_percentile", "99%"), ("99_9_percentile", "99.9%")]
+        table = T.table()
+        table[T.tr[T.th["Operation"], [T.th[title] for (key,title) in columns]]]
+        for category in sorted(latencies):
+            stats = latencies[category]
+            row = T.tr[T.td[category]]
+            for key, title in columns:
+                v = stats.get(key)
+                if key in ("samplesize", "count"):
+                    row[T.td[str(v)]]
+                elif v is None:
+                    row[T.td["-"]]
+                else:
+                    row[T.td[abbreviate_time(v)]]
+            table[row]
+        return ctx.tag[table]
+
+    def render_block_cache(self, ctx, storage):
+        cache = self.storage.block_cache
+        if cache is None:
+            return ctx.tag["Disabled."]
+        stats = cache.get_stats()
+        lookups = stats["hits"] + stats["misses"]
+        if lookups:
+            hit_ratio = "%.1f%%" % (100.0 * stats["hits"] / lookups)
+        else:
+            hit_ratio = "-"
+        return ctx.tag[T.ul[
+            T.li["Hit ratio: %s (%d of %d reads)" % (hit_ratio, stats["hits"],
+                                                     lookups)],
+            T.li["Memory used: %s of %s (%d ranges)"
+                 % (abbreviate_space(stats["bytes"]),
+                    abbreviate_space(stats["max_bytes"]), stats["entries"])],
+            T.li["Evictions: %d" % stats["evictions"]],
+            ]]
+
+    def render_crawler_pacing(self, ctx, storage):
+        pacer = self.storage.crawler_pacer
+        if pacer is None:
+            return ctx.tag["Fixed: the crawlers always run at their normal speed."]
+        s = pacer.get_status()
+        if s["client-latency"] is None:
+            latency = "-"
+        else:
+            latency = abbreviate_time(s["client-latency"])
+        if s["reactor-delay"] is None:
+            delay = "-"
+        else:
+            delay = abbreviate_time(s["reactor-delay"])
+        return ctx.tag[T.ul[
+            T.li["Speed: %.2f times normal (%s)" % (s["factor"], s["reason"])],
+            T.li["Client operations in the last %s: %d (90%% within %s)"
+                 % (abbreviate_time(pacer.latency_window),
+                    s["client-operations"], latency)],
+            T.li["Reactor delay: %s" % delay],
+            ]]
+
     def data_last_complete_bucket_count(self, ctx, data):
         s = self.storage.bucket_counter.get_state()
         count = s.get("last-complete-bucket-count")
@@ -267,3 +337,56 @@ class StorageStatus(rend.Page):
 
         return ctx.tag[p]
 
+    def render_lease_whatif_results(self, ctx, data):
+        lc = self.storage.lease_checker
+        if not lc.whatif_policies:
+            return ""
+        s = lc.get_state()
+        so_far = {}
+        whole = {}
+        if "cycle-to-date" in s:
+            so_far = s["cycle-to-date"]["whatif-space-recovered"]
+            whole = s["estimated-current-cycle"]["whatif-space-recovered"]
+        last = {}
+        h = s["history"]
+        if h:
+            last = h[max(h.keys())].get("whatif-space-recovered", {})
+
+        def cell(sr):
+            if sr is None:
+                return T.td["-"]
+            return T.td[self.format_recovered(sr, "whatif")]
+        table = T.table()
+        table[T.tr[T.th["Policy"], T.th["This cycle so far"],
+                   T.th["Whole cycle (estimated)"],
+                   T.th["Last complete cycle"]]]
+        for (name, policy) in lc.whatif_policies:
+            table[T.tr[T.td[name], cell(so_far.get(name)),
+                       cell(whole.get(name)), cell(last.get(name))]]
+        return ctx.tag["These expiration policies would recover:", table]
+
+    def render_share_scrubber(self, ctx, storage):
+        scrubber = self.storage.share_scrubber
+        if scrubber is None:
+            return ctx.tag["Disabled."]
+        p = scrubber.get_progress()
+        s = scrubber.get_state()
+        ul = T.ul()
+        ul[T.li[self.format_crawler_progress(p)]]
+        def add_results(what, results):
+            ul[T.li["%s checked %d immutable shares (%s) and found %d corrupt"
+                    % (what, results["examined-shares"],
+                       abbreviate_space(results["examined-bytes"]),
+                       len(results["corrupt-shares"]))]]
+            if results["corrupt-shares"]:
+                ul[T.li["Corrupt shares:",
+                        T.ul[[T.li["SI %s shnum %d" % corrupt_share]
+                              for corrupt_share in results["corrupt-shares"]]]]]
+        if p["cycle-in-progress"]:
+            add_results("This cycle has so far", s["cycle-to-date"])
+        last = s["last-complete-cycle"]
+        if last is not None:
+            start, end = last["cycle-start-finish-times"]
+            add_results("The last complete cycle (which finished %s ago)"
+                        % abbreviate_time(time.time() - end), last)
+        return ctx.tag[ul]